@@ -31,8 +31,10 @@
 MovieDataUpdater.
 """
 
+import hashlib
 import logging
 import os
+import re
 import shutil
 import string
 from mutagen import id3, mp4, flac
@@ -41,6 +43,7 @@ from miro import app
 from miro import prefs
 from miro import util
 from miro import fileutil
+from miro.plat.utils import PlatformFilenameType
 
 class UnknownImageObjectException(StandardError):
     """Image uses this when mutagen gives us something strange.
@@ -197,3 +200,72 @@ class FLACImage(Image):
         else:
             logging.warn("FLAC image without an identifiable type")
         self.data = image_object.data
+
+class CoverArtStore(object):
+    """Stores cover art files by the hash of their contents.
+
+    Each image is written to <directory>/<sha1 of data>.<extension>.  This
+    means that identical images embedded in many files, even for different
+    albums, only get written to disk once.
+
+    Files in the store can be shared by any number of metadata entries, so
+    they should only be removed with remove_unused().
+    """
+    FILENAME_RE = re.compile(r'^[0-9a-f]{40}\.[a-z]+$')
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path_for_image(self, image):
+        """Get the path that we store an Image at."""
+        filename = '%s.%s' % (hashlib.sha1(image.data).hexdigest(),
+                              image.get_extension())
+        return os.path.join(self.directory, PlatformFilenameType(filename))
+
+    def add(self, image):
+        """Add an Image to the store.
+
+        :returns: tuple (path, newly_created)
+        :raises EnvironmentError: error writing cover art file
+        """
+        path = self.path_for_image(image)
+        if fileutil.exists(path):
+            return path, False
+        # write to a temporary file first, so that nobody sees a partially
+        # written image at path.
+        temp_path = path + '.tmp'
+        image.write_to_file(temp_path)
+        try:
+            fileutil.rename(temp_path, path)
+        except EnvironmentError:
+            fileutil.remove(temp_path)
+            if not fileutil.exists(path):
+                raise
+            return path, False
+        return path, True
+
+    def owns_path(self, path):
+        """Check if path is a file that we created."""
+        directory, filename = os.path.split(path)
+        return (directory == self.directory and
+                self.FILENAME_RE.match(filename) is not None)
+
+    def remove_unused(self, paths, find_used_paths):
+        """Delete files that are no longer in use.
+
+        :param paths: paths that might have become unused.  Paths that
+            aren't in the store are ignored.
+        :param find_used_paths: function that takes a list of paths and
+            returns the ones that are still in use.
+        :returns: list of paths that we deleted
+        """
+        candidates = [p for p in set(paths) if self.owns_path(p)]
+        if not candidates:
+            return []
+        used_paths = set(find_used_paths(candidates))
+        removed = []
+        for path in candidates:
+            if path not in used_paths and fileutil.exists(path):
+                fileutil.delete(path)
+                removed.append(path)
+        return removed
@@ -358,8 +358,10 @@ class BulkSQLManager(object):
         self.active = False
         self.to_insert = {}
         self.to_remove = {}
+        self.to_update = {}
         self.pending_inserts = set()
         self.pending_removes = set()
+        self.pending_updates = set()
 
         self.last_call = None
 
@@ -392,11 +394,15 @@ class BulkSQLManager(object):
         for x in range(100):
             to_insert = self.to_insert
             to_remove = self.to_remove
+            to_update = self.to_update
             self.to_insert = {}
             self.to_remove = {}
-            self._commit_sql(to_insert, to_remove)
-            self._update_view_trackers(to_insert, to_remove)
-            if len(self.to_insert) == len(self.to_remove) == 0:
+            self.to_update = {}
+            self.pending_updates = set()
+            self._commit_sql(to_insert, to_remove, to_update)
+            self._update_view_trackers(to_insert, to_remove, to_update)
+            if (len(self.to_insert) == len(self.to_remove) ==
+                    len(self.to_update) == 0):
                 break
             # inside _commit_sql() or _update_view_trackers(), we were
             # asked to insert or remove more items, repeat the
@@ -406,35 +412,44 @@ class BulkSQLManager(object):
                     "have items to commit.  Are we in a circular loop?")
         self.to_insert = {}
         self.to_remove = {}
+        self.to_update = {}
         self.pending_inserts = set()
         self.pending_removes = set()
+        self.pending_updates = set()
 
-    def _commit_sql(self, to_insert, to_remove):
+    def _commit_sql(self, to_insert, to_remove, to_update):
         for table_name, objects in to_insert.items():
             logging.debug('bulk insert: %s %s', table_name, len(objects))
             self.db.bulk_insert(objects)
             for obj in objects:
                 obj.inserted_into_db()
 
+        for table_name, objects in to_update.items():
+            logging.debug('bulk update: %s %s', table_name, len(objects))
+            self.db.bulk_update(objects)
+
         for table_name, objects in to_remove.items():
             logging.debug('bulk remove: %s %s', table_name, len(objects))
             self.db.bulk_remove(objects)
             for obj in objects:
                 obj.removed_from_db()
 
-    def _update_view_trackers(self, to_insert, to_remove):
+    def _update_view_trackers(self, to_insert, to_remove, to_update):
         # figure out the total number of objects that have changed
         changed_objs = set()
         for table_name, objects in to_insert.items():
             changed_objs.update(objects)
         for table_name, objects in to_remove.items():
             changed_objs.update(objects)
+        for table_name, objects in to_update.items():
+            changed_objs.update(objects)
         # Figure out which strategy is fastest based on the number of objects
         # that have changed
         if len(changed_objs) < 100:
             self._update_view_trackers_by_object(changed_objs)
         else:
-            self._update_view_trackers_by_table(to_insert, to_remove)
+            self._update_view_trackers_by_table(to_insert, to_remove,
+                    to_update)
 
     def _update_view_trackers_by_object(self, changed_objs):
         """Update view trackers by checking each changed object.
@@ -444,16 +459,17 @@ class BulkSQLManager(object):
         for obj in changed_objs:
             self.view_tracker_manager.update_view_trackers(obj)
 
-    def _update_view_trackers_by_table(self, to_insert, to_remove):
+    def _update_view_trackers_by_table(self, to_insert, to_remove, to_update):
         """Update view trackers by checking each table
 
         This method is fastest when there are many changed objects
         """
-        for table_name in to_insert:
+        checked_tables = set(to_insert).union(to_update)
+        for table_name in checked_tables:
             self.view_tracker_manager.bulk_update_view_trackers(table_name)
 
         for table_name, objects in to_remove.items():
-            if table_name in to_insert:
+            if table_name in checked_tables:
                 # already updated the view above
                 continue
             self.view_tracker_manager.bulk_remove_from_view_trackers(
@@ -475,8 +491,35 @@ class BulkSQLManager(object):
     def will_remove(self, id_):
         return id_ in self.pending_removes
 
+    def add_update(self, obj):
+        """Defer saving obj until finish() is called.
+
+        Changes to obj will be written with a single UPDATE statement for
+        every object in its table, and its signal_change() calls won't
+        touch the database or the view trackers until then.  Outside of a
+        start()/finish() block this does nothing.
+        """
+        if not self.active:
+            return
+        if self.will_insert(obj.id) or self.will_update(obj.id):
+            return
+        table_name = self.db.table_name(obj.__class__)
+        try:
+            updates_for_table = self.to_update[table_name]
+        except KeyError:
+            updates_for_table = []
+            self.to_update[table_name] = updates_for_table
+        updates_for_table.append(obj)
+        self.pending_updates.add(obj.id)
+
+    def will_update(self, id_):
+        return id_ in self.pending_updates
+
     def add_remove(self, obj):
         table_name = self.db.table_name(obj.__class__)
+        if self.will_update(obj.id):
+            self.to_update[table_name].remove(obj)
+            self.pending_updates.remove(obj.id)
         if self.will_insert(obj.id):
             self.to_insert[table_name].remove(obj)
             self.pending_inserts.remove(obj.id)
@@ -617,12 +660,13 @@ class DDBObject(signals.SignalEmitter):
 
     @classmethod
     def select(cls, columns, where=None, values=None, convert=True,
-               db_info=None):
+               db_info=None, limit=None, joins=None, group_by=None):
         if db_info is None:
             db = app.db
         else:
             db = db_info.db
-        return db.select(cls, columns, where, values, convert=convert)
+        return db.select(cls, columns, where, values, joins=joins,
+                         limit=limit, convert=convert, group_by=group_by)
 
     def setup_new(self):
         """Initialize a newly created object."""
@@ -744,6 +788,10 @@ class DDBObject(signals.SignalEmitter):
             # view trackers in this case.  Both will be done when the
             # BulkSQLManager.finish() is called.
             return
+        if self.db_info.bulk_sql_manager.will_update(self.id):
+            # Same as above, the UPDATE will be sent with the rest of the
+            # deferred updates in BulkSQLManager.finish().
+            return
         if needs_save:
             self.db_info.db.update_obj(self)
         self.db_info.view_tracker_manager.update_view_trackers(
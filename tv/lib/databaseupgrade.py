@@ -4417,3 +4417,58 @@ def upgrade201(cursor):
             where_values.append((feed_id,))
     cursor.executemany("UPDATE feed SET expire_timedelta=NULL "
                        "WHERE id=?", where_values)
+
+def upgrade202(cursor):
+    """Add the metadata_cache table."""
+    cursor.execute("CREATE TABLE metadata_cache (id integer PRIMARY KEY, "
+                   "source text, size integer, mtime real, inode integer, "
+                   "content_hash text, result text, last_used real)")
+    cursor.execute("CREATE INDEX metadata_cache_last_used "
+                   "ON metadata_cache (last_used)")
+    cursor.execute("CREATE UNIQUE INDEX metadata_cache_key ON metadata_cache "
+                   "(content_hash, size, mtime, inode, source)")
+
+def upgrade203(cursor):
+    """Add the http_response_cache table."""
+    cursor.execute("CREATE TABLE http_response_cache (id integer PRIMARY KEY, "
+                   "cache_key text, body blob, status_code integer, "
+                   "expires real)")
+    cursor.execute("CREATE INDEX http_response_cache_expires "
+                   "ON http_response_cache (expires)")
+    cursor.execute("CREATE UNIQUE INDEX http_response_cache_key "
+                   "ON http_response_cache (cache_key)")
+
+@run_on_both
+def upgrade204(cursor):
+    """Add indexes for looking up metadata by album and cover art."""
+    cursor.execute("CREATE INDEX metadata_entry_album ON metadata (album)")
+    cursor.execute("CREATE INDEX metadata_entry_cover_art "
+                   "ON metadata (cover_art)")
+
+def upgrade205(cursor):
+    """Add the directory_scan_index table."""
+    cursor.execute("CREATE TABLE directory_scan_index "
+                   "(id integer PRIMARY KEY, owner_id integer, path text, "
+                   "parent text, is_dir integer, size integer, mtime real)")
+    cursor.execute("CREATE INDEX directory_scan_index_parent "
+                   "ON directory_scan_index (owner_id, parent)")
+    cursor.execute("CREATE UNIQUE INDEX directory_scan_index_path "
+                   "ON directory_scan_index (owner_id, path)")
+
+def upgrade206(cursor):
+    """Add the content_hash column to rss_feed_impl."""
+    cursor.execute("ALTER TABLE rss_feed_impl ADD COLUMN content_hash TEXT")
+
+def upgrade207(cursor):
+    """Add an index on item.watched_time for finding expired items."""
+    cursor.execute("CREATE INDEX item_watched_time ON item (watched_time)")
+
+def upgrade208(cursor):
+    """Add the parsed_link and parsed_license columns to rss_feed_impl.
+
+    Clear content_hash so that the next update parses the feed and fills
+    them in.
+    """
+    cursor.execute("ALTER TABLE rss_feed_impl ADD COLUMN parsed_link TEXT")
+    cursor.execute("ALTER TABLE rss_feed_impl ADD COLUMN parsed_license TEXT")
+    cursor.execute("UPDATE rss_feed_impl SET content_hash=NULL")
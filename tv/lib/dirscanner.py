@@ -0,0 +1,390 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.dirscanner`` -- Incrementally scan directories for files.
+
+DirectoryScanner keeps an index of the files and directories below a root
+directory in the directory_scan_index table.  Adding or removing an entry
+changes the mtime of its directory, so when we rescan we only need to list
+the directories whose mtime changed since the last scan.
+"""
+
+import logging
+import os
+import stat
+import time
+
+from miro import app
+from miro import fileutil
+from miro.plat.filebundle import is_file_bundle
+from miro.plat.utils import filename_to_unicode, PlatformFilenameType
+
+def _unicode_to_filename(value):
+    # reverses filename_to_unicode(), see
+    # LiveStorage._unicode_to_filename()
+    if value is not None and PlatformFilenameType != unicode:
+        return value.encode('utf-8')
+    else:
+        return value
+
+class ScanResult(object):
+    """Results of a DirectoryScanner.scan() call.
+
+    :attribute added: set of paths for files that are new since the last scan
+    :attribute removed: set of paths for files that went away
+    :attribute dirs_listed: number of directories that we listed
+    :attribute dirs_skipped: number of unchanged directories that we didn't
+    list
+    :attribute files_skipped: number of files in the unchanged directories
+    :attribute duration: how long the scan took, in seconds
+    :attribute full_scan: did we list every directory?
+    """
+    def __init__(self, full_scan):
+        self.added = set()
+        self.removed = set()
+        self.dirs_listed = 0
+        self.dirs_skipped = 0
+        self.files_skipped = 0
+        self.duration = 0.0
+        self.full_scan = full_scan
+
+    def __str__(self):
+        return ("%d added, %d removed, %d directories listed, "
+                "%d directories skipped, %d files skipped, "
+                "%s scan took %0.3f seconds" %
+                (len(self.added), len(self.removed), self.dirs_listed,
+                 self.dirs_skipped, self.files_skipped,
+                 self.full_scan and "full" or "incremental", self.duration))
+
+class _DirectoryEntry(object):
+    """Index entry for a single directory.
+
+    mtime is None if we need to list the directory on the next scan.
+    """
+    __slots__ = ('mtime', 'files', 'subdirs')
+
+    def __init__(self):
+        self.mtime = None
+        self.files = set()
+        self.subdirs = set()
+
+class DirectoryScanner(object):
+    """Find the files below a directory, without listing unchanged
+    directories.
+
+    Usage:
+
+    >>> scanner = DirectoryScanner(feed_impl.id, directory)
+    >>> for dummy in scanner.scan():
+    >>>     pass # maybe yield to the event loop here
+    >>> handle_changes(scanner.last_result)
+    >>> scanner.save()
+
+    The scanner filters out the same files as fileutil.miro_allfiles().
+
+    :param owner_id: id of the object that owns the index.  Each owner gets a
+    separate index.
+    :param root: directory to scan
+    """
+
+    # how often we list every directory, even if its mtime hasn't changed.
+    # This protects us against filesystems that don't update directory
+    # mtimes reliably.
+    FULL_SCAN_INTERVAL = 60 * 60 * 24
+    # Directories can change without changing their mtime if the change
+    # happens in the same clock tick as the scan (some filesystems only
+    # store mtimes to the nearest 2 seconds).  Don't trust mtimes that are
+    # this close to the time of the scan.
+    MTIME_GRANULARITY = 2.0
+
+    def __init__(self, owner_id, root, db_info=None):
+        if db_info is None:
+            self.db_info = app.db_info
+        else:
+            self.db_info = db_info
+        self.owner_id = owner_id
+        self.root = root
+        self.last_result = None
+        self._last_full_scan = time.time()
+        self._load()
+
+    def _execute(self, sql, values=None, is_update=False, many=False):
+        return self.db_info.db.execute(sql, values, is_update=is_update,
+                                       many=many)
+
+    def _load(self):
+        # map directory paths to _DirectoryEntry objects
+        self._dirs = {}
+        # all files in the index
+        self._files = set()
+        # map file paths to (size, mtime) for files we haven't saved yet
+        self._pending_stats = {}
+        # directories we need to write out/delete in save()
+        self._dirty = set()
+        self._forgotten = set()
+
+        rows = self._execute("SELECT path, parent, is_dir, mtime "
+                             "FROM directory_scan_index WHERE owner_id=?",
+                             (self.owner_id,))
+        root_paths = [path for path, parent, is_dir, mtime in rows
+                      if parent is None]
+        if rows and root_paths != [filename_to_unicode(self.root)]:
+            # the index is for a different directory (for example the movies
+            # directory changed).  Start fresh.
+            self.remove_index(self.owner_id, self.db_info)
+            rows = []
+        for path, parent, is_dir, mtime in rows:
+            path = _unicode_to_filename(path)
+            if parent is not None:
+                parent_entry = self._get_entry(_unicode_to_filename(parent))
+            if is_dir:
+                self._get_entry(path).mtime = mtime
+                if parent is not None:
+                    parent_entry.subdirs.add(path)
+            else:
+                parent_entry.files.add(path)
+                self._files.add(path)
+
+    def _get_entry(self, directory):
+        try:
+            return self._dirs[directory]
+        except KeyError:
+            entry = self._dirs[directory] = _DirectoryEntry()
+            return entry
+
+    @classmethod
+    def remove_index(cls, owner_id, db_info=None):
+        """Remove the stored index for an owner."""
+        if db_info is None:
+            db_info = app.db_info
+        db_info.db.execute("DELETE FROM directory_scan_index "
+                           "WHERE owner_id=?", (owner_id,), is_update=True)
+
+    def has_file(self, path):
+        """Check if a file was found by the last scan."""
+        return path in self._files
+
+    def all_files(self):
+        """Get a set containing all files found by the last scan.
+
+        Don't modify the set, it's the one that we use internally.
+        """
+        return self._files
+
+    def scan(self):
+        """Scan the root directory for changes.
+
+        This method is a generator that yields after each directory, so that
+        callers can spread the work out.  Once it's finished, last_result
+        will be set to a ScanResult object.
+        """
+        start = time.time()
+        full_scan = (start - self._last_full_scan >= self.FULL_SCAN_INTERVAL)
+        if full_scan:
+            self._last_full_scan = start
+        result = ScanResult(full_scan)
+        # real paths for directories that we've already scanned.  Used to
+        # avoid scanning a directory twice because of symlinks.
+        checked = set()
+        to_scan = [self.root]
+        while to_scan:
+            directory = to_scan.pop()
+            to_scan.extend(self._scan_directory(directory, checked, result,
+                                                start))
+            yield
+        result.duration = time.time() - start
+        self.last_result = result
+
+    def _scan_directory(self, directory, checked, result, start):
+        """Update the index for a single directory.
+
+        :returns: list of subdirectories to scan
+        """
+        expanded = fileutil.expand_filename(directory)
+        expanded = os.path.abspath(os.path.normcase(expanded))
+        real_directory = os.path.realpath(expanded)
+        if (real_directory in checked or
+                expanded in fileutil.deletes_in_progress):
+            self._forget_directory(directory, result)
+            return []
+        checked.add(real_directory)
+        try:
+            mtime = os.stat(expanded).st_mtime
+        except OSError:
+            logging.debug('OSError scanning directory; continuing',
+                          exc_info=1)
+            self._forget_directory(directory, result)
+            return []
+
+        entry = self._dirs.get(directory)
+        if (entry is not None and entry.mtime == mtime and
+                not result.full_scan):
+            result.dirs_skipped += 1
+            result.files_skipped += len(entry.files)
+            return sorted(entry.subdirs, reverse=True)
+
+        listing = self._list_directory(directory, expanded)
+        if listing is None:
+            self._forget_directory(directory, result)
+            return []
+        file_stats, subdirs, complete = listing
+        result.dirs_listed += 1
+        if entry is None:
+            entry = self._dirs[directory] = _DirectoryEntry()
+            self._dirty.add(directory)
+        files = set(file_stats)
+        if files != entry.files or subdirs != entry.subdirs:
+            for path in entry.files - files:
+                self._files.discard(path)
+                self._pending_stats.pop(path, None)
+                result.removed.add(path)
+            for path in files - entry.files:
+                self._files.add(path)
+                result.added.add(path)
+            for path in entry.subdirs - subdirs:
+                self._forget_directory(path, result)
+            entry.files = files
+            entry.subdirs = subdirs
+            self._dirty.add(directory)
+        if complete and mtime < start - self.MTIME_GRANULARITY:
+            new_mtime = mtime
+        else:
+            new_mtime = None
+        if new_mtime != entry.mtime:
+            entry.mtime = new_mtime
+            self._dirty.add(directory)
+        if directory in self._dirty:
+            self._pending_stats.update(file_stats)
+        return sorted(subdirs, reverse=True)
+
+    def _list_directory(self, directory, expanded):
+        """List a directory
+
+        :returns: (file_stats, subdirs, complete) tuple.  file_stats maps file
+        paths to (size, mtime) tuples, subdirs is a set of subdirectory paths.
+        complete is False if we skipped files that might show up later
+        without changing the mtime of the directory.  If we can't list the
+        directory, we return None.
+        """
+        try:
+            listing = os.listdir(expanded)
+        except OSError:
+            logging.debug('OSError listing directory; continuing', exc_info=1)
+            return None
+        file_stats = {}
+        subdirs = set()
+        complete = True
+        for name in listing:
+            if fileutil.skip_name_in_scan(name):
+                continue
+            path = os.path.join(directory, os.path.normcase(name))
+            expanded_path = os.path.join(expanded, os.path.normcase(name))
+            if expanded_path in fileutil.deletes_in_progress:
+                complete = False
+                continue
+            try:
+                path_stat = os.stat(expanded_path)
+            except OSError:
+                # broken symlink or a file that just got deleted
+                continue
+            if stat.S_ISDIR(path_stat.st_mode):
+                if not is_file_bundle(expanded_path):
+                    subdirs.add(path)
+            elif stat.S_ISREG(path_stat.st_mode):
+                file_stats[path] = (path_stat.st_size, path_stat.st_mtime)
+        return file_stats, subdirs, complete
+
+    def _forget_directory(self, directory, result):
+        """Remove a directory and everything below it from the index."""
+        entry = self._dirs.pop(directory, None)
+        if entry is None:
+            return
+        self._dirty.discard(directory)
+        self._forgotten.add(directory)
+        for path in entry.files:
+            self._files.discard(path)
+            self._pending_stats.pop(path, None)
+            result.removed.add(path)
+        for subdir in entry.subdirs:
+            self._forget_directory(subdir, result)
+
+    def save(self):
+        """Write the changes from our scans to the database."""
+        owner_id = self.owner_id
+        for directory in self._forgotten:
+            # Delete the directory contents, but leave the directory row.  If
+            # the parent still lists it, we will try to scan it next time.
+            directory = filename_to_unicode(directory)
+            self._execute("DELETE FROM directory_scan_index "
+                          "WHERE owner_id=? AND parent=?",
+                          (owner_id, directory), is_update=True)
+            self._execute("UPDATE directory_scan_index SET mtime=NULL "
+                          "WHERE owner_id=? AND path=?",
+                          (owner_id, directory), is_update=True)
+        for directory in self._dirty:
+            entry = self._dirs[directory]
+            parent = filename_to_unicode(directory)
+            self._execute("DELETE FROM directory_scan_index "
+                          "WHERE owner_id=? AND parent=?",
+                          (owner_id, parent), is_update=True)
+            values = []
+            for path in entry.files:
+                size, mtime = self._pending_stats.get(path, (None, None))
+                values.append((owner_id, filename_to_unicode(path), parent,
+                               False, size, mtime))
+            for path in entry.subdirs:
+                subdir_entry = self._dirs.get(path)
+                if subdir_entry is not None:
+                    mtime = subdir_entry.mtime
+                else:
+                    mtime = None
+                values.append((owner_id, filename_to_unicode(path), parent,
+                               True, None, mtime))
+            if values:
+                self._execute("INSERT INTO directory_scan_index "
+                              "(owner_id, path, parent, is_dir, size, mtime) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", values,
+                              is_update=True, many=True)
+        for directory in self._dirty:
+            mtime = self._dirs[directory].mtime
+            if directory == self.root:
+                self._execute("INSERT OR REPLACE INTO directory_scan_index "
+                              "(owner_id, path, parent, is_dir, size, mtime) "
+                              "VALUES (?, ?, NULL, 1, NULL, ?)",
+                              (owner_id, filename_to_unicode(directory),
+                               mtime), is_update=True)
+            else:
+                self._execute("UPDATE directory_scan_index SET mtime=? "
+                              "WHERE owner_id=? AND path=?",
+                              (mtime, owner_id,
+                               filename_to_unicode(directory)),
+                              is_update=True)
+        self._dirty = set()
+        self._forgotten = set()
+        self._pending_stats = {}
@@ -635,14 +635,15 @@ class RemoteDownloader(DDBObject):
     def delete(self):
         if self.filename is None:
             return
-        try:
-            fileutil.delete(self.filename)
-        except OSError:
-            logging.exception("Error deleting downloaded file: %s",
-                              to_uni(self.filename))
-
+        # Deleting big downloads can take a while, so do it in a thread.
+        # Once it's done we can check if the directory is empty.
         parent = os.path.join(fileutil.expand_filename(self.filename),
                               os.path.pardir)
+        fileutil.delete_in_background(self.filename,
+                lambda: self._remove_empty_parent(parent))
+        self.filename = None
+
+    def _remove_empty_parent(self, parent):
         parent = os.path.normpath(parent)
         movies_dir = fileutil.expand_filename(app.config.get(prefs.MOVIES_DIRECTORY))
         if ((os.path.exists(parent) and os.path.exists(movies_dir)
@@ -653,7 +654,6 @@ class RemoteDownloader(DDBObject):
             except OSError:
                 logging.exception("Error deleting empty download directory: %s",
                                   to_uni(parent))
-        self.filename = None
 
     def start(self):
         """Continues a paused, stopped, or failed download thread
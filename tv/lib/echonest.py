@@ -31,9 +31,11 @@
 
 import collections
 import difflib
+import hashlib
 import logging
 import os
 import os.path
+import time
 import urllib
 from xml.dom import minidom
 from xml.parsers import expat
@@ -101,8 +103,8 @@ def exec_codegen(codegen_info, media_path, callback, errback):
         errback(media_path, error)
 
     logging.debug("Invoking echonest codegen on %s", media_path)
-    eventloop.call_in_thread(thread_callback, thread_errback, thread_function,
-                             'exec echonest codegen')
+    eventloop.call_in_thread_pool('codegen', thread_callback, thread_errback,
+                                  thread_function, 'exec echonest codegen')
 
 def cant_run_codegen():
     # Windows doesn't support uname, but we know we can run ENMFP-codegen
@@ -113,8 +115,111 @@ def cant_run_codegen():
     return (uname[0] == 'Darwin' and
             (uname[4] != 'i386' and uname[4] != 'x86_64'))
 
+class ResponseCache(object):
+    """Stores replies from echonest and 7digital.
+
+    Replies are keyed by the request URL and POST variables and stored in the
+    http_response_cache table.  Each entry has an expiration time, after
+    which we will make the request again.
+
+    We also store failures that will probably happen again if we retry
+    (4xx status codes and replies that we can't parse), but for a shorter
+    time.  Other failures, like timeouts and 5xx status codes, aren't stored.
+    """
+    ECHONEST_TTL = 60 * 60 * 24 * 30 # 30 days
+    SEVEN_DIGITAL_TTL = 60 * 60 * 24 * 90 # 90 days
+    FAILURE_TTL = 60 * 60 * 24 # 1 day
+
+    def __init__(self, db_info):
+        self.db_info = db_info
+        self.reset_stats()
+        self.remove_expired()
+
+    def reset_stats(self):
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'expired': 0,
+        }
+
+    def get_stats(self):
+        """Get a copy of our stats.
+
+        :returns: dict with the keys "hits", "misses", "stores" and
+        "expired".
+        """
+        return self.stats.copy()
+
+    def _execute(self, sql, values=None, is_update=False):
+        return self.db_info.db.execute(sql, values, is_update=is_update)
+
+    @staticmethod
+    def make_key(url, post_vars=None):
+        """Calculate the key to store a request with."""
+        key_data = url
+        if post_vars:
+            key_data += '\n' + repr(sorted(post_vars.items()))
+        return unicode(hashlib.sha1(key_data).hexdigest())
+
+    def get(self, url, post_vars=None):
+        """Get the stored reply for a request.
+
+        :returns: (body, status_code) tuple or None if we don't have an
+        unexpired entry.  status_code is None for successful replies and body
+        is None for HTTP errors.
+        """
+        rows = self._execute("SELECT id, body, status_code, expires "
+                             "FROM http_response_cache WHERE cache_key=?",
+                             (self.make_key(url, post_vars),))
+        if not rows:
+            self.stats['misses'] += 1
+            return None
+        row_id, body, status_code, expires = rows[0]
+        if expires < time.time():
+            self._execute("DELETE FROM http_response_cache WHERE id=?",
+                          (row_id,), is_update=True)
+            self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        if body is not None:
+            body = str(body)
+        return body, status_code
+
+    def store_reply(self, url, post_vars, body, ttl):
+        """Store the body of a reply for ttl seconds."""
+        self._store(url, post_vars, body, None, ttl)
+
+    def store_error(self, url, post_vars, error):
+        """Store an HTTP error, if it's one that's worth remembering.
+
+        We only store 4xx status codes, besides 408 (request timeout) and 429
+        (too many requests).
+        """
+        if not isinstance(error, httpclient.UnexpectedStatusCode):
+            return
+        if not (400 <= error.code < 500) or error.code in (408, 429):
+            return
+        self._store(url, post_vars, None, error.code, self.FAILURE_TTL)
+
+    def _store(self, url, post_vars, body, status_code, ttl):
+        if body is not None:
+            body = buffer(body)
+        self._execute("INSERT OR REPLACE INTO http_response_cache "
+                      "(cache_key, body, status_code, expires) "
+                      "VALUES (?, ?, ?, ?)",
+                      (self.make_key(url, post_vars), body, status_code,
+                       time.time() + ttl), is_update=True)
+        self.stats['stores'] += 1
+
+    def remove_expired(self):
+        """Delete all expired entries."""
+        self._execute("DELETE FROM http_response_cache WHERE expires < ?",
+                      (time.time(),), is_update=True)
+
 def query_echonest(path, cover_art_dir, code, version, metadata, callback,
-                   errback):
+                   errback, response_cache=None):
     """Send a query to echonest to indentify a song.
 
     After the query is complete, we will either call callback(path,
@@ -127,9 +232,11 @@ def query_echonest(path, cover_art_dir, code, version, metadata, callback,
     :param metadata: dict of metadata from ID3 tags.
     :param callback: function to call on success
     :param error: function to call on error
+    :param response_cache: ResponseCache to use for echonest/7digital
+    replies, or None to always make the requests.
     """
     _EchonestQuery(path, cover_art_dir, code, version, metadata, callback,
-                   errback)
+                   errback, response_cache)
 
 class _EchonestQuery(object):
     """Functor object that does the work for query_echonest.
@@ -141,8 +248,9 @@ class _EchonestQuery(object):
     seven_digital_cache = {}
 
     def __init__(self, path, cover_art_dir, code, version, metadata, callback,
-                 errback):
+                 errback, response_cache=None):
         self.metadata = {}
+        self.response_cache = response_cache
         self.cover_art_url = None
         self.cover_art_filename = None
         self.path = path
@@ -168,6 +276,41 @@ class _EchonestQuery(object):
         trapcall.trap_call('query_echonest errback', self.errback,
                            self.path, error)
 
+    def grab_url(self, url, callback, errback, post_vars=None):
+        """Fetch an echonest/7digital url, using our response cache.
+
+        callback and errback work like they do for httpclient.grab_url(),
+        except that the data passed to callback has a "cached" key that's
+        True for replies from the response cache.
+        """
+        if self.response_cache is not None:
+            cached = self.response_cache.get(url, post_vars)
+            if cached is not None:
+                body, status_code = cached
+                # use add_idle to send the reply, since our callers expect
+                # callback/errback to run after grab_url() returns.
+                if status_code is not None:
+                    eventloop.add_idle(errback, 'echonest cached error',
+                            args=(httpclient.UnexpectedStatusCode(
+                                status_code),))
+                else:
+                    eventloop.add_idle(callback, 'echonest cached reply',
+                                       args=({'body': body, 'cached': True},))
+                return
+        def grab_url_errback(error):
+            if self.response_cache is not None:
+                self.response_cache.store_error(url, post_vars, error)
+            errback(error)
+        if post_vars is not None:
+            httpclient.grab_url(url, callback, grab_url_errback,
+                                post_vars=post_vars)
+        else:
+            httpclient.grab_url(url, callback, grab_url_errback)
+
+    def store_reply(self, url, post_vars, data, ttl):
+        if self.response_cache is not None and not data.get('cached'):
+            self.response_cache.store_reply(url, post_vars, data['body'], ttl)
+
     def query_echonest_with_code(self, code, version, metadata):
         post_vars = {
             'api_key': ECHO_NEST_API_KEY,
@@ -175,9 +318,7 @@ class _EchonestQuery(object):
             'query': self._make_echonest_query(code, version, metadata),
         }
         url = 'http://echonest.pculture.org/api/v4/song/identify?'
-        httpclient.grab_url(url,
-                            self.echonest_callback, self.echonest_errback,
-                            post_vars=post_vars)
+        self.query_echonest_url(url, post_vars)
 
     def query_echonest_with_tags(self, metadata):
         url_data = [
@@ -194,8 +335,7 @@ class _EchonestQuery(object):
                 url_data.append((key, metadata[key].encode('utf-8')))
         url = ('http://echonest.pculture.org/api/v4/song/search?' +
                 urllib.urlencode(url_data))
-        httpclient.grab_url(url, self.echonest_callback,
-                            self.echonest_errback)
+        self.query_echonest_url(url)
 
     def query_echonest_with_echonest_id(self, echonest_id):
         url_data = [
@@ -206,8 +346,13 @@ class _EchonestQuery(object):
         ]
         url = ('http://echonest.pculture.org/api/v4/song/profile?' +
                 urllib.urlencode(url_data))
-        httpclient.grab_url(url,
-                            self.echonest_callback, self.echonest_errback)
+        self.query_echonest_url(url)
+
+    def query_echonest_url(self, url, post_vars=None):
+        self.echonest_url = url
+        self.echonest_post_vars = post_vars
+        self.grab_url(url, self.echonest_callback, self.echonest_errback,
+                      post_vars)
 
     def _make_echonest_query(self, code, version, metadata):
         echonest_metadata = {'version': version}
@@ -232,7 +377,11 @@ class _EchonestQuery(object):
         except StandardError, e:
             logging.warn("Error handling echonest response: %r", data['body'],
                          exc_info=True)
+            ttl = ResponseCache.FAILURE_TTL
             self.invoke_errback(ResponseParsingError())
+        else:
+            ttl = ResponseCache.ECHONEST_TTL
+        self.store_reply(self.echonest_url, self.echonest_post_vars, data, ttl)
 
     def _handle_echonest_callback(self, echonest_reply):
         response = json.loads(echonest_reply.decode('utf-8'))['response']
@@ -289,9 +438,10 @@ class _EchonestQuery(object):
         if release_id not in self.seven_digital_cache:
             self.release_id = release_id
             seven_digital_url = self._make_7digital_url(release_id)
-            httpclient.grab_url(seven_digital_url,
-                                self.seven_digital_callback,
-                                self.seven_digital_errback)
+            def callback(data):
+                self.seven_digital_callback(data, seven_digital_url)
+            self.grab_url(seven_digital_url, callback,
+                          self.seven_digital_errback)
         else:
             self.handle_7digital_cache_hit(release_id)
 
@@ -316,10 +466,14 @@ class _EchonestQuery(object):
             len(self.seven_digital_release_ids)):
             self.finish_seven_digital_query()
 
-    def seven_digital_callback(self, data):
+    def seven_digital_callback(self, data, url):
         result = self.parse_seven_digital_callback(data['body'])
         if result is not None:
             self.seven_digital_cache[result['id']] = result
+            ttl = ResponseCache.SEVEN_DIGITAL_TTL
+        else:
+            ttl = ResponseCache.FAILURE_TTL
+        self.store_reply(url, None, data, ttl)
         self.handle_7_digital_result(result)
 
     def parse_seven_digital_callback(self, seven_digital_reply):
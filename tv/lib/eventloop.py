@@ -35,10 +35,11 @@ network requests and scheduling.
 TODO: handle user setting clock back
 """
 
+import collections
 import errno
 import heapq
+import itertools
 import logging
-import Queue
 import select
 import socket
 import threading
@@ -50,7 +51,7 @@ from miro import trapcall
 from miro import signals
 from miro import util
 from miro.clock import clock
-from miro.plat.utils import thread_body
+from miro.plat.utils import thread_body, get_logical_cpu_count
 
 cumulative = {}
 
@@ -61,6 +62,9 @@ class DelayedCall(object):
         self.args = args
         self.kwargs = kwargs
         self.canceled = False
+        # Scheduler that holds us, if we're a timeout that hasn't run or been
+        # canceled yet
+        self.scheduler = None
 
     def _unlink(self):
         """Removes the references that this object has to the outside
@@ -70,8 +74,13 @@ class DelayedCall(object):
         self.function = self.args = self.kwargs = None
 
     def cancel(self):
+        if self.canceled:
+            return
         self.canceled = True
         self._unlink()
+        scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.timeout_canceled(self)
 
     def dispatch(self):
         success = True
@@ -98,8 +107,22 @@ class DelayedCall(object):
         return success
 
 class Scheduler(object):
+    """Schedules DelayedCalls to run at some point in the future.
+
+    Timeouts are stored in a heap.  Canceling a timeout doesn't remove it
+    from the heap, we just mark it canceled and skip over it when it gets to
+    the top.  To keep the heap from filling up with canceled timeouts, we
+    rebuild it once more than half of its entries are canceled.
+    """
+    # don't bother compacting heaps smaller than this
+    COMPACT_MIN_CANCELED = 100
+
     def __init__(self):
         self.heap = []
+        self.lock = threading.Lock()
+        self.canceled_count = 0
+        self.compact_count = 0
+        self.counter = itertools.count()
 
     def add_timeout(self, delay, function, name, args=None, kwargs=None):
         if args is None:
@@ -108,35 +131,174 @@ class Scheduler(object):
             kwargs = {}
         scheduled_time = clock() + delay
         dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs)
-        heapq.heappush(self.heap, (scheduled_time, dc))
+        dc.scheduler = self
+        self.lock.acquire()
+        try:
+            heapq.heappush(self.heap,
+                           (scheduled_time, self.counter.next(), dc))
+        finally:
+            self.lock.release()
         return dc
 
-    def next_timeout(self):
-        if len(self.heap) == 0:
-            return None
+    def timeout_canceled(self, dc):
+        """Called by DelayedCall.cancel() for timeouts in our heap."""
+        self.lock.acquire()
+        try:
+            if dc.scheduler is not self:
+                # we popped the timeout off the heap in another thread
+                return
+            dc.scheduler = None
+            self.canceled_count += 1
+            if (self.canceled_count >= self.COMPACT_MIN_CANCELED and
+                    self.canceled_count * 2 > len(self.heap)):
+                self._compact()
+        finally:
+            self.lock.release()
+
+    def _compact(self):
+        new_heap = []
+        for entry in self.heap:
+            if entry[2].canceled:
+                entry[2].scheduler = None
+            else:
+                new_heap.append(entry)
+        self.heap = new_heap
+        heapq.heapify(self.heap)
+        self.canceled_count = 0
+        self.compact_count += 1
+
+    def _discard_canceled(self):
+        # Pop canceled timeouts off the top of the heap, so that we don't
+        # wake up for them.  Must be called with the lock held.
+        while self.heap and self.heap[0][2].canceled:
+            self._pop()
+
+    def _pop(self):
+        # Pop the top entry of the heap and update canceled_count.  Must be
+        # called with the lock held.
+        time, count, dc = heapq.heappop(self.heap)
+        if dc.scheduler is None:
+            # timeout_canceled() already counted this one
+            self.canceled_count -= 1
         else:
-            return max(0, self.heap[0][0] - clock())
+            dc.scheduler = None
+        return dc
+
+    def pending_count(self):
+        """Get the number of timeouts that haven't been canceled."""
+        self.lock.acquire()
+        try:
+            return len(self.heap) - self.canceled_count
+        finally:
+            self.lock.release()
+
+    def next_timeout(self):
+        self.lock.acquire()
+        try:
+            self._discard_canceled()
+            if len(self.heap) == 0:
+                return None
+            else:
+                return max(0, self.heap[0][0] - clock())
+        finally:
+            self.lock.release()
 
     def has_pending_timeout(self):
-        return len(self.heap) > 0 and self.heap[0][0] < clock()
+        self.lock.acquire()
+        try:
+            self._discard_canceled()
+            return len(self.heap) > 0 and self.heap[0][0] < clock()
+        finally:
+            self.lock.release()
 
     def process_next_timeout(self):
-        time, dc = heapq.heappop(self.heap)
+        self.lock.acquire()
+        try:
+            dc = self._pop()
+        finally:
+            self.lock.release()
         return dc.dispatch()
 
+# Priorities for idle calls.  Lower numbers get processed first.  These
+# order calls inside one CallQueue, calls in the urgent queue (see
+# add_urgent_call()) still run before all idle calls.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BACKGROUND)
+
 class CallQueue(object):
+    """Queue of DelayedCalls waiting to be run.
+
+    Calls are processed in priority order, FIFO within a priority.  To keep
+    lower priorities from starving, a priority that has been passed over
+    STARVATION_LIMIT times in a row gets to run one call before the higher
+    ones.
+
+    Calls can optionally have a coalesce key.  If a call with the same key is
+    already pending, we don't add a new call, we just return the pending one.
+    """
+    STARVATION_LIMIT = 20
+
     def __init__(self):
-        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.queues = dict((p, collections.deque()) for p in PRIORITIES)
+        self.pending_keys = {}
+        self.passed_over = dict((p, 0) for p in PRIORITIES)
         self.quit_flag = False
         self.queue_size_warning_count = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the latency stats returned by get_stats()."""
+        self.stats = dict((p, {'count': 0, 'coalesced': 0,
+                               'total_latency': 0.0, 'max_latency': 0.0})
+                          for p in PRIORITIES)
 
-    def add_idle(self, function, name, args=None, kwargs=None):
+    def get_stats(self):
+        """Get stats on how long calls waited in the queue.
+
+        :returns: dict mapping priorities to dicts with the keys "count",
+        "coalesced", "total_latency", "max_latency" and "avg_latency"
+        """
+        self.lock.acquire()
+        try:
+            retval = {}
+            for priority, stats in self.stats.items():
+                stats = stats.copy()
+                if stats['count'] > 0:
+                    stats['avg_latency'] = (stats['total_latency'] /
+                                            stats['count'])
+                else:
+                    stats['avg_latency'] = 0.0
+                retval[priority] = stats
+            return retval
+        finally:
+            self.lock.release()
+
+    def add_idle(self, function, name, args=None, kwargs=None,
+                 priority=PRIORITY_NORMAL, coalesce_key=None):
         if args is None:
             args = ()
         if kwargs is None:
             kwargs = {}
-        dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
-        self.queue.put(dc)
+        self.lock.acquire()
+        try:
+            if coalesce_key is not None:
+                pending = self.pending_keys.get(coalesce_key)
+                if pending is not None and not pending.canceled:
+                    self.stats[pending.priority]['coalesced'] += 1
+                    return pending
+            dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
+            dc.priority = priority
+            dc.coalesce_key = coalesce_key
+            dc.queued_at = clock()
+            self.queues[priority].append(dc)
+            if coalesce_key is not None:
+                self.pending_keys[coalesce_key] = dc
+            size = self._size()
+        finally:
+            self.lock.release()
 
         # Check if our queue size is too big and log a warning if so.  Only do
         # this a few times.  That should be enough to track down errors, but
@@ -145,19 +307,65 @@ class CallQueue(object):
         # NOTE: the code below doesn't take into account that this method
         # runs on multiple threads.  However, the worst that can happen is
         # we log an extra warning or two, so this doesn't seem bad.
-        if self.queue_size_warning_count < 5 and self.queue.qsize() > 1000:
+        if self.queue_size_warning_count < 5 and size > 1000:
             if self.queue_size_warning_count < 5:
                 logging.stacktrace("Queued called size too large")
                 self.queue_size_warning_count += 1
 
         return dc
 
+    def _size(self):
+        return sum(len(q) for q in self.queues.itervalues())
+
+    def _choose_priority(self):
+        chosen = None
+        for priority in PRIORITIES:
+            if not self.queues[priority]:
+                continue
+            if chosen is None:
+                chosen = priority
+            elif self.passed_over[priority] >= self.STARVATION_LIMIT:
+                chosen = priority
+                break
+        if chosen is None:
+            return None
+        for priority in PRIORITIES:
+            if priority == chosen:
+                self.passed_over[priority] = 0
+            elif self.queues[priority]:
+                self.passed_over[priority] += 1
+        return chosen
+
+    def _pop_next(self):
+        self.lock.acquire()
+        try:
+            priority = self._choose_priority()
+            if priority is None:
+                return None
+            dc = self.queues[priority].popleft()
+            if (dc.coalesce_key is not None and
+                    self.pending_keys.get(dc.coalesce_key) is dc):
+                del self.pending_keys[dc.coalesce_key]
+            latency = clock() - dc.queued_at
+            stats = self.stats[priority]
+            stats['count'] += 1
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            return dc
+        finally:
+            self.lock.release()
+
     def process_next_idle(self):
-        dc = self.queue.get()
+        dc = self._pop_next()
+        if dc is None:
+            return True
         return dc.dispatch()
 
     def has_pending_idle(self):
-        return not self.queue.empty()
+        for queue in self.queues.itervalues():
+            if queue:
+                return True
+        return False
 
     def process_idles(self):
         # Note: used for testing purposes
@@ -165,60 +373,278 @@ class CallQueue(object):
             self.process_next_idle()
 
 
+class ThreadPoolCall(object):
+    """A call queued in a ThreadPool.
+
+    Returned by call_in_thread() so that the call can be canceled.
+    """
+    def __init__(self, pool, callback, errback, function, name, args, kwargs):
+        self.pool = pool
+        self.callback = callback
+        self.errback = errback
+        self.function = function
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = clock()
+        self.canceled = False
+
+    def cancel(self):
+        """Cancel the call.
+
+        If the call hasn't started yet, it's removed from the queue.  If it's
+        already running, we can't stop it but its callback/errback won't be
+        called.
+
+        :returns: True if the call was removed from the queue
+        """
+        return self.pool.cancel_call(self)
+
 class ThreadPool(object):
     """The thread pool is used to handle calls like gethostbyname()
     that block and there's no asynchronous workaround.  What we do
     instead is call them in a separate thread and return the result in
     a callback that executes in the event loop.
+
+    Each pool keeps at least min_threads threads around.  If a call waits in
+    the queue for GROW_WAIT without an idle thread to take it, we start
+    another one, up to max_threads.  Pools with no threads at all start one
+    right away.  Extra threads exit after being idle for SHRINK_TIMEOUT.
     """
     THREADS = 4
+    GROW_WAIT = 0.1
+    SHRINK_TIMEOUT = 30.0
 
-    def __init__(self, event_loop):
+    def __init__(self, event_loop, name='default', min_threads=1,
+                 max_threads=None):
+        if max_threads is None:
+            max_threads = ThreadPool.THREADS
         self.event_loop = event_loop
-        self.queue = Queue.Queue()
+        self.name = name
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
         self.threads = []
+        # threads waiting for a call, or started but not running one yet
+        self.idle_threads = set()
+        self.grow_timer = None
+        self.thread_counter = itertools.count()
+        self.running = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the stats returned by get_stats()."""
+        self.stats = {
+            'calls': 0,
+            'canceled': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0,
+            'total_run': 0.0,
+            'max_run': 0.0,
+        }
+
+    def get_stats(self):
+        """Get stats for this pool.
+
+        :returns: dict with the keys "calls", "canceled", "total_wait",
+        "max_wait", "total_run", "max_run", "queued" and "threads"
+        """
+        self.condition.acquire()
+        try:
+            stats = self.stats.copy()
+            stats['queued'] = len(self.queue)
+            stats['threads'] = len(self.threads)
+            return stats
+        finally:
+            self.condition.release()
 
     def init_threads(self):
-        while len(self.threads) < ThreadPool.THREADS:
-            t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
-                                 target=thread_body,
-                                 args=[self.thread_loop])
-            t.setDaemon(True)
-            t.start()
-            self.threads.append(t)
+        self.condition.acquire()
+        try:
+            self.running = True
+            while len(self.threads) < self.min_threads:
+                self._start_thread()
+            # calls may have been queued before we started
+            self._check_grow()
+        finally:
+            self.condition.release()
+
+    @property
+    def idle_count(self):
+        return len(self.idle_threads)
+
+    def _start_thread(self):
+        # Must be called with the condition held.
+        t = threading.Thread(name='ThreadPool (%s) - %d' %
+                             (self.name, self.thread_counter.next()),
+                             target=thread_body,
+                             args=[self.thread_loop])
+        t.setDaemon(True)
+        self.threads.append(t)
+        self.idle_threads.add(t)
+        t.start()
+
+    def _can_grow(self):
+        # Must be called with the condition held.  Idle threads that we've
+        # notified don't leave idle_threads until they wake up, so compare
+        # against the queue length rather than checking for 0.
+        return (self.running and len(self.queue) > len(self.idle_threads) and
+                len(self.threads) < self.max_threads)
+
+    def _check_grow(self):
+        # Must be called with the condition held.  Start a thread for each
+        # call that has waited GROW_WAIT with no idle thread to take it.  If
+        # the next such call hasn't waited that long yet, check again when it
+        # has.
+        while self._can_grow():
+            if self.threads:
+                # the calls at the front of the queue go to the idle threads
+                call = self.queue[len(self.idle_threads)]
+                remaining = self.GROW_WAIT - (clock() - call.queued_at)
+                if remaining > 0:
+                    self._start_grow_timer(remaining)
+                    return
+            self._start_thread()
+
+    def _start_grow_timer(self, delay):
+        # Must be called with the condition held.
+        if self.grow_timer is not None:
+            return
+        self.grow_timer = threading.Timer(delay, self._on_grow_timer)
+        self.grow_timer.setDaemon(True)
+        self.grow_timer.start()
+
+    def _on_grow_timer(self):
+        self.condition.acquire()
+        try:
+            self.grow_timer = None
+            self._check_grow()
+        finally:
+            self.condition.release()
+
+    def _get_next_call(self):
+        # Wait for the next call to run, must be called with the condition
+        # held.  Returns None if the thread should exit.
+        current = threading.currentThread()
+        if current not in self.threads:
+            # close_threads() was called while we were running a call
+            return None
+        self.idle_threads.add(current)
+        try:
+            while self.running and not self.queue and current in self.threads:
+                if len(self.threads) <= self.min_threads:
+                    self.condition.wait()
+                else:
+                    start = clock()
+                    self.condition.wait(self.SHRINK_TIMEOUT)
+                    if (not self.queue and
+                            clock() - start >= self.SHRINK_TIMEOUT and
+                            len(self.threads) > self.min_threads):
+                        return None
+            if not self.running or current not in self.threads:
+                # close_threads() was called while we were waiting.  If
+                # init_threads() was called after that, we aren't one of the
+                # new threads, so we shouldn't take calls.
+                return None
+        finally:
+            self.idle_threads.discard(current)
+        call = self.queue.popleft()
+        wait = clock() - call.queued_at
+        self.stats['calls'] += 1
+        self.stats['total_wait'] += wait
+        self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+        self._check_grow()
+        return call
 
     def thread_loop(self):
         while True:
-            next_item = self.queue.get()
-            if next_item == "QUIT":
-                break
-            else:
-                callback, errback, func, name, args, kwargs, = next_item
+            self.condition.acquire()
             try:
-                result = func(*args, **kwargs)
-            except KeyboardInterrupt:
-                raise
-            except Exception, exc:
-                logging.debug(">>> thread_loop: %s %s %s %s\n%s",
-                              func, name, args, kwargs,
-                              "".join(traceback.format_exc()))
-                func = errback
-                name = 'Thread Pool Errback (%s)' % name
-                args = (exc,)
-            else:
-                func = callback
-                name = 'Thread Pool Callback (%s)' % name
-                args = (result,)
-            if not self.event_loop.quit_flag:
-                self.event_loop.idle_queue.add_idle(func, name, args=args)
-                self.event_loop.wakeup()
+                call = self._get_next_call()
+                if call is None:
+                    try:
+                        self.threads.remove(threading.currentThread())
+                    except ValueError:
+                        pass
+                    return
+            finally:
+                self.condition.release()
+            self._run_call(call)
+
+    def _run_call(self, call):
+        start = clock()
+        try:
+            result = call.function(*call.args, **call.kwargs)
+        except KeyboardInterrupt:
+            raise
+        except Exception, exc:
+            logging.debug(">>> thread_loop: %s %s %s %s\n%s",
+                          call.function, call.name, call.args, call.kwargs,
+                          "".join(traceback.format_exc()))
+            func = call.errback
+            name = 'Thread Pool Errback (%s)' % call.name
+            args = (exc,)
+        else:
+            func = call.callback
+            name = 'Thread Pool Callback (%s)' % call.name
+            args = (result,)
+        run_time = clock() - start
+        self.condition.acquire()
+        try:
+            self.stats['total_run'] += run_time
+            self.stats['max_run'] = max(self.stats['max_run'], run_time)
+        finally:
+            self.condition.release()
+        if call.canceled:
+            return
+        if not self.event_loop.quit_flag:
+            self.event_loop.idle_queue.add_idle(func, name, args=args)
+            self.event_loop.wakeup()
 
     def queue_call(self, callback, errback, function, name, *args, **kwargs):
-        self.queue.put((callback, errback, function, name, args, kwargs))
+        call = ThreadPoolCall(self, callback, errback, function, name, args,
+                              kwargs)
+        self.condition.acquire()
+        try:
+            self.queue.append(call)
+            self._check_grow()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return call
+
+    def cancel_call(self, call):
+        self.condition.acquire()
+        try:
+            if call.canceled:
+                return False
+            call.canceled = True
+            try:
+                self.queue.remove(call)
+            except ValueError:
+                return False
+            self.stats['canceled'] += 1
+            return True
+        finally:
+            self.condition.release()
+
+    def has_pending_calls(self):
+        return len(self.queue) > 0
 
     def close_threads(self):
-        for x in xrange(len(self.threads)):
-            self.queue.put("QUIT")
+        self.condition.acquire()
+        try:
+            self.running = False
+            self.condition.notifyAll()
+            threads = self.threads
+            self.threads = []
+            self.idle_threads = set()
+            if self.grow_timer is not None:
+                self.grow_timer.cancel()
+                self.grow_timer = None
+        finally:
+            self.condition.release()
         # Why is there a timeout on the join() here, what's wrong?  On
         # shutdown, the system waits for the eventloop to finish using 
         # eventloop.join() but eventloop calls close_threads() which wait
@@ -226,12 +652,172 @@ class ThreadPool(object):
         # in a blocking operation which is exactly the point of having them
         # so eventloop.join() in turn blocks.  So if it doesn't clean up
         # in time let the daemon flag in the Thread() do its job.  See #16584.
-        for t in self.threads:
+        for t in threads:
             try:
                 t.join(0.5)
             except StandardError:
                 pass
-        self.threads = []
+
+POLL_READ = 1
+POLL_WRITE = 2
+
+class PollerBase(object):
+    """Base class for pollers.
+
+    Pollers keep a persistent map of file descriptors to the events we're
+    interested in.  Call register()/unregister() when that changes, then
+    poll() to wait for events.  Subclasses implement poll().
+    """
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, events):
+        """Start watching fd, or change the events we watch it for.
+
+        :param events: bitmask of POLL_READ and POLL_WRITE
+        """
+        if events:
+            self.fds[fd] = events
+        else:
+            self.unregister(fd)
+
+    def unregister(self, fd):
+        """Stop watching fd.  Does nothing if we weren't watching it."""
+        self.fds.pop(fd, None)
+
+    def forget(self, fd):
+        """Forget about fd without unregistering it.
+
+        Call this when fd was closed and its number may have been reused by
+        a new socket.  The next register() or sync() will treat it as a new
+        fd.
+        """
+        self.fds.pop(fd, None)
+
+    def sync(self, readfds, writefds):
+        """Make the registered fds match a read and write list.
+
+        This is for code that calculates the fds to watch each time through
+        the loop (for example libcurl's fdset()).  Only fds that are new,
+        removed or have different events get re-registered.  If fd numbers
+        can get reused between calls, use forget() to tell us about it.
+        """
+        wanted = dict((fd, POLL_READ) for fd in readfds)
+        for fd in writefds:
+            wanted[fd] = wanted.get(fd, 0) | POLL_WRITE
+        for fd in self.fds.keys():
+            if fd not in wanted:
+                self.unregister(fd)
+        for fd, events in wanted.iteritems():
+            if self.fds.get(fd) != events:
+                self.register(fd, events)
+
+    def close(self):
+        self.fds = {}
+
+class SelectPoller(PollerBase):
+    """Waits for socket events using select()."""
+
+    def poll(self, timeout, excfds=()):
+        """Wait for events.
+
+        :param timeout: max time to wait in seconds, or None to wait forever
+        :param excfds: extra fds to watch for exceptional conditions
+        :returns: (readable, writable, exceptional) lists of fds
+        """
+        readfds = []
+        writefds = []
+        for fd, events in self.fds.items():
+            if events & POLL_READ:
+                readfds.append(fd)
+            if events & POLL_WRITE:
+                writefds.append(fd)
+        return select.select(readfds, writefds, list(excfds), timeout)
+
+class EpollPoller(PollerBase):
+    """Waits for socket events using epoll().
+
+    Registration is persistent in the kernel, so the cost of poll() depends
+    on the number of ready fds rather than the number of watched fds.
+    """
+    def __init__(self):
+        PollerBase.__init__(self)
+        self.epoll = select.epoll()
+
+    def _epoll_mask(self, events):
+        mask = 0
+        if events & POLL_READ:
+            mask |= select.EPOLLIN
+        if events & POLL_WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, events):
+        if not events:
+            self.unregister(fd)
+            return
+        # Always tell the kernel about the fd, even if our events didn't
+        # change.  The fd may have been closed and its number reused, in
+        # which case the kernel forgot about it.
+        mask = self._epoll_mask(events)
+        if fd in self.fds:
+            try:
+                self.epoll.modify(fd, mask)
+            except IOError, e:
+                # If the fd was closed, the kernel dropped it from the epoll
+                # set.  The fd number may have been reused since then.
+                if e.errno != errno.ENOENT:
+                    raise
+                self.epoll.register(fd, mask)
+        else:
+            try:
+                self.epoll.register(fd, mask)
+            except IOError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self.epoll.modify(fd, mask)
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        if self.fds.pop(fd, None) is None:
+            return
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            # fd was already closed
+            pass
+
+    def poll(self, timeout, excfds=()):
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            # make EINTR look like it does for select()
+            raise select.error(e.errno, e.strerror)
+        readable = []
+        writable = []
+        exceptional = []
+        for fd, mask in events:
+            if mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                readable.append(fd)
+            if mask & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR):
+                if self.fds.get(fd, 0) & POLL_WRITE:
+                    writable.append(fd)
+            if mask & select.EPOLLERR and fd in excfds:
+                exceptional.append(fd)
+        return readable, writable, exceptional
+
+    def close(self):
+        PollerBase.close(self)
+        self.epoll.close()
+
+def make_poller():
+    """Create the best poller for our platform."""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    else:
+        return SelectPoller()
 
 class SimpleEventLoop(signals.SignalEmitter):
     def __init__(self):
@@ -243,8 +829,34 @@ class SimpleEventLoop(signals.SignalEmitter):
         self.quit_flag = False
         self.wake_sender, self.wake_receiver = util.make_dummy_socket_pair()
         self.loop_ready = threading.Event()
+        self.poller = make_poller()
+        self.poller.register(self.wake_receiver.fileno(), POLL_READ)
+        # thread that's running loop(), or None
+        self.loop_thread = None
+
+    def update_fds(self):
+        """Update the fds that our poller is watching.
+
+        By default, we call calc_fds() and sync the poller to its result.
+        Subclasses that register fds with the poller as they change can
+        override this to do nothing.
+
+        :returns: list of fds to watch for exceptional conditions
+        """
+        readfds, writefds, excfds = self.calc_fds()
+        readfds = list(readfds)
+        readfds.append(self.wake_receiver.fileno())
+        self.poller.sync(readfds, writefds)
+        return excfds
 
     def loop(self):
+        self.loop_thread = threading.currentThread()
+        try:
+            self._loop()
+        finally:
+            self.loop_thread = None
+
+    def _loop(self):
         self.loop_ready.set()
         self.emit('thread-will-start')
         self.emit('thread-started', threading.currentThread())
@@ -253,11 +865,10 @@ class SimpleEventLoop(signals.SignalEmitter):
         while not self.quit_flag:
             self.emit('begin-loop')
             timeout = self.calc_timeout()
-            readfds, writefds, excfds = self.calc_fds()
-            readfds.append(self.wake_receiver.fileno())
+            excfds = self.update_fds()
             try:
                 read_fds_ready, write_fds_ready, exc_fds_ready = \
-                        select.select(readfds, writefds, excfds, timeout)
+                        self.poller.poll(timeout, excfds)
             except select.error, (err, detail):
                 if err == errno.EINTR:
                     logging.warning ("eventloop: %s", detail)
@@ -282,13 +893,38 @@ class SimpleEventLoop(signals.SignalEmitter):
         self.wake_receiver.recv(1024)
 
 class EventLoop(SimpleEventLoop):
+    # Thread pools for call_in_thread(), maps names to (min_threads,
+    # max_threads).  Each pool gets its own queue, so a slow category of
+    # calls can't starve the others.  A max_threads of None means one thread
+    # per CPU.
+    THREAD_POOLS = {
+        'default': (1, 4),
+        # getaddrinfo() and SSL handshakes
+        'network': (1, 4),
+        # DAAP client connections
+        'sharing': (0, 2),
+        # echonest codegen processes
+        'codegen': (0, None),
+        # reading files to fingerprint them for the metadata result cache
+        'files': (0, 1),
+        # fileutil.delete_in_background().  Deleting big directories can
+        # take a while, so keep it from holding up the files pool.
+        'delete': (0, 1),
+    }
+
     def __init__(self):
         SimpleEventLoop.__init__(self)
         self.create_signal('event-finished')
         self.scheduler = Scheduler()
         self.idle_queue = CallQueue()
         self.urgent_queue = CallQueue()
-        self.threadpool = ThreadPool(self)
+        self.threadpools = {}
+        for name, (min_threads, max_threads) in self.THREAD_POOLS.items():
+            if max_threads is None:
+                max_threads = max(get_logical_cpu_count(), 1)
+            self.threadpools[name] = ThreadPool(self, name, min_threads,
+                                                max_threads)
+        self.threadpool = self.threadpools['default']
         self.read_callbacks = {}
         self.write_callbacks = {}
         self.clear_removed_callbacks()
@@ -299,23 +935,63 @@ class EventLoop(SimpleEventLoop):
         self.removed_write_callbacks = set()
 
     def add_read_callback(self, sock, callback):
-        self.read_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.read_callbacks[fd] = callback
+        self._update_poller(fd)
 
     def remove_read_callback(self, sock):
-        del self.read_callbacks[sock.fileno()]
-        self.removed_read_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.read_callbacks[fd]
+        self.removed_read_callbacks.add(fd)
+        self._update_poller(fd)
 
     def add_write_callback(self, sock, callback):
-        self.write_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.write_callbacks[fd] = callback
+        self._update_poller(fd)
 
     def remove_write_callback(self, sock):
-        del self.write_callbacks[sock.fileno()]
-        self.removed_write_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.write_callbacks[fd]
+        self.removed_write_callbacks.add(fd)
+        self._update_poller(fd)
+
+    def _update_poller(self, fd):
+        events = 0
+        if fd in self.read_callbacks:
+            events |= POLL_READ
+        if fd in self.write_callbacks:
+            events |= POLL_WRITE
+        self.poller.register(fd, events)
+
+    def get_thread_pool(self, pool_name):
+        try:
+            return self.threadpools[pool_name]
+        except KeyError:
+            pool = ThreadPool(self, pool_name)
+            self.threadpools[pool_name] = pool
+            if self.threadpool.running:
+                pool.init_threads()
+            return pool
 
     def call_in_thread(self, callback, errback, function, name,
                        *args, **kwargs):
-        self.threadpool.queue_call(callback, errback, function, name,
-                                  *args, **kwargs)
+        return self.threadpool.queue_call(callback, errback, function, name,
+                                          *args, **kwargs)
+
+    def call_in_thread_pool(self, pool_name, callback, errback, function,
+                            name, *args, **kwargs):
+        pool = self.get_thread_pool(pool_name)
+        return pool.queue_call(callback, errback, function, name,
+                               *args, **kwargs)
+
+    def init_threads(self):
+        for pool in self.threadpools.values():
+            pool.init_threads()
+
+    def close_threads(self):
+        for pool in self.threadpools.values():
+            pool.close_threads()
 
     def run_idle_next_loop(self, function, name, args=None, kwargs=None):
         """Add an idle callback to be called on the next event loop."""
@@ -334,8 +1010,9 @@ class EventLoop(SimpleEventLoop):
             if self.quit_flag:
                 break
 
-    def calc_fds(self):
-        return (self.read_callbacks.keys(), self.write_callbacks.keys(), [])
+    def update_fds(self):
+        # We keep the poller up to date in add_read_callback(), etc.
+        return []
 
     def calc_timeout(self):
         return self.scheduler.next_timeout()
@@ -397,6 +1074,7 @@ class EventLoop(SimpleEventLoop):
                     success = trapcall.trap_call(when, function)
                     if not success:
                         del map_[fd]
+                        self._update_poller(fd)
                     return success
                 yield callback_event
 
@@ -455,34 +1133,78 @@ def add_timeout(delay, function, name, args=None, kwargs=None):
     _eventloop.wakeup()
     return dc
 
-def add_idle(function, name, args=None, kwargs=None):
+def add_idle(function, name, args=None, kwargs=None,
+             priority=PRIORITY_NORMAL, coalesce_key=None):
     """Schedule a function to be called when we get some spare time.
     Returns a ``DelayedCall`` object that can be used to cancel the
     call.
+
+    :param priority: one of PRIORITY_HIGH, PRIORITY_NORMAL or
+                     PRIORITY_BACKGROUND
+    :param coalesce_key: if given and an idle call with the same key is
+                         still pending, don't schedule a new call.  The
+                         pending ``DelayedCall`` is returned instead.
     """
-    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs)
+    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs,
+                                        priority, coalesce_key)
     _eventloop.wakeup()
     return dc
 
-def add_urgent_call(function, name, args=None, kwargs=None):
+def add_urgent_call(function, name, args=None, kwargs=None,
+                    coalesce_key=None):
     """Schedule a function to be called as soon as possible.  This
     method should be used for things like GUI actions, where the user
     is waiting on us.
+
+    :param coalesce_key: works the same as for ``add_idle()``
     """
-    dc = _eventloop.urgent_queue.add_idle(function, name, args, kwargs)
+    dc = _eventloop.urgent_queue.add_idle(function, name, args, kwargs,
+                                          coalesce_key=coalesce_key)
     _eventloop.wakeup()
     return dc
 
+def in_event_loop_thread():
+    """Check if we're running inside the event loop thread."""
+    return threading.currentThread() is _eventloop.loop_thread
+
+def get_idle_queue_stats():
+    """Get latency stats for the idle queue.
+
+    See ``CallQueue.get_stats()`` for the format.
+    """
+    return _eventloop.idle_queue.get_stats()
+
 def call_in_thread(callback, errback, function, name, *args, **kwargs):
     """Schedule a function to be called in a separate thread.
 
+    Returns a ``ThreadPoolCall`` object that can be used to cancel the
+    call.
+
     .. Warning::
 
        Do not put code that accesses the database or the UI here!
     """
-    _eventloop.call_in_thread(
+    return _eventloop.call_in_thread(
         callback, errback, function, name, *args, **kwargs)
 
+def call_in_thread_pool(pool_name, callback, errback, function, name,
+                        *args, **kwargs):
+    """Like ``call_in_thread()``, but use a named thread pool.
+
+    See ``EventLoop.THREAD_POOLS`` for the pools.  Unknown names get a new
+    pool with the default limits.
+    """
+    return _eventloop.call_in_thread_pool(
+        pool_name, callback, errback, function, name, *args, **kwargs)
+
+def get_thread_pool_stats():
+    """Get wait and run time stats for each thread pool.
+
+    :returns: dict mapping pool names to ``ThreadPool.get_stats()`` dicts
+    """
+    return dict((name, pool.get_stats())
+                for name, pool in _eventloop.threadpools.items())
+
 lt = None
 
 profile_file = None
@@ -529,10 +1251,10 @@ def disconnect(signal, callback):
     _eventloop.disconnect(signal, callback)
 
 def thread_pool_quit():
-    _eventloop.threadpool.close_threads()
+    _eventloop.close_threads()
 
 def thread_pool_init():
-    _eventloop.threadpool.init_threads()
+    _eventloop.init_threads()
 
 def as_idle(func):
     """Decorator to make a methods run as an idle function
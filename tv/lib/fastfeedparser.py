@@ -0,0 +1,587 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""fastfeedparser.py -- Fast path for parsing common RSS 2.0 and Atom feeds.
+
+feedparser can handle almost anything that calls itself a feed, but it's
+slow.  It runs every element through its SAX handler, sanitizes every chunk
+of HTML in the feed and builds up a dict with everything it finds.
+
+Most feeds we see are well-formed RSS 2.0 or Atom 1.0 podcast feeds.  This
+module parses those with a streaming ElementTree parser and only calculates
+the values that FeedParserValues and the feed code actually use (guids,
+titles, links, enclosures, dates, thumbnails, descriptions, etc).  The values
+are calculated the same way feedparser calculates them and are returned in
+the same FeedParserDict structure.
+
+If we see anything that we don't handle exactly like feedparser does, we give
+up and parse() returns None.  Callers should then use the full feedparser.
+"""
+
+import logging
+import re
+from cStringIO import StringIO
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+from miro import feedparser
+from miro.feedparser import FeedParserDict
+
+_MIXIN = feedparser._FeedParserMixin
+
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+_XML_BASE = '{%s}base' % XML_NS
+
+# namespace URI -> the prefix feedparser uses for it
+_NAMESPACES = dict((uri.lower(), prefix)
+                   for uri, prefix in _MIXIN.namespaces.items())
+
+# We only handle feeds that expat and feedparser decode the same way.
+_XML_DECL_RE = re.compile(r'^<\?xml[^>]*?encoding=["\']([^"\']*)["\']')
+_ENCODINGS = ('utf-8', 'utf8', 'us-ascii', 'ascii')
+_UTF8_BOM = '\xef\xbb\xbf'
+
+# Elements with feedparser handlers that only set values we never use.  We
+# skip them (but still look at their children).
+_IGNORED = frozenset([
+    'author', 'managingeditor', 'dc_author', 'dc_creator', 'itunes_author',
+    'name', 'itunes_name', 'email', 'itunes_email', 'contributor',
+    'dc_contributor', 'itunes_owner', 'webmaster', 'dc_publisher',
+    'category', 'dc_subject', 'keywords', 'media_category',
+    'itunes_category', 'itunes_keywords', 'itunes_explicit', 'itunes_block',
+    'language', 'dc_language', 'copyright', 'rights', 'dc_rights',
+    'generator', 'admin_generatoragent', 'admin_errorreportsto', 'cloud',
+    'created', 'dcterms_created', 'expirationdate', 'info',
+    'feedburner_browserfriendly', 'width', 'height',
+])
+
+# Elements that only matter inside entries.  At the feed level they set
+# things like the feed subtitle, which we don't use.
+_ENTRY_ONLY = frozenset([
+    'guid', 'description', 'summary', 'itunes_summary', 'subtitle',
+    'itunes_subtitle', 'tagline', 'content', 'content_encoded', 'fullitem',
+    'pubdate', 'dc_date', 'updated', 'modified', 'dcterms_modified',
+    'published', 'issued', 'dcterms_issued', 'media_thumbnail',
+    'media_text',
+])
+
+_TITLE_ELEMENTS = frozenset(['title', 'dc_title', 'media_title'])
+_UPDATED_ELEMENTS = frozenset(['pubdate', 'dc_date', 'updated', 'modified',
+                               'dcterms_modified'])
+_PUBLISHED_ELEMENTS = frozenset(['published', 'issued', 'dcterms_issued'])
+_ENCLOSURE_ELEMENTS = frozenset(['enclosure', 'media_content'])
+_SUBTITLE_ELEMENTS = frozenset(['subtitle', 'itunes_subtitle', 'tagline'])
+_SUMMARY_ELEMENTS = frozenset(['summary', 'itunes_summary'])
+# content element -> default content type
+_CONTENT_ELEMENTS = {
+    'content': 'text/plain',
+    'content_encoded': 'text/html',
+    'fullitem': 'text/html',
+}
+_URL_ELEMENTS = frozenset(['url', 'uri', 'homepage'])
+# Elements that we get text from.  feedparser turns child elements of these
+# into text (or drops them), so we don't handle feeds that have them.
+_TEXT_ELEMENTS = (_TITLE_ELEMENTS | _UPDATED_ELEMENTS | _PUBLISHED_ELEMENTS |
+                  _SUBTITLE_ELEMENTS | _SUMMARY_ELEMENTS | _URL_ELEMENTS |
+                  frozenset(_CONTENT_ELEMENTS.keys()) |
+                  frozenset(['description', 'guid', 'media_text',
+                             'creativecommons_license', '#link',
+                             '#ignored']))
+_IMAGE_CHILDREN = frozenset(['title', 'link', 'description', 'url', 'href',
+                             'width', 'height'])
+
+# Values stored by elements that feedparser doesn't have a handler for.
+# These are the only ones we keep.
+_FEED_VALUES = frozenset(['ttl', 'license'])
+_ENTRY_VALUES = frozenset(['thumbnail', 'comments', 'license', 'id'])
+
+# Sanitizing HTML is by far the slowest part of parsing a feed.  When a feed
+# changes, most of its entries stay the same, so we keep the results around
+# for the next time.
+HTML_CACHE_SIZE = 1000
+
+_special_cache = {}
+_html_cache = {}
+
+class UnsupportedFeed(StandardError):
+    """The fast path can't handle a feed."""
+
+def parse(data):
+    """Parse a feed with the fast path.
+
+    :param data: the body of the feed, as a byte string
+
+    :returns: a FeedParserDict like feedparser.parse() returns, or None if
+        the feed needs to be parsed by feedparser.
+    """
+    if not _check_data(data):
+        return None
+    try:
+        return _FastParser().parse(data)
+    except (UnsupportedFeed, SyntaxError), e:
+        # ElementTree.ParseError is a subclass of SyntaxError
+        logging.debug("fastfeedparser: falling back to feedparser (%s)", e)
+        return None
+
+def _check_data(data):
+    """Check that a feed is something that we can try to parse."""
+    if not isinstance(data, str):
+        return False
+    # feedparser strips DOCTYPE and ENTITY declarations out of the whole
+    # feed, even from inside CDATA sections.
+    if '<!DOCTYPE' in data or '<!ENTITY' in data:
+        return False
+    if data.startswith(_UTF8_BOM):
+        data = data[len(_UTF8_BOM):]
+    m = _XML_DECL_RE.match(data)
+    if m is not None and m.group(1).lower() not in _ENCODINGS:
+        return False
+    return data.startswith('<')
+
+def _is_special(name):
+    """Does feedparser have a handler for an element?"""
+    try:
+        return _special_cache[name]
+    except KeyError:
+        special = (hasattr(_MIXIN, '_start_' + name) or
+                   hasattr(_MIXIN, '_end_' + name))
+        _special_cache[name] = special
+        return special
+
+def _map_content_type(content_type):
+    content_type = content_type.lower()
+    if content_type == 'text':
+        return 'text/plain'
+    elif content_type == 'html':
+        return 'text/html'
+    elif content_type == 'xhtml':
+        return 'application/xhtml+xml'
+    return content_type
+
+def _unicode(value):
+    if isinstance(value, str):
+        return unicode(value, 'utf-8')
+    return value
+
+def _href_from_url(attrs):
+    """Port of _FeedParserMixin._itsAnHrefDamnIt()."""
+    href = attrs.get('url', attrs.get('uri', attrs.get('href', None)))
+    if href:
+        for key in ('url', 'uri'):
+            try:
+                del attrs[key]
+            except KeyError:
+                pass
+        attrs['href'] = href
+    return attrs
+
+class _FastParser(object):
+    """Parses a single feed.
+
+    This tracks the same state that feedparser's _FeedParserMixin does, but
+    only for the elements that we handle.
+    """
+    def __init__(self):
+        self.feed = FeedParserDict()
+        self.entries = []
+        self.entry = None
+        self.version = None
+        # maps namespace URIs to the prefix the document uses for them
+        self.prefixes = {}
+        # maps prefixes from the document to feedparser's prefixes
+        self.namespacemap = {}
+        self.names = {}
+        self.inenclosure = 0
+        self.inimage = False
+        self.guidislink = False
+        self.stack = []
+        self.baseuri = ''
+        self.basestack = []
+
+    def parse(self, data):
+        events = ElementTree.iterparse(StringIO(data),
+                                       events=('start', 'end', 'start-ns'))
+        for event, elem in events:
+            if event == 'start':
+                self.start(elem)
+            elif event == 'end':
+                self.end(elem)
+            else:
+                self.start_ns(*elem)
+        if self.version is None:
+            raise UnsupportedFeed("no feed element")
+        result = FeedParserDict()
+        result['feed'] = self.feed
+        result['entries'] = self.entries
+        result['bozo'] = 0
+        result['version'] = self.version
+        return result
+
+    def start_ns(self, prefix, uri):
+        self.prefixes[uri] = prefix
+        loweruri = uri.lower()
+        if 'backend.userland.com/rss' in loweruri:
+            loweruri = 'http://backend.userland.com/rss'
+        if loweruri in _NAMESPACES:
+            self.namespacemap[prefix or None] = _NAMESPACES[loweruri]
+        self.names.clear()
+
+    def element_name(self, tag):
+        """Get the name that feedparser uses for an element.
+
+        This is the name of the _start_* and _end_* methods that feedparser
+        calls, or the key it uses to store the value.
+        """
+        try:
+            return self.names[tag]
+        except KeyError:
+            pass
+        if tag[0] == '{':
+            uri, local = tag[1:].split('}', 1)
+        else:
+            uri, local = '', tag
+        loweruri = uri.lower()
+        if 'backend.userland.com/rss' in loweruri:
+            loweruri = 'http://backend.userland.com/rss'
+        prefix = _NAMESPACES.get(loweruri)
+        if prefix is None:
+            prefix = self.prefixes.get(uri)
+        if prefix:
+            prefix = prefix.lower()
+            name = '%s_%s' % (self.namespacemap.get(prefix, prefix),
+                              local.lower())
+        else:
+            name = local.lower()
+        self.names[tag] = name
+        return name
+
+    def attributes(self, elem):
+        """Get the attributes for an element, normalized like feedparser
+        does it.
+        """
+        attrs = {}
+        for key, value in elem.attrib.items():
+            if key[0] == '{':
+                uri, local = key[1:].split('}', 1)
+                prefix = _NAMESPACES.get(uri.lower(), '')
+                if prefix:
+                    attrs[('%s:%s' % (prefix, local)).lower()] = value
+                else:
+                    attrs[local.lower()] = value
+                given_prefix = self.prefixes.get(uri)
+                if uri == XML_NS:
+                    given_prefix = 'xml'
+                if given_prefix:
+                    attrs[('%s:%s' % (given_prefix, local)).lower()] = value
+            else:
+                attrs[key.lower()] = value
+        return FeedParserDict([(k, _unicode(k in ('rel', 'type') and
+                                            v.lower() or v))
+                               for k, v in attrs.items()])
+
+    def context(self):
+        if self.entry is not None:
+            return self.entry
+        else:
+            return self.feed
+
+    def resolve_uri(self, uri):
+        return _unicode(feedparser._urljoin(self.baseuri, uri))
+
+    def start(self, elem):
+        attrib = elem.attrib
+        if attrib:
+            base = attrib.get(_XML_BASE) or attrib.get('base')
+            if base:
+                self.baseuri = feedparser._urljoin(self.baseuri, base)
+        self.basestack.append(self.baseuri)
+        name = self.element_name(elem.tag)
+        parent = self.stack and self.stack[-1] or None
+        self.stack.append(name)
+        if parent is None:
+            self.start_root(elem, name)
+        elif parent in _TEXT_ELEMENTS:
+            raise UnsupportedFeed("%s inside %s" % (name, parent))
+        elif parent == 'rss':
+            if name != 'channel' or attrib:
+                raise UnsupportedFeed("%s inside rss" % name)
+        elif name in ('item', 'entry'):
+            if (self.entry is not None or self.inimage or
+                    parent not in ('channel', 'feed')):
+                raise UnsupportedFeed("misplaced %s" % name)
+            attrs = self.attributes(elem)
+            for key in ('rdf:about', 'lastmod', 'href'):
+                if attrs.has_key(key):
+                    raise UnsupportedFeed("%s attribute on %s" % (key, name))
+            self.entry = FeedParserDict()
+            self.entries.append(self.entry)
+            self.guidislink = False
+        elif self.inimage:
+            if name not in _IMAGE_CHILDREN:
+                raise UnsupportedFeed("%s inside image" % name)
+        elif name in _ENCLOSURE_ELEMENTS:
+            self.inenclosure += 1
+            attrs = _href_from_url(self.attributes(elem))
+            self.context().setdefault('enclosures', []).append(
+                FeedParserDict(attrs))
+        elif name == 'link':
+            self.start_link(elem)
+        elif self.entry is None:
+            self.start_feed_element(elem, name)
+        else:
+            self.start_entry_element(elem, name)
+
+    def start_root(self, elem, name):
+        if name == 'rss':
+            if not elem.get('version', '').startswith('2.'):
+                raise UnsupportedFeed("RSS version %s" % elem.get('version'))
+            self.version = 'rss20'
+        elif name == 'feed' and elem.tag == '{%s}feed' % ATOM_NS:
+            self.version = 'atom10'
+        else:
+            raise UnsupportedFeed("root element %s" % elem.tag)
+
+    def start_link(self, elem):
+        attrs = self.attributes(elem)
+        attrs.setdefault('rel', 'alternate')
+        attrs.setdefault('type', 'text/html')
+        attrs = _href_from_url(attrs)
+        if attrs.has_key('href'):
+            attrs['href'] = self.resolve_uri(attrs['href'])
+        if not attrs.has_key('href'):
+            self.stack[-1] = '#link'
+        if attrs['rel'] == 'enclosure':
+            # feedparser never decrements inenclosure for these
+            self.inenclosure += 1
+            self.context().setdefault('enclosures', []).append(
+                FeedParserDict(attrs))
+        if attrs.has_key('href'):
+            if ((attrs.get('rel') == 'alternate' and
+                 _map_content_type(attrs.get('type')) in
+                 _MIXIN.html_types)):
+                self.context()['link'] = attrs['href']
+
+    def start_feed_element(self, elem, name):
+        if name == 'image':
+            self.inimage = True
+            self.feed.setdefault('image', FeedParserDict())
+        elif name == 'itunes_image':
+            self.feed['image'] = FeedParserDict({
+                'href': _unicode(elem.get('href'))})
+        elif name == 'cc_license':
+            self.set_cc_license(elem)
+        elif (name in _TITLE_ELEMENTS or name in _IGNORED or
+              name in _ENTRY_ONLY or name in _URL_ELEMENTS or
+              name == 'creativecommons_license'):
+            pass
+        elif _is_special(name):
+            raise UnsupportedFeed("feed element %s" % name)
+
+    def start_entry_element(self, elem, name):
+        if name == 'guid':
+            attrs = self.attributes(elem)
+            self.guidislink = (attrs.get('ispermalink', 'true') == 'true')
+        elif name == 'media_thumbnail':
+            attrs = FeedParserDict(self.attributes(elem))
+            if self.inenclosure:
+                try:
+                    self.entry['enclosures'][-1]['thumbnail'] = attrs
+                except KeyError:
+                    pass
+            else:
+                self.entry['thumbnail'] = attrs
+        elif name == 'itunes_image':
+            self.entry['image'] = FeedParserDict({
+                'href': _unicode(elem.get('href'))})
+        elif name == 'cc_license':
+            self.set_cc_license(elem)
+        elif name == 'description' or name in _SUMMARY_ELEMENTS:
+            if self.entry.has_key('summary'):
+                # feedparser treats this as content, which we don't use
+                self.stack[-1] = '#ignored'
+        elif (name in _TITLE_ELEMENTS or name in _IGNORED or
+              name in _ENTRY_ONLY or name in _URL_ELEMENTS or
+              name == 'creativecommons_license'):
+            pass
+        elif _is_special(name):
+            raise UnsupportedFeed("entry element %s" % name)
+
+    def set_cc_license(self, elem):
+        attrs = self.attributes(elem)
+        value = (attrs.get('rdf:resource') or u'').strip()
+        if value:
+            value = self.resolve_uri(value)
+        self.context()['license'] = value
+
+    def end(self, elem):
+        name = self.stack.pop()
+        if not self.stack:
+            return
+        self.end_element(elem, name)
+        # feedparser only restores the parent's base URI if it's set
+        self.basestack.pop()
+        if self.basestack and self.basestack[-1]:
+            self.baseuri = self.basestack[-1]
+
+    def end_element(self, elem, name):
+        parent = self.stack[-1]
+        if name in ('item', 'entry') and parent in ('channel', 'feed'):
+            self.entry = None
+        elif self.inimage:
+            self.end_image_element(elem, name)
+        elif name in _ENCLOSURE_ELEMENTS:
+            self.inenclosure -= 1
+        elif name == '#link':
+            self.context()['link'] = self.resolve_uri(self.text(elem))
+        elif name in _TITLE_ELEMENTS:
+            self.context()['title'] = self.content_value(
+                elem, 'title', 'text/plain')
+        elif self.entry is None:
+            self.end_feed_element(elem, name)
+        else:
+            self.end_entry_element(elem, name)
+        if parent in ('channel', 'feed'):
+            # We're done with this part of the feed, free up the memory.
+            elem.clear()
+
+    def end_image_element(self, elem, name):
+        if name == 'image':
+            self.inimage = False
+        elif name in _URL_ELEMENTS:
+            self.feed['image']['href'] = self.resolve_uri(self.text(elem))
+        elif name in ('title', 'link', 'description'):
+            # these get stored in the image dict, which we don't need, but
+            # make sure they're not something we can't handle.
+            self.text(elem)
+
+    def end_feed_element(self, elem, name):
+        if name == 'creativecommons_license':
+            self.feed['license'] = self.resolve_uri(self.text(elem))
+        elif name in _FEED_VALUES and not _is_special(name):
+            self.feed[name] = self.generic_value(elem, name)
+
+    def end_entry_element(self, elem, name):
+        entry = self.entry
+        if name == 'guid':
+            value = self.text(elem)
+            if value:
+                value = self.resolve_uri(value)
+            entry['id'] = value
+            if self.guidislink:
+                entry.setdefault('link', value)
+        elif name == 'description':
+            entry['summary'] = self.content_value(elem, name, 'text/html')
+        elif name in _SUMMARY_ELEMENTS:
+            entry['summary'] = self.content_value(elem, 'summary',
+                                                  'text/plain')
+        elif name in _SUBTITLE_ELEMENTS:
+            entry['subtitle'] = self.content_value(elem, 'subtitle',
+                                                   'text/plain')
+        elif name in _CONTENT_ELEMENTS:
+            content_type = _map_content_type(self.attributes(elem).get(
+                'type', _CONTENT_ELEMENTS[name]))
+            if ((content_type in ['text/plain'] + _MIXIN.html_types and
+                 not entry.has_key('description'))):
+                entry['description'] = self.content_value(
+                    elem, 'content', _CONTENT_ELEMENTS[name])
+        elif name in _UPDATED_ELEMENTS:
+            if not entry.has_key('updated_parsed'):
+                entry['updated_parsed'] = feedparser._parse_date(
+                    self.text(elem))
+        elif name in _PUBLISHED_ELEMENTS:
+            if not entry.has_key('published_parsed'):
+                entry['published_parsed'] = feedparser._parse_date(
+                    self.text(elem))
+        elif name == 'media_text':
+            value = self.text(elem)
+            if self.inenclosure:
+                try:
+                    entry['enclosures'][-1]['text'] = value
+                except KeyError:
+                    # feedparser's strict parser crashes here
+                    raise UnsupportedFeed("media:text outside enclosure")
+            else:
+                entry['text'] = value
+        elif name == 'creativecommons_license':
+            entry['license'] = self.resolve_uri(self.text(elem))
+        elif name in _ENTRY_VALUES and not _is_special(name):
+            entry[name] = self.generic_value(elem, name)
+
+    def text(self, elem):
+        """Get the stripped text for an element."""
+        if len(elem):
+            raise UnsupportedFeed("%s has child elements" % elem.tag)
+        return _unicode((elem.text or '').strip())
+
+    def generic_value(self, elem, name):
+        """Get the value for an element without a feedparser handler."""
+        value = self.text(elem)
+        if value and name in _MIXIN.can_be_relative_uri:
+            value = self.resolve_uri(value)
+        return value
+
+    def content_value(self, elem, name, default_type):
+        """Get the value for an element that feedparser treats as content.
+
+        If the content is HTML, it gets run through the same URI resolving
+        and sanitizing that feedparser does.
+        """
+        attrs = self.attributes(elem)
+        if attrs.has_key('mode'):
+            raise UnsupportedFeed("content mode")
+        content_type = _map_content_type(attrs.get('type', default_type))
+        value = self.text(elem)
+        if content_type not in _MIXIN.html_types:
+            return value
+        if content_type != 'text/html':
+            raise UnsupportedFeed("content type %s" % content_type)
+        if '<' not in value and '&' not in value:
+            # no markup, so resolving URIs doesn't change anything and
+            # sanitizing just strips
+            if name in _MIXIN.can_contain_dangerous_markup:
+                value = value.strip().replace(u'\r\n', u'\n')
+            return value
+        cache_key = (name, self.baseuri, value)
+        try:
+            return _html_cache[cache_key]
+        except KeyError:
+            pass
+        if name in _MIXIN.can_contain_relative_uris:
+            value = feedparser._resolveRelativeURIs(value, self.baseuri,
+                                                    'utf-8')
+        if name in _MIXIN.can_contain_dangerous_markup:
+            value = feedparser.sanitizeHTML(value, 'utf-8')
+        value = _unicode(value)
+        if len(_html_cache) >= HTML_CACHE_SIZE:
+            _html_cache.clear()
+        _html_cache[cache_key] = value
+        return value
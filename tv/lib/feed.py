@@ -32,20 +32,22 @@
 FIXME - talk about Feed architecture here
 """
 
+import cPickle
+import hashlib
 import os
 import re
 import time
 import xml
-from urlparse import urljoin
+from urlparse import urljoin, urlparse
 from HTMLParser import HTMLParser, HTMLParseError
+from collections import deque
 from cStringIO import StringIO
 from datetime import datetime, timedelta
 import logging
 
 from miro.gtcache import gettext as _
 from miro.feedparser import FeedParserDict
-from miro.xhtmltools import (unescape, xhtmlify, fix_xml_header,
-                             fix_html_header)
+from miro.xhtmltools import fix_xml_header, fix_html_header
 
 from miro.database import DDBObject, ObjectNotFoundError
 from miro.httpclient import grab_url
@@ -58,13 +60,17 @@ from miro import download_utils
 from miro import eventloop
 from miro import feedupdate
 from miro import models
+from miro import net
 from miro import prefs
 from miro.plat import resources
 from miro import downloader
 from miro.util import (returns_unicode, returns_filename, unicodify, check_u,
                        check_f, quote_unicode_url, to_uni,
                        is_url, stringify, is_magnet_uri)
+from miro import dirscanner
 from miro import fileutil
+from miro import linkgrabber
+from miro.linkgrabber import RSSLinkGrabber
 from miro.plat.utils import filename_to_unicode, make_url_safe, unmake_url_safe
 from miro.plat.filebundle import is_file_bundle
 from miro import filetypes
@@ -108,6 +114,52 @@ class _RateLimiter(object):
         # get ready for the next check() call
         self.last_time = time.time()
 
+class _ItemRow(object):
+    """Column values for an existing item, as loaded by _ItemIndex.
+
+    It has the same attributes as the Item columns that FeedParserValues
+    looks at, so it can be passed to compare_to_item().
+    """
+    def __init__(self, columns, values):
+        self.__dict__.update(zip(columns, values))
+
+class _ItemIndex(object):
+    """Helper class used by create_items_for_parsed() to find the existing
+    item for a feed entry.
+
+    The index is built from one query that only fetches the columns that
+    FeedParserValues uses, so none of the feed's items have to be restored.
+    Items are looked up by guid, then by (url, title), then items without a
+    guid are looked up by enclosure url.
+    """
+    def __init__(self, feed_id):
+        columns = ('id',) + FeedParserValues.columns
+        self.by_id = {}
+        self.by_url_title = {}
+        self.nokey_by_url = {}
+        for values in models.Item.select(columns, 'feed_id=?', (feed_id,)):
+            row = _ItemRow(columns, values)
+            if row.rss_id is not None:
+                self.by_id[row.rss_id] = row
+            else:
+                self.nokey_by_url.setdefault(row.url, []).append(row)
+            by_url_title_key = (row.url, row.entry_title)
+            if by_url_title_key != (None, None):
+                self.by_url_title[by_url_title_key] = row
+
+    def match(self, fp_values):
+        """Get the rows for the items that fp_values is an entry for."""
+        rss_id = fp_values.data['rss_id']
+        if rss_id is not None and rss_id in self.by_id:
+            return [self.by_id[rss_id]]
+        by_url_title_key = (fp_values.data['url'],
+                fp_values.data['entry_title'])
+        if (by_url_title_key != (None, None) and
+                by_url_title_key in self.by_url_title):
+            return [self.by_url_title[by_url_title_key]]
+        return [row for row in self.nokey_by_url.get(fp_values.data['url'], ())
+                if fp_values.compare_to_item_enclosures(row)]
+
 # Notes on character set encoding of feeds:
 #
 # The parsing libraries built into Python mostly use byte strings
@@ -227,7 +279,7 @@ def _on_config_change(obj, key, value):
 def run_feedparser(html, callback, errback):
     if _RUN_FEED_PARSER_INLINE:
         try:
-            rv = feedparserutil.parse(html)
+            rv = feedparserutil.parse_feed_body(html)
         except StandardError, e:
             errback(e)
         else:
@@ -237,6 +289,40 @@ def run_feedparser(html, callback, errback):
                            lambda msg, result: callback(result),
                            lambda msg, error: errback(error))
 
+def run_link_scraper(html, baseurl, charset, callback, errback):
+    """Find the links in a page using linkgrabber.scrape_links().
+
+    Like run_feedparser(), this happens in the worker process.
+    """
+    if _RUN_FEED_PARSER_INLINE:
+        try:
+            rv = linkgrabber.scrape_links(html, baseurl, charset)
+        except StandardError, e:
+            errback(e)
+        else:
+            callback(rv)
+    else:
+        workerprocess.send(workerprocess.ScrapeLinksTask(html, baseurl,
+                                                         charset),
+                           lambda msg, result: callback(result),
+                           lambda msg, error: errback(error))
+
+# Parts of a feed that some servers change on every request, even if nothing
+# else in the feed changed.  calc_content_hash() ignores them.
+VOLATILE_CONTENT_RE = re.compile(
+    r'<lastBuildDate[^>]*>.*?</lastBuildDate>|<!--.*?-->', re.S | re.I)
+
+def calc_content_hash(html):
+    """Calculate a hash for a feed body.
+
+    The hash ignores elements that change on every request (see
+    VOLATILE_CONTENT_RE), so we can tell if a feed changed even if the server
+    doesn't support etags or last-modified.
+    """
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    return unicode(hashlib.sha1(VOLATILE_CONTENT_RE.sub('', html)).hexdigest())
+
 # Wait X seconds before updating the feeds at startup
 INITIAL_FEED_UPDATE_DELAY = 5.0
 
@@ -393,7 +479,14 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
     ICON_CACHE_VITAL = True
 
     def setup_new(self, url, initiallyAutoDownloadable=None,
-                 search_term=None, title=None):
+                 search_term=None, title=None, defer_generate=False):
+        """Create a new feed.
+
+        If defer_generate is True, we don't start downloading the feed as
+        soon as it's inserted.  Instead the first download waits its turn
+        in the feedupdate queue.  Use this when adding lots of feeds at
+        once.
+        """
         check_u(url)
         if initiallyAutoDownloadable == None:
             mode = app.config.get(prefs.CHANNEL_AUTO_DEFAULT)
@@ -435,6 +528,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         self.searchTerm = search_term
         self.userTitle = None
         self.visible = True
+        self._defer_generate = defer_generate
         self.setup_common()
 
     def setup_restored(self):
@@ -514,7 +608,10 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         return cls.make_view("orig_url LIKE 'dtv:directoryfeed:%'")
 
     def on_db_insert(self):
-        self.generate_feed(True)
+        if self._defer_generate:
+            feedupdate.queue_update(self, lambda: self.generate_feed(True))
+        else:
+            self.generate_feed(True)
 
     def in_folder(self):
         return self.folder_id is not None
@@ -550,9 +647,10 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
     def update_after_restore(self):
         if self.actualFeed.__class__ == FeedImpl:
             # Our initial FeedImpl was never updated, call
-            # generate_feed again
+            # generate_feed again.  Go through the update queue so that a
+            # bunch of these don't all start downloading at once.
             self.loading = True
-            eventloop.add_idle(lambda: self.generate_feed(True), "generate_feed")
+            feedupdate.queue_update(self, lambda: self.generate_feed(True))
         else:
             self.schedule_update_events(INITIAL_FEED_UPDATE_DELAY)
 
@@ -561,63 +659,54 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             return self.actualFeed.clean_old_items()
 
     def invalidate_counts(self):
-        for cached_count_attr in ('_num_available', '_num_unwatched',
-                '_num_downloaded', '_num_downloading'):
-            if cached_count_attr in self.__dict__:
-                del self.__dict__[cached_count_attr]
+        self.__dict__.pop('_counts', None)
 
     def recalc_counts(self):
-        self.invalidate_counts()
-        self.signal_change(needs_save=False)
-        if self.in_folder():
-            self.get_folder().signal_change(needs_save=False)
+        """Recount our items after they change.
 
-    def num_downloaded(self):
-        """Returns the number of downloaded items in the feed.
+        The counting happens later in an idle callback, together with the
+        other feeds that changed.  See _CountUpdater.
         """
+        _count_updater.add(self.id)
+
+    def _get_counts(self):
+        if self.id in _count_updater.dirty:
+            # our items changed, but _count_updater hasn't run yet.  Get the
+            # new counts without changing the counts that we've signaled.
+            return _count_updater.get_dirty_counts(self.id)
         try:
-            return self._num_downloaded
+            return self._counts
         except AttributeError:
-            self._num_downloaded = self.downloaded_items.count()
-            return self._num_downloaded
+            self._counts = models.Item.feed_counts([self.id]).get(self.id,
+                                                                 _NO_COUNTS)
+            return self._counts
+
+    def num_downloaded(self):
+        """Returns the number of downloaded items in the feed.
+        """
+        return self._get_counts()[0]
 
     def num_downloading(self):
         """Returns the number of downloading items in the feed.
         """
-        try:
-            return self._num_downloading
-        except AttributeError:
-            self._num_downloading = self.downloading_items.count()
-            return self._num_downloading
+        return self._get_counts()[1]
 
     def num_unwatched(self):
         """Returns string with number of unwatched videos in feed
         """
-        try:
-            return self._num_unwatched
-        except AttributeError:
-            self._num_unwatched = self.unwatched_items.count()
-            return self._num_unwatched
+        return self._get_counts()[2]
 
     def num_available(self):
         """Returns string with number of available videos in feed
         """
-        try:
-            return self._num_available
-        except AttributeError:
-            self._num_available = (self.available_items.count() -
-                    self.auto_pending_items.count())
-            return self._num_available
+        return self._get_counts()[3]
 
     def mark_as_viewed(self):
         """Sets the last time the feed was viewed to now
         """
-        try:
-            del self._num_available
-        except AttributeError:
-            pass
         for item in list(self.available_items):
             item.unset_new()
+        self.recalc_counts()
         if self.in_folder():
             self.get_folder().signal_change()
         self.signal_change()
@@ -644,26 +733,25 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if next is not None:
             next.download(autodl = True)
 
+    def _expiring_view(self):
+        watched_before = _expire_cutoff(self.orig_url, self.expire,
+                                        self.expire_timedelta, datetime.now())
+        if watched_before is None:
+            return None
+        return models.Item.feed_expiring_view(self.id, watched_before)
+
     def expiring_items(self):
-        # items in watched folders never expire
-        if self.is_watched_folder():
-            return []
-        if self.expire == u'never':
+        view = self._expiring_view()
+        if view is None:
             return []
-        elif self.expire == u'system':
-            expire_after_x_days = app.config.get(prefs.EXPIRE_AFTER_X_DAYS)
-            if expire_after_x_days == -1:
-                return []
-            delta = timedelta(days=expire_after_x_days)
-        else:
-            delta = self.expire_timedelta
-        return models.Item.feed_expiring_view(self.id, datetime.now() - delta)
+        return view
 
     def expire_items(self):
         """Expires items from the feed that are ready to expire.
         """
-        for item in self.expiring_items():
-            item.expire()
+        view = self._expiring_view()
+        if view is not None:
+            models.Item.bulk_expire(list(view.id_list()))
 
     def signal_items(self):
         for item in self.items:
@@ -872,6 +960,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
                           self.orig_url)
         if newFeed:
             self.finish_generate_feed(newFeed)
+            self.emit('update-finished')
 
     def is_watched_folder(self):
         return self.orig_url.startswith("dtv:directoryfeed:")
@@ -909,6 +998,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
     def _generate_feed_errback(self, error, removeOnError):
         if not self.id_exists():
             return
+        self.emit('update-finished')
         logging.warning("Couldn't load podcast at %s (%s)",
                         self.orig_url, error)
         self._handle_feed_loading_error(error.getFriendlyDescription())
@@ -931,6 +1021,10 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             if f is not None: # already have this feed, so delete us
                 self.remove()
                 return
+        # We're done downloading.  Let the feedupdate queue know in case it
+        # started us, since ask_for_scrape() can wait a long time for the
+        # user.
+        self.emit('update-finished')
         self.download = None
         modified = unicodify(info.get('last-modified'))
         etag = unicodify(info.get('etag'))
@@ -1139,6 +1233,8 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if isinstance(self.actualFeed, DirectoryWatchFeedImpl):
             move_items_to = None
         self.cancel_update_events()
+        # we may still be waiting to generate the feed
+        feedupdate.forget_feed(self)
         if self.download is not None:
             self.download.cancel()
             self.download = None
@@ -1200,8 +1296,21 @@ class ThrottledUpdateFeedImpl(FeedImpl):
                     self.update)
         else:
             if self.updateFreq > 0:
-                feedupdate.schedule_update(self.updateFreq, self.ufeed,
-                        self.update)
+                # only back off from the default frequency.  Frequencies
+                # from the feed itself (ttl) or from our subclasses were
+                # picked for this feed.
+                default_freq = (app.config.get(
+                    prefs.CHECK_CHANNELS_EVERY_X_MN) * 60)
+                feedupdate.schedule_periodic_update(self.updateFreq,
+                        self.ufeed, self.update,
+                        backoff=(self.updateFreq == default_freq))
+
+    def cancel_update_events(self):
+        feedupdate.cancel_update(self.ufeed)
+
+    def remove(self):
+        feedupdate.forget_feed(self.ufeed)
+        FeedImpl.remove(self)
 
 class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     """
@@ -1225,12 +1334,21 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                     channel_title=channel_title)
             if not item.matches_search(self.ufeed.searchTerm):
                 item.remove()
+        self.found_new_items = True
 
     def remember_old_items(self):
-        self.old_items = set(self.items)
+        self.old_items = set(self.items.id_list())
+        self.found_new_items = False
 
     def create_items_for_parsed(self, parsed):
-        """Update the feed using parsed XML passed in"""
+        """Update the feed using parsed XML passed in
+
+        If the bulk_sql_manager is already active, our changes get saved
+        when whoever started it calls finish().
+        """
+        if app.bulk_sql_manager.active:
+            self._create_items_for_parsed(parsed)
+            return
         app.bulk_sql_manager.start()
         try:
             self._create_items_for_parsed(parsed)
@@ -1267,55 +1385,40 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                 self.thumbURL = image_url
                 self.ufeed.icon_cache.request_update(is_vital=True)
 
-        items_byid = {}
-        items_byURLTitle = {}
-        items_nokey = []
-        for item in self.items:
-            rate_limiter.check_for_sleep()
-            try:
-                items_byid[item.get_rss_id()] = item
-            except KeyError:
-                items_nokey.append(item)
-            by_url_title_key = (item.url, item.entry_title)
-            if by_url_title_key != (None, None):
-                items_byURLTitle[by_url_title_key] = item
+        item_index = _ItemIndex(self.ufeed.id)
+        updates = []
         for entry in parsed.entries:
             rate_limiter.check_for_sleep()
             entry = self.add_scraped_thumbnail(entry)
             fp_values = FeedParserValues(entry)
-            new = True
-            if fp_values.data['rss_id'] is not None:
-                id_ = fp_values.data['rss_id']
-                if items_byid.has_key(id_):
-                    item = items_byid[id_]
-                    if not fp_values.compare_to_item(item):
-                        item.update_from_feed_parser_values(fp_values)
-                    new = False
-                    self.old_items.discard(item)
-            if new:
-                by_url_title_key = (fp_values.data['url'],
-                        fp_values.data['entry_title'])
-                if by_url_title_key != (None, None):
-                    if items_byURLTitle.has_key(by_url_title_key):
-                        item = items_byURLTitle[by_url_title_key]
-                        if not fp_values.compare_to_item(item):
-                            item.update_from_feed_parser_values(fp_values)
-                        new = False
-                        self.old_items.discard(item)
-            if new:
-                for item in items_nokey:
-                    if fp_values.compare_to_item(item):
-                        new = False
-                    else:
-                        try:
-                            if fp_values.compare_to_item_enclosures(item):
-                                item.update_from_feed_parser_values(fp_values)
-                                new = False
-                                self.old_items.discard(item)
-                        except StandardError:
-                            pass
-            if new and fp_values.first_video_enclosure is not None:
+            matches = item_index.match(fp_values)
+            for row in matches:
+                if not fp_values.compare_to_item(row):
+                    row.__dict__.update(fp_values.data)
+                    updates.append((row.id, fp_values))
+                self.old_items.discard(row.id)
+            if not matches and fp_values.first_video_enclosure is not None:
                 self._handle_new_entry(entry, fp_values, channel_title)
+        self._update_items(updates)
+
+    def _update_items(self, updates):
+        """Update existing items with new values from the feed.
+
+        :param updates: list of (item id, FeedParserValues) tuples
+        """
+        if not updates:
+            return
+        app.db.ensure_objects_loaded(models.Item,
+                [id_ for id_, fp_values in updates], app.db_info)
+        for id_, fp_values in updates:
+            try:
+                item = models.Item.get_by_id(id_)
+            except ObjectNotFoundError:
+                continue
+            # save all the changes with one UPDATE when the bulk_sql_manager
+            # finishes
+            app.bulk_sql_manager.add_update(item)
+            item.update_from_feed_parser_values(fp_values)
 
     def _allow_feed_to_override_title(self):
         """Should the RSS feed override the default title?
@@ -1350,6 +1453,7 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
         if hasattr(self, "old_items"):
             self.truncate_old_items()
             del self.old_items
+            feedupdate.update_result(self.ufeed, self.found_new_items)
         self.signal_change()
 
     def truncate_old_items(self):
@@ -1373,8 +1477,15 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
         if extra <= 0:
             return
 
+        # only the items that are no longer in the feed need to be restored
+        old_ids = list(self.old_items)
+        app.db.ensure_objects_loaded(models.Item, old_ids, app.db_info)
         candidates = []
-        for item in self.old_items:
+        for id_ in old_ids:
+            try:
+                item = models.Item.get_by_id(id_)
+            except ObjectNotFoundError:
+                continue
             if item.downloader is None:
                 candidates.append((item.creation_time, item))
         candidates.sort()
@@ -1398,24 +1509,28 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.initialHTML = initialHTML
         self.etag = etag
         self.modified = modified
+        self.content_hash = None
+        self.pending_content_hash = None
+        # parts of the last parse that we need when we skip parsing an
+        # unchanged feed body
+        self.parsed_link = None
+        self.parsed_license = None
         self.download = None
 
     @returns_unicode
     def get_base_href(self):
-        try:
-            return self.parsed.link
-        except AttributeError:
-            return FeedImpl.get_base_href(self)
+        if self.parsed_link is not None:
+            return self.parsed_link
+        return FeedImpl.get_base_href(self)
 
     @returns_unicode
     def get_link(self):
         """Returns a link to a webpage associated with the feed
         """
         self.ufeed.confirm_db_thread()
-        try:
-            return self.parsed.link
-        except AttributeError:
-            return u""
+        if self.parsed_link is not None:
+            return self.parsed_link
+        return u""
 
     def feedparser_finished(self):
         self.updating = False
@@ -1436,28 +1551,53 @@ class RSSFeedImpl(RSSFeedImplBase):
             logging.warn("Empty feed, not updating: %s", self.url)
             self.feedparser_finished()
             return
+        # merge the results along with other feeds that finished parsing
+        # around the same time.
+        feedupdate.add_parsed(self.ufeed,
+                lambda: self._reconcile_parsed(parsed),
+                self.feedparser_finished)
+
+    def _reconcile_parsed(self, parsed):
         start = clock()
         self.parsed = parsed
+        self.content_hash = self.pending_content_hash
+        self.parsed_link = parsed.get('link')
+        self.parsed_license = parsed["feed"].get("license")
         self.remember_old_items()
         self.create_items_for_parsed(parsed)
 
         try:
-            updateFreq = self.parsed["feed"]["ttl"]
+            updateFreq = parsed["feed"]["ttl"]
         except KeyError:
             updateFreq = 0
         self.set_update_frequency(updateFreq)
+        # save content_hash and the parsed values
+        self.signal_change()
 
-        self.feedparser_finished()
         end = clock()
         if end - start > 1.0:
             logging.timing("feed update for: %s too slow (%.3f secs)",
                            self.url, end - start)
 
-    def call_feedparser(self, html):
+    def call_feedparser(self, html, content_hash=None):
         self.ufeed.confirm_db_thread()
+        if content_hash is None:
+            content_hash = calc_content_hash(html)
+        # don't set content_hash until the parse succeeds
+        self.pending_content_hash = content_hash
+        feedupdate.fetch_finished(self.ufeed)
         run_feedparser(html, self.feedparser_callback,
                 self.feedparser_errback)
 
+    def _content_unchanged(self, content_hash):
+        """Check if a feed body is the same as the last one we parsed.
+
+        content_hash, parsed_link and parsed_license are saved together
+        after each parse, so this works across restarts.
+        """
+        return (self.content_hash is not None and
+                content_hash == self.content_hash)
+
     def update(self):
         """Updates a feed
         """
@@ -1502,6 +1642,7 @@ class RSSFeedImpl(RSSFeedImplBase):
         if info.get('status') == 304:
             logging.debug("RSSFeedImpl: _update_callback: "
                           "status 304 (%s)", self.ufeed)
+            feedupdate.update_result(self.ufeed, False)
             self.schedule_update_events(-1)
             self.updating = False
             self.ufeed.signal_change()
@@ -1520,16 +1661,25 @@ class RSSFeedImpl(RSSFeedImplBase):
             self.modified = unicodify(info['last-modified'])
         else:
             self.modified = None
-        self.call_feedparser(html)
+        content_hash = calc_content_hash(html)
+        if self._content_unchanged(content_hash):
+            logging.debug("RSSFeedImpl: _update_callback: "
+                          "content unchanged (%s)", self.ufeed)
+            feedupdate.record_content_check(True, len(html))
+            feedupdate.update_result(self.ufeed, False)
+            self.schedule_update_events(-1)
+            self.updating = False
+            self.ufeed.signal_change()
+            return
+        feedupdate.record_content_check(False, len(html))
+        self.call_feedparser(html, content_hash)
 
     @returns_unicode
     def get_license(self):
         """Returns the URL of the license associated with the feed
         """
-        try:
-            return self.parsed["feed"]["license"]
-        except (AttributeError, KeyError):
-            pass
+        if self.parsed_license is not None:
+            return self.parsed_license
         return u""
 
     def on_remove(self):
@@ -1541,14 +1691,25 @@ class RSSFeedImpl(RSSFeedImplBase):
         """Called by pickle during deserialization
         """
         FeedImpl.setup_restored(self)
+        self.pending_content_hash = None
         self.download = None
 
     def clean_old_items(self):
         self.modified = None
         self.etag = None
+        self.content_hash = None
         self.update()
 
 class RSSMultiFeedBase(RSSFeedImplBase):
+    """Base class for feeds made up of several RSS feeds.
+
+    We download all of the feeds at once and add the items for each one as
+    soon as it's parsed, so the results from fast servers show up before
+    the slow ones respond.  Downloads that take longer than
+    DOWNLOAD_TIMEOUT seconds are canceled.
+    """
+    DOWNLOAD_TIMEOUT = 30
+
     def setup_new(self, url, ufeed, title):
         RSSFeedImplBase.setup_new(self, url, ufeed, title)
         self.etag = {}
@@ -1556,6 +1717,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         self.download_dc = {}
         self.updating = 0
         self._urls = None
+        self._download_timeouts = {}
+        self._download_start = {}
 
     def setup_restored(self):
         """Called by pickle during deserialization
@@ -1564,6 +1727,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         self.download_dc = {}
         self.updating = 0
         self._urls = None
+        self._download_timeouts = {}
+        self._download_start = {}
 
     @property
     def urls(self):
@@ -1632,18 +1797,43 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         for url in self.urls:
             etag = self.etag.get(url)
             modified = self.modified.get(url)
+            self._download_start[url] = clock()
             self.download_dc[url] = grab_url(
                 url,
                 lambda x, url=url: self._update_callback(x, url),
                 lambda x, url=url: self._update_errback(x, url),
                 etag=etag, modified=modified,
                 default_mime_type=u'application/rss+xml',)
+            self._download_timeouts[url] = eventloop.add_timeout(
+                self.DOWNLOAD_TIMEOUT, self._download_timed_out,
+                "RSSMultiFeedBase download timeout", args=(url,))
             self.updating += 1
         self.ufeed.signal_change(needs_save=False)
 
+    def _download_finished(self, url):
+        """Log how long the download for url took, and stop its timeout."""
+        timeout = self._download_timeouts.pop(url, None)
+        if timeout is not None:
+            timeout.cancel()
+        start = self._download_start.pop(url, None)
+        if start is not None:
+            logging.timing("%s: %s responded in %.3f secs", self.url, url,
+                           clock() - start)
+
+    def _download_timed_out(self, url):
+        self._download_timeouts.pop(url, None)
+        if not self.ufeed.id_exists() or url not in self._download_start:
+            return
+        if url in self.download_dc:
+            self.download_dc[url].cancel()
+        self._update_errback(net.ConnectionTimeout(urlparse(url)[1]), url)
+
     def _update_errback(self, error, url):
-        if not self.ufeed.id_exists():
+        # if url isn't in _download_start, we already timed out or canceled
+        # the download
+        if not self.ufeed.id_exists() or url not in self._download_start:
             return
+        self._download_finished(url)
         logging.warn("WARNING: error in Feed.update for %s (%s) -- %s",
                      self.ufeed, stringify(url), stringify(error))
         self.schedule_update_events(-1)
@@ -1652,8 +1842,9 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         self.ufeed.signal_change(needs_save=False)
 
     def _update_callback(self, info, url):
-        if not self.ufeed.id_exists():
+        if not self.ufeed.id_exists() or url not in self._download_start:
             return
+        self._download_finished(url)
         if info.get('status') == 304:
             logging.debug("RSSMultiFeedBase: _update_callback: "
                           "status 304 (%s)", self.ufeed)
@@ -1687,7 +1878,11 @@ class RSSMultiFeedBase(RSSFeedImplBase):
     def _cancel_all_downloads(self):
         for dc in self.download_dc.values():
             dc.cancel()
+        for timeout in self._download_timeouts.values():
+            timeout.cancel()
         self.download_dc = {}
+        self._download_timeouts = {}
+        self._download_start = {}
         self.updating = 0
 
     def clean_old_items(self):
@@ -1725,6 +1920,178 @@ class SavedSearchFeedImpl(RSSMultiFeedBase):
     def calc_urls(self):
         return searchengines.get_request_urls(self.engine, self.query)
 
+class ScraperPageCache(object):
+    """Stores the pages that a ScraperFeedImpl downloaded on disk.
+
+    When a page hasn't changed, the server answers our conditional request
+    with a 304 and no body.  We use the copy stored here to keep following
+    the links on the page.
+    """
+    def __init__(self, feed_id):
+        self.directory = os.path.join(
+            app.config.get(prefs.SUPPORT_DIRECTORY), 'scraper-cache',
+            str(feed_id))
+
+    def _path(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+
+    def load(self, url):
+        """Get a page that we stored with save().
+
+        :returns: dict with the "body", "redirected-url" and "charset" of
+            the page, or None if we don't have it.
+        """
+        try:
+            f = fileutil.open_file(self._path(url), 'rb')
+            try:
+                return cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            return None
+
+    def save(self, url, info):
+        page = {
+            'body': info['body'],
+            'redirected-url': info['redirected-url'],
+            'charset': info.get('charset'),
+        }
+        try:
+            if not fileutil.exists(self.directory):
+                fileutil.makedirs(self.directory)
+            f = fileutil.open_file(self._path(url), 'wb')
+            try:
+                cPickle.dump(page, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            logging.warning("error saving scraped page %s: %s", url, e)
+
+    def clear(self):
+        if fileutil.exists(self.directory):
+            fileutil.delete(self.directory)
+
+class ScrapeRun(object):
+    """Downloads and scrapes the pages for one ScraperFeedImpl update.
+
+    Up to MAX_DOWNLOADS pages download at once.  Each page gets downloaded
+    at most once per run, no matter how many pages link to it.  Pages are
+    scraped for links in the worker process (see run_link_scraper()).
+
+    Once there's nothing left to download or scrape, we call
+    ScraperFeedImpl.check_done().
+    """
+    MAX_DOWNLOADS = 8
+
+    def __init__(self, feed_impl):
+        self.feed_impl = feed_impl
+        self.ufeed = feed_impl.ufeed
+        # list of (url, depth, link_number, top) tuples to download
+        self.queue = deque()
+        # urls that we've queued during this run
+        self.seen = set()
+        self.downloads = set()
+        self.scrapes_pending = 0
+        self.canceled = False
+        self.page_cache = ScraperPageCache(self.ufeed.id)
+        # urls of the items in our feed
+        self.item_urls = set(row[0] for row in models.Item.select(['url'],
+            'feed_id=?', (self.ufeed.id,)))
+
+    def add_page(self, url, depth, link_number, top=False):
+        if url in self.seen:
+            return
+        self.seen.add(url)
+        self.queue.append((url, depth, link_number, top))
+        self.start_downloads()
+
+    def start_downloads(self):
+        while self.queue and len(self.downloads) < self.MAX_DOWNLOADS:
+            self.download_page(*self.queue.popleft())
+
+    def download_page(self, url, depth, link_number, top):
+        etag = modified = None
+        if self.feed_impl.linkHistory.has_key(url):
+            etag = self.feed_impl.linkHistory[url].get('etag', None)
+            modified = self.feed_impl.linkHistory[url].get('modified', None)
+        def callback(info):
+            self.downloads.discard(download)
+            if self.is_stopped():
+                return
+            try:
+                self.on_page_downloaded(url, info, depth, link_number, top)
+            finally:
+                self.check_done()
+        def errback(error):
+            self.downloads.discard(download)
+            if self.is_stopped():
+                return
+            logging.warning("unhandled error for ScraperFeedImpl: %s", error)
+            self.check_done()
+        download = grab_url(url, callback, errback, etag=etag,
+                modified=modified, default_mime_type='text/html')
+        self.downloads.add(download)
+
+    def on_page_downloaded(self, url, info, depth, link_number, top):
+        self.feed_impl.save_page_history(info)
+        if info['status'] == 304:
+            page = self.page_cache.load(url)
+        elif info.has_key('body'):
+            page = info
+            self.page_cache.save(url, info)
+        else:
+            page = None
+        if page is not None:
+            self.scrape_page(page['body'], page['redirected-url'],
+                             page.get('charset'), depth, link_number, top)
+
+    def scrape_page(self, html, baseurl, charset, depth, link_number,
+                    top=False):
+        def callback(result):
+            self.scrapes_pending -= 1
+            if self.is_stopped():
+                return
+            try:
+                self.on_page_scraped(result, depth, link_number, top)
+            finally:
+                self.check_done()
+        def errback(error):
+            self.scrapes_pending -= 1
+            if self.is_stopped():
+                return
+            logging.warning("error scraping %s: %s", baseurl, error)
+            self.check_done()
+        self.scrapes_pending += 1
+        run_link_scraper(html, baseurl, charset, callback, errback)
+
+    def on_page_scraped(self, result, depth, link_number, top):
+        title, urls, link_dict = result
+        if top and title is not None:
+            self.feed_impl.title = title
+            self.ufeed.signal_change()
+        if top:
+            self.feed_impl.process_links((urls, link_dict), 0, link_number)
+        else:
+            self.feed_impl.process_links((urls, link_dict), depth + 1,
+                                         link_number)
+
+    def is_stopped(self):
+        return self.canceled or not self.ufeed.id_exists()
+
+    def check_done(self):
+        self.start_downloads()
+        if not (self.downloads or self.queue or self.scrapes_pending):
+            self.feed_impl.check_done()
+
+    def cancel(self):
+        self.canceled = True
+        for download in self.downloads:
+            download.cancel()
+        self.downloads = set()
+        self.queue.clear()
+
 class ScraperFeedImpl(ThrottledUpdateFeedImpl):
     """A feed based on un unformatted HTML or pre-enclosure RSS
     """
@@ -1740,7 +2107,7 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
             self.linkHistory[url]['etag'] = unicodify(etag)
         if not modified is None:
             self.linkHistory[url]['modified'] = unicodify(modified)
-        self.downloads = set()
+        self.scrape_run = None
 
         self.set_update_frequency(360)
         self.schedule_update_events(0)
@@ -1755,41 +2122,11 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
             self.linkHistory[url] = self.tempHistory[url]
         self.tempHistory = {}
 
-    def get_html(self, urlList, depth=0, link_number=0, top=False):
-        """Grabs HTML at the given URL, then processes it
+    def save_page_history(self, info):
+        """Remember the etag and last-modified headers for a page in
+        tempHistory.
         """
-        url = urlList.pop(0)
-        #print "Grabbing %s" % url
-        etag = None
-        modified = None
-        if self.linkHistory.has_key(url):
-            etag = self.linkHistory[url].get('etag', None)
-            modified = self.linkHistory[url].get('modified', None)
-        def callback(info):
-            if not self.ufeed.id_exists():
-                return
-            self.downloads.discard(download)
-            try:
-                self.process_downloaded_html(info, urlList, depth, link_number,
-                                           top)
-            finally:
-                self.check_done()
-        def errback(error):
-            if not self.ufeed.id_exists():
-                return
-            self.downloads.discard(download)
-            logging.warning("unhandled error for ScraperFeedImpl.get_html: %s",
-                            error)
-            self.check_done()
-        download = grab_url(url, callback, errback, etag=etag,
-                modified=modified, default_mime_type='text/html')
-        self.downloads.add(download)
-
-    def process_downloaded_html(self, info, urlList, depth, link_number,
-                              top=False):
         self.ufeed.confirm_db_thread()
-        #print "Done grabbing %s" % info['updated-url']
-
         if not self.tempHistory.has_key(info['updated-url']):
             self.tempHistory[info['updated-url']] = {}
         if info.has_key('etag'):
@@ -1797,20 +2134,9 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
         if info.has_key('last-modified'):
             self.tempHistory[info['updated-url']]['modified'] = unicodify(info['last-modified'])
 
-        if info['status'] != 304 and info.has_key('body'):
-            if info.has_key('charset'):
-                subLinks = self.scrape_links(info['body'], info['redirected-url'], charset=info['charset'], setTitle=top)
-            else:
-                subLinks = self.scrape_links(info['body'], info['redirected-url'], setTitle=top)
-            if top:
-                self.process_links(subLinks, 0, link_number)
-            else:
-                self.process_links(subLinks, depth+1, link_number)
-        if len(urlList) > 0:
-            self.get_html(urlList, depth, link_number)
-
     def check_done(self):
-        if len(self.downloads) == 0:
+        if self.scrape_run is not None:
+            self.scrape_run = None
             self.save_cache_history()
             self.updating = False
             self.ufeed.signal_change()
@@ -1822,9 +2148,9 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
             title = dict_['title']
         else:
             title = link
-        for item in self.items:
-            if item.get_url() == link:
-                return
+        if link in self.scrape_run.item_urls:
+            return
+        self.scrape_run.item_urls.add(link)
         # Anywhere we call this, we need to convert the input back to unicode
         title = feedparserutil.sanitizeHTML(title, "utf-8").decode('utf-8')
         if dict_.has_key('thumbnail') > 0:
@@ -1850,8 +2176,6 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
         maxDepth = 2
         urls = links[0]
         links = links[1]
-        # List of URLs that should be downloaded
-        newURLs = []
 
         if depth < maxDepth:
             for link in urls:
@@ -1880,7 +2204,7 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
                      mimetype.startswith('application/atom+xml') or
                      mimetype.startswith('application/rdf+xml')) and
                     depth < maxDepth -1):
-                    newURLs.append(link)
+                    self.scrape_run.add_page(link, depth, link_number)
 
                 #This is a video
                 elif (mimetype.startswith('video/') or
@@ -1889,13 +2213,12 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
                       mimetype == "application/x-annodex" or
                       mimetype == "application/x-bittorrent"):
                     self.add_video_item(link, links[link], link_number)
-            if len(newURLs) > 0:
-                self.get_html(newURLs, depth, link_number)
 
     def on_remove(self):
-        for download in self.downloads:
-            download.cancel()
-        self.downloads = set()
+        if self.scrape_run is not None:
+            self.scrape_run.cancel()
+            self.scrape_run = None
+        ScraperPageCache(self.ufeed.id).clear()
 
     def update(self):
         # FIXME: go through and add error handling
@@ -1908,99 +2231,29 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
             self.updating = True
             self.ufeed.signal_change(needs_save=False)
 
+        self.scrape_run = ScrapeRun(self)
         if not self.initialHTML is None:
             html = self.initialHTML
             self.initialHTML = None
             redir_url = self.url
             charset = self.initialCharset
             self.initialCharset = None
-            subLinks = self.scrape_links(html, redir_url, charset=charset,
-                                        setTitle=True)
-            self.process_links(subLinks, 0, 0)
-            self.check_done()
+            self.scrape_run.seen.add(self.url)
+            self.scrape_run.page_cache.save(self.url, {
+                'body': html,
+                'redirected-url': redir_url,
+                'charset': charset,
+            })
+            self.scrape_run.scrape_page(html, redir_url, charset, 0, 0,
+                                        top=True)
         else:
-            self.get_html([self.url], top=True)
-
-    def scrape_links(self, html, baseurl, setTitle=False, charset=None):
-        try:
-            if not charset is None:
-                html = fix_html_header(html, charset)
-            xmldata = html
-            parser = xml.sax.make_parser()
-            parser.setFeature(xml.sax.handler.feature_namespaces, 1)
-            try:
-                parser.setFeature(xml.sax.handler.feature_external_ges, 0)
-            except StandardError:
-                pass
-            if charset is not None:
-                handler = RSSLinkGrabber(baseurl, charset)
-            else:
-                handler = RSSLinkGrabber(baseurl)
-            parser.setContentHandler(handler)
-            try:
-                parser.parse(StringIO(xmldata))
-            except IOError:
-                pass
-            except AttributeError:
-                # bug in the python standard library causes this to be raised
-                # sometimes.  See #3201.
-                pass
-            links = handler.links
-            linkDict = {}
-            for link in links:
-                if ((link[0].startswith('http://')
-                     or link[0].startswith('https://'))):
-                    if not linkDict.has_key(to_uni(link[0], charset)):
-                        linkDict[to_uni(link[0], charset)] = {}
-                    if not link[1] is None:
-                        linkDict[to_uni(link[0], charset)]['title'] = to_uni(link[1], charset).strip()
-                    if not link[2] is None:
-                        linkDict[to_uni(link[0], charset)]['thumbnail'] = to_uni(link[2], charset)
-            if setTitle and not handler.title is None:
-                self.ufeed.confirm_db_thread()
-                try:
-                    self.title = to_uni(handler.title, charset)
-                finally:
-                    self.ufeed.signal_change()
-            return ([x[0] for x in links if x[0].startswith('http://') or x[0].startswith('https://')], linkDict)
-        except (xml.sax.SAXException, ValueError, IOError,
-                xml.sax.SAXNotRecognizedException):
-            (links, linkDict) = self.scrape_html_links(html, baseurl,
-                                                     setTitle=setTitle,
-                                                     charset=charset)
-            return (links, linkDict)
-
-    def scrape_html_links(self, html, baseurl, setTitle=False, charset=None):
-        """Given a string containing an HTML file, return a dictionary of
-        links to titles and thumbnails
-        """
-        lg = HTMLLinkGrabber()
-        links = lg.get_links(html, baseurl)
-        if setTitle and not lg.title is None:
-            self.ufeed.confirm_db_thread()
-            try:
-                self.title = to_uni(lg.title, charset)
-            finally:
-                self.ufeed.signal_change()
-
-        linkDict = {}
-        for link in links:
-            if link[0].startswith('http://') or link[0].startswith('https://'):
-                if not linkDict.has_key(to_uni(link[0], charset)):
-                    linkDict[to_uni(link[0], charset)] = {}
-                if not link[1] is None:
-                    linkDict[to_uni(link[0], charset)]['title'] = to_uni(link[1], charset).strip()
-                if not link[2] is None:
-                    linkDict[to_uni(link[0], charset)]['thumbnail'] = to_uni(link[2], charset)
-        return ([x[0] for x in links
-                 if x[0].startswith('http://') or x[0].startswith('https://')],
-                linkDict)
+            self.scrape_run.add_page(self.url, 0, 0, top=True)
 
     def setup_restored(self):
         """Called by pickle during deserialization
         """
         FeedImpl.setup_restored(self)
-        self.downloads = set()
+        self.scrape_run = None
         self.tempHistory = {}
 
 class DirectoryScannerImplBase(FeedImpl):
@@ -2013,10 +2266,12 @@ class DirectoryScannerImplBase(FeedImpl):
     def setup_new(self, *args, **kwargs):
         FeedImpl.setup_new(self, *args, **kwargs)
         self.pending_paths_to_add = []
+        self._directory_scanner = None
 
     def setup_restored(self):
         FeedImpl.setup_restored(self)
         self.pending_paths_to_add = []
+        self._directory_scanner = None
 
     def expire_items(self):
         """Directory Items shouldn't automatically expire
@@ -2191,6 +2446,22 @@ class DirectoryScannerImplBase(FeedImpl):
         if should_halt_early():
             return
 
+        # scan the filesystem for changes
+        scan_dir = self._scan_dir()
+        if fileutil.isdir(scan_dir) and not is_file_bundle(scan_dir):
+            scanner = self._get_directory_scanner(scan_dir)
+            start = time.time()
+            for dummy in scanner.scan():
+                if time.time() - start > 0.4:
+                    yield
+                    if should_halt_early():
+                        return
+                    start = time.time()
+            logging.debug("%s: scanned %s: %s", self, scan_dir,
+                          scanner.last_result)
+        else:
+            scanner = None
+
         # Remove items with deleted files or that that are in feeds
         to_remove = []
         duplicate_paths = []
@@ -2200,7 +2471,7 @@ class DirectoryScannerImplBase(FeedImpl):
                 continue
             filename = item.get_filename()
             if (filename is None or
-                not fileutil.isfile(filename) or
+                not self._file_exists(filename, scanner) or
                 known_files.contains_path(filename)):
                 to_remove.append(item)
             if filename not in my_files:
@@ -2233,20 +2504,13 @@ class DirectoryScannerImplBase(FeedImpl):
 
         # adds any files we don't know about
         # files on the filesystem
-        scan_dir = self._scan_dir()
-        if fileutil.isdir(scan_dir) and not is_file_bundle(scan_dir):
-            all_files = []
-            start = time.time()
-            for f in fileutil.miro_allfiles(scan_dir):
-                all_files.append(f)
-                if time.time() - start > 0.4:
-                    yield
-                    if should_halt_early():
-                        return
-                    start = time.time()
+        if scanner is not None:
             start = time.time()
             to_add = []
-            for path in self._filter_paths(all_files, known_files):
+            # Check all files in the index, not only the newly added ones.
+            # Files that belonged to other feeds may have become ours.
+            candidates = scanner.all_files() - my_files
+            for path in self._filter_paths(candidates, known_files):
                 to_add.append(path)
                 if time.time() - start > 0.4:
                     yield
@@ -2270,11 +2534,42 @@ class DirectoryScannerImplBase(FeedImpl):
                     yield # yield after each batch
                     if should_halt_early():
                         return
+            # Only save the index once we've made items for the new files.
+            # If we quit before this, the next scan will find them again.
+            scanner.save()
         self._after_update()
         self.updating = False
         self.pending_paths_to_add = []
         self.schedule_update_events(-1)
 
+    def _get_directory_scanner(self, scan_dir):
+        """Get a DirectoryScanner for our scan directory.
+
+        We keep the scanner around between updates, so that we only need to
+        load the index from the DB once.
+        """
+        scanner = self._directory_scanner
+        if scanner is None or scanner.root != scan_dir:
+            scanner = dirscanner.DirectoryScanner(self.id, scan_dir)
+            self._directory_scanner = scanner
+        return scanner
+
+    def _file_exists(self, filename, scanner):
+        """Check if a file for one of our items still exists.
+
+        If the file is in the scanner's index, then it exists and we can skip
+        calling isfile().
+        """
+        if scanner is not None:
+            if scanner.has_file(filename):
+                return True
+            elif filename in scanner.last_result.removed:
+                return False
+        return fileutil.isfile(filename)
+
+    def on_remove(self):
+        dirscanner.DirectoryScanner.remove_index(self.id)
+
     def _add_batch_of_videos(self, path_iter, max_time):
         """Make a bunch of filenames, but don't take too long.
 
@@ -2398,7 +2693,12 @@ class DirectoryFeedImpl(DirectoryScannerImplBase):
 
 class SearchFeedImpl(RSSMultiFeedBase):
     """Search and Search Results feeds
+
+    When searching all engines, the same video often comes back from more
+    than one of them.  We only add the first result for each enclosure URL.
     """
+    DOWNLOAD_TIMEOUT = 15
+
     def setup_new(self, ufeed):
         self.engine = searchengines.get_search_engines()[0].name
         self.query = u''
@@ -2406,6 +2706,7 @@ class SearchFeedImpl(RSSMultiFeedBase):
                                    title=_('Search'))
         self.initialUpdate = True
         self.searching = False
+        self._result_urls = set()
         self.set_update_frequency(-1)
         self.ufeed.autoDownloadable = False
         # keeps the items from being seen as 'newly available'
@@ -2413,6 +2714,7 @@ class SearchFeedImpl(RSSMultiFeedBase):
 
     def setup_restored(self):
         self.searching = False
+        self._result_urls = None
         RSSMultiFeedBase.setup_restored(self)
 
     def calc_urls(self):
@@ -2433,6 +2735,7 @@ class SearchFeedImpl(RSSMultiFeedBase):
         finally:
             app.bulk_sql_manager.finish()
         self._urls = []
+        self._result_urls = set()
         self.searching = False
         if set_engine is not None:
             self.engine = set_engine
@@ -2469,7 +2772,14 @@ class SearchFeedImpl(RSSMultiFeedBase):
     def _handle_new_entry(self, entry, fp_values, channel_title):
         """Handle getting a new entry from a feed."""
         url = fp_values.data['url']
+        if self._result_urls is None:
+            self._result_urls = set(row[0] for row in models.Item.select(
+                ['url'], 'feed_id=?', (self.ufeed.id,)))
+        if url in self._result_urls:
+            # another search engine already gave us this result
+            return
         if url is not None:
+            self._result_urls.add(url)
             dl = downloader.get_existing_downloader_by_url(url)
             if dl is not None:
                 for item in dl.item_list:
@@ -2522,133 +2832,6 @@ class ManualFeedImpl(FeedImpl):
         self.ufeed.expire = u'never'
         self.set_update_frequency(-1)
 
-LINK_PATTERN = re.compile("<(a|embed)\s[^>]*(href|src)\s*=\s*\"([^\"]*)\"[^>]*>(.*?)</a(.*)", re.S)
-IMG_PATTERN = re.compile(".*<img\s.*?src\s*=\s*\"(.*?)\".*?>", re.S)
-TAG_PATTERN = re.compile("<.*?>")
-
-class HTMLLinkGrabber(HTMLParser):
-    """Parse HTML document and grab all of the links and titles.
-    """
-    # FIXME: Grab link title from ALT tags in images
-    # FIXME: Grab document title from TITLE tags
-    def get_links(self, data, baseurl):
-        self.links = []
-        self.lastLink = None
-        self.inLink = False
-        self.inObject = False
-        self.baseurl = baseurl
-        self.inTitle = False
-        self.title = None
-        self.thumbnailUrl = None
-
-        match = LINK_PATTERN.search(data)
-        while match:
-            try:
-                link_url = match.group(3).encode('ascii')
-            except UnicodeError:
-                link_url = match.group(3)
-                i = len(link_url) - 1
-                while (i >= 0):
-                    if 127 < ord(link_url[i]) <= 255:
-                        link_url = (link_url[:i] +
-                                    "%%%02x" % (ord(link_url[i])) +
-                                    link_url[i+1:])
-                    i = i - 1
-
-            link = urljoin(baseurl, link_url)
-            desc = match.group(4)
-            img_match = IMG_PATTERN.match(desc)
-            if img_match:
-                try:
-                    thumb = urljoin(baseurl, img_match.group(1).encode('ascii'))
-                except UnicodeError:
-                    thumb = None
-            else:
-                thumb = None
-            desc =  TAG_PATTERN.sub(' ', desc)
-            self.links.append((link, desc, thumb))
-            match = LINK_PATTERN.search(match.group(5))
-        return self.links
-
-class RSSLinkGrabber(xml.sax.handler.ContentHandler,
-                     xml.sax.handler.ErrorHandler):
-    def __init__(self, baseurl, charset=None):
-        self.baseurl = baseurl
-        self.charset = charset
-
-    def startDocument(self):
-        #print "Got start document"
-        self.enclosureCount = 0
-        self.itemCount = 0
-        self.links = []
-        self.inLink = False
-        self.inDescription = False
-        self.inTitle = False
-        self.inItem = False
-        self.descHTML = ''
-        self.theLink = ''
-        self.title = None
-        self.firstTag = True
-        self.errors = 0
-        self.fatal_errors = 0
-
-    def startElementNS(self, name, qname, attrs):
-        tag = name[1]
-        if self.firstTag:
-            self.firstTag = False
-            if tag not in ['rss', 'feed']:
-                raise xml.sax.SAXNotRecognizedException("Not an RSS file")
-        if tag.lower() == 'enclosure' or tag.lower() == 'content':
-            self.enclosureCount += 1
-        elif tag.lower() == 'link':
-            self.inLink = True
-            self.theLink = ''
-        elif tag.lower() == 'description':
-            self.inDescription = True
-            self.descHTML = ''
-        elif tag.lower() == 'item':
-            self.itemCount += 1
-            self.inItem = True
-        elif tag.lower() == 'title' and not self.inItem:
-            self.inTitle = True
-
-    def endElementNS(self, name, qname):
-        tag = name[1]
-        if tag.lower() == 'description':
-            lg = HTMLLinkGrabber()
-            try:
-                html = xhtmlify(unescape(self.descHTML), add_top_tags=True)
-                if not self.charset is None:
-                    html = fix_html_header(html, self.charset)
-                self.links[:0] = lg.get_links(html, self.baseurl)
-            except HTMLParseError: # Don't bother with bad HTML
-                logging.warning("bad HTML in description for %s", self.baseurl)
-            self.inDescription = False
-        elif tag.lower() == 'link':
-            self.links.append((self.theLink, None, None))
-            self.inLink = False
-        elif tag.lower() == 'item':
-            self.inItem = False
-        elif tag.lower() == 'title' and not self.inItem:
-            self.inTitle = False
-
-    def characters(self, data):
-        if self.inDescription:
-            self.descHTML += data
-        elif self.inLink:
-            self.theLink += data
-        elif self.inTitle:
-            if self.title is None:
-                self.title = data
-            else:
-                self.title += data
-
-    def error(self, exception):
-        self.errors += 1
-
-    def fatalError(self, exception):
-        self.fatal_errors += 1
-
 class HTMLFeedURLParser(HTMLParser):
     """Grabs the feed link from the given webpage
     """
@@ -2680,13 +2863,153 @@ class HTMLFeedURLParser(HTMLParser):
                                              'application/xml']):
             self.link = urljoin(self.baseurl, attrdict['href'])
 
+def _expire_cutoff(orig_url, expire, expire_timedelta, now):
+    """Get the time to expire a feed's items at.
+
+    :returns: datetime.  Items watched before it are ready to expire.  None if
+        the feed's items never expire.
+    """
+    # items in watched folders never expire
+    if orig_url.startswith(u"dtv:directoryfeed:"):
+        return None
+    if expire == u'never':
+        return None
+    elif expire == u'system':
+        expire_after_x_days = app.config.get(prefs.EXPIRE_AFTER_X_DAYS)
+        if expire_after_x_days == -1:
+            return None
+        return now - timedelta(days=expire_after_x_days)
+    elif expire_timedelta is not None:
+        return now - expire_timedelta
+    else:
+        return None
+
+def expiring_item_ids():
+    """Get the ids of items that are ready to expire in all feeds."""
+    now = datetime.now()
+    cutoffs = {}
+    for feed_id, orig_url, expire, expire_timedelta in Feed.select(
+            ['id', 'orig_url', 'expire', 'expire_timedelta']):
+        cutoff = _expire_cutoff(orig_url, expire, expire_timedelta, now)
+        if cutoff is not None:
+            cutoffs[feed_id] = cutoff
+    if not cutoffs:
+        return []
+    # Use the watched_time index to find every item that could be expiring,
+    # then check each against the cutoff for its feed.
+    rows = models.Item.select(['id', 'feed_id', 'watched_time'],
+                              'watched_time < ? AND keep = 0',
+                              (max(cutoffs.values()),))
+    return [item_id for item_id, feed_id, watched_time in rows
+            if feed_id in cutoffs and watched_time < cutoffs[feed_id]]
+
 def expire_items():
     try:
-        for feed in Feed.make_view():
-            feed.expire_items()
+        models.Item.bulk_expire(expiring_item_ids())
     finally:
         eventloop.add_timeout(300, expire_items, "Expire Items")
 
+# (downloaded, downloading, unwatched, available) counts for feeds without
+# items
+_NO_COUNTS = (0, 0, 0, 0)
+
+class _CountUpdater(object):
+    """Keeps the item counts for feeds up to date.
+
+    Items call Feed.recalc_counts() when they change in a way that might
+    change their feed's counts.  Rather than counting right away, we
+    remember the feed and count all the changed feeds with one query in an
+    idle callback.  Then we signal the feeds whose counts changed, so the
+    tab list gets all the new counts at once.
+    """
+    def __init__(self):
+        # ids of feeds that need to be counted
+        self.dirty = set()
+        # counts for dirty feeds that were needed before update_dirty() ran
+        self.dirty_counts = {}
+
+    def add(self, feed_id):
+        self.dirty.add(feed_id)
+        # the items changed again, so any counts we have are stale
+        self.dirty_counts.pop(feed_id, None)
+        eventloop.add_idle(self.update_dirty, 'update feed counts',
+                           coalesce_key=(id(self), 'update_dirty'))
+
+    def get_dirty_counts(self, feed_id):
+        """Get the counts for a feed in dirty.
+
+        We count the feed the first time this is called, then use those
+        counts until its items change again or update_dirty() runs.  That
+        way building a feed's info only counts it once.
+        """
+        try:
+            return self.dirty_counts[feed_id]
+        except KeyError:
+            counts = models.Item.feed_counts([feed_id]).get(feed_id,
+                                                           _NO_COUNTS)
+            self.dirty_counts[feed_id] = counts
+            return counts
+
+    def update_dirty(self):
+        feed_ids = self.dirty
+        if not feed_ids:
+            return
+        counts = models.Item.feed_counts(feed_ids)
+        self.dirty = set()
+        self.dirty_counts = {}
+        self._update_feeds(feed_ids, counts, signal_new=True)
+
+    def update_all(self):
+        """Count items for every feed.
+
+        This catches any changes that didn't go through recalc_counts().
+        Feeds that we haven't counted before just get their counts stored,
+        since nothing has shown them yet.
+        """
+        counts = models.Item.feed_counts()
+        feed_ids = set(row[0] for row in Feed.select(['id']))
+        self._update_feeds(feed_ids - self.dirty, counts, signal_new=False)
+        self._update_feeds(feed_ids & self.dirty, counts, signal_new=True)
+        self.dirty = set()
+        self.dirty_counts = {}
+
+    def _update_feeds(self, feed_ids, counts, signal_new):
+        changed_folder_ids = set()
+        for feed_id in feed_ids:
+            try:
+                feed = Feed.get_by_id(feed_id)
+            except ObjectNotFoundError:
+                continue
+            new_counts = counts.get(feed_id, _NO_COUNTS)
+            old_counts = feed.__dict__.get('_counts')
+            if old_counts == new_counts:
+                continue
+            feed._counts = new_counts
+            if old_counts is None and not signal_new:
+                continue
+            feed.signal_change(needs_save=False)
+            if feed.in_folder():
+                changed_folder_ids.add(feed.folder_id)
+        for folder_id in changed_folder_ids:
+            try:
+                folder = models.ChannelFolder.get_by_id(folder_id)
+            except ObjectNotFoundError:
+                continue
+            folder.signal_change(needs_save=False)
+
+_count_updater = _CountUpdater()
+
+def update_counts():
+    """Count items for every feed and schedule the next time to do it.
+
+    Counts normally get updated as items change, this corrects any that
+    we've missed.
+    """
+    try:
+        _count_updater.update_all()
+    finally:
+        eventloop.add_timeout(600, update_counts, "Update Feed Counts")
+
 def lookup_feed(url, search_term=None):
     try:
         return Feed.get_by_url_and_search(url, search_term)
@@ -38,6 +38,7 @@ import threading
 from miro.clock import clock
 
 from miro import eventloop
+from miro import fastfeedparser
 from miro import feedparser
 from miro import filetypes
 from miro import flashscraper
@@ -90,6 +91,19 @@ def parse(url_file_stream_or_string):
     _yahoo_hack(parsed['entries'])
     return parsed
 
+def parse_feed_body(html):
+    """Parse the body of a feed that we downloaded.
+
+    Well-formed RSS 2.0 and Atom feeds are handled by fastfeedparser, which
+    is much faster and only calculates the values that we use.  Anything
+    else goes through parse().
+    """
+    parsed = fastfeedparser.parse(html)
+    if parsed is None:
+        return parse(html)
+    _yahoo_hack(parsed['entries'])
+    return parsed
+
 def _yahoo_hack(feedparser_entries):
     """Hack yahoo search to provide enclosures"""
     for entry in feedparser_entries:
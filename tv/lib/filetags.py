@@ -188,24 +188,18 @@ def _track_from_filename(full_path):
         number = ''.join(initial_int[-2:]) # e.g. '204' is disc 2, track 04
         return int(number)
 
-def _make_cover_art_file(album_name, objects, cover_art_directory):
+def _make_cover_art_file(objects, cover_art_directory):
     """Given an iterable of mutagen cover art objects, returns the path to a
-    newly-created file created from one of the objects. If given more than one
-    object, uses the one most likely to be cover art.
+    file created from one of the objects. If given more than one object, uses
+    the one most likely to be cover art.
+
+    Files are stored in a coverart.CoverArtStore, so files with identical
+    cover art share the same path.
 
     :returns: tuple (path, newly_created) or None if we didn't create a path
     """
-    if album_name is None:
-        return None
     if cover_art_directory is None:
         cover_art_directory = app.config.get(prefs.COVER_ART_DIRECTORY)
-    # quote the album so that the filename doesn't have any illegal characters
-    # in it.
-    dest_filename = calc_cover_art_filename(album_name)
-    path = os.path.join(cover_art_directory, dest_filename)
-    if os.path.exists(path):
-        # already made cover art, no need to make it again
-        return path, False
     if not isinstance(objects, list):
         objects = [objects]
 
@@ -230,12 +224,13 @@ def _make_cover_art_file(album_name, objects, cover_art_directory):
         # no attached image is definitively cover art. use the first one.
         cover_image = images[0]
 
+    store = coverart.CoverArtStore(cover_art_directory)
     try:
-        cover_image.write_to_file(path)
+        return store.add(cover_image)
     except EnvironmentError:
-        logging.warn("Couldn't write cover art file: {0}".format(path))
+        logging.warn("Couldn't write cover art file: {0}".format(
+            store.path_for_image(cover_image)))
         return None
-    return path, True
 
 MUTAGEN_ERRORS = None
 def _setup_mutagen_errors():
@@ -366,12 +361,10 @@ def _parse_mutagen(filename, muta, cover_art_directory):
     cover_art_info = None
     if hasattr(muta, 'pictures'):
         image_data = muta.pictures
-        cover_art_info = _make_cover_art_file(data.get('album'), image_data,
-                                              cover_art_directory)
+        cover_art_info = _make_cover_art_file(image_data, cover_art_directory)
     elif 'cover_art' in data:
         image_data = data['cover_art']
-        cover_art_info = _make_cover_art_file(data.get('album'), image_data,
-                                              cover_art_directory)
+        cover_art_info = _make_cover_art_file(image_data, cover_art_directory)
         del data['cover_art']
     if cover_art_info is not None:
         data['cover_art'], data['created_cover_art'] = cover_art_info
@@ -250,6 +250,37 @@ def delete(path, retry_after=10, retry_for=60, firsttime=True):
     else:
         deletes_in_progress.discard(path)
 
+def delete_in_background(path, callback=None):
+    """Delete a file or directory in a thread.
+
+    Big files and directories with lots of files can take a while to delete,
+    so we do it outside of the event loop.  If the thread can't delete path,
+    we fall back to delete(), which retries files that are in use on
+    Windows.
+
+    :param callback: function to call in the event loop once we're done
+    """
+    import eventloop
+    expanded = expand_filename(path)
+    # keep directory scans from picking the file up again while we delete it
+    deletes_in_progress.add(expanded)
+    def thread_delete():
+        if os.path.isfile(expanded):
+            os.remove(expanded)
+        elif os.path.isdir(expanded):
+            shutil.rmtree(expanded)
+    def thread_callback(result):
+        deletes_in_progress.discard(expanded)
+        if callback is not None:
+            callback()
+    def thread_errback(error):
+        deletes_in_progress.discard(expanded)
+        delete(path)
+        if callback is not None:
+            callback()
+    eventloop.call_in_thread_pool('delete', thread_callback, thread_errback,
+                                  thread_delete, 'Delete %s' % path)
+
 def miro_listdir(directory):
     """Directory listing that's safe and convenient for finding new
     videos in a directory.
@@ -289,6 +320,16 @@ def miro_listdir(directory):
             pass
     return files, directories
 
+def skip_name_in_scan(name):
+    """Check if a directory scan should skip over a file or directory.
+
+    We skip hidden files, "Incomplete Downloads" and thumbs.db, which is a
+    windows file that speeds up thumbnails.  We know it's not a movie file.
+    """
+    name_lower = name.lower()
+    return (name.startswith('.') or name_lower == 'thumbs.db' or
+            name_lower == "incomplete downloads")
+
 def miro_allfiles(directory, checked=None):
     """Directory listing that's safe and convenient for finding new
     videos in a directory.
@@ -318,11 +359,7 @@ def miro_allfiles(directory, checked=None):
         logging.debug('OSError walking directory; continuing', exc_info=1)
         return
     for name in listing:
-        name_lower = name.lower()
-        if (name.startswith('.') or name_lower == 'thumbs.db' or
-                name_lower == "incomplete downloads"):
-            # thumbs.db is a windows file that speeds up thumbnails.
-            # We know it's not a movie file.
+        if skip_name_in_scan(name):
             continue
         path = os.path.join(directory, os.path.normcase(name))
         expanded_path = os.path.join(expanded_directory, os.path.normcase(name))
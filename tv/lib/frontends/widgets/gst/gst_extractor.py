@@ -64,21 +64,30 @@ def scaled_size(from_size, to_size):
         return width, to_size[1]
 
 
+# Set to False to create new pipelines for each file rather than reusing
+# them.  This is mostly useful to compare performance.
+REUSE_PIPELINE = True
+
+# How long to wait for a single file before giving up on it (in ms)
+FILE_TIMEOUT = 30000
+
 class Extractor:
-    def __init__(self, filename, thumbnail_filename):
-        logging.info("running gstreamer Extractor on %s", filename)
-        self.thumbnail_filename = thumbnail_filename
-        self.filename = filename
+    """Gets the duration and a screenshot for media files.
 
+    An Extractor can process any number of files.  We keep our playbin
+    pipeline around and just change its uri for each file, rather than
+    setting up a new pipeline each time.  The thumbnail pipeline uses
+    decodebin, which can't be reused, so that one gets created for each video
+    file.
+    """
+    def __init__(self):
         self.timeout = None
-        self.grabit = False
-        self.first_pause = True
-        self.doing_thumbnailing = False
-        self.success = False
-        self.duration = -1
-        self.buffer_probes = {}
-        self.audio_only = False
-        self.saw_video_tag = self.saw_audio_tag = False
+        self.thumbnail_pipeline = None
+        self.thumbnail_bus = None
+        # generation gets incremented for each file.  We use it to ignore
+        # callbacks that were scheduled while handling a previous file.
+        self.generation = 0
+        self.failed = False
 
         self.pipeline = gst.element_factory_make('playbin')
         self.videosink = gst.element_factory_make("fakesink", "videosink")
@@ -86,29 +95,76 @@ class Extractor:
         self.audiosink = gst.element_factory_make("fakesink", "audiosink")
         self.pipeline.set_property("audio-sink", self.audiosink)
 
-        self.thumbnail_pipeline = None
-
         self.bus = self.pipeline.get_bus()
         self.bus.add_signal_watch()
         self.watch_id = self.bus.connect("message", self.on_bus_message)
 
+    def _reset(self, filename, thumbnail_filename):
+        self.generation += 1
+        self.filename = filename
+        self.thumbnail_filename = thumbnail_filename
+        self.grabit = False
+        self.first_pause = True
+        self.doing_thumbnailing = False
+        self.success = False
+        self.duration = -1
+        self.buffer_probes = {}
+        self.audio_only = False
+        self.saw_video_tag = self.saw_audio_tag = False
+        self.media_type = 'other'
+        self.timed_out = self.error = False
+
+    def process(self, filename, thumbnail_filename):
+        """Process a single file.
+
+        :returns: (media_type, duration, success) tuple
+        """
+        logging.info("running gstreamer Extractor on %s", filename)
+        self._reset(filename, thumbnail_filename)
+        # If something goes wrong before we finish, our pipeline may be in a
+        # bad state.
+        self.failed = True
         fileurl = urllib.pathname2url(os.path.abspath(filename))
         logging.warn("FILE URL: %r", 'file:' + fileurl)
         self.pipeline.set_property("uri", "file:%s" % fileurl)
         self.pipeline.set_state(gst.STATE_PAUSED)
+        self.timeout = gobject.timeout_add(FILE_TIMEOUT, self.on_timeout)
+        gtk.main()
+        self.disconnect()
+        # ignore any callbacks that are still pending for this file
+        self.generation += 1
+        self.failed = self.timed_out or self.error
+        return self.get_result()
 
+    def close(self):
+        self.cancel_timeout()
+        self.disconnect()
+        if self.bus is not None:
+            self.bus.disconnect(self.watch_id)
+            self.bus.remove_signal_watch()
+            self.bus = None
+        self.pipeline = None
+
+    def idle_add(self, func):
+        """Schedule func to be called for the file we're processing now."""
+        generation = self.generation
+        def callback():
+            if generation != self.generation:
+                return False
+            return func()
+        gobject.idle_add(callback)
 
     def on_bus_message(self, bus, message):
         if message.type == gst.MESSAGE_ERROR:
             logging.warn("gstreamer error: %s", message)
-            gobject.idle_add(self.error_occurred)
+            self.idle_add(self.error_occurred)
 
         elif message.type == gst.MESSAGE_STATE_CHANGED:
             _prev, state, _pending = message.parse_state_changed()
             if state == gst.STATE_PAUSED:
                 if message.src == self.pipeline:
                     logging.info("gstreamer ready")
-                    gobject.idle_add(self.paused_reached)
+                    self.idle_add(self.paused_reached)
 
                 elif (message.src == self.thumbnail_pipeline and
                       not self.doing_thumbnailing):
@@ -148,14 +204,12 @@ class Extractor:
         self.cancel_timeout()
         gtk.main_quit()
 
-    def run(self):
-        gobject.threads_init()
-        self.timeout = gobject.timeout_add(30000, self.on_timeout)
-        gtk.main()
-
     def on_timeout(self):
         logging.warn("on_timeout() reached.  Quitting.")
+        self.timeout = None
+        self.timed_out = True
         self.done()
+        return False
 
     def cancel_timeout(self):
         if self.timeout is not None:
@@ -235,6 +289,7 @@ class Extractor:
         return False
 
     def error_occurred(self):
+        self.error = True
         self.disconnect()
         self.done()
         return False
@@ -278,30 +333,35 @@ class Extractor:
         return False
 
     def buffer_probe_handler(self, pad, buff, name):
-        gobject.idle_add(
+        self.idle_add(
             lambda: self.buffer_probe_handler_real(pad, buff, name))
         return True
 
     def disconnect(self):
+        """Stop processing the current file.
+
+        This stops our playbin pipeline so that it can be reused for the
+        next file and throws away the thumbnail pipeline.  It's safe to call
+        this more than once.
+        """
         if self.pipeline is not None:
             self.pipeline.set_state(gst.STATE_NULL)
-            if not self.audio_only:
-                for sink in self.pipeline.sinks():
-                    name = sink.get_name()
-                    factoryname = sink.get_factory().get_name()
-                    if factoryname == "fakesink":
-                        pad = sink.get_pad("sink")
-                        pad.remove_buffer_probe(self.buffer_probes[name])
-                        del self.buffer_probes[name]
-            self.pipeline = None
+            # drop any messages for this file, so that we don't see them
+            # when we process the next one
+            while self.bus is not None and self.bus.pop() is not None:
+                pass
         if self.thumbnail_pipeline is not None:
             self.thumbnail_pipeline.set_state(gst.STATE_NULL)
+            for sink in self.thumbnail_pipeline.sinks():
+                name = sink.get_name()
+                if name in self.buffer_probes:
+                    pad = sink.get_pad("sink")
+                    pad.remove_buffer_probe(self.buffer_probes.pop(name))
+            self.thumbnail_bus.disconnect(self.thumbnail_watch_id)
+            self.thumbnail_bus.remove_signal_watch()
+            self.thumbnail_bus = None
             self.thumbnail_pipeline = None
 
-        if self.bus is not None:
-            self.bus.disconnect(self.watch_id)
-            self.bus = None
-
 
 def make_verbose():
     import logging
@@ -319,10 +379,22 @@ def make_verbose():
         if callable(fun):
             Extractor.__dict__[mem] = wrap_func(fun)
 
+# Extractor that we use for all files.  We create a new one if processing a
+# file fails, since the old pipeline might be in a bad state.
+_extractor = None
+
 def run(movie_file, thumbnail_file):
-    extractor = Extractor(movie_file, thumbnail_file)
-    extractor.run()
-    return extractor.get_result()
+    global _extractor
+    if _extractor is None:
+        gobject.threads_init()
+        _extractor = Extractor()
+    extractor = _extractor
+    try:
+        return extractor.process(movie_file, thumbnail_file)
+    finally:
+        if extractor.failed or not REUSE_PIPELINE:
+            extractor.close()
+            _extractor = None
 
 def main(argv):
     if "--verbose" in argv:
@@ -87,15 +87,17 @@ def resize_one_dimension(image, width_scale, height_scale,
 
 class ImagePool(util.Cache):
     def create_new_value(self, (path, size), invalidator=None):
+        if size is not None:
+            # scale the full-sized image from our cache, so that we only load
+            # each file once, no matter how many sizes we display it at.
+            image = self.get((path, None), invalidator=invalidator)
+            return resize_image(image, *size)
         try:
-            image = widgetset.Image(path)
+            return widgetset.Image(path)
         except StandardError:
             logging.warn("error loading image %s:\n%s", path,
                     traceback.format_exc())
-            image = broken_image
-        if size is not None:
-            image = resize_image(image, *size)
-        return image
+            return broken_image
 
 class ImageSurfacePool(util.Cache):
     def create_new_value(self, (path, size), invalidator=None):
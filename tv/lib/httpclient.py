@@ -959,6 +959,9 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             except NetworkError, e:
                 transfer.call_errback(e)
                 continue
+            if hasattr(pycurl, 'SOCKOPTFUNCTION'):
+                transfer.handle.setopt(pycurl.SOCKOPTFUNCTION,
+                                       self.on_new_socket)
             self.transfer_map[transfer.handle] = transfer
             self.multi.add_handle(transfer.handle)
 
@@ -974,6 +977,13 @@ class LibCURLManager(eventloop.SimpleEventLoop):
                 continue
             self.multi.remove_handle(transfer.handle)
 
+    def on_new_socket(self, fd, purpose):
+        # libcurl can close a socket and open a new one with the same fd
+        # number between loops.  fdset() would return the same fds, so make
+        # sure the poller registers the new socket.
+        self.poller.forget(fd)
+        return 0
+
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
@@ -62,7 +62,8 @@ class IconCacheUpdater:
                    and item.url == item.dbItem.get_thumbnail_url()):
                 is_vital = False
         if self.started and self.running_count < RUNNING_MAX:
-            eventloop.add_idle(item.request_icon, "Icon Request")
+            eventloop.add_idle(item.request_icon, "Icon Request",
+                               priority=eventloop.PRIORITY_BACKGROUND)
             self.running_count += 1
         else:
             if is_vital:
@@ -86,7 +87,8 @@ class IconCacheUpdater:
             self.running_count -= 1
             return
 
-        eventloop.add_idle(item.request_icon, "Icon Request")
+        eventloop.add_idle(item.request_icon, "Icon Request",
+                           priority=eventloop.PRIORITY_BACKGROUND)
 
     @eventloop.as_idle
     def clear_vital(self):
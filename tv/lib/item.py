@@ -101,6 +101,13 @@ class FeedParserValues(object):
     attribute for various attributes using in Item (entry_title,
     rss_id, url, etc...).
     """
+
+    # Item columns that get their values from the entry
+    columns = ('license', 'rss_id', 'entry_title', 'thumbnail_url',
+               'entry_description', 'link', 'payment_link', 'comments_link',
+               'url', 'enclosure_size', 'enclosure_type', 'enclosure_format',
+               'release_date')
+
     def __init__(self, entry):
         self.entry = entry
         self.first_video_enclosure = get_first_video_enclosure(entry)
@@ -792,6 +799,55 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
                 (feed_id,),
                 joins={'remote_downloader AS rd': 'item.downloader_id=rd.id'})
 
+    @classmethod
+    def feed_counts(cls, feed_ids=None):
+        """Count the items for Feed.num_downloaded(), num_downloading(),
+        num_unwatched() and num_available().
+
+        This gets the same numbers as counting feed_downloaded_view(),
+        feed_downloading_view(), feed_unwatched_view() and
+        feed_available_view() minus feed_auto_pending_view(), but for lots
+        of feeds with a single query.
+
+        :param feed_ids: feeds to count items for, or None for all feeds
+        :returns: dict mapping feed ids to (downloaded, downloading,
+            unwatched, available) tuples.  Feeds without items are left out.
+        """
+        downloaded = ("(item.is_file_item OR "
+                      "rd.state IN ('finished', 'uploading', "
+                      "'uploading-paused'))")
+        columns = [
+            'item.feed_id',
+            'SUM(%s)' % downloaded,
+            "SUM(rd.state IN ('downloading', 'uploading') AND "
+            "rd.main_item_id=item.id)",
+            "SUM(item.watched_time IS NULL AND "
+            "item.file_type IN ('audio', 'video') AND %s)" % downloaded,
+            'SUM(item.new)',
+            'SUM(feed.autoDownloadable AND NOT item.was_downloaded AND '
+            '(item.eligible_for_autodownload OR feed.getEverything))',
+        ]
+        joins = {
+            'remote_downloader AS rd': 'item.downloader_id=rd.id',
+            'feed': 'item.feed_id=feed.id',
+        }
+        if feed_ids is not None:
+            # use literal ids rather than "?" so that we don't run into
+            # sqlite's limit on the number of parameters
+            where = 'item.feed_id IN (%s)' % ', '.join(
+                str(int(feed_id)) for feed_id in feed_ids)
+        else:
+            where = None
+        counts = {}
+        for row in cls.select(columns, where, joins=joins,
+                              group_by='item.feed_id', convert=False):
+            row = [value or 0 for value in row]
+            (feed_id, downloaded_count, downloading_count, unwatched_count,
+             new_count, auto_pending_count) = row
+            counts[feed_id] = (downloaded_count, downloading_count,
+                               unwatched_count, new_count - auto_pending_count)
+        return counts
+
     @classmethod
     def children_view(cls, parent_id):
         return cls.make_view('parent_id=?', (parent_id,))
@@ -1277,12 +1333,50 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
 
     def expire(self):
         self.confirm_db_thread()
+        self._expire()
+        self.recalc_feed_counts()
+
+    def _expire(self):
+        """Expire the item without recalculating our feed's counts."""
         self._remove_from_playlists()
         if self.is_external():
             self.delete_files_and_remove()
         else:
             self.delete_files_and_expire()
-        self.recalc_feed_counts()
+
+    @classmethod
+    def bulk_expire(cls, item_ids):
+        """Expire a list of items.
+
+        All the database changes are saved together by the
+        BulkSQLManager and we recalculate counts once per feed, rather than
+        once per item.
+        """
+        if not item_ids:
+            return
+        app.db.ensure_objects_loaded(cls, item_ids, app.db_info)
+        feed_ids = set()
+        app.bulk_sql_manager.start()
+        try:
+            for item_id in item_ids:
+                if app.bulk_sql_manager.will_remove(item_id):
+                    # removed when we expired its container item
+                    continue
+                try:
+                    item = cls.get_by_id(item_id)
+                except database.ObjectNotFoundError:
+                    continue
+                feed_ids.add(item.feed_id)
+                app.bulk_sql_manager.add_update(item)
+                item._expire()
+        finally:
+            app.bulk_sql_manager.finish()
+        for feed_id in feed_ids:
+            try:
+                feed = models.Feed.get_by_id(feed_id)
+            except database.ObjectNotFoundError:
+                continue
+            feed.recalc_counts()
 
     def delete_files_and_remove(self):
         if self.is_downloaded():
@@ -2261,6 +2355,9 @@ class FileItem(Item):
 
     def expire(self):
         self.confirm_db_thread()
+        self._expire()
+
+    def _expire(self):
         if self.has_parent():
             # if we can't find the parent, it's possible that it was
             # already deleted.
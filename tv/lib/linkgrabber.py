@@ -0,0 +1,232 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""linkgrabber.py -- Find links in HTML pages and pre-enclosure RSS feeds.
+
+ScraperFeedImpl uses this to find videos and pages to follow.  The code here
+doesn't touch the database, so scrape_links() can run in the worker process
+(see workerprocess.ScrapeLinksTask).
+"""
+
+import logging
+import re
+import xml.sax
+import xml.sax.handler
+from urlparse import urljoin
+from HTMLParser import HTMLParser, HTMLParseError
+from cStringIO import StringIO
+
+from miro.util import to_uni
+from miro.xhtmltools import unescape, xhtmlify, fix_html_header
+
+LINK_PATTERN = re.compile("<(a|embed)\s[^>]*(href|src)\s*=\s*\"([^\"]*)\"[^>]*>(.*?)</a(.*)", re.S)
+IMG_PATTERN = re.compile(".*<img\s.*?src\s*=\s*\"(.*?)\".*?>", re.S)
+TAG_PATTERN = re.compile("<.*?>")
+
+class HTMLLinkGrabber(HTMLParser):
+    """Parse HTML document and grab all of the links and titles.
+    """
+    # FIXME: Grab link title from ALT tags in images
+    # FIXME: Grab document title from TITLE tags
+    def get_links(self, data, baseurl):
+        self.links = []
+        self.lastLink = None
+        self.inLink = False
+        self.inObject = False
+        self.baseurl = baseurl
+        self.inTitle = False
+        self.title = None
+        self.thumbnailUrl = None
+
+        match = LINK_PATTERN.search(data)
+        while match:
+            try:
+                link_url = match.group(3).encode('ascii')
+            except UnicodeError:
+                link_url = match.group(3)
+                i = len(link_url) - 1
+                while (i >= 0):
+                    if 127 < ord(link_url[i]) <= 255:
+                        link_url = (link_url[:i] +
+                                    "%%%02x" % (ord(link_url[i])) +
+                                    link_url[i+1:])
+                    i = i - 1
+
+            link = urljoin(baseurl, link_url)
+            desc = match.group(4)
+            img_match = IMG_PATTERN.match(desc)
+            if img_match:
+                try:
+                    thumb = urljoin(baseurl, img_match.group(1).encode('ascii'))
+                except UnicodeError:
+                    thumb = None
+            else:
+                thumb = None
+            desc =  TAG_PATTERN.sub(' ', desc)
+            self.links.append((link, desc, thumb))
+            match = LINK_PATTERN.search(match.group(5))
+        return self.links
+
+class RSSLinkGrabber(xml.sax.handler.ContentHandler,
+                     xml.sax.handler.ErrorHandler):
+    def __init__(self, baseurl, charset=None):
+        self.baseurl = baseurl
+        self.charset = charset
+
+    def startDocument(self):
+        #print "Got start document"
+        self.enclosureCount = 0
+        self.itemCount = 0
+        self.links = []
+        self.inLink = False
+        self.inDescription = False
+        self.inTitle = False
+        self.inItem = False
+        self.descHTML = ''
+        self.theLink = ''
+        self.title = None
+        self.firstTag = True
+        self.errors = 0
+        self.fatal_errors = 0
+
+    def startElementNS(self, name, qname, attrs):
+        tag = name[1]
+        if self.firstTag:
+            self.firstTag = False
+            if tag not in ['rss', 'feed']:
+                raise xml.sax.SAXNotRecognizedException("Not an RSS file")
+        if tag.lower() == 'enclosure' or tag.lower() == 'content':
+            self.enclosureCount += 1
+        elif tag.lower() == 'link':
+            self.inLink = True
+            self.theLink = ''
+        elif tag.lower() == 'description':
+            self.inDescription = True
+            self.descHTML = ''
+        elif tag.lower() == 'item':
+            self.itemCount += 1
+            self.inItem = True
+        elif tag.lower() == 'title' and not self.inItem:
+            self.inTitle = True
+
+    def endElementNS(self, name, qname):
+        tag = name[1]
+        if tag.lower() == 'description':
+            lg = HTMLLinkGrabber()
+            try:
+                html = xhtmlify(unescape(self.descHTML), add_top_tags=True)
+                if not self.charset is None:
+                    html = fix_html_header(html, self.charset)
+                self.links[:0] = lg.get_links(html, self.baseurl)
+            except HTMLParseError: # Don't bother with bad HTML
+                logging.warning("bad HTML in description for %s", self.baseurl)
+            self.inDescription = False
+        elif tag.lower() == 'link':
+            self.links.append((self.theLink, None, None))
+            self.inLink = False
+        elif tag.lower() == 'item':
+            self.inItem = False
+        elif tag.lower() == 'title' and not self.inItem:
+            self.inTitle = False
+
+    def characters(self, data):
+        if self.inDescription:
+            self.descHTML += data
+        elif self.inLink:
+            self.theLink += data
+        elif self.inTitle:
+            if self.title is None:
+                self.title = data
+            else:
+                self.title += data
+
+    def error(self, exception):
+        self.errors += 1
+
+    def fatalError(self, exception):
+        self.fatal_errors += 1
+
+def _is_http_url(url):
+    return url.startswith('http://') or url.startswith('https://')
+
+def _make_link_dict(links, charset):
+    link_dict = {}
+    for link in links:
+        if _is_http_url(link[0]):
+            url = to_uni(link[0], charset)
+            if not link_dict.has_key(url):
+                link_dict[url] = {}
+            if not link[1] is None:
+                link_dict[url]['title'] = to_uni(link[1], charset).strip()
+            if not link[2] is None:
+                link_dict[url]['thumbnail'] = to_uni(link[2], charset)
+    return link_dict
+
+def _scrape_rss_links(html, baseurl, charset):
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, 1)
+    try:
+        parser.setFeature(xml.sax.handler.feature_external_ges, 0)
+    except StandardError:
+        pass
+    handler = RSSLinkGrabber(baseurl, charset)
+    parser.setContentHandler(handler)
+    try:
+        parser.parse(StringIO(html))
+    except IOError:
+        pass
+    except AttributeError:
+        # bug in the python standard library causes this to be raised
+        # sometimes.  See #3201.
+        pass
+    return handler.title, handler.links
+
+def scrape_links(html, baseurl, charset=None):
+    """Find the links in a page.
+
+    The page is parsed as RSS if possible, and as HTML otherwise.
+
+    :returns: (title, urls, link_dict) tuple.  title is the title of the
+        page or None, urls is a list of the http and https links in the page,
+        in order, and link_dict maps those links to dicts with the
+        "title" and "thumbnail" for the link, when the page has them.
+    """
+    if not charset is None:
+        html = fix_html_header(html, charset)
+    try:
+        title, links = _scrape_rss_links(html, baseurl, charset)
+    except (xml.sax.SAXException, ValueError, IOError,
+            xml.sax.SAXNotRecognizedException):
+        lg = HTMLLinkGrabber()
+        links = lg.get_links(html, baseurl)
+        title = lg.title
+    if title is not None:
+        title = to_uni(title, charset)
+    return (title, [link[0] for link in links if _is_http_url(link[0])],
+            _make_link_dict(links, charset))
@@ -43,6 +43,7 @@ from miro import conversions
 from miro import downloader
 from miro import eventloop
 from miro import feed
+from miro import feedupdate
 from miro import guide
 from miro import fileutil
 from miro import commandline
@@ -86,7 +87,6 @@ class ViewTracker(object):
         self.added_order = []
         # Need to use a list because added messages must be sent in the same
         # order they were received
-        self.changes_pending = False
 
     def send_messages(self):
         message = self.make_changed_message(
@@ -133,10 +133,8 @@ class ViewTracker(object):
     def schedule_send_messages(self):
         # We don't send messages immediately so that if an object gets changed
         # multiple times, only one callback gets sent.
-        if not self.changes_pending:
-            eventloop.add_urgent_call(self.send_messages,
-                                      'view tracker update' )
-            self.changes_pending = True
+        eventloop.add_urgent_call(self.send_messages, 'view tracker update',
+                                  coalesce_key=(id(self), 'send_messages'))
 
     def add_callbacks(self):
         for view in self.get_object_views():
@@ -455,6 +453,8 @@ class BackendMessageHandler(messages.MessageHandler):
         self.new_video_count_tracker = None
         self.new_audio_count_tracker = None
         self.unwatched_count_tracker = None
+        # map ids from SetFeedDisplayed to the feed ids that we prioritized
+        self.displayed_feed_ids = {}
         search_feed = Feed.get_search_feed()
         search_feed.connect('update-finished', self._search_update_finished)
 
@@ -557,6 +557,32 @@ class BackendMessageHandler(messages.MessageHandler):
             logging.warning("handle_mark_feed_seen: can't find feed by id %s",
                             message.id)
 
+    def handle_set_feed_displayed(self, message):
+        if not message.displayed:
+            # Unprioritize exactly the feeds that we prioritized.  A
+            # folder's children may have changed while it was displayed.
+            feed_ids = self.displayed_feed_ids.pop(message.id, None)
+            if feed_ids is not None:
+                feedupdate.unprioritize(feed_ids)
+            return
+        try:
+            feed_ = feed.Feed.get_by_id(message.id)
+        except database.ObjectNotFoundError:
+            try:
+                folder = ChannelFolder.get_by_id(message.id)
+            except database.ObjectNotFoundError:
+                logging.warning("handle_set_feed_displayed: can't find feed "
+                                "by id %s", message.id)
+                return
+            feed_ids = [f.id for f in folder.get_children_view()]
+        else:
+            feed_ids = [feed_.id]
+        old_feed_ids = self.displayed_feed_ids.pop(message.id, None)
+        if old_feed_ids is not None:
+            feedupdate.unprioritize(old_feed_ids)
+        self.displayed_feed_ids[message.id] = feed_ids
+        feedupdate.prioritize(feed_ids)
+
     def handle_mark_item_watched(self, message):
         itemsource.get_handler(message.info).mark_watched(message.info)
 
@@ -307,6 +307,15 @@ class MarkFeedSeen(BackendMessage):
     def __init__(self, id_):
         self.id = id_
 
+class SetFeedDisplayed(BackendMessage):
+    """Tell the backend if the user is looking at a feed or feed folder.
+
+    Feeds that are displayed get updated before other feeds.
+    """
+    def __init__(self, id_, displayed):
+        self.id = id_
+        self.displayed = displayed
+
 class MarkItemWatched(BackendMessage):
     """Mark an item as watched.
     """
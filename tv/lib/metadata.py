@@ -34,14 +34,17 @@ Module properties:
     attribute_names -- set of attribute names for metadata
 """
 
+import ast
 import collections
 import contextlib
+import hashlib
 import logging
-import os.path
+import os
 import time
 
 from miro import app
 from miro import clock
+from miro import coverart
 from miro import database
 from miro import echonest
 from miro import eventloop
@@ -54,7 +57,8 @@ from miro import prefs
 from miro import signals
 from miro import workerprocess
 from miro.plat.utils import (filename_to_unicode,
-                             get_enmfp_executable_info)
+                             get_enmfp_executable_info,
+                             get_logical_cpu_count)
 
 attribute_names = set([
     'file_type', 'duration', 'album', 'album_artist', 'album_tracks',
@@ -159,6 +163,23 @@ class MetadataStatus(database.DDBObject):
                                  db_info=db_info)
             return view.get_singleton()
 
+    @classmethod
+    def path_in_db(cls, path, db_info=None):
+        """Test if there is a MetadataStatus for a path in the database.
+
+        This uses the index on path, so it's quick and doesn't restore any
+        objects.  Objects that are being removed as part of a bulk SQL
+        operation don't count.
+        """
+        if db_info is None:
+            db_info = app.db_info
+
+        rows = cls.select(['id'], 'path=?', (filename_to_unicode(path),),
+                          db_info=db_info, limit=1)
+        if not rows:
+            return False
+        return not db_info.bulk_sql_manager.will_remove(rows[0][0])
+
     @classmethod
     def paths_for_album(cls, album, db_info=None):
         rows = cls.select(['path',],
@@ -372,9 +393,9 @@ class MetadataEntry(database.DDBObject):
         for name in self.metadata_columns:
             setattr(self, name, None)
         self.__dict__.update(data)
-        if source != 'user-data':
-            # we only save cover_art for user-data.  Other sources save the
-            # cover art using a per-album filename.
+        if source not in ('user-data', 'mutagen'):
+            # we only save cover_art for user-data and mutagen.  Other
+            # sources save the cover art using a per-album filename.
             self.cover_art = None
 
     def update_metadata(self, new_data):
@@ -405,6 +426,22 @@ class MetadataEntry(database.DDBObject):
                              order_by='priority ASC',
                              db_info=db_info)
 
+    @classmethod
+    def cover_art_for_album(cls, album, db_info=None):
+        """Get the cover art that mutagen found for an album.
+
+        :returns: cover art path or None if no file in the album had cover
+        art.
+        """
+        rows = cls.select(['cover_art'],
+                          'album=? AND source=? AND cover_art IS NOT NULL '
+                          'AND NOT disabled', (album, u'mutagen'),
+                          db_info=db_info, limit=1)
+        if rows:
+            return rows[0][0]
+        else:
+            return None
+
     @classmethod
     def get_entry(cls, source, status, db_info=None):
         view = cls.make_view('source=? AND status_id=?',
@@ -436,6 +473,196 @@ class MetadataEntry(database.DDBObject):
             entry.signal_change()
             return True
 
+def calc_file_fingerprint(path, hash_size=8192):
+    """Calculate a fingerprint for the contents of a file.
+
+    The fingerprint is the file's size, mtime and inode, plus a hash of the
+    first and last hash_size bytes.  It's cheap to calculate, but still
+    changes if the file is edited or replaced.
+
+    :returns: (size, mtime, inode, content_hash) tuple, or None if the file
+    can't be read
+    """
+    try:
+        stat_result = os.stat(path)
+        content_hash = hashlib.sha1()
+        f = fileutil.open_file(path, 'rb')
+        try:
+            content_hash.update(f.read(hash_size))
+            if stat_result.st_size > hash_size:
+                f.seek(max(hash_size, stat_result.st_size - hash_size))
+                content_hash.update(f.read(hash_size))
+        finally:
+            f.close()
+    except EnvironmentError:
+        return None
+    return (stat_result.st_size, stat_result.st_mtime, stat_result.st_ino,
+            content_hash.hexdigest())
+
+def calc_file_fingerprints(paths):
+    """Calculate fingerprints for several files.
+
+    This reads from each file, so it should be run in a thread rather than
+    in the event loop.
+
+    :returns: dict mapping paths to calc_file_fingerprint() results
+    """
+    return dict((path, calc_file_fingerprint(path)) for path in paths)
+
+class MetadataResultCache(object):
+    """Stores the results of mutagen and movie data tasks.
+
+    Results are keyed by the metadata source and calc_file_fingerprint().  If
+    a file gets re-added to the library without changing, we can use the
+    stored result instead of sending a new task to the worker process.
+
+    Results are stored in the metadata_cache table.  If we have more than
+    MAX_ENTRIES rows, we remove the least recently used ones.
+    """
+    MAX_ENTRIES = 20000
+    # remove this many extra rows when we evict, so that we don't have to
+    # evict on every store.
+    EVICT_EXTRA = 500
+    # keys in result dicts for files that we create
+    FILE_KEYS = ('cover_art', 'screenshot')
+    # max number of content hashes to look up in one query.  This keeps us
+    # under sqlite's limit on the number of variables in a statement.
+    LOOKUP_CHUNK_SIZE = 500
+
+    def __init__(self, db_info):
+        self.db_info = db_info
+        self.entry_count = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'stale': 0,
+        }
+
+    def get_stats(self):
+        """Get a copy of our stats.
+
+        :returns: dict with the keys "hits", "misses", "stores", "evictions"
+        and "stale".  stale counts entries we threw out because a cover art
+        or screenshot file was missing.
+        """
+        return self.stats.copy()
+
+    def _execute(self, sql, values=None, is_update=False):
+        return self.db_info.db.execute(sql, values, is_update=is_update)
+
+    def _get_entry_count(self):
+        if self.entry_count is None:
+            self.entry_count = self._execute(
+                "SELECT COUNT(*) FROM metadata_cache")[0][0]
+        return self.entry_count
+
+    def get(self, source, fingerprint):
+        """Get the result for a fingerprint.
+
+        :returns: result dict or None if we don't have one
+        """
+        if fingerprint is None:
+            return None
+        return self.get_many(source, [fingerprint]).get(fingerprint)
+
+    def get_many(self, source, fingerprints):
+        """Get the results for several fingerprints at once.
+
+        This uses one SELECT and one UPDATE for every LOOKUP_CHUNK_SIZE
+        fingerprints, rather than a couple queries per fingerprint.  None
+        values in fingerprints are skipped.
+
+        :returns: dict mapping fingerprints to result dicts.  Fingerprints
+        that we don't have results for aren't included.
+        """
+        fingerprints = set(fp for fp in fingerprints if fp is not None)
+        hashes = list(set(fp[3] for fp in fingerprints))
+        found = {}
+        hit_ids = []
+        stale_ids = []
+        for start in xrange(0, len(hashes), self.LOOKUP_CHUNK_SIZE):
+            chunk = hashes[start:start+self.LOOKUP_CHUNK_SIZE]
+            rows = self._execute("SELECT id, size, mtime, inode, "
+                                 "content_hash, result FROM metadata_cache "
+                                 "WHERE source=? AND content_hash IN (%s)" %
+                                 ', '.join('?' * len(chunk)),
+                                 [source] + chunk)
+            for row in rows:
+                row_id, fingerprint, result_repr = row[0], row[1:5], row[5]
+                if fingerprint not in fingerprints:
+                    continue
+                try:
+                    result = ast.literal_eval(result_repr)
+                except (ValueError, SyntaxError):
+                    logging.warn("MetadataResultCache: bad result: %r",
+                                 result_repr)
+                    result = None
+                if result is None or not self._files_exist(result):
+                    stale_ids.append(row_id)
+                else:
+                    hit_ids.append(row_id)
+                    found[fingerprint] = result
+        if stale_ids:
+            self._execute_for_ids("DELETE FROM metadata_cache "
+                                  "WHERE id IN (%s)", stale_ids)
+            self.entry_count = None
+        if hit_ids:
+            self._execute_for_ids("UPDATE metadata_cache SET last_used=? "
+                                  "WHERE id IN (%s)", hit_ids,
+                                  (time.time(),))
+        self.stats['stale'] += len(stale_ids)
+        self.stats['hits'] += len(found)
+        self.stats['misses'] += len(fingerprints) - len(found)
+        return found
+
+    def _execute_for_ids(self, sql, ids, values=()):
+        for start in xrange(0, len(ids), self.LOOKUP_CHUNK_SIZE):
+            chunk = ids[start:start+self.LOOKUP_CHUNK_SIZE]
+            self._execute(sql % ', '.join('?' * len(chunk)),
+                          list(values) + chunk, is_update=True)
+
+    def _files_exist(self, result):
+        for key in self.FILE_KEYS:
+            path = result.get(key)
+            if path is not None and not fileutil.exists(path):
+                return False
+        return True
+
+    def store(self, source, fingerprint, result):
+        """Store a result for a fingerprint."""
+        if fingerprint is None:
+            return
+        self._execute("INSERT OR REPLACE INTO metadata_cache "
+                      "(source, size, mtime, inode, content_hash, result, "
+                      "last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (source,) + fingerprint + (repr(result), time.time()),
+                      is_update=True)
+        self.stats['stores'] += 1
+        # we don't know if INSERT OR REPLACE added a row, so just recount
+        # when we next need to.
+        self.entry_count = None
+        if self._get_entry_count() > self.MAX_ENTRIES:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until we're well under
+        MAX_ENTRIES.
+        """
+        count = self._get_entry_count() - self.MAX_ENTRIES + self.EVICT_EXTRA
+        if count <= 0:
+            return
+        self._execute("DELETE FROM metadata_cache WHERE id IN "
+                      "(SELECT id FROM metadata_cache "
+                      "ORDER BY last_used LIMIT ?)", (count,),
+                      is_update=True)
+        self.stats['evictions'] += count
+        self.entry_count = None
+
 class _MetadataProcessor(signals.SignalEmitter):
     """Base class for processors that handle getting metadata somehow.
 
@@ -470,33 +697,130 @@ class _MetadataProcessor(signals.SignalEmitter):
         pass
 
 class _TaskProcessor(_MetadataProcessor):
-    """Handle sending tasks to the worker process.  """
+    """Handle sending tasks to the worker process.
+
+    If we have a MetadataResultCache, we check it before sending a task and
+    store the results of tasks that succeed.  Fingerprinting files means
+    reading from them, so we do that in the "files" thread pool, then look
+    up all the fingerprints from an add_tasks() call with one
+    MetadataResultCache.get_many() call.
+
+    Subclasses can support batching by setting SUPPORTS_BATCHES and
+    implementing _make_batch_task().  Then if batch_size is more than 1,
+    add_tasks() groups tasks into batches of up to batch_size paths and sends
+    each batch as a single task.  We hold on to the results for a batch until
+    it's done, then emit them all at once so that they get saved in the same
+    run_updates() call.
+    """
+    SUPPORTS_BATCHES = False
 
-    def __init__(self, source_name, limit):
+    def __init__(self, source_name, limit, result_cache=None, batch_size=1):
         _MetadataProcessor.__init__(self, source_name)
         self.limit = limit
+        self.result_cache = result_cache
+        self.batch_size = batch_size
+        # map source paths to the task id of the batch they were sent in
+        self._batch_ids = {}
+        # map batch task ids to (path, result) tuples that we've received
+        self._batch_results = collections.defaultdict(list)
+        # set while we handle the results of a batch, so that we send pending
+        # tasks all at once afterwards, rather than one at a time.
+        self._finishing_batch = False
         # map source paths to tasks
         self._active_tasks = {}
         self._pending_tasks = {}
+        # map source paths to tasks that we're calculating fingerprints for
+        self._fingerprinting = {}
+        # map source paths to fingerprints for tasks we've sent
+        self._fingerprints = {}
 
     def task_count(self):
-        return len(self._active_tasks) + len(self._pending_tasks)
+        return (len(self._active_tasks) + len(self._pending_tasks) +
+                len(self._fingerprinting))
 
     def add_task(self, task):
-        if len(self._active_tasks) < self.limit:
-            self._send_task(task)
-        else:
-            self._pending_tasks[task.source_path] = task
+        self.add_tasks([task])
+
+    def add_tasks(self, tasks):
+        if self.result_cache is None:
+            self._queue_tasks(tasks)
+            return
+        for task in tasks:
+            self._fingerprinting[task.source_path] = task
+        paths = [task.source_path for task in tasks]
+        eventloop.call_in_thread_pool('files',
+            lambda fingerprints: self._check_cache(tasks, fingerprints),
+            lambda error: self._check_cache(tasks, {}),
+            calc_file_fingerprints,
+            '%s: calc fingerprints' % self.source_name, paths)
+
+    def _check_cache(self, tasks, fingerprints):
+        # skip tasks that were removed (and maybe re-added) while we were
+        # calculating fingerprints
+        tasks = [task for task in tasks
+                 if self._fingerprinting.get(task.source_path) is task]
+        for task in tasks:
+            del self._fingerprinting[task.source_path]
+        cached = self.result_cache.get_many(self.source_name,
+                                            fingerprints.values())
+        to_queue = []
+        cached_results = []
+        for task in tasks:
+            fingerprint = fingerprints.get(task.source_path)
+            result = cached.get(fingerprint)
+            if result is None:
+                self._fingerprints[task.source_path] = fingerprint
+                to_queue.append(task)
+            else:
+                # copy the result, since it may be shared with other paths
+                cached_results.append((task.source_path, result.copy()))
+        self._queue_tasks(to_queue)
+        for path, result in cached_results:
+            logging.debug("%s result cached: %r", self.source_name, path)
+            self.emit('task-complete', path, result)
+
+    def _queue_tasks(self, tasks):
+        to_send = []
+        for task in tasks:
+            if len(self._active_tasks) + len(to_send) < self.limit:
+                to_send.append(task)
+            else:
+                self._pending_tasks[task.source_path] = task
+        self._send_tasks(to_send)
+
+    def _send_tasks(self, tasks):
+        if not self.SUPPORTS_BATCHES or self.batch_size <= 1:
+            for task in tasks:
+                self._send_task(task)
+            return
+        for start in xrange(0, len(tasks), self.batch_size):
+            chunk = tasks[start:start+self.batch_size]
+            if len(chunk) == 1:
+                self._send_task(chunk[0])
+            else:
+                self._send_batch(chunk)
 
     def _send_task(self, task):
         self._active_tasks[task.source_path] = task
+        self._batch_ids.pop(task.source_path, None)
         workerprocess.send(task, self._callback, self._errback)
 
+    def _send_batch(self, tasks):
+        batch_task = self._make_batch_task(tasks)
+        for task in tasks:
+            self._active_tasks[task.source_path] = task
+            self._batch_ids[task.source_path] = batch_task.task_id
+        workerprocess.send(batch_task, self._batch_callback,
+                           self._batch_errback, self._partial_callback)
+
     def remove_task_for_path(self, path):
         self.remove_tasks_for_paths([path])
 
     def remove_tasks_for_paths(self, paths):
         for path in paths:
+            self._fingerprints.pop(path, None)
+            self._fingerprinting.pop(path, None)
+            self._batch_ids.pop(path, None)
             try:
                 del self._active_tasks[path]
             except KeyError:
@@ -506,9 +830,15 @@ class _TaskProcessor(_MetadataProcessor):
                 except KeyError:
                     pass
 
-        while len(self._active_tasks) < self.limit and self._pending_tasks:
-            path, task = self._pending_tasks.popitem()
-            self._send_task(task)
+        if not self._finishing_batch:
+            self._send_pending_tasks()
+
+    def _send_pending_tasks(self):
+        count = min(self.limit - len(self._active_tasks),
+                    len(self._pending_tasks))
+        if count > 0:
+            self._send_tasks([self._pending_tasks.popitem()[1]
+                              for i in xrange(count)])
 
     def _callback(self, task, result):
         if task.source_path not in self._active_tasks:
@@ -517,6 +847,11 @@ class _TaskProcessor(_MetadataProcessor):
             return
         logging.debug("%s done: %r", self.source_name, task.source_path)
         self._check_for_none_values(result)
+        fingerprint = self._fingerprints.get(task.source_path)
+        if self.result_cache is not None and fingerprint is not None:
+            # store a copy, since our handlers may change result
+            self.result_cache.store(self.source_name, fingerprint,
+                                    result.copy())
         self.emit('task-complete', task.source_path, result)
         self.remove_task_for_path(task.source_path)
 
@@ -537,6 +872,58 @@ class _TaskProcessor(_MetadataProcessor):
         self.emit('task-error', task.source_path, error)
         self.remove_task_for_path(task.source_path)
 
+    def _partial_callback(self, batch_task, path, result):
+        if self._batch_ids.get(path) != batch_task.task_id:
+            logging.debug("%s done but already removed: %r", self.source_name,
+                          path)
+            return
+        self._batch_results[batch_task.task_id].append((path, result))
+
+    def _batch_callback(self, batch_task, result):
+        # We should have gotten partial results for each path that's still
+        # part of the batch.
+        self._finish_batch(batch_task,
+                           ValueError("%s didn't return a result" %
+                                      batch_task))
+
+    def _batch_errback(self, batch_task, error):
+        logging.warn("Error running %s: %s", batch_task, error)
+        self._finish_batch(batch_task, error)
+
+    def _finish_batch(self, batch_task, error):
+        """Handle the results for a batch task that's done.
+
+        Paths that we don't have results for fail with error.
+        """
+        batch_id = batch_task.task_id
+        self._finishing_batch = True
+        try:
+            for path, result in self._batch_results.pop(batch_id, []):
+                # check that the path wasn't removed since we got the result
+                if self._batch_ids.get(path) != batch_id:
+                    continue
+                task = self._active_tasks[path]
+                if isinstance(result, Exception):
+                    self._errback(task, result)
+                else:
+                    self._callback(task, result)
+            for path in batch_task.source_paths:
+                if self._batch_ids.get(path) == batch_id:
+                    self._errback(self._active_tasks[path], error)
+        finally:
+            self._finishing_batch = False
+        self._send_pending_tasks()
+
+class _MutagenProcessor(_TaskProcessor):
+    """_TaskProcessor that sends MutagenBatchTasks."""
+    SUPPORTS_BATCHES = True
+
+    def _make_batch_task(self, tasks):
+        """Make a task that processes the paths for a list of tasks."""
+        return workerprocess.MutagenBatchTask(
+            [task.source_path for task in tasks],
+            tasks[0].cover_art_directory)
+
 class _EchonestQueue(object):
     """Queue for echonest tasks.
 
@@ -590,12 +977,20 @@ class _EchonestProcessor(_MetadataProcessor):
     Currently we use ENMF to generate codes, but we may switch to echoprint in
     the future
 
-    _EchonestProcessor stops calling the codegen processor once a certain
-    buffer of codes to be sent to echonest is built up.
+    We run up to codegen_limit codegen processes at once.  We stop starting
+    new ones once the codes that are running plus the codes waiting to be
+    sent to echonest reach code_buffer_size.
+
+    If we have a MetadataResultCache, we store the codes that we generate
+    there, so we never have to run the codegen twice for the same file.  If
+    we have an echonest.ResponseCache, we pass it to query_echonest() so
+    that repeated lookups don't need to go over the network.
     """
 
-    # Cooldown time for our codegen process
+    # Cooldown time for each codegen slot after a codegen process finishes
     CODEGEN_COOLDOWN_TIME = 5.0
+    # source name for codes that we store in the MetadataResultCache
+    CODEGEN_CACHE_SOURCE = u'echonest-codegen'
 
     # constants that control pausing after we get a bunch of HTTP errors.
     # These settings mean that if we get 3 errors in 5 minutes, then we will
@@ -607,10 +1002,14 @@ class _EchonestProcessor(_MetadataProcessor):
     # handles it's work using httpclient rather than making tasks and sending
     # them to workerprocess.
 
-    def __init__(self, code_buffer_size, cover_art_dir):
+    def __init__(self, code_buffer_size, cover_art_dir, codegen_limit=1,
+                 result_cache=None, response_cache=None):
         _MetadataProcessor.__init__(self, u'echonest')
         self._code_buffer_size = code_buffer_size
+        self._codegen_limit = codegen_limit
         self._cover_art_dir = cover_art_dir
+        self.result_cache = result_cache
+        self.response_cache = response_cache
         # We create 3 queues to handle items at various stages of the process.
         # - _metadata_fetch_queue holds paths that we need to fetch the
         #    metadata for.  It's the first queue that paths go to
@@ -620,12 +1019,21 @@ class _EchonestProcessor(_MetadataProcessor):
         self._metadata_fetch_queue = _EchonestQueue()
         self._codegen_queue = _EchonestQueue()
         self._echonest_queue = _EchonestQueue()
-        self._running_codegen = False
+        # maps paths that we're running the codegen on to (start time,
+        # fingerprint) tuples
+        self._codegen_in_flight = {}
+        # paths popped from _codegen_queue that are waiting for their
+        # fingerprint to be checked against result_cache
+        self._codegen_fingerprinting = set()
         self._querying_echonest = False
         self._codegen_info = get_enmfp_executable_info()
-        self._codegen_cooldown_end = 0
+        # times when codegen slots finish their cooldown, oldest first
+        self._codegen_cooldowns = collections.deque()
         self._codegen_cooldown_caller = eventloop.DelayedFunctionCaller(
             self._process_queue)
+        # when the codegen went from idle to busy
+        self._codegen_busy_start = None
+        self.reset_stats()
         self._metadata_for_path = {}
         self._paths_in_system = set()
         self._http_error_times = collections.deque()
@@ -661,26 +1069,97 @@ class _EchonestProcessor(_MetadataProcessor):
         # chance.
         return 'title' in metadata
 
-    def _run_codegen(self, path):
+    def reset_stats(self):
+        self.stats = {
+            'codegen_runs': 0,
+            'codegen_errors': 0,
+            'codegen_cache_hits': 0,
+            'codegen_time': 0.0,
+            'codegen_busy_time': 0.0,
+        }
+
+    def get_stats(self):
+        """Get stats for the codegen and our queues.
+
+        :returns: dict.  The "codegen_*" counts are totals since the last
+        reset_stats() call.  codegen_time is the total time that codegen
+        processes ran, codegen_busy_time is the time that at least one was
+        running.  The "*_queue" and "codegen_in_flight" values are the
+        current queue depths.
+        """
+        stats = self.stats.copy()
+        busy_time = stats['codegen_busy_time']
+        if self._codegen_busy_start is not None:
+            busy_time += clock.clock() - self._codegen_busy_start
+        if busy_time > 0:
+            stats['codegen_per_second'] = stats['codegen_runs'] / busy_time
+        else:
+            stats['codegen_per_second'] = 0.0
+        stats['codegen_in_flight'] = len(self._codegen_in_flight)
+        stats['metadata_fetch_queue'] = len(self._metadata_fetch_queue)
+        stats['codegen_queue'] = len(self._codegen_queue)
+        stats['echonest_queue'] = len(self._echonest_queue)
+        return stats
+
+    def _run_codegens(self, paths):
+        if self.result_cache is None:
+            for path in paths:
+                self._run_codegen(path, None)
+            return
+        # Fingerprinting reads from the files, so do it in the files pool
+        # rather than on the event loop.  The paths hold their codegen slots
+        # until we know whether the cache has their codes.
+        self._codegen_fingerprinting.update(paths)
+        eventloop.call_in_thread_pool('files',
+                lambda fingerprints: self._check_codegen_cache(paths,
+                                                               fingerprints),
+                lambda error: self._check_codegen_cache(paths, {}),
+                calc_file_fingerprints, 'echonest: calc fingerprints', paths)
+
+    def _check_codegen_cache(self, paths, fingerprints):
+        self._codegen_fingerprinting.difference_update(paths)
+        cached = self.result_cache.get_many(self.CODEGEN_CACHE_SOURCE,
+                                            fingerprints.values())
+        for path in paths:
+            if path not in self._paths_in_system:
+                # removed while we were calculating the fingerprint
+                continue
+            fingerprint = fingerprints.get(path)
+            result = cached.get(fingerprint)
+            if result is not None:
+                self.stats['codegen_cache_hits'] += 1
+                self._echonest_queue.add(path, result['code'])
+            else:
+                self._run_codegen(path, fingerprint)
+        self._process_queue()
+
+    def _run_codegen(self, path, fingerprint):
+        if not self._codegen_in_flight:
+            self._codegen_busy_start = clock.clock()
+        self._codegen_in_flight[path] = (clock.clock(), fingerprint)
         echonest.exec_codegen(self._codegen_info, path, self._codegen_callback,
                                 self._codegen_errback)
-        self._running_codegen = True
 
     def _codegen_callback(self, path, code):
+        fingerprint = self._codegen_in_flight.get(path, (None, None))[1]
+        if self.result_cache is not None and fingerprint is not None:
+            self.result_cache.store(self.CODEGEN_CACHE_SOURCE, fingerprint,
+                                    {'code': code})
         if path in self._paths_in_system:
             self._echonest_queue.add(path, code)
         else:
             logging.warn("_EchonestProcessor._codegen_callback called for "
                          "path not in system: %r", path)
-        self._codegen_finished()
+        self._codegen_finished(path)
 
     def _codegen_errback(self, path, error):
         logging.warn("Error running echonest codegen for %r (%s)" %
                      (path, error))
+        self.stats['codegen_errors'] += 1
         self.emit('task-error', path, error)
-        del self._metadata_for_path[path]
+        self._metadata_for_path.pop(path, None)
         self._paths_in_system.discard(path)
-        self._codegen_finished()
+        self._codegen_finished(path)
 
     def _query_echonest(self, path, code):
         if path not in self._paths_in_system:
@@ -691,7 +1170,7 @@ class _EchonestProcessor(_MetadataProcessor):
         metadata = self._metadata_for_path.pop(path)
         echonest.query_echonest(path, self._cover_art_dir, code, version,
                                 metadata, self._echonest_callback,
-                                self._echonest_errback)
+                                self._echonest_errback, self.response_cache)
         self._querying_echonest = True
 
     def _echonest_callback(self, path, metadata):
@@ -722,8 +1201,16 @@ class _EchonestProcessor(_MetadataProcessor):
             self._process_metadata_fetch_queue()
         if self._should_process_echonest_queue():
             self._process_echonest_queue()
-        if self._should_process_codegen_queue():
-            self._run_codegen(self._codegen_queue.pop())
+        codegen_paths = []
+        while self._should_process_codegen_queue(len(codegen_paths)):
+            codegen_paths.append(self._codegen_queue.pop())
+            # keep the codegen queue filled so that we can use all of our
+            # codegen slots
+            if (not self._codegen_queue and
+                    self._should_process_metadata_fetch_queue()):
+                self._process_metadata_fetch_queue()
+        if codegen_paths:
+            self._run_codegens(codegen_paths)
 
     def _should_process_metadata_fetch_queue(self):
         # Try not to fetch metadata more quickly than we need to.  Only do it
@@ -731,14 +1218,21 @@ class _EchonestProcessor(_MetadataProcessor):
         return (self._metadata_fetch_queue and
                 len(self._codegen_queue) + len(self._echonest_queue) < 10)
 
-    def _should_process_codegen_queue(self):
+    def _should_process_codegen_queue(self, starting_count=0):
+        running_count = (len(self._codegen_in_flight) +
+                         len(self._codegen_fingerprinting) + starting_count)
         if not (self._codegen_queue and
-                not self._running_codegen and
-                len(self._echonest_queue) < self._code_buffer_size):
+                running_count < self._codegen_limit and
+                (running_count + len(self._echonest_queue) <
+                 self._code_buffer_size)):
             return False
-        cooldown_left = self._codegen_cooldown_end - clock.clock()
-        if cooldown_left > 0:
-            self._codegen_cooldown_caller.call_after_timeout(cooldown_left)
+        now = clock.clock()
+        while self._codegen_cooldowns and self._codegen_cooldowns[0] <= now:
+            self._codegen_cooldowns.popleft()
+        if running_count + len(self._codegen_cooldowns) >= self._codegen_limit:
+            # wait for the next slot to finish its cooldown
+            self._codegen_cooldown_caller.call_after_timeout(
+                self._codegen_cooldowns[0] - now)
             return False
         return True
 
@@ -777,10 +1271,21 @@ class _EchonestProcessor(_MetadataProcessor):
                     self._echonest_queue.add(path, None)
                 return
 
-    def _codegen_finished(self):
-        self._running_codegen = False
-        self._codegen_cooldown_end = (clock.clock() +
-                                      self.CODEGEN_COOLDOWN_TIME)
+    def _codegen_finished(self, path):
+        now = clock.clock()
+        try:
+            start_time, fingerprint = self._codegen_in_flight.pop(path)
+        except KeyError:
+            logging.warn("_EchonestProcessor._codegen_finished called for "
+                         "path not in flight: %r", path)
+        else:
+            self.stats['codegen_runs'] += 1
+            self.stats['codegen_time'] += now - start_time
+            if not self._codegen_in_flight:
+                self.stats['codegen_busy_time'] += (now -
+                                                    self._codegen_busy_start)
+                self._codegen_busy_start = None
+        self._codegen_cooldowns.append(now + self.CODEGEN_COOLDOWN_TIME)
         self._process_queue()
 
     def _should_pause_from_http_errors(self):
@@ -955,6 +1460,7 @@ class LibraryProgressCountTracker(object):
                          "file_finished (%s)", path)
         else:
             tracker.file_finished(path)
+            self._forget_finished_paths(self.file_types[path])
 
     def file_finished_local_processing(self, path):
         try:
@@ -1002,83 +1508,74 @@ class LibraryProgressCountTracker(object):
 
         old_tracker.remove_file(path)
         self.file_types[path] = new_file_type
+        self._forget_finished_paths(old_file_type)
 
-class _ProcessingCountTracker(object):
-    """Helps MetadataManager keep track of counts for MetadataProgressUpdate
-
-    For each file type, this class tracks the number of files that we're
-    still getting metadata for.
-    """
-    def __init__(self):
-        # map file type to the count for that type
-        self.counts = collections.defaultdict(int)
-        # map file type to the total for that type.  The total should track
-        # the number of file_started() calls, without ever going down.  Once
-        # the counts goes down to zero, it should be reset
-        self.totals = collections.defaultdict(int)
-        # map paths to the file type we currently think they are
-        self.file_types = {}
+    def _forget_finished_paths(self, file_type):
+        """Drop file_types entries once the tracker for a type resets.
 
-    def get_count(self, file_type):
-        return self.counts[file_type]
-
-    def get_total(self, file_type):
-        return self.totals[file_type]
-
-    def file_started(self, path, metadata=None):
-        """Add a path to our counts.
-
-        metadata is an optional dict of metadata for that file.
+        ProgressCountTracker forgets about all of its files once they're all
+        finished, so we should too.  Otherwise file_types would grow for every
+        path ever processed.
         """
-        if metadata is not None:
-            file_type = metadata['file_type']
-        else:
-            file_type = filetypes.item_file_type_for_filename(path)
-        self.file_types[path] = file_type
-        self.counts[file_type] += 1
-        self.totals[file_type] += 1
+        if self.trackers[file_type].all_files:
+            return
+        for path, path_file_type in self.file_types.items():
+            if path_file_type == file_type:
+                del self.file_types[path]
 
-    def check_file_type(self, path, metadata):
-        """Check we have the right file type for a path.
+class _CoverArtCache(object):
+    """Remembers cover art lookups while we build metadata for many paths.
 
-        Call this whenever the metadata changes for a path.
-        """
-        new_file_type = metadata['file_type']
-        try:
-            old_file_type = self.file_types[path]
-        except KeyError:
-            # not a big deal, we probably finished the file at the same time
-            # as the metadata update.
-            return
-        if new_file_type != old_file_type:
-            self.counts[old_file_type] -= 1
-            self.counts[new_file_type] += 1
-            # change total value too, since the original guess was wrong
-            self.totals[old_file_type] -= 1
-            self.totals[new_file_type] += 1
-            self.file_types[path] = new_file_type
+    Tracks from the same album share the same cover art, so we only want to
+    query the DB and stat the cover art files once per album.
+    """
+    def __init__(self, cover_art_dir, db_info):
+        self.cover_art_dir = cover_art_dir
+        self.db_info = db_info
+        self.albums = {}
+        self.existing_paths = {}
 
-    def file_finished(self, path):
-        """Remove a file from our counts."""
+    def path_exists(self, path):
         try:
-            file_type = self.file_types.pop(path)
+            return self.existing_paths[path]
         except KeyError:
-            # Not tracking this path, just ignore
-            return
-        self.counts[file_type] -= 1
-        if self.counts[file_type] == 0:
-            self.totals[file_type] = 0
+            exists = self.existing_paths[path] = os.path.exists(path)
+            return exists
 
-    def file_moved(self, old_path, new_path):
-        """Change the name for a file."""
+    def album_cover_art(self, album):
+        """Get the cover art to use for files in an album
+
+        :returns: tuple (echonest_path, fallback_path).  echonest_path is
+        cover art from echonest, it takes precedence over the file's own
+        cover art.  fallback_path is cover art from another file in the
+        album, or the cover art that older versions stored using the album
+        name.  Either can be None.
+        """
         try:
-            self.file_types[new_path] = self.file_types.pop(old_path)
+            return self.albums[album]
         except KeyError:
-            # not tracking this path, just ignore
-            return
-
-    def file_being_processed(self, path):
-        return path in self.file_types
+            rv = self.albums[album] = self._lookup_album(album)
+            return rv
+
+    def forget_album(self, album):
+        """Forget the cover art for an album after we got new cover art."""
+        self.albums.pop(album, None)
+
+    def _lookup_album(self, album):
+        filename = filetags.calc_cover_art_filename(album)
+        echonest_path = os.path.join(self.cover_art_dir, 'echonest',
+                                     filename)
+        if os.path.exists(echonest_path):
+            return (echonest_path, None)
+        mutagen_cover_art = MetadataEntry.cover_art_for_album(album,
+                                                              self.db_info)
+        if (mutagen_cover_art is not None and
+            self.path_exists(mutagen_cover_art)):
+            return (None, mutagen_cover_art)
+        old_mutagen_path = os.path.join(self.cover_art_dir, filename)
+        if os.path.exists(old_mutagen_path):
+            return (None, old_mutagen_path)
+        return (None, None)
 
 class MetadataManagerBase(signals.SignalEmitter):
     """Extract and track metadata for files.
@@ -1100,6 +1597,9 @@ class MetadataManagerBase(signals.SignalEmitter):
     # mean more responsiveness, longer times allow us to bulk update many
     # items at once.
     UPDATE_INTERVAL = 1.0
+    # max number of files to send to the worker process in a single mutagen
+    # task
+    MUTAGEN_BATCH_SIZE = 20
     RETRY_TEMPORARY_INTERVAL = 3600
     # how often to re-try net lookups that have failed
     NET_LOOKUP_RETRY_INTERVAL = 60 * 60 * 24 * 7 # 1 week
@@ -1115,10 +1615,22 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.cover_art_dir = cover_art_dir
         self.screenshot_dir = screenshot_dir
         self.echonest_cover_art_dir = os.path.join(cover_art_dir, 'echonest')
-        self.mutagen_processor = _TaskProcessor(u'mutagen', 100)
-        self.moviedata_processor = _TaskProcessor(u'movie-data', 100)
+        self.result_cache = self.make_result_cache()
+        self.cover_art_store = self.make_cover_art_store()
+        self._unused_cover_art_candidates = set()
+        # _CoverArtCache used while we build metadata for a batch of paths
+        self._cover_art_cache = None
+        self._remove_unused_cover_art_caller = \
+                eventloop.DelayedFunctionCaller(self.remove_unused_cover_art)
+        self.mutagen_processor = _MutagenProcessor(u'mutagen', 100,
+                                                   self.result_cache,
+                                                   self.MUTAGEN_BATCH_SIZE)
+        self.moviedata_processor = _TaskProcessor(u'movie-data', 100,
+                                                  self.result_cache)
+        codegen_limit = self.calc_codegen_limit()
         self.echonest_processor = _EchonestProcessor(
-            5, self.echonest_cover_art_dir)
+            max(5, codegen_limit * 2), self.echonest_cover_art_dir,
+            codegen_limit, self.result_cache, self.make_response_cache())
         self.pending_mutagen_tasks = []
         self.bulk_add_count = 0
         self.metadata_processors = [
@@ -1147,11 +1659,35 @@ class MetadataManagerBase(signals.SignalEmitter):
         self._retry_net_lookup_caller = \
                 eventloop.DelayedFunctionCaller(self.retry_net_lookup)
         self._retry_net_lookup_entries = {}
-        self._setup_path_placeholders()
-        self._setup_net_lookup_count()
+        self._setup_counts()
         # send initial NetLookupCounts message
         self._send_net_lookup_counts()
 
+    def make_result_cache(self):
+        """Create a MetadataResultCache for our worker process tasks.
+
+        Return None to not cache results.
+        """
+        return None
+
+    def make_response_cache(self):
+        """Create an echonest.ResponseCache for our echonest queries.
+
+        Return None to not cache replies.
+        """
+        return None
+
+    def calc_codegen_limit(self):
+        """Get the max number of echonest codegens to run at once."""
+        return 1
+
+    def make_cover_art_store(self):
+        """Create a coverart.CoverArtStore to remove unused cover art from.
+
+        Return None to never remove cover art files.
+        """
+        return None
+
     def _reset_new_metadata(self):
         self.new_metadata = collections.defaultdict(dict)
 
@@ -1180,31 +1716,25 @@ class MetadataManagerBase(signals.SignalEmitter):
                         logging.warn("MetadataManager: error creating: %s" 
                                      "(%s)", path, e)
 
-    def _setup_path_placeholders(self):
-        """Add None values to the cache for all MetadataStatus objects
+    def _setup_counts(self):
+        """Set up total_count and net_lookup_count
 
-        This makes path_in_system() work since it checks if the key exists.
-        However, we don't actually want to load the objects yet, since this is
-        called pretty early in the startup process.
-        """
-        rows = MetadataStatus.select(["path"], db_info=self.db_info)
-        for row in rows:
-            self.db_info.db.cache.set('metadata', row[0], None)
-        # also set up total_count here, since it's convenient.  total_count
-        # tracks the total number of paths in the system
-        self.total_count = len(rows)
-
-    def _setup_net_lookup_count(self):
-        """Set up net_lookup_count
-
-        net_lookup_count tracks the number of paths in the system with
-        net_lookup_enabled=True.
+        total_count tracks the total number of paths in the system and
+        net_lookup_count tracks the number of paths with
+        net_lookup_enabled=True.  We calculate both with a single aggregate
+        query, rather than loading any objects, since this is called pretty
+        early in the startup process.  After this, they are updated as paths
+        are added, removed and changed.
         """
+        self.total_count = self.net_lookup_count = 0
         cursor = self.db_info.db.cursor
-        cursor.execute("SELECT COUNT(1) "
+        cursor.execute("SELECT net_lookup_enabled, COUNT(1) "
                        "FROM metadata_status "
-                       "WHERE net_lookup_enabled=1")
-        self.net_lookup_count = cursor.fetchone()[0]
+                       "GROUP BY net_lookup_enabled")
+        for net_lookup_enabled, count in cursor.fetchall():
+            self.total_count += count
+            if net_lookup_enabled:
+                self.net_lookup_count += count
 
     @contextlib.contextmanager
     def bulk_add(self):
@@ -1233,8 +1763,8 @@ class MetadataManagerBase(signals.SignalEmitter):
         return self.bulk_add_count != 0
 
     def _send_pending_mutagen_tasks(self):
-        for task in self.pending_mutagen_tasks:
-            self.mutagen_processor.add_task(task)
+        # send all the tasks at once so that they get batched together
+        self.mutagen_processor.add_tasks(self.pending_mutagen_tasks)
         self.pending_mutagen_tasks = []
 
     def _translate_path(self, path):
@@ -1287,7 +1817,9 @@ class MetadataManagerBase(signals.SignalEmitter):
 
     def path_in_system(self, path):
         """Test if a path is in the metadata system."""
-        return self.db_info.db.cache.key_exists('metadata', path)
+        if self.db_info.db.cache.key_exists('metadata', path):
+            return True
+        return MetadataStatus.path_in_db(path, self.db_info)
 
     def worker_task_count(self):
         return (self.mutagen_processor.task_count() +
@@ -1352,16 +1884,56 @@ class MetadataManagerBase(signals.SignalEmitter):
                                                            self.db_info):
                 if entry.screenshot is not None:
                     self.remove_screenshot(entry.screenshot)
+                if entry.cover_art is not None:
+                    self._unused_cover_art_candidates.add(entry.cover_art)
                 entry.remove()
             status.remove()
             if status.current_processor is not None:
                 self.count_tracker.file_finished(path)
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
         self._send_net_lookup_counts_caller.call_when_idle()
+        if (self.cover_art_store is not None and
+            self._unused_cover_art_candidates):
+            # wait until the removals are committed before checking which
+            # files are still used.
+            self._remove_unused_cover_art_caller.call_when_idle()
 
     def remove_screenshot(self, screenshot):
         fileutil.delete(screenshot)
 
+    def remove_unused_cover_art(self):
+        """Delete cover art files for removed entries that nothing else uses.
+        """
+        if self.closed:
+            return
+        candidates = self._unused_cover_art_candidates
+        self._unused_cover_art_candidates = set()
+        removed = self.cover_art_store.remove_unused(
+            candidates, self._find_used_cover_art)
+        if removed:
+            logging.debug("removed %d unused cover art files", len(removed))
+
+    def _find_used_cover_art(self, paths):
+        """Find which cover art paths are still used.
+
+        Subclasses can extend this to check tables other than metadata.
+        """
+        return self._find_used_filenames('metadata', 'cover_art', paths)
+
+    def _find_used_filenames(self, table, column, paths):
+        """Find which paths are stored in a column of a table."""
+        sql_to_path = dict((filename_to_unicode(p), p) for p in paths)
+        sql_values = sql_to_path.keys()
+        used = []
+        # stay under SQLite's limit on the number of variables in a query
+        for start in xrange(0, len(sql_values), 500):
+            chunk = sql_values[start:start+500]
+            rows = self.db_info.db.execute(
+                "SELECT DISTINCT %s FROM %s WHERE %s IN (%s)" %
+                (column, table, column, ', '.join('?' * len(chunk))), chunk)
+            used.extend(sql_to_path[row[0]] for row in rows)
+        return used
+
     def will_move_files(self, paths):
         """Prepare for files to be moved
 
@@ -1388,7 +1960,7 @@ class MetadataManagerBase(signals.SignalEmitter):
         except KeyError:
             logging.warn("_process_files_moved: %s not in DB", old_path)
             return
-        if self.db_info.db.cache.key_exists('metadata', new_path):
+        if self.path_in_system(new_path):
             # There's already an entry for the new status.  What to do
             # here?  Let's use the new one
             logging.warn("_process_files_moved: already an object for "
@@ -1414,12 +1986,16 @@ class MetadataManagerBase(signals.SignalEmitter):
         status = self._get_status_for_path(path)
 
         metadata = self._get_metadata_from_filename(path)
+        mutagen_cover_art = None
         for entry in MetadataEntry.metadata_for_status(status, self.db_info):
             entry_metadata = entry.get_metadata()
+            if entry.source == u'mutagen':
+                # _add_cover_art() decides if we should use this
+                mutagen_cover_art = entry_metadata.pop('cover_art', None)
             metadata.update(entry_metadata)
         metadata['has_drm'] = status.get_has_drm()
         metadata['net_lookup_enabled'] = status.net_lookup_enabled
-        self._add_cover_art(metadata)
+        self._add_cover_art(metadata, mutagen_cover_art)
         return metadata
 
     def refresh_metadata_for_paths(self, paths):
@@ -1431,27 +2007,51 @@ class MetadataManagerBase(signals.SignalEmitter):
         """
 
         new_metadata = {}
-        for p in paths:
-            # make sure we include None values
-            metadata = dict((name, None) for name in attribute_names)
-            metadata.update(self.get_metadata(p))
-            new_metadata[p] = metadata
+        self._cover_art_cache = self._make_cover_art_cache()
+        try:
+            for p in paths:
+                # make sure we include None values
+                metadata = dict((name, None) for name in attribute_names)
+                metadata.update(self.get_metadata(p))
+                new_metadata[p] = metadata
+        finally:
+            self._cover_art_cache = None
         self.emit("new-metadata", new_metadata)
 
-    def _add_cover_art(self, metadata):
-        """Add the cover art path to a metadata dict """
+    def _make_cover_art_cache(self):
+        return _CoverArtCache(self.cover_art_dir, self.db_info)
+
+    def _add_cover_art(self, metadata, mutagen_cover_art=None):
+        """Add the cover art path to a metadata dict
+
+        :param metadata: metadata dict to update
+        :param mutagen_cover_art: cover art that mutagen found in the file
+        """
 
         # if the user hasn't explicitly set the cover art for an item, get it
-        # using the album.
-        if 'album' in metadata and 'cover_art' not in metadata:
-            filename = filetags.calc_cover_art_filename(metadata['album'])
-            mutagen_path = os.path.join(self.cover_art_dir, filename)
-            echonest_path = os.path.join(self.cover_art_dir, 'echonest',
-                                         filename)
-            if os.path.exists(echonest_path):
-                metadata['cover_art'] = echonest_path
-            elif os.path.exists(mutagen_path):
-                metadata['cover_art'] = mutagen_path
+        # using the album.  Cover art from echonest is stored using the album
+        # name and takes precedence.  Cover art from mutagen is stored by
+        # content, so if the file doesn't have any, we need to find another
+        # file from the album that does.  Older versions stored mutagen
+        # cover art using the album name, so check for that last.
+        if 'cover_art' in metadata:
+            return
+        if 'album' not in metadata:
+            if mutagen_cover_art is not None:
+                metadata['cover_art'] = mutagen_cover_art
+            return
+        cache = self._cover_art_cache
+        if cache is None:
+            cache = self._make_cover_art_cache()
+        echonest_path, fallback_path = cache.album_cover_art(
+            metadata['album'])
+        if echonest_path is not None:
+            metadata['cover_art'] = echonest_path
+        elif (mutagen_cover_art is not None and
+              cache.path_exists(mutagen_cover_art)):
+            metadata['cover_art'] = mutagen_cover_art
+        elif fallback_path is not None:
+            metadata['cover_art'] = fallback_path
 
     def set_user_data(self, path, user_data):
         """Update metadata based on user-inputted data
@@ -1704,11 +2304,13 @@ class MetadataManagerBase(signals.SignalEmitter):
         # be expected.  It seems fast enough in other cases to me - BDK
         new_metadata_copy = self.new_metadata
         app.bulk_sql_manager.start()
+        self._cover_art_cache = self._make_cover_art_cache()
         try:
             self._process_metadata_finished()
             self._process_metadata_errors()
             self.emit('new-metadata', self.new_metadata)
         finally:
+            self._cover_art_cache = None
             self._reset_new_metadata()
             try:
                 app.bulk_sql_manager.finish()
@@ -1776,6 +2378,9 @@ class MetadataManagerBase(signals.SignalEmitter):
         else:
             can_skip_get_metadata = False
         status.update_after_success(entry, result)
+        if ('cover_art' in result and 'album' in result and
+            self._cover_art_cache is not None):
+            self._cover_art_cache.forget_album(result['album'])
         if can_skip_get_metadata:
             self.new_metadata[path].update(result)
         else:
@@ -1839,6 +2444,23 @@ class LibraryMetadataManager(MetadataManagerBase):
     def make_count_tracker(self):
         return LibraryProgressCountTracker()
 
+    def make_result_cache(self):
+        return MetadataResultCache(self.db_info)
+
+    def make_response_cache(self):
+        return echonest.ResponseCache(self.db_info)
+
+    def calc_codegen_limit(self):
+        return max(get_logical_cpu_count(), 1)
+
+    def make_cover_art_store(self):
+        return coverart.CoverArtStore(self.cover_art_dir)
+
+    def _find_used_cover_art(self, paths):
+        # items store cover art that they got through _add_cover_art() too
+        return (MetadataManagerBase._find_used_cover_art(self, paths) +
+                self._find_used_filenames('item', 'cover_art', paths))
+
 class DeviceMetadataManager(MetadataManagerBase):
     """MetadataManager for devices."""
 
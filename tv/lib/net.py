@@ -328,10 +328,11 @@ class AsyncSocket(object):
             eventloop.remove_write_callback(self.socket)
             trap_call(self, errback, ConnectionTimeout(host))
             self.connectionErrback = None
-        eventloop.call_in_thread(onAddressLookup, handleGetAddrInfoException,
-                                 socket.getaddrinfo,
-                                 "getAddrInfo - %s:%s" % (host, port),
-                                 host, port)
+        eventloop.call_in_thread_pool('network', onAddressLookup,
+                                      handleGetAddrInfoException,
+                                      socket.getaddrinfo,
+                                      "getAddrInfo - %s:%s" % (host, port),
+                                      host, port)
 
     def accept_connection(self, family, host, port, callback, errback):
         def finishAccept():
@@ -506,9 +507,10 @@ class AsyncSSLStream(AsyncSocket):
                         disable_read_timeout=None):
         def onSocketOpen(self):
             self.socket.setblocking(1)
-            eventloop.call_in_thread(onSSLOpen, handleSSLError, convert_to_ssl,
-                                   "AsyncSSL onSocketOpen()",
-                                   self.socket)
+            eventloop.call_in_thread_pool('network', onSSLOpen,
+                                          handleSSLError, convert_to_ssl,
+                                          "AsyncSSL onSocketOpen()",
+                                          self.socket)
         def onSSLOpen(ssl):
             if self.socket is None:
                 # the connection was closed while we were calling
@@ -29,6 +29,7 @@
 
 import os
 import logging
+import time
 
 from xml.dom import minidom
 from xml.sax import saxutils
@@ -43,6 +44,7 @@ from miro import app
 from miro import folder
 from miro import dialogs
 from miro import eventloop
+from miro import messages
 from miro import tabs
 
 from miro.gtcache import gettext as _
@@ -187,6 +189,7 @@ class Importer(object):
         self.current_folder = None
         self.ignored_feeds = 0
         self.imported_feeds = 0
+        self.last_progress_time = 0
 
     @eventloop.as_idle
     def import_subscriptions(self, pathname, show_summary=True):
@@ -201,12 +204,37 @@ class Importer(object):
 
         try:
             subscriptions = self.import_content(content)
-            self.result = subscription.Subscriber().add_subscriptions(
-                subscriptions)
-            if show_summary:
-                self.show_import_summary()
         except expat.ExpatError:
             self.show_xml_error()
+            return
+
+        # OPML files can have thousands of feeds.  Add them all in one go
+        # and let the feedupdate queue download them a few at a time.
+        if show_summary:
+            progress_callback = self.show_progress
+            title = self.progress_title()
+            messages.ProgressDialogStart(title).send_to_frontend()
+        else:
+            progress_callback = None
+        try:
+            self.result = subscription.Subscriber().bulk_add_subscriptions(
+                subscriptions, progress_callback)
+        finally:
+            if show_summary:
+                messages.ProgressDialogFinished().send_to_frontend()
+        if show_summary:
+            self.show_import_summary()
+
+    def progress_title(self):
+        return _("Importing Podcasts")
+
+    def show_progress(self, done, total):
+        current_time = time.time()
+        if current_time < self.last_progress_time + 0.5 and done < total:
+            return
+        self.last_progress_time = current_time
+        text = '%s (%s/%s)' % (self.progress_title(), done, total)
+        messages.ProgressDialog(text, float(done) / total).send_to_frontend()
 
     def import_content(self, content):
         dom = minidom.parseString(content)
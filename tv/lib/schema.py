@@ -493,6 +493,7 @@ class ItemSchema(MultiClassObjectSchema):
             ('item_feed_downloader', ('feed_id', 'downloader_id',)),
             ('item_file_type', ('file_type',)),
             ('item_filename', ('filename',)),
+            ('item_watched_time', ('watched_time',)),
     )
 
 class DeviceItemSchema(ObjectSchema):
@@ -653,6 +654,9 @@ class RSSFeedImplSchema(FeedImplSchema):
         ('initialHTML', SchemaBinary(noneOk=True)),
         ('etag', SchemaString(noneOk=True)),
         ('modified', SchemaString(noneOk=True)),
+        ('content_hash', SchemaString(noneOk=True)),
+        ('parsed_link', SchemaString(noneOk=True)),
+        ('parsed_license', SchemaString(noneOk=True)),
     ]
 
 class SavedSearchFeedImplSchema(FeedImplSchema):
@@ -992,13 +996,75 @@ class MetadataEntrySchema(DDBObjectSchema):
 
     indexes = (
         ('metadata_entry_status', ('status_id',)),
+        ('metadata_entry_album', ('album',)),
+        ('metadata_entry_cover_art', ('cover_art',)),
     )
 
     unique_indexes = (
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 201
+class MetadataCacheSchema(NoObjectSchema):
+    """Schema for metadata.MetadataResultCache."""
+    table_name = 'metadata_cache'
+    fields = DDBObjectSchema.fields + [
+        ('source', SchemaString()),
+        ('size', SchemaInt()),
+        ('mtime', SchemaFloat()),
+        ('inode', SchemaInt()),
+        ('content_hash', SchemaString()),
+        ('result', SchemaString()),
+        ('last_used', SchemaFloat()),
+    ]
+
+    indexes = (
+        ('metadata_cache_last_used', ('last_used',)),
+    )
+
+    unique_indexes = (
+        ('metadata_cache_key',
+         ('content_hash', 'size', 'mtime', 'inode', 'source')),
+    )
+
+class HTTPResponseCacheSchema(NoObjectSchema):
+    """Schema for echonest.ResponseCache."""
+    table_name = 'http_response_cache'
+    fields = DDBObjectSchema.fields + [
+        ('cache_key', SchemaString()),
+        ('body', SchemaBinary(noneOk=True)),
+        ('status_code', SchemaInt(noneOk=True)),
+        ('expires', SchemaFloat()),
+    ]
+
+    indexes = (
+        ('http_response_cache_expires', ('expires',)),
+    )
+
+    unique_indexes = (
+        ('http_response_cache_key', ('cache_key',)),
+    )
+
+class DirectoryScanIndexSchema(NoObjectSchema):
+    """Schema for dirscanner.DirectoryScanner."""
+    table_name = 'directory_scan_index'
+    fields = DDBObjectSchema.fields + [
+        ('owner_id', SchemaInt()),
+        ('path', SchemaFilename()),
+        ('parent', SchemaFilename(noneOk=True)),
+        ('is_dir', SchemaBool()),
+        ('size', SchemaInt(noneOk=True)),
+        ('mtime', SchemaFloat(noneOk=True)),
+    ]
+
+    indexes = (
+        ('directory_scan_index_parent', ('owner_id', 'parent')),
+    )
+
+    unique_indexes = (
+        ('directory_scan_index_path', ('owner_id', 'path')),
+    )
+
+VERSION = 208
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
@@ -1011,7 +1077,8 @@ object_schemas = [
     PlaylistItemMapSchema, PlaylistFolderItemMapSchema,
     TabOrderSchema, ThemeHistorySchema, DisplayStateSchema, GlobalStateSchema,
     DBLogEntrySchema, ViewStateSchema, MetadataStatusSchema,
-    MetadataEntrySchema
+    MetadataEntrySchema, MetadataCacheSchema, HTTPResponseCacheSchema,
+    DirectoryScanIndexSchema,
 ]
 
 device_object_schemas = [
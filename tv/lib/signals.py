@@ -99,44 +99,69 @@ class WeakCallback:
         return self.ref() is None
 
 class CallbackSet(object):
-    """Stores callbacks connected to a signal for SignalEmitter."""
+    """Stores callbacks connected to a signal for SignalEmitter.
+
+    The list returned by all_callbacks() is cached until a callback is added
+    or removed, since signals get emitted much more often than they get
+    connected to.
+    """
     def __init__(self):
         self.callbacks = {}
         self.callbacks_after = {}
         self.callbacks_before = {}
+        self._all_callbacks = None
+        self.weak_count = 0
+
+    def _added(self, callback):
+        self._all_callbacks = None
+        if isinstance(callback, WeakCallback):
+            self.weak_count += 1
+
+    def _removed(self, callback):
+        self._all_callbacks = None
+        if isinstance(callback, WeakCallback):
+            self.weak_count -= 1
 
     def add_callback(self, id_, callback):
         self.callbacks[id_] = callback
+        self._added(callback)
 
     def add_callback_after(self, id_, callback):
         self.callbacks_after[id_] = callback
+        self._added(callback)
 
     def add_callback_before(self, id_, callback):
         self.callbacks_before[id_] = callback
+        self._added(callback)
 
     def remove_callback(self, id_):
-        if id_ in self.callbacks:
-            del self.callbacks[id_]
-        elif id_ in self.callbacks_after:
-            del self.callbacks_after[id_]
-        elif id_ in self.callbacks_before:
-            del self.callbacks_before[id_]
-        else:
-            logging.warning(
-                "disconnect called but callback_handle not in the callback")
+        for callback_dict in (self.callbacks,
+                              self.callbacks_after,
+                              self.callbacks_before):
+            if id_ in callback_dict:
+                self._removed(callback_dict.pop(id_))
+                return
+        logging.warning(
+            "disconnect called but callback_handle not in the callback")
 
     def all_callbacks(self):
         """Get a list of all Callback objects stored.
 
-        The list will contain callbacks added with add_callback() then
-        callbacks added with add_callback_after().
+        The list will contain callbacks added with add_callback_before(),
+        then add_callback(), then add_callback_after().
+
+        The list is shared between calls, don't modify it.
         """
-        return (self.callbacks_before.values() +
-                self.callbacks.values() +
-                self.callbacks_after.values())
+        if self._all_callbacks is None:
+            self._all_callbacks = (self.callbacks_before.values() +
+                                   self.callbacks.values() +
+                                   self.callbacks_after.values())
+        return self._all_callbacks
 
     def clear_old_weak_references(self):
         """Remove any dead WeakCallbacks."""
+        if self.weak_count == 0:
+            return
         all_dicts = (self.callbacks,
                      self.callbacks_after,
                      self.callbacks_before)
@@ -144,6 +169,7 @@ class CallbackSet(object):
             for id_, callback in callback_dict.items():
                 if callback.is_dead():
                     del callback_dict[id_]
+                    self._removed(callback)
 
     def __len__(self):
         return (len(self.callbacks) + len(self.callbacks_after) +
@@ -156,6 +182,8 @@ class SignalEmitter(object):
         self._currently_emitting = set()
         self._okay_to_nest = set()
         self._frozen = False
+        # maps signal names to the do_* method names for them
+        self._method_names = {}
         for name in signal_names:
             self.create_signal(name)
 
@@ -169,6 +197,7 @@ class SignalEmitter(object):
         if name in self.signal_callbacks:
             raise KeyError("%s was already created" % name)
         self.signal_callbacks[name] = CallbackSet()
+        self._method_names[name] = 'do_' + name.replace('-', '_')
         if okay_to_nest:
             self._okay_to_nest.add(name)
 
@@ -251,33 +280,33 @@ class SignalEmitter(object):
     def emit(self, name, *args):
         if self._frozen:
             return
+        callbacks = self.get_callbacks(name)
+        self_callback = getattr(self, self._method_names[name], None)
+        if self_callback is None and len(callbacks) == 0:
+            # Nobody is listening, skip the nesting checks and the rest.
+            return False
         if name not in self._okay_to_nest:
             if name in self._currently_emitting:
                 raise NestedSignalError("Can't emit %s while handling %s" %
                         (name, name))
             self._currently_emitting.add(name)
         try:
-            callback_returned_true = self._run_signal(name, args)
+            callback_returned_true = self._run_signal(callbacks,
+                                                      self_callback, args)
         finally:
             self._currently_emitting.discard(name)
-            self.clear_old_weak_references()
+            # Only prune the signal we emitted.  Dead callbacks on other
+            # signals are harmless until those signals get emitted.
+            callbacks.clear_old_weak_references()
         return callback_returned_true
 
-    def _run_signal(self, name, args):
-        callback_returned_true = False
-        try:
-            self_callback = getattr(self, 'do_' + name.replace('-', '_'))
-        except AttributeError:
-            pass
-        else:
-            if self_callback(*args):
-                callback_returned_true = True
-        if not callback_returned_true:
-            for callback in self.get_callbacks(name).all_callbacks():
-                if callback.invoke(self, args):
-                    callback_returned_true = True
-                    break
-        return callback_returned_true
+    def _run_signal(self, callbacks, self_callback, args):
+        if self_callback is not None and self_callback(*args):
+            return True
+        for callback in callbacks.all_callbacks():
+            if callback.invoke(self, args):
+                return True
+        return False
 
     def clear_old_weak_references(self):
         for callback_set in self.signal_callbacks.values():
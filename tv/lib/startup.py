@@ -498,6 +498,7 @@ def on_frontend_started():
     app.icon_cache_updater.start_updates()
     yield None
     feed.expire_items()
+    feed.update_counts()
     yield None
     commandline.startup()
     yield None
@@ -929,17 +929,15 @@ class LiveStorage(signals.SignalEmitter):
         for obj in objects:
             obj.reset_changed_attributes()
 
-    def update_obj(self, obj):
-        """Update a DDBObject on disk."""
-
-        obj_schema = self._schema_map[obj.__class__]
-        setters = []
+    def _changed_values_for_obj(self, obj_schema, obj):
+        """Get the columns and values that need to be saved for obj."""
+        columns = []
         values = []
         for name, schema_item in obj_schema.fields:
             if (isinstance(schema_item, schema.SchemaSimpleItem) and
                     name not in obj.changed_attributes):
                 continue
-            setters.append('%s=?' % name)
+            columns.append(name)
             value = getattr(obj, name)
             try:
                 schema_item.validate(value)
@@ -948,6 +946,14 @@ class LiveStorage(signals.SignalEmitter):
                 raise
             values.append(self._converter.to_sql(obj_schema, name,
                 schema_item, value))
+        return columns, values
+
+    def update_obj(self, obj):
+        """Update a DDBObject on disk."""
+
+        obj_schema = self._schema_map[obj.__class__]
+        columns, values = self._changed_values_for_obj(obj_schema, obj)
+        setters = ['%s=?' % name for name in columns]
         obj.reset_changed_attributes()
         if values:
             sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
@@ -963,6 +969,30 @@ class LiveStorage(signals.SignalEmitter):
                             "(id: %s, count: %s)" %
                             (obj.id, self.cursor.rowcount))
 
+    def bulk_update(self, objects):
+        """Update a list of objects in one go.
+
+        Objects that changed the same set of columns are saved with a single
+        executemany() call.  Throws a ValueError if the objects don't all use
+        the same database table.
+        """
+        if len(objects) == 0:
+            return
+        obj_schema = self._schema_map[objects[0].__class__]
+        value_lists = {}
+        for obj in objects:
+            if obj_schema != self._schema_map[obj.__class__]:
+                raise ValueError("Incompatible types for bulk update")
+            columns, values = self._changed_values_for_obj(obj_schema, obj)
+            obj.reset_changed_attributes()
+            if values:
+                values.append(obj.id)
+                value_lists.setdefault(tuple(columns), []).append(values)
+        for columns, value_list in value_lists.items():
+            sql = "UPDATE %s SET %s WHERE id=?" % (obj_schema.table_name,
+                    ', '.join('%s=?' % name for name in columns))
+            self.execute(sql, value_list, is_update=True, many=True)
+
     def remove_obj(self, obj):
         """Remove a DDBObject from disk."""
 
@@ -1033,7 +1063,8 @@ class LiveStorage(signals.SignalEmitter):
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
-    def _get_query_bottom(self, table_name, where, joins, order_by, limit):
+    def _get_query_bottom(self, table_name, where, joins, order_by, limit,
+            group_by=None):
         sql = StringIO()
         sql.write("FROM %s\n" % table_name)
         if joins is not None:
@@ -1041,6 +1072,8 @@ class LiveStorage(signals.SignalEmitter):
                 sql.write('LEFT JOIN %s ON %s\n' % (join_table, join_where))
         if where is not None:
             sql.write("WHERE %s" % where)
+        if group_by is not None:
+            sql.write(" GROUP BY %s" % group_by)
         if order_by is not None:
             sql.write(" ORDER BY %s" % order_by)
         if limit is not None:
@@ -1147,12 +1180,12 @@ class LiveStorage(signals.SignalEmitter):
         self.execute(sql.getvalue(), values, is_update=True)
 
     def select(self, klass, columns, where, values, joins=None, limit=None,
-            convert=True):
+            convert=True, group_by=None):
         schema = self._schema_map[klass]
         sql = StringIO()
         sql.write('SELECT %s ' % ', '.join(columns))
         sql.write(self._get_query_bottom(schema.table_name, where, joins, None,
-            limit))
+            limit, group_by))
         results = self.execute(sql.getvalue(), values)
         if not convert:
             return results
@@ -38,6 +38,7 @@ Platforms need to ensure that this script is available and that it can be run
 with the command line and env from plat.utils.miro_helper_program_info().
 """
 
+import collections
 import ctypes
 import cPickle as pickle
 import logging
@@ -48,6 +49,7 @@ import sys
 import threading
 import trapcall
 import warnings
+import zlib
 import Queue
 
 from miro import app
@@ -72,8 +74,15 @@ def _on_windows():
 # ** Protocol between miro and subprocesses **
 #
 # We spawn a child process and communicate to it by sending messages through
-# it's stdin and stdout.  Each message contains a length (a unsigned long)
-# followed by a pickled object.
+# it's stdin and stdout.  Messages are sent in frames.  Each frame contains a
+# length (an unsigned long long), a flags byte, then the payload.  Normally the
+# payload is a single object pickled with the highest pickle protocol.  If
+# FRAME_BATCH is set, the payload is several pickles, each prefixed with their
+# length.  If FRAME_COMPRESSED is set, the payload is zlib compressed.
+#
+# Writers batch together messages that pile up while they are writing.  In
+# the main process, we queue up messages and write them all from an idle
+# callback, so sending lots of tasks at once only costs a few writes.
 #
 # The communication goes like this:
 #
@@ -115,9 +124,10 @@ class SubprocessMessage(messagetools.Message):
 
 class StartupInfo(SubprocessMessage):
     """Data needed to bootstrap the subprocess."""
-    def __init__(self, config_dict, in_unit_tests):
+    def __init__(self, config_dict, in_unit_tests, compress_threshold=None):
         self.config_dict = config_dict
         self.in_unit_tests = in_unit_tests
+        self.compress_threshold = compress_threshold
 
 class HandlerInfo(SubprocessMessage):
     """Describes how to build a SubprocessHandler object."""
@@ -252,6 +262,14 @@ class SubprocessResponder(messagetools.MessageHandler):
         """Called after the subprocess restarts after a crash."""
         pass
 
+    def on_crash(self):
+        """Called when the subprocess quits unexpectedly.
+
+        This is called right away, before we wait out restart_delay and call
+        on_restart().
+        """
+        pass
+
     def handle_subprocess_error(self, msg):
         if msg.soft_fail:
             app.controller.failed_soft('in subprocess', msg.report)
@@ -262,6 +280,82 @@ class LoadError(StandardError):
     """Exception for corrupt data when reading from a pipe."""
 
 SIZEOF_LONG = struct.calcsize("Q")
+# Each frame starts with the size of the payload and some flags
+FRAME_HEADER = struct.Struct("QB")
+# The payload is several messages, each prefixed with its size
+FRAME_BATCH = 1
+# The payload is zlib compressed
+FRAME_COMPRESSED = 2
+PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+# Don't put more than this much data in a single frame, unless a single
+# message is larger
+MAX_FRAME_SIZE = 1024 * 1024
+
+class MessageStats(object):
+    """Tracks message counts, sizes and latencies for one side of a pipe.
+
+    Stats are kept for each message type, keyed by class name.  For sent
+    messages, latency is the time between when we started to pickle the
+    message and when it was written.  For received messages, it's the time
+    spent unpickling.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.messages = {}
+            self.frames = 0
+            self.frame_bytes = 0
+            self.compressed_frames = 0
+
+    def record_message(self, message_type, size, latency):
+        with self.lock:
+            try:
+                info = self.messages[message_type]
+            except KeyError:
+                info = self.messages[message_type] = {
+                    'count': 0,
+                    'bytes': 0,
+                    'total_latency': 0.0,
+                    'max_latency': 0.0,
+                }
+            info['count'] += 1
+            info['bytes'] += size
+            info['total_latency'] += latency
+            info['max_latency'] = max(info['max_latency'], latency)
+
+    def record_frame(self, size, compressed):
+        with self.lock:
+            self.frames += 1
+            self.frame_bytes += size
+            if compressed:
+                self.compressed_frames += 1
+
+    def get_stats(self):
+        """Get a snapshot of our stats.
+
+        :returns: dict with the keys "frames", "frame_bytes",
+        "compressed_frames" and "messages".  "messages" maps message types
+        to dicts with the keys "count", "bytes", "total_latency",
+        "max_latency" and "avg_latency".
+        """
+        with self.lock:
+            messages = {}
+            for message_type, info in self.messages.iteritems():
+                info = info.copy()
+                info['avg_latency'] = info['total_latency'] / info['count']
+                messages[message_type] = info
+            return {
+                'frames': self.frames,
+                'frame_bytes': self.frame_bytes,
+                'compressed_frames': self.compressed_frames,
+                'messages': messages,
+            }
+
+def _message_type(obj):
+    return type(obj).__name__
 
 def _read_bytes_from_pipe(pipe, length):
     """Read size bytes from a pipe.
@@ -282,27 +376,53 @@ def _read_bytes_from_pipe(pipe, length):
         data.append(d)
     return ''.join(data)
 
-def _load_obj(pipe):
-    """Load an object from one side of a pipe.
-
-    _load_obj blocks until the all the data has been sent.
+def _read_frame(pipe, stats=None):
+    """Read one frame from a pipe.
 
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
 
-    :returns: Python object send from the other side
+    :returns: list of pickle strings
     """
-    size_data = _read_bytes_from_pipe(pipe, SIZEOF_LONG)
-    if len(size_data) < SIZEOF_LONG:
+    header = _read_bytes_from_pipe(pipe, FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
         raise LoadError("EOF reached while reading size field "
-                "(read %s bytes)" % len(size_data))
-    size = struct.unpack("Q", size_data)[0]
-    pickle_data = _read_bytes_from_pipe(pipe, size)
-    if len(pickle_data) < size:
+                "(read %s bytes)" % len(header))
+    size, flags = FRAME_HEADER.unpack(header)
+    data = _read_bytes_from_pipe(pipe, size)
+    if len(data) < size:
         raise LoadError("EOF reached while reading pickle data "
-                "(read %s bytes)" % len(pickle_data))
+                "(read %s bytes)" % len(data))
+    if stats is not None:
+        stats.record_frame(size, flags & FRAME_COMPRESSED)
+    if flags & FRAME_COMPRESSED:
+        try:
+            data = zlib.decompress(data)
+        except zlib.error, e:
+            raise LoadError("Compressed data corrupt: %s" % e)
+    if not flags & FRAME_BATCH:
+        return [data]
+    pickles = []
+    pos = 0
+    while pos < len(data):
+        if pos + SIZEOF_LONG > len(data):
+            raise LoadError("Batch frame truncated")
+        (length,) = struct.unpack_from("Q", data, pos)
+        pos += SIZEOF_LONG
+        if pos + length > len(data):
+            raise LoadError("Batch frame truncated")
+        pickles.append(data[pos:pos+length])
+        pos += length
+    return pickles
+
+def _unpickle(pickle_data, stats=None):
+    """Unpickle an object read from a pipe.
+
+    :raises LoadError: data read was corrupted
+    """
+    start = clock.clock()
     try:
-        return pickle.loads(pickle_data)
+        obj = pickle.loads(pickle_data)
     except pickle.PickleError:
         raise LoadError("Pickle data corrupt")
     except ImportError:
@@ -311,6 +431,55 @@ def _load_obj(pipe):
         # log this exception for easier debugging.
         send_subprocess_error_for_exception()
         raise LoadError("Unknown error in pickle.loads: %s" % e)
+    if stats is not None:
+        stats.record_message(_message_type(obj), len(pickle_data),
+                             clock.clock() - start)
+    return obj
+
+def _build_frame(pickles, compress_threshold=None):
+    """Build a frame to send a list of pickle strings.
+
+    If compress_threshold is not None, then we try to compress payloads that
+    are at least that many bytes.
+
+    :returns: (frame_data, payload_size, compressed) tuple
+    """
+    if len(pickles) == 1:
+        flags = 0
+        data = pickles[0]
+    else:
+        flags = FRAME_BATCH
+        parts = []
+        for pickle_data in pickles:
+            parts.append(struct.pack("Q", len(pickle_data)))
+            parts.append(pickle_data)
+        data = ''.join(parts)
+    compressed = False
+    if compress_threshold is not None and len(data) >= compress_threshold:
+        compressed_data = zlib.compress(data, 1)
+        if len(compressed_data) < len(data):
+            data = compressed_data
+            flags |= FRAME_COMPRESSED
+            compressed = True
+    # Send the header and data in a single write.  Our pipes are unbuffered,
+    # so each write() is a system call.
+    return FRAME_HEADER.pack(len(data), flags) + data, len(data), compressed
+
+def _load_obj(pipe):
+    """Load a single object from one side of a pipe.
+
+    _load_obj blocks until the all the data has been sent.  Use a
+    MessageReader if the other side may send batches of messages.
+
+    :raises IOError: low-level error while reading from the pipe
+    :raises LoadError: data read was corrupted
+
+    :returns: Python object send from the other side
+    """
+    pickles = _read_frame(pipe)
+    if len(pickles) != 1:
+        raise LoadError("Expected 1 object, got %s" % len(pickles))
+    return _unpickle(pickles[0])
 
 def _dump_obj(obj, pipe):
     """Dump an object to the other side of the pipe.
@@ -318,19 +487,145 @@ def _dump_obj(obj, pipe):
     :raises IOError: low-level error while writing to the pipe
     :raises pickle.PickleError: obj could not be pickled
     """
-
-    pickle_data = pickle.dumps(obj)
-    size_data = struct.pack("Q", len(pickle_data))
+    frame_data = _build_frame([pickle.dumps(obj, PICKLE_PROTOCOL)])[0]
     # NOTE: We do a blocking write here.  This should be fine, since on both
     # sides we have a thread dedicated to just reading from the pipe and
     # pushing the data into a Queue.  However, there's some chance that the
     # process on the other side has gone really haywire and the reader thread
     # is hung.  I (BDK) can't really see a way for this to realistically
     # happen, so we stick with blocking writes.
-    pipe.write(size_data)
-    pipe.write(pickle_data)
+    pipe.write(frame_data)
     pipe.flush()
 
+class MessageReader(object):
+    """Reads messages from one side of a pipe.
+
+    Frames can contain several messages, so we store any extras until the
+    next call to read().
+    """
+    def __init__(self, pipe, stats=None):
+        self.pipe = pipe
+        self.stats = stats
+        self.pending = collections.deque()
+
+    def read(self):
+        """Read the next object from the pipe.
+
+        :raises IOError: low-level error while reading from the pipe
+        :raises LoadError: data read was corrupted
+        """
+        while not self.pending:
+            self.pending.extend(_read_frame(self.pipe, self.stats))
+        return _unpickle(self.pending.popleft(), self.stats)
+
+class MessageWriter(object):
+    """Writes messages to one side of a pipe.
+
+    Messages are pickled as soon as they are sent, but writing can be put off
+    until flush() is called.  Any messages waiting when we write get batched
+    together into as few frames as possible.
+
+    It's safe for multiple threads to use a MessageWriter at once.  If a
+    thread calls send() while another thread is writing, the message gets
+    added to the batch for the writing thread instead of waiting for it.
+    """
+    def __init__(self, pipe, stats=None, compress_threshold=None):
+        self.pipe = pipe
+        self.stats = stats
+        self.compress_threshold = compress_threshold
+        self.lock = threading.Condition()
+        # (pickle_data, message_type, start_time) tuples
+        self.pending = []
+        self.writing = False
+
+    def queue(self, obj):
+        """Queue up an object to be written at the next flush().
+
+        :raises pickle.PickleError: obj could not be pickled
+        """
+        start = clock.clock()
+        pickle_data = pickle.dumps(obj, PICKLE_PROTOCOL)
+        with self.lock:
+            self.pending.append((pickle_data, _message_type(obj), start))
+
+    def send(self, obj, wait=False):
+        """Send an object over the pipe.
+
+        :param wait: see flush()
+        :raises IOError: low-level error while writing to the pipe
+        :raises pickle.PickleError: obj could not be pickled
+        """
+        self.queue(obj)
+        self.flush(wait)
+
+    def has_pending(self):
+        return len(self.pending) > 0
+
+    def flush(self, wait=False):
+        """Write out all queued messages.
+
+        If another thread is writing, it will pick up our messages, so
+        normally we return right away.  If wait is True, we wait until
+        the messages are actually written instead.
+
+        If a write fails, we drop the batch that we were writing, but keep
+        any other queued messages for the next flush().  Those may have been
+        left for us by other threads.
+
+        :raises IOError: low-level error while writing to the pipe
+        """
+        with self.lock:
+            if self.writing and not wait:
+                return
+            while self.writing:
+                self.lock.wait()
+            if not self.pending:
+                return
+            self.writing = True
+        try:
+            while True:
+                with self.lock:
+                    batch = self._next_batch()
+                    if not batch:
+                        self._finish_writing()
+                        return
+                self._write_batch(batch)
+        except:
+            with self.lock:
+                self._finish_writing()
+            raise
+
+    def _finish_writing(self):
+        # Must be called with the lock held.
+        self.writing = False
+        self.lock.notify_all()
+
+    def _next_batch(self):
+        # Must be called with the lock held.
+        size = 0
+        for i, (pickle_data, message_type, start) in enumerate(self.pending):
+            size += len(pickle_data)
+            if size > MAX_FRAME_SIZE and i > 0:
+                break
+        else:
+            i = len(self.pending)
+        batch = self.pending[:i]
+        del self.pending[:i]
+        return batch
+
+    def _write_batch(self, batch):
+        frame_data, size, compressed = _build_frame(
+            [pickle_data for (pickle_data, message_type, start) in batch],
+            self.compress_threshold)
+        self.pipe.write(frame_data)
+        self.pipe.flush()
+        if self.stats is not None:
+            end = clock.clock()
+            self.stats.record_frame(size, compressed)
+            for (pickle_data, message_type, start) in batch:
+                self.stats.record_message(message_type, len(pickle_data),
+                                          end - start)
+
 class SubprocessManager(object):
     """Manages a running subprocess
 
@@ -339,14 +634,16 @@ class SubprocessManager(object):
     """
 
     def __init__(self, message_base_class, responder, handler_class,
-            handler_args=None, restart_delay=60):
+            handler_args=None, restart_delay=60, compress_threshold=None):
         """Create a new SubprocessManager.
 
         This method prepares the subprocess to run.  Use start() to start it
         up.
 
         We will install a MessageHandler for message_base_class that sends
-        them to the subprocess.
+        them to the subprocess.  If message_base_class is None, we don't
+        install a handler, this is useful when something else is routing
+        messages to several SubprocessManagers.
 
         responder will receive callbacks when the subprocess sends messages.
 
@@ -355,10 +652,15 @@ class SubprocessManager(object):
 
         restart_delay controls how quickly we restart crashed subprocesses.
         We will not start more than 1 process per <restart_delay> seconds.
+
+        If compress_threshold is not None, messages frames at least that many
+        bytes get compressed in both directions.  This is off by default since
+        copying data through a pipe is usually cheaper than compressing it.
         """
         if handler_args is None:
             handler_args = ()
-        message_base_class.install_handler(self)
+        if message_base_class is not None:
+            message_base_class.install_handler(self)
         self.responder = responder
         self.handler_class = handler_class
         self.handler_args = handler_args
@@ -368,6 +670,11 @@ class SubprocessManager(object):
         self.thread = None
         self.start_time = 0
         self.restart_delay = restart_delay
+        self.compress_threshold = compress_threshold
+        self.writer = None
+        self.flush_idle = None
+        self.sent_stats = MessageStats()
+        self.received_stats = MessageStats()
 
     # Process management
 
@@ -382,6 +689,8 @@ class SubprocessManager(object):
         """Does the work to startup a new process/thread."""
         # create our child process.
         self.process = self._start_subprocess()
+        self.writer = MessageWriter(self.process.stdin, self.sent_stats,
+                                    self.compress_threshold)
         # create thread to handle the subprocess's output.  It would be nice
         # to eliminate this thread, but I don't see an easy way to integrate
         # it into the eventloop, since windows doesn't have support for
@@ -390,7 +699,7 @@ class SubprocessManager(object):
         # This thread only handles the subprocess output.  We write to the
         # subprocess stdin from the eventloop.
         self.thread = SubprocessResponderThread(self.process.stdout,
-                self.responder, self._on_thread_quit)
+                self.responder, self._on_thread_quit, self.received_stats)
         self.thread.daemon = True
         self.thread.start()
         # work is all done, do some finishing touches
@@ -421,6 +730,8 @@ class SubprocessManager(object):
         if not self.is_running:
             return
 
+        # write out anything that send_message() queued up
+        self.flush_messages()
         # we're about to shut down, tell our responder
         trapcall.trap_call("subprocess shutdown", self.responder.on_shutdown)
         # Politely ask our process to shutdown
@@ -476,6 +787,7 @@ class SubprocessManager(object):
             logging.warn("Subprocess quit unexpectedly (quit_type: %s, "
                          "sent_quit: %s).  Will restart subprocess",
                          self.thread.quit_type, self.sent_quit)
+            trapcall.trap_call("subprocess crash", self.responder.on_crash)
             # NOTE: should we enforce some sort of cool-down time before
             # restarting the subprocess?
             time_since_start = clock.clock() - self.start_time
@@ -508,33 +820,82 @@ class SubprocessManager(object):
 
         self.thread = None
         self.process = None
+        self.writer = None
         self.is_running = False
+        if self.flush_idle is not None:
+            self.flush_idle.cancel()
+            self.flush_idle = None
 
     # Handle communication to our child process
 
     def send_message(self, msg):
-        """Send a message to our subprocess """
+        """Send a message to our subprocess
+
+        The message gets pickled right away.  In the event loop thread, we
+        wait until the current idle callback finishes to write it.  That way
+        if we send a bunch of messages at once, they get batched together.
+        In other threads, we write it right away, since the event loop might
+        not be running.
+        """
 
         if not self.is_running:
             raise ValueError("subprocess not running")
         try:
-            _dump_obj(msg, self.process.stdin)
+            self.writer.queue(msg)
+        except pickle.PickleError:
+            logging.warn("Error pickling message in send_message() (%s)", msg)
+            return
+        if not eventloop.in_event_loop_thread():
+            self.flush_messages()
+        elif self.flush_idle is None:
+            self.flush_idle = eventloop.add_idle(self._flush_idle_callback,
+                    'flush subprocess messages',
+                    priority=eventloop.PRIORITY_HIGH)
+
+    def _flush_idle_callback(self):
+        self.flush_idle = None
+        self.flush_messages()
+
+    def flush_messages(self, wait=False):
+        """Write out messages queued by send_message().
+
+        :param wait: see MessageWriter.flush()
+        """
+        if self.writer is None:
+            return
+        try:
+            self.writer.flush(wait)
         except IOError:
             logging.warn("Broken pipe in send_message()")
             # we could try to restart our subprocess here, but if the pipe is
             # really broken, then our thread will quit soon and this will
             # cause a restart.
-        except pickle.PickleError:
-            logging.warn("Error pickling message in send_message() (%s)", msg)
 
     def send_quit(self):
         """Ask the subprocess to shutdown."""
         self.send_message(None)
+        self.flush_messages(wait=True)
         self.sent_quit = True
 
+    def get_stats(self):
+        """Get stats about the messages we've sent/received.
+
+        :returns: dict with the keys "sent" and "received".  The values are
+        the dicts returned by MessageStats.get_stats().
+        """
+        return {
+            'sent': self.sent_stats.get_stats(),
+            'received': self.received_stats.get_stats(),
+        }
+
+    def reset_stats(self):
+        self.sent_stats.reset()
+        self.received_stats.reset()
+
     def _send_startup_info(self):
         self.send_message(StartupInfo(self._get_config_dict(),
-                                      hasattr(app, 'in_unit_tests')))
+                                      hasattr(app, 'in_unit_tests'),
+                                      self.compress_threshold))
         self.send_message(HandlerInfo(self.handler_class, self.handler_args))
 
     def _get_config_dict(self):
@@ -556,19 +917,19 @@ class SubprocessManager(object):
         # just forward the message to our process
         self.send_message(msg)
 
-def _read_from_pipe(pipe):
+def _read_from_pipe(reader):
     """Read objects from a pipe.
 
-    This method is a generator that reads pickled objects from pipe.  It
-    terminates when None is sent over the pipe.
+    This method is a generator that reads pickled objects using a
+    MessageReader.  It terminates when None is sent over the pipe.
 
-    raises the same exceptions that _load_obj does, namely:
+    raises the same exceptions that MessageReader.read() does, namely:
 
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
     """
     while True:
-        msg = _load_obj(pipe)
+        msg = reader.read()
         if msg is None:
             return # other side wants to quit
         yield msg
@@ -585,11 +946,13 @@ class SubprocessResponderThread(threading.Thread):
     QUIT_BAD_DATA = 2
     QUIT_UNKNOWN = 3
 
-    def __init__(self, subprocess_stdout, responder, quit_callback):
+    def __init__(self, subprocess_stdout, responder, quit_callback,
+                 stats=None):
         """Create a new SubprocessResponderThread
 
         :param subprocess_stdout: STDOUT pipe from our subprocess
         :param responder: SubprocessResponder object to handle messages
+        :param stats: MessageStats to track the messages we read
         """
 
         threading.Thread.__init__(self)
@@ -597,11 +960,13 @@ class SubprocessResponderThread(threading.Thread):
         self.subprocess_stdout = subprocess_stdout
         self.responder = responder
         self.quit_callback = quit_callback
+        self.stats = stats
         self.quit_type = None
 
     def run(self):
         try:
-            for msg in _read_from_pipe(self.subprocess_stdout):
+            reader = MessageReader(self.subprocess_stdout, self.stats)
+            for msg in _read_from_pipe(reader):
                 self.responder.handle(msg)
         except LoadError, e:
             logging.warn("Quiting from bad data from our subprocess in "
@@ -637,7 +1002,7 @@ def subprocess_main():
     sys.stdout = sys.stdin = None
     # initialize things
     try:
-        handler = _subprocess_setup(stdin, stdout)
+        handler, reader = _subprocess_setup(stdin, stdout)
     except Exception, e:
         # error reading our initial messages.  Try to log a warning, then
         # quit.
@@ -648,7 +1013,7 @@ def subprocess_main():
     logging.info("_subprocess_setup() finished")
     # startup thread to process stdin
     queue = Queue.Queue()
-    thread = threading.Thread(target=_subprocess_pipe_thread, args=(stdin,
+    thread = threading.Thread(target=_subprocess_pipe_thread, args=(reader,
         queue))
     thread.daemon = False
     thread.start()
@@ -673,7 +1038,17 @@ def subprocess_main():
 def _finish_subprocess_message_stream(stdout):
     """Signal that we are done sending messages in the subprocess."""
     try:
-        _dump_obj(None, stdout)
+        handler = SubprocessResponse.handler
+    except AttributeError:
+        handler = None
+    try:
+        if isinstance(handler, PipeMessageProxy):
+            # go through the writer so that we don't write in the middle of
+            # another thread's frame.  Wait for the write to finish, since
+            # we're about to quit.
+            handler.writer.send(None, wait=True)
+        else:
+            _dump_obj(None, stdout)
     except IOError:
         # just ignore since we're done writing out anyways
         pass
@@ -683,9 +1058,10 @@ def _finish_subprocess_message_stream(stdout):
 def _subprocess_setup(stdin, stdout):
     """Does initial setup for a subprocess.
 
-    Returns a SubprocessHandler to use for the subprocess
+    Returns a (SubprocessHandler, MessageReader) tuple to use for the
+    subprocess
 
-    raises the same exceptions that _load_obj does, namely:
+    raises the same exceptions that MessageReader.read() does, namely:
 
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
@@ -696,10 +1072,12 @@ def _subprocess_setup(stdin, stdout):
     # setup MessageHandler for messages going to the main process
     msg_handler = PipeMessageProxy(stdout)
     SubprocessResponse.install_handler(msg_handler)
+    reader = MessageReader(stdin)
     # load startup info
-    msg = _load_obj(stdin)
+    msg = reader.read()
     if not isinstance(msg, StartupInfo):
         raise LoadError("first message must a StartupInfo obj")
+    msg_handler.writer.compress_threshold = msg.compress_threshold
     # setup some basic modules like config and gtcache
     utils.initialize_locale()
     config.load(config.ManualConfig())
@@ -711,24 +1089,24 @@ def _subprocess_setup(stdin, stdout):
     logging_setup = True
     logging.info("Logging Started")
     # setup our handler
-    msg = _load_obj(stdin)
+    msg = reader.read()
     if not isinstance(msg, HandlerInfo):
         raise LoadError("second message must a HandlerInfo obj")
     try:
-        return msg.handler_class(*msg.handler_args)
+        return msg.handler_class(*msg.handler_args), reader
     except StandardError, e:
         # log this exception for easier debugging.
         send_subprocess_error_for_exception()
         raise LoadError("Exception while constructing handler: %s" % e)
 
-def _subprocess_pipe_thread(stdin, queue):
+def _subprocess_pipe_thread(reader, queue):
     """Thread inside the subprocess that reads messages from stdin.
 
     We use a separate thread so that our pipe doesn't get backed up while we
     are process messages
     """
     try:
-        for msg in _read_from_pipe(stdin):
+        for msg in _read_from_pipe(reader):
             queue.put(msg)
     except StandardError, e:
         # we could try to send a SubprocessError message, but it's highly
@@ -744,16 +1122,16 @@ class PipeMessageProxy(object):
     This is used in the subprocess to send messages back to the main process
     over it's stdout pipe
 
-    It's safe for multiple threads in the subprocess to use this at once
+    It's safe for multiple threads in the subprocess to use this at once.  If
+    several worker threads finish at the same time, their results get
+    batched together.
     """
     def __init__(self, fileobj):
-        self.fileobj = fileobj
-        self.lock = threading.Lock()
+        self.writer = MessageWriter(fileobj)
 
     def handle(self, msg):
         try:
-            with self.lock:
-                _dump_obj(msg, self.fileobj)
+            self.writer.send(msg)
         except pickle.PickleError:
             send_subprocess_error_for_exception()
         # NOTE: we don't handle IOError here because what can we do about
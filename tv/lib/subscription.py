@@ -47,11 +47,13 @@ import logging
 import urllib2
 import urlparse
 
+from miro import app
 from miro import httpclient
 from miro import singleclick
 from miro import feed
 from miro import folder
 from miro import guide
+from miro import models
 
 
 SUBSCRIBE_HOSTS = ('subscribe.getdemocracy.com', 'subscribe.getmiro.com')
@@ -124,6 +126,14 @@ def find_subscribe_links(url):
     else:
         return [{'type': 'feed', 'url': urllib2.unquote(path[1:])}]
 
+def _count_subscriptions(subscriptions_list):
+    count = 0
+    for subscription in subscriptions_list:
+        count += 1
+        if subscription['type'] == 'folder':
+            count += _count_subscriptions(subscription['children'])
+    return count
+
 class Subscriber(object):
     """
     This class represents the common functionality of the subscription
@@ -131,6 +141,48 @@ class Subscriber(object):
     command-line additions).
     """
 
+    def __init__(self):
+        self.bulk = False
+        self.progress_callback = None
+
+    def bulk_add_subscriptions(self, subscriptions_list,
+                               progress_callback=None):
+        """Add lots of subscriptions at once.
+
+        This works like add_subscriptions(), but it's made for things like
+        OPML files with thousands of feeds:
+
+            - All feeds and folders get inserted in a single transaction.
+            - New feeds don't start downloading right away.  Their first
+              update goes through the feedupdate queue, in the order they
+              were listed.
+
+        :param progress_callback: if given, called with (done, total) as
+            we handle subscriptions.  Folders count as one subscription
+            plus their children.
+        """
+        self.bulk = True
+        self.progress_callback = progress_callback
+        self.progress_done = 0
+        self.progress_total = _count_subscriptions(subscriptions_list)
+        self.known_feeds = set(tuple(row) for row in
+                               feed.Feed.select(['orig_url', 'searchTerm']))
+        self.set_folder_count = 0
+        app.bulk_sql_manager.start()
+        try:
+            result = self.add_subscriptions(subscriptions_list)
+        finally:
+            app.bulk_sql_manager.finish()
+            self.bulk = False
+        if self.set_folder_count > 0:
+            models.Item.update_folder_trackers()
+        return result
+
+    def _report_progress(self):
+        self.progress_done += 1
+        if self.progress_callback is not None:
+            self.progress_callback(self.progress_done, self.progress_total)
+
     def add_subscriptions(self, subscriptions_list, parent_folder=None):
         """
         We loop through the list of subscriptions, creating things as
@@ -177,6 +229,8 @@ class Subscriber(object):
             else:
                 raise ValueError('unknown subscription type: %s' %
                                  subscription_type)
+            if self.bulk:
+                self._report_progress()
         return added, ignored
 
     def handle_folder(self, folder_dict, parent_folder):
@@ -211,9 +265,18 @@ class Subscriber(object):
         url = feed_dict['url']
 
         search_term = feed_dict.get('search_term')
-        f = feed.lookup_feed(url, search_term)
+        if self.bulk:
+            # Feeds we add won't be in the database until the end of the
+            # transaction, so keep track of what we have ourselves.
+            if (url, search_term) in self.known_feeds:
+                return False
+            self.known_feeds.add((url, search_term))
+            f = None
+        else:
+            f = feed.lookup_feed(url, search_term)
         if f is None:
-            f = feed.Feed(url, search_term=search_term)
+            f = feed.Feed(url, search_term=search_term,
+                          defer_generate=self.bulk)
             title = feed_dict.get('title')
             if title is not None and title != '':
                 f.set_title(title)
@@ -230,7 +293,13 @@ class Subscriber(object):
                 else:
                     f.set_expiration(u'feed', expiry_time)
             if parent_folder is not None:
-                f.set_folder(parent_folder)
+                if self.bulk:
+                    # bulk_add_subscriptions() updates the trackers once
+                    # at the end
+                    f.set_folder(parent_folder, update_trackers=False)
+                    self.set_folder_count += 1
+                else:
+                    f.set_folder(parent_folder)
             return True
         else:
             return False
@@ -60,6 +60,7 @@ from miro.test.httpclienttest import *
 from miro.test.httpdownloadertest import *
 from miro.test.httpauthtoolstest import *
 from miro.test.feedtest import *
+from miro.test.feedupdatetest import *
 from miro.test.feedparsertest import *
 from miro.test.parseurltest import *
 from miro.test.utiltest import *
@@ -2,6 +2,7 @@ import os
 import unittest
 import pprint
 
+from miro import fastfeedparser
 from miro import feedparserutil
 from miro.item import FeedParserValues
 from miro.plat import resources
@@ -236,6 +237,129 @@ class FeedParserValuesTest(unittest.TestCase):
             self.assertEquals(fpv.data["thumbnail_url"], url)
 
 
+# feeds in FPTESTINPUT that fastfeedparser should leave to feedparser
+FAST_PATH_FALLBACKS = ('feed_with_nul_bytes.xml', 'ooze.rss')
+
+FAST_PATH_FEED = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:media="http://search.yahoo.com/mrss/"
+  xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd"
+  xmlns:content="http://purl.org/rss/1.0/modules/content/"
+  xml:base="http://example.com/base/">
+<channel>
+<title>Feed &amp; Title</title>
+<image><url>logo.png</url><title>Logo</title></image>
+<ttl>60</ttl>
+<item>
+ <guid>http://example.com/guid1</guid>
+ <title>One &lt;i&gt;x&lt;/i&gt;</title>
+ <enclosure url="http://example.com/1.mp4" length="123" type="Video/MP4"/>
+ <media:thumbnail url="http://example.com/1.jpg"/>
+ <pubDate>Mon, 06 Sep 2010 16:45:00 GMT</pubDate>
+ <comments>comments/1</comments>
+</item>
+<item>
+ <link>rel/2.html</link>
+ <guid isPermaLink="false">guid2</guid>
+ <content:encoded><![CDATA[<p><a href="x.html">Hi</a><script>x()</script></p>]]></content:encoded>
+ <description>not used, content:encoded came first</description>
+ <media:content url="http://example.com/2.mov" type="video/quicktime">
+   <media:text>enclosure text</media:text>
+ </media:content>
+</item>
+<item>
+ <itunes:subtitle>only a subtitle</itunes:subtitle>
+ <itunes:image href="http://example.com/3.png"/>
+ <enclosure url="http://example.com/3.mp3" type="audio/mpeg"/>
+</item>
+</channel>
+</rss>
+"""
+
+def _feed_values(parsed):
+    feed = parsed['feed']
+    image = feed.get('image')
+    if image is not None:
+        image = image.get('url', image.get('href'))
+    return (feed.get('title'), image, feed.get('ttl'), feed.get('license'))
+
+@dynamic_test(expected_cases=9)
+class FastFeedParserTest(MiroTestCase):
+    def check_same_as_feedparser(self, data):
+        fast = fastfeedparser.parse(data)
+        full = feedparserutil.parse(data)
+        self.assertNotEquals(fast, None)
+        self.assertEquals(_feed_values(fast), _feed_values(full))
+        self.assertEquals(len(fast['entries']), len(full['entries']))
+        for fast_entry, full_entry in zip(fast['entries'], full['entries']):
+            self.assertEquals(FeedParserValues(fast_entry).data,
+                              FeedParserValues(full_entry).data)
+        return fast
+
+    @classmethod
+    def generate_tests(cls):
+        for path in os.listdir(FPTESTINPUT):
+            yield (path,)
+
+    def dynamic_test_case(self, path):
+        data = open(os.path.join(FPTESTINPUT, path)).read()
+        if path in FAST_PATH_FALLBACKS:
+            self.assertEquals(fastfeedparser.parse(data), None)
+            parsed = feedparserutil.parse_feed_body(data)
+            self.assertEquals(len(parsed['entries']),
+                              len(feedparserutil.parse(data)['entries']))
+        else:
+            self.check_same_as_feedparser(data)
+
+    def test_feedparser_quirks(self):
+        parsed = self.check_same_as_feedparser(FAST_PATH_FEED)
+        self.assertEquals(_feed_values(parsed),
+                          (u'Feed & Title', u'http://example.com/base/logo.png',
+                           u'60', None))
+        data = [FeedParserValues(e).data for e in parsed['entries']]
+        # guids without isPermaLink="false" are used as links
+        self.assertEquals(data[0]['link'], u'http://example.com/guid1')
+        self.assertEquals(data[0]['thumbnail_url'],
+                          u'http://example.com/1.jpg')
+        self.assertEquals(data[0]['comments_link'],
+                          u'http://example.com/base/comments/1')
+        self.assertEquals(data[1]['link'], u'http://example.com/base/rel/2.html')
+        self.assertEquals(data[1]['rss_id'], u'http://example.com/base/guid2')
+        # media:text overrides the description
+        self.assertEquals(data[1]['entry_description'], u'enclosure text')
+        self.assertEquals(parsed['entries'][1]['summary'],
+                          u'<p><a href="http://example.com/base/x.html">Hi</a>'
+                          '</p>')
+        self.assertEquals(data[2]['entry_description'], u'only a subtitle')
+        self.assertEquals(data[2]['thumbnail_url'],
+                          u'http://example.com/3.png')
+
+    def test_fallback(self):
+        # things that the fast path leaves to feedparser
+        for data in (
+            FAST_PATH_FEED.replace('<ttl>', '<dtv:startnback xmlns:dtv='
+                                   '"http://participatoryculture.org/RSSModules/'
+                                   'dtv/1.0">1</dtv:startnback><ttl>'),
+            FAST_PATH_FEED.replace('utf-8', 'iso-8859-1'),
+            FAST_PATH_FEED.replace('<channel>',
+                                   '<!DOCTYPE rss SYSTEM "foo"><channel>'),
+            FAST_PATH_FEED.replace('version="2.0"', 'version="0.91"'),
+            FAST_PATH_FEED.replace('</channel>', ''),
+            u'<rss version="2.0"><channel></channel></rss>',
+            ):
+            self.assertEquals(fastfeedparser.parse(data), None)
+            parsed = feedparserutil.parse_feed_body(data)
+            self.assert_('entries' in parsed)
+
+    def test_html_cache(self):
+        fastfeedparser._html_cache.clear()
+        first = fastfeedparser.parse(FAST_PATH_FEED)
+        self.assertEquals(len(fastfeedparser._html_cache), 1)
+        second = fastfeedparser.parse(FAST_PATH_FEED)
+        self.assertEquals(len(fastfeedparser._html_cache), 1)
+        self.assertEquals(first['entries'][1]['summary'],
+                          second['entries'][1]['summary'])
+
+
 # FIXME - could use way more feedparser tests
 
 if __name__ == "__main__":
@@ -6,8 +6,16 @@ from miro import app
 from miro import prefs
 from miro import dialogs
 from miro import feedparserutil
+from miro import feedupdate
 from miro.item import Item
-from miro.feed import validate_feed_url, normalize_feed_url, Feed
+from miro import eventloop
+from miro import searchengines
+from miro.feed import (validate_feed_url, normalize_feed_url, Feed,
+                       calc_content_hash, update_counts, ScraperFeedImpl,
+                       ScraperPageCache, ScrapeRun)
+from miro.test import mock
+from miro.singleclick import _build_entry
+from miro.item import FeedParserValues
 
 from miro.test.framework import MiroTestCase, EventLoopTest
 
@@ -251,6 +259,180 @@ jalabel_nov28.jpg" />
         self.assertEqual(len(items), 4)
         my_feed.remove()
 
+class ContentHashTest(FeedTestCase):
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        feedupdate.global_update_queue.reset_stats()
+
+    def write_feed(self, build_date, guids):
+        items = ["""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Downhill Battle Pics</title>
+      <link>http://downhillbattle.org/</link>
+      <lastBuildDate>%s</lastBuildDate>
+      <!-- generated at %s -->
+""" % (build_date, build_date)]
+        for guid in guids:
+            items.append("""\
+<item>
+ <title>Bumper Sticker</title>
+ <guid>guid-%s</guid>
+ <enclosure url="http://downhillbattle.org/key/gallery/%s.mpg" />
+</item>
+""" % (guid, guid))
+        items.append("""
+   </channel>
+</rss>""")
+        self.write_file("\n".join(items))
+
+    def check_stats(self, unchanged, changed):
+        stats = feedupdate.get_stats()
+        self.assertEquals(stats['content_unchanged'], unchanged)
+        self.assertEquals(stats['content_changed'], changed)
+
+    def test_calc_content_hash(self):
+        self.write_feed('Tue, 10 Jun 2003 09:41:01 GMT', [1, 2])
+        hash1 = calc_content_hash(open(self.filename).read())
+        self.write_feed('Wed, 11 Jun 2003 10:00:00 GMT', [1, 2])
+        hash2 = calc_content_hash(open(self.filename).read())
+        self.write_feed('Wed, 11 Jun 2003 10:00:00 GMT', [1, 2, 3])
+        hash3 = calc_content_hash(open(self.filename).read())
+        self.assertEquals(hash1, hash2)
+        self.assertNotEquals(hash1, hash3)
+
+    def test_skip_unchanged(self):
+        self.write_feed('Tue, 10 Jun 2003 09:41:01 GMT', [1, 2])
+        feed = self.make_feed()
+        self.assertEquals(Item.make_view().count(), 2)
+        self.assertNotEquals(feed.actualFeed.content_hash, None)
+        # only the volatile parts changed, so we shouldn't parse the feed
+        self.write_feed('Wed, 11 Jun 2003 10:00:00 GMT', [1, 2])
+        self.update_feed(feed)
+        self.check_stats(1, 0)
+        self.assert_(not feed.actualFeed.updating)
+        # a real change should be parsed
+        self.write_feed('Wed, 11 Jun 2003 10:00:00 GMT', [1, 2, 3])
+        self.update_feed(feed)
+        self.check_stats(1, 1)
+        self.assertEquals(Item.make_view().count(), 3)
+
+    def test_skip_unchanged_after_restart(self):
+        self.write_feed('Tue, 10 Jun 2003 09:41:01 GMT', [1, 2])
+        feed = self.make_feed()
+        # reload the feed objects, like we would after a restart.  We
+        # shouldn't need anything from the last parse, besides what's in the
+        # database, to skip parsing.
+        self.reload_object(feed.actualFeed)
+        feed = self.reload_object(feed)
+        self.write_feed('Wed, 11 Jun 2003 10:00:00 GMT', [1, 2])
+        self.update_feed(feed)
+        self.check_stats(1, 0)
+        self.assert_(not feed.actualFeed.updating)
+
+    def test_clean_old_items_reparses(self):
+        self.write_feed('Tue, 10 Jun 2003 09:41:01 GMT', [1, 2])
+        feed = self.make_feed()
+        feed.actualFeed.clean_old_items()
+        while feed.actualFeed.updating:
+            self.processThreads()
+            self.process_idles()
+            sleep(0.1)
+        self.check_stats(0, 1)
+
+class ItemReconcileTest(FeedTestCase):
+    def write_feed(self, entries):
+        items = ["""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Downhill Battle Pics</title>
+      <link>http://downhillbattle.org/</link>
+"""]
+        for guid, title, description in entries:
+            if guid is not None:
+                guid = '<guid>guid-%s</guid>' % guid
+            else:
+                guid = ''
+            items.append("""\
+<item>
+ <title>%s</title>
+ %s
+ <enclosure url="http://downhillbattle.org/key/gallery/%s.mpg" />
+ <description>%s</description>
+</item>
+""" % (title, guid, title.split()[0], description))
+        items.append("""
+   </channel>
+</rss>""")
+        self.write_file("\n".join(items))
+
+    def check_items(self, *entries):
+        actual = set((i.rss_id, i.entry_title, i.entry_description)
+                     for i in Item.make_view())
+        correct = set()
+        for guid, title, description in entries:
+            if guid is not None:
+                guid = 'guid-%s' % guid
+            correct.add((guid, title, description))
+        self.assertEquals(actual, correct)
+
+    def check_saved(self, item_count):
+        # the updates should be on disk, not just in the restored objects
+        rows = Item.select(['entry_title', 'entry_description'])
+        self.assertEquals(len(rows), item_count)
+        self.assertEquals(set(tuple(r) for r in rows),
+                set((i.entry_title, i.entry_description)
+                    for i in Item.make_view()))
+
+    def test_update_by_guid(self):
+        self.write_feed([(1, u'one', u'first'), (2, u'two', u'second')])
+        feed = self.make_feed()
+        self.write_feed([(1, u'one', u'changed'), (2, u'two', u'second')])
+        self.update_feed(feed)
+        self.check_items((1, u'one', u'changed'), (2, u'two', u'second'))
+        self.check_saved(2)
+        self.assert_(not app.bulk_sql_manager.pending_updates)
+
+    def test_update_by_url_title(self):
+        self.write_feed([(None, u'one', u'first')])
+        feed = self.make_feed()
+        self.write_feed([(None, u'one', u'changed')])
+        self.update_feed(feed)
+        self.check_items((None, u'one', u'changed'))
+        self.check_saved(1)
+
+    def test_update_by_enclosure(self):
+        # items without a guid are matched by their enclosure if the title
+        # changes
+        self.write_feed([(None, u'one', u'first'), (None, u'two', u'second')])
+        feed = self.make_feed()
+        self.write_feed([(None, u'one renamed', u'first'),
+                         (None, u'two', u'second')])
+        self.update_feed(feed)
+        self.check_items((None, u'one renamed', u'first'),
+                         (None, u'two', u'second'))
+        self.check_saved(2)
+
+    def test_new_entry(self):
+        self.write_feed([(1, u'one', u'first')])
+        feed = self.make_feed()
+        self.write_feed([(1, u'one', u'first'), (2, u'two', u'second')])
+        self.update_feed(feed)
+        self.check_items((1, u'one', u'first'), (2, u'two', u'second'))
+
+class UpdateAfterRestoreTest(FeedTestCase):
+    def test_never_generated(self):
+        # feeds that never got generated should go through the update queue
+        # when we restore them, rather than all starting at once.
+        mock_queue_update = self.patch_for_test(
+            'miro.feedupdate.queue_update')
+        feed = Feed(u'http://example.com/feed', defer_generate=True)
+        mock_queue_update.reset_mock()
+        feed.update_after_restore()
+        self.assertEquals(mock_queue_update.call_count, 1)
+        self.assertEquals(mock_queue_update.call_args[0][0], feed)
+        self.assert_(feed.loading)
+
 class OldItemExpireTest(FeedTestCase):
     # Test that old items expire when the feed gets too big
     def setUp(self):
@@ -377,6 +559,257 @@ support participatory culture and build a fairer music industry.</description>
         self.assertEquals(Item.make_view().count(), 4)
         self.check_guids(3, 4, 5, 6)
 
+class FeedCountsTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.feeds = [Feed(u'http://example.com/%d' % i,
+                           initiallyAutoDownloadable=False)
+                      for i in range(3)]
+        for feed in self.feeds:
+            for i in range(feed.id % 4 + 1):
+                url = u'http://example.com/%d/%d.mpg' % (feed.id, i)
+                entry = _build_entry(url, 'video/mpeg')
+                Item(FeedParserValues(entry), feed_id=feed.id)
+        self.signaled = []
+        for feed in self.feeds:
+            self.track_signals(feed)
+
+    def track_signals(self, feed):
+        def signal_change(needs_save=True):
+            self.signaled.append(feed.id)
+        feed.signal_change = signal_change
+
+    def check_counts(self, feed):
+        self.assertEquals(feed.num_downloaded(),
+                          feed.downloaded_items.count())
+        self.assertEquals(feed.num_downloading(),
+                          feed.downloading_items.count())
+        self.assertEquals(feed.num_unwatched(), feed.unwatched_items.count())
+        self.assertEquals(feed.num_available(),
+                          (feed.available_items.count() -
+                           feed.auto_pending_items.count()))
+
+    def test_feed_counts(self):
+        counts = Item.feed_counts()
+        for feed in self.feeds:
+            self.check_counts(feed)
+            self.assertEquals(counts[feed.id][3], feed.num_available())
+            self.assert_(feed.num_available() > 0)
+        self.assertEquals(Item.feed_counts([self.feeds[0].id]).keys(),
+                          [self.feeds[0].id])
+
+    def test_batched_update(self):
+        for feed in self.feeds:
+            feed.num_available()
+        changed = self.feeds[1]
+        for item in list(changed.available_items)[:2]:
+            item.unset_new()
+            changed.recalc_counts()
+        # counts are correct right away, but the feed only gets signaled
+        # once, after the changes are done.
+        self.check_counts(changed)
+        self.assertEquals(self.signaled, [])
+        self.runPendingIdles()
+        self.assertEquals(self.signaled, [changed.id])
+        self.check_counts(changed)
+
+    def test_dirty_counts_queried_once(self):
+        changed = self.feeds[1]
+        list(changed.available_items)[0].unset_new()
+        changed.recalc_counts()
+        feed_counts = Item.feed_counts
+        mock_feed_counts = self.patch_for_test('miro.item.Item.feed_counts',
+                                               autospec=False)
+        mock_feed_counts.side_effect = feed_counts
+        # getting all the counts for a dirty feed should only count it once
+        self.check_counts(changed)
+        self.assertEquals(mock_feed_counts.call_count, 1)
+        # until its items change again
+        changed.recalc_counts()
+        self.check_counts(changed)
+        self.assertEquals(mock_feed_counts.call_count, 2)
+        self.runPendingIdles()
+        self.assertEquals(mock_feed_counts.call_count, 3)
+        self.check_counts(changed)
+        self.assertEquals(mock_feed_counts.call_count, 3)
+
+    def test_update_counts(self):
+        for feed in self.feeds:
+            feed.num_available()
+        changed = self.feeds[2]
+        # change an item behind the feed's back.
+        list(changed.available_items)[0].unset_new()
+        self.assertNotEquals(changed.num_available(),
+                             changed.available_items.count())
+        update_counts()
+        self.assertEquals(self.signaled, [changed.id])
+        self.check_counts(changed)
+
+class ScraperFeedTest(EventLoopTest):
+    PAGE_COUNT = 20
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.pages = {}
+        links = ''.join('<a href="http://example.com/page%d.html">%d</a>' %
+                        (i, i) for i in range(self.PAGE_COUNT))
+        # link to the first page twice, it should only get downloaded once
+        links += '<a href="http://example.com/page0.html">again</a>'
+        self.add_page(u'http://example.com/index.html', links)
+        for i in range(self.PAGE_COUNT):
+            self.add_page(u'http://example.com/page%d.html' % i,
+                          '<a href="http://example.com/video%d.mpg">%d</a>'
+                          '<a href="http://example.com/index.html">home</a>' %
+                          (i, i))
+        self.requests = []
+        self.downloads_running = self.max_downloads_running = 0
+        self.patch_function('miro.feed.grab_url', self.fake_grab_url)
+        self.feed = Feed(u'dtv:manualFeed')
+        self.feed_impl = ScraperFeedImpl(u'http://example.com/index.html',
+                                         ufeed=self.feed)
+        self.feed._set_feed_impl(self.feed_impl)
+
+    def add_page(self, url, links):
+        self.pages[url] = '<html><body>%s</body></html>' % links
+
+    def fake_grab_url(self, url, callback, errback, etag=None,
+                      modified=None, default_mime_type=None):
+        self.requests.append(url)
+        info = {
+            'updated-url': url,
+            'redirected-url': url,
+            'content-type': 'text/html',
+            'etag': 'etag-%s' % hash(self.pages[url]),
+        }
+        if etag == info['etag']:
+            info['status'] = 304
+        else:
+            info['status'] = 200
+            info['body'] = self.pages[url]
+        def finish():
+            self.downloads_running -= 1
+            callback(info)
+        self.downloads_running += 1
+        self.max_downloads_running = max(self.max_downloads_running,
+                                         self.downloads_running)
+        eventloop.add_idle(finish, 'fake grab_url')
+        return mock.Mock()
+
+    def run_update(self):
+        self.requests = []
+        self.feed_impl.update()
+        self.runPendingIdles()
+        self.assert_(not self.feed_impl.updating)
+
+    def item_urls(self):
+        return set(item.get_url() for item in self.feed.items)
+
+    def test_update(self):
+        self.run_update()
+        self.assertEquals(self.item_urls(),
+                          set(u'http://example.com/video%d.mpg' % i
+                              for i in range(self.PAGE_COUNT)))
+        self.assertEquals(len(self.requests), self.PAGE_COUNT + 1)
+        self.assertEquals(len(set(self.requests)), len(self.requests))
+        self.assertEquals(self.max_downloads_running,
+                          ScrapeRun.MAX_DOWNLOADS)
+
+    def test_unchanged_pages(self):
+        self.run_update()
+        # add a video to a page.  Even though the index page doesn't change,
+        # we use the cached copy to find the page and the new video
+        self.add_page(u'http://example.com/page1.html',
+                      '<a href="http://example.com/video1.mpg">1</a>'
+                      '<a href="http://example.com/new.mpg">new</a>')
+        self.run_update()
+        self.assertEquals(len(self.requests), self.PAGE_COUNT + 1)
+        self.assert_(u'http://example.com/new.mpg' in self.item_urls())
+        self.assertEquals(self.feed.items.count(), self.PAGE_COUNT + 1)
+
+    def test_remove_clears_cache(self):
+        self.run_update()
+        cache = ScraperPageCache(self.feed.id)
+        self.assertNotEquals(cache.load(u'http://example.com/index.html'),
+                             None)
+        self.feed.remove()
+        self.assertEquals(cache.load(u'http://example.com/index.html'), None)
+
+class SearchFeedTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        searchengines._engines = [
+            searchengines.SearchEngineInfo(u"all", u"Search All", u"", -1),
+        ]
+        self.results = {}
+        for name, videos in ((u'fast', (1, 2)), (u'slow', (2, 3)),
+                             (u'stuck', (4,))):
+            searchengines._engines.append(searchengines.SearchEngineInfo(
+                name, name, u'http://%s.example.com/?q=%%s' % name))
+            self.results[name] = self.make_results(videos)
+        self.pending = {}
+        self.patch_function('miro.feed.grab_url', self.fake_grab_url)
+        self.feed = Feed(u'dtv:search')
+        self.feed_impl = self.feed.actualFeed
+
+    def make_results(self, videos):
+        entries = ''.join('<item><title>Video %d</title>'
+                          '<enclosure url="http://example.com/%d.mpg" '
+                          'type="video/mpeg" /></item>' % (i, i)
+                          for i in videos)
+        return ('<?xml version="1.0"?><rss version="2.0"><channel>'
+                '<title>Results</title>%s</channel></rss>' % entries)
+
+    def fake_grab_url(self, url, callback, errback, etag=None,
+                      modified=None, default_mime_type=None):
+        name = url.split('/')[2].split('.')[0]
+        self.pending[name] = lambda: callback({
+            'status': 200,
+            'body': self.results[name],
+            'updated-url': url,
+            'redirected-url': url,
+            'content-type': 'application/rss+xml',
+        })
+        return mock.Mock()
+
+    def respond(self, name):
+        self.pending.pop(name)()
+
+    def result_urls(self):
+        return sorted(item.get_url() for item in self.feed.items)
+
+    def test_results_stream_in(self):
+        self.feed_impl.lookup(u'all', u'query')
+        self.assertEquals(sorted(self.pending.keys()),
+                          [u'fast', u'slow', u'stuck'])
+        self.respond(u'fast')
+        # results show up before the other engines respond
+        self.assertEquals(self.result_urls(),
+                          [u'http://example.com/1.mpg',
+                           u'http://example.com/2.mpg'])
+        self.assert_(self.feed_impl.searching)
+        # video 2 only gets added once
+        self.respond(u'slow')
+        self.assertEquals(self.result_urls(),
+                          [u'http://example.com/1.mpg',
+                           u'http://example.com/2.mpg',
+                           u'http://example.com/3.mpg'])
+        self.assert_(self.feed_impl.searching)
+
+    def test_timeout(self):
+        self.feed_impl.DOWNLOAD_TIMEOUT = 0.1
+        self.feed.connect('update-finished',
+                          lambda feed: self.stopEventLoop(abnormal=False))
+        self.feed_impl.lookup(u'all', u'query')
+        self.respond(u'fast')
+        self.respond(u'slow')
+        with self.allow_warnings():
+            self.runEventLoop(timeout=5)
+        self.assert_(not self.feed_impl.searching)
+        self.assertEquals(len(self.result_urls()), 3)
+        # a late response from the engine that timed out is ignored
+        self.respond(u'stuck')
+        self.assertEquals(len(self.result_urls()), 3)
+
 class FeedParserAttributesTestCase(FeedTestCase):
     """Test that we save/restore attributes from feedparser correctly.
 
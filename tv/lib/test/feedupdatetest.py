@@ -0,0 +1,209 @@
+from miro import app
+from miro import feedupdate
+from miro import signals
+from miro.test.framework import EventLoopTest
+
+class FakeFeedImpl(object):
+    def __init__(self, url):
+        self.url = url
+
+class FakeFeed(signals.SignalEmitter):
+    def __init__(self, id_, url):
+        signals.SignalEmitter.__init__(self, 'update-finished', 'removed')
+        self.id = id_
+        self.actualFeed = FakeFeedImpl(url)
+
+    def get_title(self):
+        return self.actualFeed.url
+
+    def id_exists(self):
+        return True
+
+class FeedUpdateQueueTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.updated = []
+        self.next_id = 0
+
+    def make_feed(self, url):
+        self.next_id += 1
+        return FakeFeed(self.next_id, url)
+
+    def update_callback(self, feed):
+        return lambda: self.updated.append(feed)
+
+    def queue_update(self, feed):
+        self.queue.schedule_update(0, feed, self.update_callback(feed))
+
+    def finish_update(self, feed):
+        feed.emit('update-finished')
+        self.runPendingIdles()
+
+    def test_global_limit(self):
+        feeds = [self.make_feed(u'http://example%d.com/feed' % i)
+                 for i in range(5)]
+        for feed in feeds:
+            self.queue_update(feed)
+        self.run_pending_timeouts()
+        self.assertEquals(self.updated, feeds[:feedupdate.MAX_UPDATES])
+        self.finish_update(feeds[0])
+        self.assertEquals(self.updated, feeds[:feedupdate.MAX_UPDATES+1])
+        stats = self.queue.get_stats()
+        self.assertEquals(stats['updating'], feedupdate.MAX_UPDATES)
+        self.assertEquals(stats['queued'], 1)
+        self.assertEquals(stats['started'], feedupdate.MAX_UPDATES + 1)
+        self.assertEquals(stats['finished'], 1)
+
+    def test_host_limit(self):
+        self.assert_(feedupdate.MAX_UPDATES > feedupdate.MAX_UPDATES_PER_HOST)
+        same_host = [self.make_feed(u'http://example.com/feed%d' % i)
+                     for i in range(feedupdate.MAX_UPDATES_PER_HOST)]
+        waiting = self.make_feed(u'http://EXAMPLE.com/waiting')
+        other = self.make_feed(u'http://other.com/feed')
+        for feed in same_host + [waiting, other]:
+            self.queue_update(feed)
+        self.run_pending_timeouts()
+        # waiting has to wait because too many feeds from its host are
+        # updating
+        self.assertEquals(self.updated, same_host + [other])
+        self.assertEquals(self.queue.get_stats()['host_limited'], 1)
+        self.finish_update(same_host[0])
+        self.assertEquals(self.updated, same_host + [other, waiting])
+
+    def test_prioritize(self):
+        feeds = [self.make_feed(u'http://example%d.com/feed' % i)
+                 for i in range(5)]
+        for feed in feeds:
+            self.queue_update(feed)
+        self.queue.prioritize([feeds[4].id])
+        self.run_pending_timeouts()
+        self.assertEquals(self.updated, feeds[:3])
+        self.finish_update(feeds[0])
+        self.assertEquals(self.updated, feeds[:3] + [feeds[4]])
+        self.assertEquals(self.queue.get_stats()['prioritized'], 1)
+        self.queue.unprioritize([feeds[4].id])
+        self.assertEquals(self.queue.prioritized, {})
+
+    def test_backoff(self):
+        feed = self.make_feed(u'http://example.com/feed')
+        self.assertEquals(self.queue.backoff_factor(feed), 1)
+        for i in range(feedupdate.BACKOFF_AFTER):
+            self.queue.update_result(feed, False)
+        self.assertEquals(self.queue.backoff_factor(feed), 2)
+        for i in range(feedupdate.BACKOFF_AFTER * 10):
+            self.queue.update_result(feed, False)
+        self.assertEquals(self.queue.backoff_factor(feed),
+                          feedupdate.MAX_BACKOFF_FACTOR)
+        self.queue.update_result(feed, True)
+        self.assertEquals(self.queue.backoff_factor(feed), 1)
+
+    def test_periodic_update_delay(self):
+        feed = self.make_feed(u'http://example.com/feed')
+        for i in range(feedupdate.BACKOFF_AFTER):
+            self.queue.update_result(feed, False)
+        delays = []
+        self.queue.schedule_update = (lambda delay, feed, callback:
+                                      delays.append(delay))
+        self.queue.schedule_periodic_update(1000, feed,
+                                            self.update_callback(feed))
+        # 2000 seconds from the backoff, plus up to 10% jitter
+        self.assertEquals(len(delays), 1)
+        self.assert_(2000 <= delays[0] <= 2200, delays[0])
+        self.assertEquals(self.queue.get_stats()['backed_off'], 1)
+        # feeds with their own update frequency shouldn't back off
+        self.queue.schedule_periodic_update(1000, feed,
+                                            self.update_callback(feed),
+                                            backoff=False)
+        self.assert_(1000 <= delays[1] <= 1100, delays[1])
+        self.assertEquals(self.queue.get_stats()['backed_off'], 1)
+
+    def test_forget_feed(self):
+        feeds = [self.make_feed(u'http://example%d.com/feed' % i)
+                 for i in range(4)]
+        for feed in feeds:
+            self.queue_update(feed)
+        self.run_pending_timeouts()
+        self.queue.forget_feed(feeds[3])
+        self.finish_update(feeds[0])
+        self.assertEquals(self.updated, feeds[:3])
+        self.assertEquals(self.queue.get_stats()['queued'], 0)
+
+    def test_queue_update(self):
+        feeds = [self.make_feed(u'http://example%d.com/feed' % i)
+                 for i in range(5)]
+        for feed in feeds:
+            self.queue.queue_update(feed, self.update_callback(feed))
+        # queueing twice shouldn't give us 2 entries
+        self.queue.queue_update(feeds[0], self.update_callback(feeds[0]))
+        self.assertEquals(self.queue.get_stats()['scheduled'], 0)
+        self.runPendingIdles()
+        self.assertEquals(self.updated, feeds[:feedupdate.MAX_UPDATES])
+        self.finish_update(feeds[0])
+        self.assertEquals(self.updated, feeds[:feedupdate.MAX_UPDATES+1])
+        self.assertEquals(self.queue.get_stats()['queued'], 1)
+
+    def test_fetch_finished(self):
+        feeds = [self.make_feed(u'http://example%d.com/feed' % i)
+                 for i in range(5)]
+        for feed in feeds:
+            self.queue_update(feed)
+        self.run_pending_timeouts()
+        self.assertEquals(self.updated, feeds[:feedupdate.MAX_UPDATES])
+        # once a feed is downloaded, another one can start downloading
+        self.queue.fetch_finished(feeds[0])
+        self.runPendingIdles()
+        self.assertEquals(self.updated, feeds[:feedupdate.MAX_UPDATES+1])
+        stats = self.queue.get_stats()
+        self.assertEquals(stats['processing'], 1)
+        self.assertEquals(stats['updating'], feedupdate.MAX_UPDATES + 1)
+        self.finish_update(feeds[0])
+        self.assertEquals(self.queue.get_stats()['processing'], 0)
+
+    def test_pending_parse_limit(self):
+        limit = feedupdate.MAX_UPDATES + feedupdate.MAX_PENDING_PARSES
+        feeds = [self.make_feed(u'http://example%d.com/feed' % i)
+                 for i in range(limit + 5)]
+        for feed in feeds:
+            self.queue_update(feed)
+        self.run_pending_timeouts()
+        # finish downloading feeds as fast as they start.  Once
+        # MAX_PENDING_PARSES feeds are waiting to be processed we stop
+        # starting new downloads, but the ones that already started can
+        # still finish.
+        finished = 0
+        while finished < len(self.updated):
+            self.queue.fetch_finished(self.updated[finished])
+            self.runPendingIdles()
+            finished += 1
+        self.assertEquals(self.updated, feeds[:limit-1])
+        self.assertEquals(self.queue.get_stats()['processing'], limit-1)
+        # nothing else starts until we're below MAX_PENDING_PARSES again
+        for feed in feeds[:feedupdate.MAX_UPDATES-1]:
+            self.finish_update(feed)
+        self.assertEquals(self.updated, feeds[:limit-1])
+        self.finish_update(feeds[feedupdate.MAX_UPDATES-1])
+        self.assertEquals(self.updated,
+                          feeds[:limit-1+feedupdate.MAX_UPDATES])
+
+    def test_reconcile_batch(self):
+        feeds = [self.make_feed(u'http://example%d.com/feed' % i)
+                 for i in range(feedupdate.RECONCILE_BATCH_SIZE + 1)]
+        reconciled = []
+        finished = []
+        def reconcile(feed):
+            # we should be inside a transaction shared with the other feeds
+            self.assert_(app.bulk_sql_manager.active)
+            reconciled.append(feed)
+        def finish(feed):
+            self.assert_(not app.bulk_sql_manager.active)
+            finished.append(feed)
+        for feed in feeds:
+            self.queue.add_parsed(feed, lambda feed=feed: reconcile(feed),
+                                  lambda feed=feed: finish(feed))
+        self.runPendingIdles()
+        self.assertEquals(reconciled, feeds)
+        self.assertEquals(finished, feeds)
+        stats = self.queue.get_stats()
+        self.assertEquals(stats['reconciled'], len(feeds))
+        self.assertEquals(stats['reconcile_batches'], 2)
@@ -12,6 +12,9 @@ from miro.test.framework import MiroTestCase, dynamic_test
 import shutil
 from os import path, stat
 
+from mutagen import id3
+
+from miro import coverart
 from miro.plat import resources
 from miro.plat.utils import PlatformFilenameType
 from miro.filetags import calc_cover_art_filename, process_file
@@ -44,9 +47,11 @@ class FileTagsTest(MiroTestCase):
         # cover art nedes to be handled specially
         cover_art = expected.pop('cover_art')
         if cover_art:
-            # cover art should be stored using the album name as its file
-            correct_path = path.join(self.tempdir, results['album'])
-            self.assertEquals(results.pop('cover_art'), correct_path)
+            # cover art should be stored using the hash of its contents
+            cover_art = results.pop('cover_art')
+            store = coverart.CoverArtStore(self.tempdir)
+            self.assert_(store.owns_path(cover_art))
+            self.assert_(path.exists(cover_art))
             self.assertEquals(results.pop('created_cover_art'), True)
         else:
             self.assert_('cover_art' not in results)
@@ -73,8 +78,7 @@ class FileTagsTest(MiroTestCase):
 
         # process the first file
         result_1 = process_file(dest_paths[0], self.tempdir)
-        self.assertEquals(result_1['cover_art'],
-                          path.join(self.tempdir, result_1['album']))
+        self.assertEquals(result_1['created_cover_art'], True)
         self.assert_(path.exists(result_1['cover_art']))
         org_mtime = stat(result_1['cover_art']).st_mtime
 
@@ -87,6 +91,57 @@ class FileTagsTest(MiroTestCase):
             self.assert_(path.exists(results['cover_art']))
             self.assertEquals(stat(results['cover_art']).st_mtime,
                               org_mtime)
+            self.assertEquals(results['created_cover_art'], False)
+
+class CoverArtStoreTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.store = coverart.CoverArtStore(self.tempdir)
+
+    def make_image(self, data, mime='image/jpeg'):
+        return coverart.Image(id3.APIC(mime=mime, type=3, data=data))
+
+    def test_add(self):
+        image_path, created = self.store.add(self.make_image('image data'))
+        self.assertEquals(created, True)
+        self.assertEquals(path.dirname(image_path), self.tempdir)
+        self.assert_(image_path.endswith('.jpg'))
+        self.assertEquals(open(image_path, 'rb').read(), 'image data')
+        self.assert_(self.store.owns_path(image_path))
+
+    def test_dedup(self):
+        # identical images should be stored once, different ones separately
+        path1, created1 = self.store.add(self.make_image('image data'))
+        path2, created2 = self.store.add(self.make_image('image data'))
+        path3, created3 = self.store.add(self.make_image('other data'))
+        self.assertEquals(path1, path2)
+        self.assertEquals((created1, created2, created3), (True, False, True))
+        self.assertNotEqual(path1, path3)
+
+    def test_owns_path(self):
+        self.assert_(not self.store.owns_path(
+            path.join(self.tempdir, 'Album Name')))
+        self.assert_(not self.store.owns_path(
+            path.join(self.tempdir, 'echonest', 'a' * 40 + '.jpg')))
+
+    def test_remove_unused(self):
+        used_path = self.store.add(self.make_image('used'))[0]
+        unused_path = self.store.add(self.make_image('unused'))[0]
+        other_path = path.join(self.tempdir, 'Album Name')
+        open(other_path, 'wb').write('album art')
+        checked_paths = []
+        def find_used_paths(paths):
+            checked_paths.extend(paths)
+            return [used_path]
+        removed = self.store.remove_unused(
+            [used_path, unused_path, unused_path, other_path],
+            find_used_paths)
+        self.assertEquals(removed, [unused_path])
+        self.assertSameSet(checked_paths, [used_path, unused_path])
+        self.assert_(path.exists(used_path))
+        self.assert_(not path.exists(unused_path))
+        # we should never remove files outside of the store
+        self.assert_(path.exists(other_path))
 
 @dynamic_test()
 class TestCalcCoverArtFilename(MiroTestCase):
@@ -18,6 +18,7 @@ from miro import devices
 from miro import eventloop
 from miro import extensionmanager
 from miro import feed
+from miro import feedupdate
 from miro import downloader
 from miro import httpauth
 from miro import httpclient
@@ -361,8 +362,11 @@ class MiroTestCase(unittest.TestCase):
         # shutdown workerprocess if we started it for some reason.
         workerprocess.shutdown()
         workerprocess._subprocess_manager = \
-                workerprocess.WorkerSubprocessManager()
+                workerprocess.WorkerProcessPool()
         workerprocess._miro_task_queue.reset()
+        # forget about feed updates that were queued up in this test
+        feedupdate.global_update_queue = feedupdate.FeedUpdateQueue()
+        feed._count_updater = feed._CountUpdater()
         self.reset_log_filter()
         signals.system.disconnect_all()
         util.chatter = True
@@ -705,14 +709,15 @@ class EventLoopTest(MiroTestCase):
         eventloop.add_idle(function, name, args=None, kwargs=None)
 
     def hasIdles(self):
-        return not (eventloop._eventloop.idle_queue.queue.empty() and
-                    eventloop._eventloop.urgent_queue.queue.empty())
+        return (eventloop._eventloop.idle_queue.has_pending_idle() or
+                eventloop._eventloop.urgent_queue.has_pending_idle())
 
     def processThreads(self):
-        eventloop._eventloop.threadpool.init_threads()
-        while not eventloop._eventloop.threadpool.queue.empty():
-            sleep(0.05)
-        eventloop._eventloop.threadpool.close_threads()
+        eventloop._eventloop.init_threads()
+        for pool in eventloop._eventloop.threadpools.values():
+            while pool.has_pending_calls():
+                sleep(0.05)
+        eventloop._eventloop.close_threads()
 
     def process_idles(self):
         eventloop._eventloop.idle_queue.process_idles()
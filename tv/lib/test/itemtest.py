@@ -5,7 +5,7 @@ import tempfile
 
 from miro import app
 from miro import prefs
-from miro.feed import Feed
+from miro.feed import Feed, expiring_item_ids
 from miro.item import Item, FileItem, FeedParserValues, on_new_metadata
 from miro.fileobject import FilenameType
 from miro.downloader import RemoteDownloader
@@ -143,6 +143,46 @@ class ExpiredViewTest(MiroTestCase):
 
         self.assertEquals(list(f3.expiring_items()), [i5])
 
+    def test_expiring_item_ids(self):
+        f1 = Feed(u'http://example.com/1')
+        f1.set_expiration(u'never', 0)
+        f2 = Feed(u'http://example.com/2')
+        f2.set_expiration(u'system', 0)
+        f3 = Feed(u'http://example.com/3')
+        f3.set_expiration(u'feed', 24)
+        def make_item(f, watched_ago, keep=False):
+            item = Item(fp_values_for_url(u'http://example.com/%s/%s' %
+                                          (f.id, watched_ago)),
+                        feed_id=f.id)
+            item.watched_time = datetime.now() - watched_ago
+            item.keep = keep
+            item.signal_change()
+            return item
+        make_item(f1, timedelta(days=12))
+        i3 = make_item(f2, timedelta(days=12))
+        make_item(f2, timedelta(days=3))
+        make_item(f2, timedelta(days=12), keep=True)
+        i5 = make_item(f3, timedelta(days=3))
+        make_item(f3, timedelta(hours=12))
+        self.assertSameSet(expiring_item_ids(), [i3.id, i5.id])
+
+    def test_bulk_expire(self):
+        f = Feed(u'http://example.com/1')
+        f.set_expiration(u'feed', 24)
+        items = []
+        for i in range(5):
+            item = Item(fp_values_for_url(u'http://example.com/1/%s' % i),
+                        feed_id=f.id)
+            item.watched_time = datetime.now() - timedelta(days=3)
+            item.signal_change()
+            items.append(item)
+        f.expire_items()
+        for item in items:
+            self.assert_(item.expired)
+            self.assertEquals(item.watched_time, None)
+        self.assertEquals(list(f.expiring_items()), [])
+        self.assertEquals(expiring_item_ids(), [])
+
 class ItemRatingTest(MiroTestCase):
     def test_get_auto_rating(self):
         feed = Feed(u'http://example.com/1')
@@ -15,6 +15,7 @@ from miro.tabs import TabOrder
 from miro import itemsource
 from miro import messages
 from miro import messagehandler
+from miro import feedupdate
 
 from miro.test import mock, testobjects
 from miro.test.framework import MiroTestCase, EventLoopTest, uses_httpclient
@@ -344,6 +345,20 @@ class FeedTrackTest(TrackerTest):
         self.assertEquals(type(message), messages.TabsChanged)
         self.assertEquals(message.type, 'feed')
 
+    def test_set_folder_displayed(self):
+        queue = feedupdate.global_update_queue
+        messages.SetFeedDisplayed(self.feed_folder.id, True).send_to_backend()
+        self.runUrgentCalls()
+        self.assertEquals(dict(queue.prioritized), {self.feed2.id: 1})
+        # the folder's children change while it's displayed.  We should
+        # still unprioritize the feeds that we prioritized.
+        self.feed1.set_folder(self.feed_folder)
+        self.feed2.set_folder(None)
+        messages.SetFeedDisplayed(self.feed_folder.id,
+                                  False).send_to_backend()
+        self.runUrgentCalls()
+        self.assertEquals(dict(queue.prioritized), {})
+
     def test_initial_list(self):
         self.check_message_count(1)
         message1 = self.test_handler.messages[0]
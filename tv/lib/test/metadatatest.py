@@ -17,6 +17,7 @@ from miro import app
 from miro import database
 from miro import devices
 from miro import echonest
+from miro import eventloop
 from miro import item
 from miro import httpclient
 from miro import messages
@@ -32,6 +33,18 @@ from miro.plat.utils import (PlatformFilenameType,
                              utf8_to_filename, unicode_to_filename)
 from miro.test import testobjects
 
+def call_in_thread_pool_now(pool_name, callback, errback, function, name,
+                            *args, **kwargs):
+    """Replacement for eventloop.call_in_thread_pool() that runs function
+    right away, in the current thread.
+    """
+    try:
+        result = function(*args, **kwargs)
+    except StandardError, e:
+        errback(e)
+    else:
+        callback(result)
+
 class MockMetadataProcessor(object):
     """Replaces the mutagen and movie data code with test values."""
     def __init__(self):
@@ -83,11 +96,13 @@ class MockMetadataProcessor(object):
             raise ValueError("No %s run scheduled for %s" %
                              (name, source_path))
 
-    def send(self, task, callback, errback):
+    def send(self, task, callback, errback, partial_callback=None):
         task_data = (task, callback, errback)
 
         if isinstance(task, workerprocess.MutagenTask):
             self.add_task_data(task.source_path, 'mutagen', task_data)
+        elif isinstance(task, workerprocess.MutagenBatchTask):
+            self.add_batch_task_data(task, callback, partial_callback)
         elif isinstance(task, workerprocess.MovieDataProgramTask):
             self.add_task_data(task.source_path, 'movie-data', task_data)
         elif isinstance(task, workerprocess.CancelFileOperations):
@@ -95,12 +110,27 @@ class MockMetadataProcessor(object):
         else:
             raise TypeError(task)
 
+    def add_batch_task_data(self, task, callback, partial_callback):
+        # Store callbacks for each path in the batch.  Once we have results
+        # for all of them, call the callback for the whole batch.
+        remaining = set(task.source_paths)
+        def path_done(path, result):
+            partial_callback(task, path, result)
+            remaining.discard(path)
+            if not remaining:
+                callback(task, None)
+        for path in task.source_paths:
+            path_callback = lambda t, result, path=path: path_done(path,
+                                                                  result)
+            self.add_task_data(path, 'mutagen',
+                               (task, path_callback, path_callback))
+
     def exec_codegen(self, codegen_info, path, callback, errback):
         task_data = (callback, errback)
         self.add_task_data(path, 'echonest-codegen', task_data)
 
     def query_echonest(self, path, album_art_dir, code, version, metadata,
-                       callback, errback):
+                       callback, errback, response_cache=None):
         if path in self.query_echonest_codes:
             raise ValueError("query_echonest already called for %s" % path)
         self.query_echonest_codes[path] = code
@@ -164,6 +194,12 @@ class MetadataManagerTest(MiroTestCase):
                             self.processor.exec_codegen)
         self.patch_function('miro.echonest.query_echonest',
                             self.processor.query_echonest)
+        # Calculate fingerprints for the result cache right away
+        self.patch_function('miro.eventloop.call_in_thread_pool',
+                            call_in_thread_pool_now)
+        # Most tests expect a single codegen process at once
+        self.patch_function('miro.metadata.get_logical_cpu_count',
+                            lambda: 1)
         self.metadata_manager = metadata.LibraryMetadataManager(self.tempdir,
                                                                 self.tempdir)
         # For these examples we want to run echonest by default
@@ -637,6 +673,67 @@ class MetadataManagerTest(MiroTestCase):
         self.check_run_mutagen('foo3.mp3', 'audio', 400, 'Baz', 'Fights',
                                cover_art=False)
 
+    def test_remove_unused_cover_art(self):
+        # Test that we delete cover art from the store once no files use it
+        shared_path = os.path.join(self.tempdir, 'a' * 40 + '.jpg')
+        unique_path = os.path.join(self.tempdir, 'b' * 40 + '.jpg')
+        album_path = self.cover_art('Old Album')
+        cover_art_paths = [shared_path, shared_path, unique_path, album_path]
+        for cover_art in cover_art_paths:
+            open(cover_art, 'wb').write("FAKE FILE")
+        paths = []
+        for i, cover_art in enumerate(cover_art_paths):
+            filename = 'foo-%d.mp3' % i
+            self.check_add_file(filename)
+            path = self.make_path(filename)
+            # the files with shared cover art have different albums
+            self.processor.run_mutagen_callback(path, {
+                'file_type': u'audio', 'duration': 100,
+                'album': u'Album %d' % i, 'cover_art': cover_art,
+            })
+            paths.append(path)
+        self.metadata_manager._process_metadata_finished()
+        self.metadata_manager.remove_files([paths[0], paths[2], paths[3]])
+        eventloop._eventloop.idle_queue.process_idles()
+        # paths[1] still uses the shared cover art
+        self.assert_(os.path.exists(shared_path))
+        self.assert_(not os.path.exists(unique_path))
+        # we only remove files that are in the cover art store
+        self.assert_(os.path.exists(album_path))
+        self.metadata_manager.remove_files([paths[1]])
+        eventloop._eventloop.idle_queue.process_idles()
+        self.assert_(not os.path.exists(shared_path))
+
+    def test_cover_art_lookup_per_album(self):
+        # Test that refreshing metadata for an album only looks up its cover
+        # art once
+        cover_art = os.path.join(self.tempdir, 'a' * 40 + '.jpg')
+        open(cover_art, 'wb').write("FAKE FILE")
+        paths = []
+        for i in range(3):
+            filename = 'foo-%d.mp3' % i
+            self.check_add_file(filename)
+            path = self.make_path(filename)
+            mutagen_data = {
+                'file_type': u'audio', 'duration': 100, 'album': u'Album',
+            }
+            if i == 0:
+                mutagen_data['cover_art'] = cover_art
+            self.processor.run_mutagen_callback(path, mutagen_data)
+            paths.append(path)
+        self.metadata_manager._process_metadata_finished()
+        cover_art_for_album = metadata.MetadataEntry.cover_art_for_album
+        mock_lookup = self.patch_for_test(
+            'miro.metadata.MetadataEntry.cover_art_for_album', autospec=False)
+        mock_lookup.side_effect = cover_art_for_album
+        signal_handler = mock.Mock()
+        self.metadata_manager.connect("new-metadata", signal_handler)
+        self.metadata_manager.refresh_metadata_for_paths(paths)
+        self.assertEquals(mock_lookup.call_count, 1)
+        new_metadata = signal_handler.call_args[0][1]
+        for path in paths:
+            self.assertEquals(new_metadata[path]['cover_art'], cover_art)
+
     def test_audio_no_duration(self):
         # Test audio files where mutagen can't get the duration
         self.check_add_file('foo.mp3')
@@ -1025,6 +1122,42 @@ class MetadataManagerTest(MiroTestCase):
         self.check_path_in_system('baz.mp3', True)
         self.check_path_in_system('qux.avi', True)
         self.check_path_in_system('other-file.avi', False)
+        # path_in_system() shouldn't need to load objects into the cache
+        self.assertFalse(app.db.cache.key_exists('metadata',
+                                                 self.make_path('bar.avi')))
+
+    def test_path_in_system_bulk_remove(self):
+        # paths being removed as part of a bulk SQL operation shouldn't be in
+        # the system, even though they're still in the DB
+        self.check_add_file('foo.avi')
+        self.check_add_file('bar.avi')
+        app.bulk_sql_manager.start()
+        try:
+            self.metadata_manager.remove_file(self.make_path('foo.avi'))
+            self.check_path_in_system('foo.avi', False)
+            self.check_path_in_system('bar.avi', True)
+        finally:
+            app.bulk_sql_manager.finish()
+        self.check_path_in_system('foo.avi', False)
+        self.check_path_in_system('bar.avi', True)
+
+    def test_counts_after_reload(self):
+        # total_count and net_lookup_count should be calculated from the DB
+        # when we create a new metadata manager
+        self.check_add_file('foo.mp3')
+        self.check_add_file('bar.mp3')
+        self.check_add_file('baz.avi')
+        self.check_set_net_lookup_enabled('foo.mp3', True)
+        self.check_set_net_lookup_enabled('bar.mp3', True)
+        self.check_set_net_lookup_enabled('baz.avi', False)
+        self.metadata_manager.remove_file(self.make_path('foo.mp3'))
+        self.assertEquals(self.metadata_manager.total_count, 2)
+        self.assertEquals(self.metadata_manager.net_lookup_count, 1)
+        self.clear_ddb_object_cache()
+        self.metadata_manager = metadata.LibraryMetadataManager(self.tempdir,
+                                                                self.tempdir)
+        self.assertEquals(self.metadata_manager.total_count, 2)
+        self.assertEquals(self.metadata_manager.net_lookup_count, 1)
 
     def test_path_in_system_failed_insert(self):
         # check that if the DB insert fails for some reason, then path in 
@@ -1321,6 +1454,56 @@ class MetadataManagerTest(MiroTestCase):
         correct_paths = paths[100:150] + new_paths
         self.assertSameSet(self.processor.mutagen_paths(), correct_paths)
 
+    def test_bulk_add_batches(self):
+        # files added inside bulk_add() should be sent to mutagen in batches
+        paths = ['/videos/video-%d.avi' % i for i in xrange(50)]
+        mm = self.metadata_manager
+        with mm.bulk_add():
+            for p in paths:
+                mm.add_file(p)
+        batches = {}
+        for task, callback, errback in \
+                self.processor.task_data['mutagen'].values():
+            batches[task.task_id] = task
+        batches = sorted(batches.values(), key=lambda t: t.source_paths[0])
+        self.assertEquals([t.source_paths for t in batches],
+                          [paths[:20], paths[20:40], paths[40:]])
+        metadata = {
+            'file_type': u'video',
+            'duration': 100,
+        }
+        # results should be held until the batch is finished
+        batch_paths = paths[:20]
+        for p in batch_paths[:-1]:
+            self.processor.run_mutagen_callback(p, metadata)
+        self.assertEquals(mm.metadata_finished, [])
+        # we should drop results for removed paths
+        mm.remove_files([batch_paths[0]])
+        self.processor.run_mutagen_callback(batch_paths[-1], metadata)
+        self.assertSameSet([path for (processor, path, result)
+                            in mm.metadata_finished], batch_paths[1:])
+        # if the batch task fails, the paths without results should fail
+        mm.metadata_finished = []
+        batch_paths = paths[20:40]
+        self.processor.run_mutagen_callback(batch_paths[0], metadata)
+        with self.allow_warnings():
+            mm.mutagen_processor._batch_errback(batches[1], ValueError())
+        self.assertSameSet([path for (processor, path, result)
+                            in mm.metadata_finished], batch_paths[:1])
+        self.assertSameSet([path for (processor, path, error)
+                            in mm.metadata_errors], batch_paths[1:])
+
+    def test_batching_is_opt_in(self):
+        # processors that don't support batches send one task per path, even
+        # with a batch_size
+        processor = self.metadata_manager.moviedata_processor
+        processor.batch_size = 5
+        paths = ['/videos/video-%d.avi' % i for i in xrange(3)]
+        processor.add_tasks([
+            workerprocess.MovieDataProgramTask(p, self.tempdir)
+            for p in paths])
+        self.assertSameSet(self.processor.movie_data_paths(), paths)
+
 class EchonestNetErrorTest(EventLoopTest):
     # Test our pause/retry logic when we get HTTP errors from echonest
 
@@ -1637,6 +1820,7 @@ class TestEchonestQueries(MiroTestCase):
         ]
         self.thriller_release_id = 282494
         echonest._EchonestQuery.seven_digital_cache = {}
+        self.response_cache = None
 
     def callback(self, *args):
         self.callback_data = args
@@ -1674,7 +1858,8 @@ class TestEchonestQueries(MiroTestCase):
         self.reply_metadata = {}
         echonest.query_echonest(self.path, self.album_art_dir,
                                 None, 3.15, self.query_metadata,
-                                self.callback, self.errback)
+                                self.callback, self.errback,
+                                self.response_cache)
 
     def start_query_with_echonest_id(self):
         """Send an echonest id to echonest.query_echonest()."""
@@ -1683,7 +1868,8 @@ class TestEchonestQueries(MiroTestCase):
         self.reply_metadata = {}
         echonest.query_echonest(self.path, self.album_art_dir,
                                 None, 3.15, self.query_metadata,
-                                self.callback, self.errback)
+                                self.callback, self.errback,
+                                self.response_cache)
 
     def start_query_with_code(self):
         """Send a generated code to echonest.query_echonest()."""
@@ -1694,7 +1880,8 @@ class TestEchonestQueries(MiroTestCase):
         del self.query_metadata['album']
         echonest.query_echonest(self.path, self.album_art_dir,
                                 self.echonest_code, 3.15, self.query_metadata,
-                                self.callback, self.errback)
+                                self.callback, self.errback,
+                                self.response_cache)
 
     def check_grab_url(self, url, query_dict=None, post_vars=None,
                        write_file=None):
@@ -2162,6 +2349,145 @@ class TestEchonestQueries(MiroTestCase):
         # echonest query
         self.check_callback()
 
+    def setup_response_cache(self):
+        self.response_cache = echonest.ResponseCache(app.db_info)
+
+    def run_cached_replies(self):
+        """Run the idle callbacks that send replies from the response cache.
+        """
+        eventloop._eventloop.idle_queue.process_idles()
+
+    def test_response_cache(self):
+        # test that a repeated query doesn't go over the network
+        self.setup_response_cache()
+        self.test_query_with_tags()
+        old_metadata = self.reply_metadata
+        echonest._EchonestQuery.seven_digital_cache = {}
+        self.callback_data = None
+        self.start_query_with_tags()
+        self.check_grab_url_not_called()
+        self.run_cached_replies()
+        self.check_grab_url_not_called()
+        # the album art is already downloaded, so we shouldn't create it
+        self.reply_metadata = old_metadata
+        del self.reply_metadata['created_cover_art']
+        self.check_callback()
+        stats = self.response_cache.get_stats()
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['stores'], 2)
+
+    def test_response_cache_7digital(self):
+        # test that 7digital replies are cached separately from the echonest
+        # query that found the release.
+        self.setup_response_cache()
+        self.test_query_with_tags()
+        echonest._EchonestQuery.seven_digital_cache = {}
+        self.callback_data = None
+        self.setup_query_metadata_for_rock_music()
+        self.start_query_with_code()
+        self.check_echonest_grab_url_call_with_code()
+        self.send_echonest_reply('rock-music')
+        self.check_grab_url_not_called()
+        self.run_cached_replies()
+        self.check_grab_url_not_called()
+        self.reply_metadata['album'] = 'Bossanova'
+        self.reply_metadata['album_artist'] = 'Pixies'
+        self.reply_metadata['cover_art'] = os.path.join(self.album_art_dir,
+                                                        'Bossanova')
+        self.check_callback()
+
+    def test_response_cache_http_error(self):
+        # test that we remember 404 errors, but not server errors
+        self.setup_response_cache()
+        self.start_query_with_tags()
+        self.send_http_error()
+        self.check_errback()
+        self.errback_data = None
+        mock_grab_url.reset_mock()
+        self.start_query_with_tags()
+        self.check_grab_url_not_called()
+        self.run_cached_replies()
+        self.check_errback()
+        self.assertEquals(self.errback_data[1].code, 404)
+
+        self.setup_query_metadata_for_billie_jean()
+        self.start_query_with_tags()
+        errback = mock_grab_url.call_args[0][2]
+        with self.allow_warnings():
+            errback(httpclient.UnexpectedStatusCode(503))
+        mock_grab_url.reset_mock()
+        self.start_query_with_tags()
+        self.assertEquals(mock_grab_url.call_count, 1)
+
+    def test_response_cache_invalid_reply(self):
+        # test that we remember 7digital replies that we can't parse
+        self.setup_response_cache()
+        self.start_query_with_tags()
+        self.send_echonest_reply('rock-music')
+        with self.allow_warnings():
+            self.send_7digital_reply('invalid-xml')
+        self.check_callback()
+        self.callback_data = None
+        self.start_query_with_code()
+        self.send_echonest_reply('rock-music')
+        self.check_grab_url_not_called()
+        with self.allow_warnings():
+            self.run_cached_replies()
+        self.check_grab_url_not_called()
+        self.check_callback()
+
+    def test_response_cache_expires(self):
+        # test that we re-send queries once the cached reply expires
+        self.setup_response_cache()
+        self.start_query_with_tags()
+        with mock.patch.object(echonest.ResponseCache, 'ECHONEST_TTL', -1):
+            with self.allow_warnings():
+                self.send_echonest_reply('no-releases')
+        self.start_query_with_tags()
+        self.check_echonest_grab_url_call()
+        self.assertEquals(self.response_cache.get_stats()['expired'], 1)
+
+class ResponseCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = echonest.ResponseCache(app.db_info)
+        self.url = 'http://echonest.pculture.org/api/v4/song/identify?'
+
+    def test_store_and_get(self):
+        self.assertEquals(self.cache.get(self.url), None)
+        self.cache.store_reply(self.url, None, 'body\0data', 100)
+        self.assertEquals(self.cache.get(self.url), ('body\0data', None))
+        # POST variables are part of the key
+        post_vars = {'query': 'abc', 'bucket': ['tracks', 'id:7digital']}
+        self.assertEquals(self.cache.get(self.url, post_vars), None)
+        self.cache.store_reply(self.url, post_vars, 'other body', 100)
+        self.assertEquals(self.cache.get(self.url, post_vars.copy()),
+                          ('other body', None))
+        self.assertEquals(self.cache.get(self.url), ('body\0data', None))
+        stats = self.cache.get_stats()
+        self.assertEquals(stats['hits'], 3)
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['stores'], 2)
+
+    def test_store_error(self):
+        self.cache.store_error(self.url, None,
+                               httpclient.UnexpectedStatusCode(404))
+        self.assertEquals(self.cache.get(self.url), (None, 404))
+        # temporary errors shouldn't be stored
+        for error in (httpclient.UnexpectedStatusCode(503),
+                      httpclient.UnexpectedStatusCode(429),
+                      httpclient.ConnectionError('timeout')):
+            self.cache.store_error(self.url + 'x', None, error)
+            self.assertEquals(self.cache.get(self.url + 'x'), None)
+
+    def test_expired(self):
+        self.cache.store_reply(self.url, None, 'body', -1)
+        self.cache.store_reply(self.url + 'x', None, 'body', 100)
+        self.cache.remove_expired()
+        rows = app.db_info.db.execute("SELECT COUNT(*) "
+                                      "FROM http_response_cache", None)
+        self.assertEquals(rows[0][0], 1)
+
 class ProgressUpdateTest(MiroTestCase):
     # Test the objects used to send the MetadataProgressUpdate messages
     def test_count_tracker(self):
@@ -2284,3 +2610,307 @@ class ProgressUpdateTest(MiroTestCase):
                              {'file_type': u"audio"})
         self.assertEquals(counter.get_count_info('video'), (0, 0, 0))
         self.assertEquals(counter.get_count_info('audio'), (3, 1, 1))
+
+    def test_library_count_tracker_forgets_paths(self):
+        # once all files for a type are finished, LibraryProgressCountTracker
+        # shouldn't keep track of their paths anymore
+        counter = metadata.LibraryProgressCountTracker()
+        sentinal = PlatformFilenameType("sentinal.avi")
+        counter.file_started(sentinal, {'file_type': u"video"})
+        paths = [PlatformFilenameType("file-%s.mp3" % i) for i in range(5)]
+        for path in paths:
+            counter.file_started(path, {'file_type': u"audio"})
+        for path in paths[:-1]:
+            counter.file_finished(path)
+        self.assertEquals(len(counter.file_types), 6)
+        counter.file_finished(paths[-1])
+        self.assertEquals(counter.get_count_info('audio'), (0, 0, 0))
+        self.assertEquals(counter.file_types, {sentinal: u'video'})
+        # changing the type of the last file should also drop it
+        counter.file_updated(sentinal, {'file_type': u"audio"})
+        self.assertEquals(counter.file_types, {sentinal: u'audio'})
+        counter.file_finished(sentinal)
+        self.assertEquals(counter.file_types, {})
+
+class MetadataResultCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = metadata.MetadataResultCache(app.db_info)
+        self.path = self.make_file('song.mp3', 'a' * 100000)
+
+    def make_file(self, filename, contents):
+        path = os.path.join(self.tempdir, filename)
+        f = open(path, 'wb')
+        f.write(contents)
+        f.close()
+        return path
+
+    def test_fingerprint(self):
+        os.utime(self.path, (1000000, 1000000))
+        fingerprint = metadata.calc_file_fingerprint(self.path)
+        self.assertEquals(fingerprint[0], 100000)
+        self.assertEquals(metadata.calc_file_fingerprint(self.path),
+                          fingerprint)
+        # changing the end of the file should change the hash, even if the
+        # size and mtime stay the same
+        f = open(self.path, 'r+b')
+        f.seek(-1, 2)
+        f.write('b')
+        f.close()
+        os.utime(self.path, (1000000, 1000000))
+        new_fingerprint = metadata.calc_file_fingerprint(self.path)
+        self.assertEquals(new_fingerprint[:3], fingerprint[:3])
+        self.assertNotEqual(new_fingerprint, fingerprint)
+        missing_path = os.path.join(self.tempdir, 'missing.mp3')
+        self.assertEquals(metadata.calc_file_fingerprint(missing_path), None)
+
+    def test_store_and_get(self):
+        fingerprint = metadata.calc_file_fingerprint(self.path)
+        result = {'title': u'Song', 'duration': 100, 'drm': False}
+        self.assertEquals(self.cache.get(u'mutagen', fingerprint), None)
+        self.cache.store(u'mutagen', fingerprint, result)
+        self.assertEquals(self.cache.get(u'mutagen', fingerprint), result)
+        # results are separate for each source
+        self.assertEquals(self.cache.get(u'movie-data', fingerprint), None)
+        self.assertEquals(self.cache.get(u'mutagen', None), None)
+        stats = self.cache.get_stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['stores'], 1)
+
+    def test_missing_files(self):
+        # if the screenshot is gone, we shouldn't use the result
+        fingerprint = metadata.calc_file_fingerprint(self.path)
+        screenshot = self.make_file('screenshot.png', 'fake png')
+        self.cache.store(u'movie-data', fingerprint,
+                         {'screenshot': screenshot})
+        self.assertEquals(self.cache.get(u'movie-data', fingerprint),
+                          {'screenshot': screenshot})
+        os.remove(screenshot)
+        self.assertEquals(self.cache.get(u'movie-data', fingerprint), None)
+        self.assertEquals(self.cache.get_stats()['stale'], 1)
+
+    def test_eviction(self):
+        self.cache.MAX_ENTRIES = 10
+        self.cache.EVICT_EXTRA = 5
+        fingerprints = [(i, 0.0, i, 'hash') for i in xrange(11)]
+        for i, fingerprint in enumerate(fingerprints):
+            self.cache.store(u'mutagen', fingerprint, {'track': i})
+        # storing the 11th entry should remove the 6 oldest ones
+        self.assertEquals(self.cache.get_stats()['evictions'], 6)
+        for fingerprint in fingerprints[:6]:
+            self.assertEquals(self.cache.get(u'mutagen', fingerprint), None)
+        for i, fingerprint in enumerate(fingerprints[6:]):
+            self.assertEquals(self.cache.get(u'mutagen', fingerprint),
+                              {'track': i + 6})
+
+class MetadataResultCacheManagerTest(EventLoopTest):
+    # Test that MetadataManager uses the result cache
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.processor = MockMetadataProcessor()
+        self.patch_function('miro.workerprocess.send', self.processor.send)
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        self.metadata_manager = metadata.LibraryMetadataManager(self.tempdir,
+                                                                self.tempdir)
+        self.path = os.path.join(self.tempdir, 'song.mp3')
+        open(self.path, 'wb').write('fake mp3 data')
+
+    def add_file(self, path):
+        self.metadata_manager.add_file(path)
+        # fingerprints get calculated in a thread, then checked against the
+        # cache in the thread's callback
+        self.processThreads()
+        self.process_idles()
+
+    def add_file_and_process(self):
+        self.add_file(self.path)
+        if self.processor.mutagen_paths():
+            self.processor.run_mutagen_callback(self.path, {
+                'file_type': u'audio',
+                'title': u'Song',
+                'duration': 100,
+            })
+        self.process_idles()
+        self.metadata_manager.run_updates()
+
+    def get_title(self):
+        return self.metadata_manager.get_metadata(self.path).get('title')
+
+    def test_readd_unchanged_file(self):
+        self.add_file_and_process()
+        self.assertEquals(self.get_title(), u'Song')
+        self.metadata_manager.remove_file(self.path)
+        self.processor.reset()
+        # Re-adding the file shouldn't create a new mutagen task.  Until the
+        # fingerprint is calculated, we should count it as a task.
+        self.metadata_manager.add_file(self.path)
+        self.assertEquals(self.metadata_manager.worker_task_count(), 1)
+        self.processThreads()
+        self.process_idles()
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.metadata_manager.run_updates()
+        self.assertEquals(self.get_title(), u'Song')
+        self.assertEquals(self.metadata_manager.worker_task_count(), 0)
+        cache_stats = self.metadata_manager.result_cache.get_stats()
+        self.assertEquals(cache_stats['hits'], 1)
+
+    def test_readd_changed_file(self):
+        self.add_file_and_process()
+        self.metadata_manager.remove_file(self.path)
+        self.processor.reset()
+        open(self.path, 'wb').write('new fake mp3 data')
+        self.add_file(self.path)
+        self.assertEquals(self.processor.mutagen_paths(), [self.path])
+
+    def test_fingerprint_in_thread(self):
+        # adding a file shouldn't read from it in the event loop
+        mock_calc = self.patch_for_test(
+            'miro.metadata.calc_file_fingerprint')
+        mock_calc.return_value = None
+        self.metadata_manager.add_file(self.path)
+        self.assertEquals(mock_calc.call_count, 0)
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.processThreads()
+        self.assertEquals(mock_calc.call_count, 1)
+        self.process_idles()
+        self.assertEquals(self.processor.mutagen_paths(), [self.path])
+
+    def test_remove_while_fingerprinting(self):
+        self.metadata_manager.add_file(self.path)
+        self.metadata_manager.remove_file(self.path)
+        self.processThreads()
+        self.process_idles()
+        self.assertEquals(self.processor.mutagen_paths(), [])
+        self.assertEquals(self.metadata_manager.worker_task_count(), 0)
+
+    def test_batched_lookup(self):
+        paths = []
+        for i in xrange(5):
+            path = os.path.join(self.tempdir, 'song-%d.mp3' % i)
+            open(path, 'wb').write('fake mp3 data %d' % i)
+            paths.append(path)
+        result_cache = self.metadata_manager.result_cache
+        for path in paths[:3]:
+            result_cache.store(u'mutagen',
+                               metadata.calc_file_fingerprint(path),
+                               {'file_type': u'audio', 'title': u'Song'})
+        execute = mock.Mock(wraps=result_cache._execute)
+        result_cache._execute = execute
+        with self.metadata_manager.bulk_add():
+            for path in paths:
+                self.metadata_manager.add_file(path)
+        self.processThreads()
+        self.process_idles()
+        # We should look up all 5 paths with 1 SELECT, then update the
+        # last_used column for the hits with 1 UPDATE.
+        self.assertEquals(execute.call_count, 2)
+        self.assertEquals(sorted(self.processor.mutagen_paths()),
+                          sorted(paths[3:]))
+        cache_stats = result_cache.get_stats()
+        self.assertEquals(cache_stats['hits'], 3)
+        self.assertEquals(cache_stats['misses'], 2)
+
+class EchonestCodegenTest(MiroTestCase):
+    # Test running the echonest codegen in parallel
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.processor = MockMetadataProcessor()
+        self.patch_function('miro.echonest.exec_codegen',
+                            self.processor.exec_codegen)
+        self.patch_function('miro.echonest.query_echonest',
+                            self.processor.query_echonest)
+        self.mock_call_in_thread_pool = self.patch_function(
+            'miro.eventloop.call_in_thread_pool', call_in_thread_pool_now)
+        self.result_cache = metadata.MetadataResultCache(app.db_info)
+        self.echonest_processor = self.make_echonest_processor()
+        self.paths = []
+        for i in xrange(10):
+            path = os.path.join(self.tempdir, 'song-%d.mp3' % i)
+            f = open(path, 'wb')
+            f.write('song %d' % i)
+            f.close()
+            self.paths.append(path)
+
+    def make_echonest_processor(self):
+        processor = metadata._EchonestProcessor(6, self.tempdir, 3,
+                                                self.result_cache)
+        processor.CODEGEN_COOLDOWN_TIME = 0.0
+        return processor
+
+    def add_paths(self, paths):
+        for path in paths:
+            # no title, so we need to run the codegen
+            self.echonest_processor.add_path(path, lambda: {})
+
+    def run_codegen(self):
+        for path in self.processor.echonest_codegen_paths():
+            self.processor.run_echonest_codegen_callback(path,
+                                                         'code-' + path)
+
+    def test_parallel_codegen(self):
+        self.add_paths(self.paths)
+        self.assertEquals(len(self.processor.echonest_codegen_paths()), 3)
+        # once the codes are finished, we should start new codegens, until
+        # we have a full buffer of codes waiting for echonest
+        while self.processor.echonest_codegen_paths():
+            self.run_codegen()
+            stats = self.echonest_processor.get_stats()
+            self.assert_(stats['codegen_in_flight'] <= 3)
+            self.assert_(stats['codegen_in_flight'] +
+                         stats['echonest_queue'] <= 6)
+        self.assertEquals(len(self.processor.echonest_paths()), 1)
+        stats = self.echonest_processor.get_stats()
+        self.assertEquals(stats['echonest_queue'], 6)
+        self.assertEquals(stats['codegen_runs'], 7)
+        self.assertEquals(stats['metadata_fetch_queue'] +
+                          stats['codegen_queue'], 3)
+        # finishing echonest queries should make room for more codegens
+        self.processor.run_echonest_callback(
+            self.processor.echonest_paths()[0], {})
+        self.assertEquals(len(self.processor.echonest_codegen_paths()), 1)
+
+    def test_fingerprint_in_thread(self):
+        # fingerprinting the files should happen in the files pool, and
+        # should hold the codegen slots until it finishes
+        mock_call = self.mock_call_in_thread_pool
+        mock_call.side_effect = None
+        self.add_paths(self.paths)
+        self.assertEquals(self.processor.echonest_codegen_paths(), [])
+        self.assertEquals(mock_call.call_count, 3)
+        for args, kwargs in mock_call.call_args_list:
+            self.assertEquals(args[0], 'files')
+            self.assertEquals(args[3], metadata.calc_file_fingerprints)
+        # once we have the fingerprints, we should start the codegens
+        for args, kwargs in mock_call.call_args_list:
+            args[1](metadata.calc_file_fingerprints(args[5]))
+        self.assertEquals(sorted(self.processor.echonest_codegen_paths()),
+                          sorted(self.paths[:3]))
+        self.assertEquals(mock_call.call_count, 3)
+
+    def test_cooldown(self):
+        self.echonest_processor.CODEGEN_COOLDOWN_TIME = 100.0
+        self.add_paths(self.paths)
+        self.run_codegen()
+        # all of our slots are cooling down, so we shouldn't start any more
+        # codegens yet
+        self.assertEquals(len(self.processor.echonest_codegen_paths()), 0)
+        self.assertEquals(self.echonest_processor.get_stats()['codegen_runs'],
+                          3)
+
+    def test_codes_cached(self):
+        self.add_paths(self.paths[:1])
+        self.run_codegen()
+        self.assertEquals(self.processor.query_echonest_codes,
+                          {self.paths[0]: 'code-' + self.paths[0]})
+        # If the file gets added again, we should use the code that we
+        # stored rather than running the codegen
+        self.processor.reset()
+        self.echonest_processor = self.make_echonest_processor()
+        self.add_paths(self.paths[:1])
+        self.assertEquals(self.processor.echonest_codegen_paths(), [])
+        self.assertEquals(self.processor.query_echonest_codes,
+                          {self.paths[0]: 'code-' + self.paths[0]})
+        stats = self.echonest_processor.get_stats()
+        self.assertEquals(stats['codegen_cache_hits'], 1)
+        self.assertEquals(stats['codegen_runs'], 0)
@@ -1,7 +1,19 @@
 import email.Utils
+import logging
+import os
+import select
 import socket
-
+import time
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+from miro import eventloop
 from miro import net
+from miro import util
+from miro.test import mock
 from miro.test.framework import EventLoopTest, MiroTestCase
 
 class TestingConnectionHandler(net.ConnectionHandler):
@@ -468,3 +480,175 @@ class ConnectionHandlerTest(EventLoopTest):
         # just make sure it doesn't throw an exception
         str(self.connectionHandler)
         self.assert_(True)
+
+class PollerTestBase(object):
+    # subclasses set this to the eventloop.PollerBase subclass to test
+    poller_class = None
+
+    def setUp(self):
+        self.poller = self.poller_class()
+        self.sockets = []
+
+    def tearDown(self):
+        self.poller.close()
+        for sock in self.sockets:
+            sock.close()
+
+    def make_pair(self):
+        pair = util.make_dummy_socket_pair()
+        self.sockets.extend(pair)
+        return pair
+
+    def test_read(self):
+        sender, receiver = self.make_pair()
+        self.poller.register(receiver.fileno(), eventloop.POLL_READ)
+        self.assertEquals(self.poller.poll(0)[0], [])
+        sender.send("a")
+        readable, writable, exceptional = self.poller.poll(1)
+        self.assertEquals(readable, [receiver.fileno()])
+        self.assertEquals(writable, [])
+
+    def test_write(self):
+        sender, receiver = self.make_pair()
+        self.poller.register(sender.fileno(), eventloop.POLL_WRITE)
+        readable, writable, exceptional = self.poller.poll(1)
+        self.assertEquals(writable, [sender.fileno()])
+
+    def test_modify_and_unregister(self):
+        sender, receiver = self.make_pair()
+        sender.send("a")
+        self.poller.register(receiver.fileno(), eventloop.POLL_READ)
+        self.poller.register(receiver.fileno(),
+                             eventloop.POLL_READ | eventloop.POLL_WRITE)
+        readable, writable, exceptional = self.poller.poll(1)
+        self.assertEquals(readable, [receiver.fileno()])
+        self.assertEquals(writable, [receiver.fileno()])
+        self.poller.unregister(receiver.fileno())
+        # unregistering twice should be fine
+        self.poller.unregister(receiver.fileno())
+        self.assertEquals(self.poller.poll(0), ([], [], []))
+
+    def test_sync(self):
+        sender, receiver = self.make_pair()
+        sender2, receiver2 = self.make_pair()
+        sender.send("a")
+        sender2.send("a")
+        self.poller.sync([receiver.fileno(), receiver2.fileno()], [])
+        self.assertSameSet(self.poller.poll(1)[0],
+                           [receiver.fileno(), receiver2.fileno()])
+        self.poller.sync([receiver2.fileno()], [])
+        self.assertEquals(self.poller.poll(1)[0], [receiver2.fileno()])
+
+    def test_sync_only_changes(self):
+        sender, receiver = self.make_pair()
+        self.poller.sync([receiver.fileno()], [])
+        self.poller.register = mock.Mock(wraps=self.poller.register)
+        self.poller.sync([receiver.fileno()], [])
+        self.assertEquals(self.poller.register.call_count, 0)
+        self.poller.sync([receiver.fileno()], [receiver.fileno()])
+        self.assertEquals(self.poller.register.call_count, 1)
+
+    def test_forget_reused_fd(self):
+        sender, receiver = self.make_pair()
+        fd = receiver.fileno()
+        self.poller.sync([fd], [])
+        # close receiver and put a new socket at the same fd number
+        sender2, receiver2 = self.make_pair()
+        receiver.close()
+        os.dup2(receiver2.fileno(), fd)
+        try:
+            self.poller.forget(fd)
+            self.poller.sync([fd], [])
+            sender2.send("a")
+            self.assertEquals(self.poller.poll(1)[0], [fd])
+        finally:
+            self.poller.unregister(fd)
+            os.close(fd)
+
+class SelectPollerTest(PollerTestBase, MiroTestCase):
+    poller_class = eventloop.SelectPoller
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        PollerTestBase.setUp(self)
+
+    def tearDown(self):
+        PollerTestBase.tearDown(self)
+        MiroTestCase.tearDown(self)
+
+class EpollPollerTest(SelectPollerTest):
+    poller_class = eventloop.EpollPoller
+
+if not hasattr(select, 'epoll'):
+    del EpollPollerTest
+
+class PollerBenchmarkTest(MiroTestCase):
+    """Measure the overhead of a loop iteration with lots of idle sockets
+    open, which is what we see with lots of DAAP clients and downloads.
+    """
+    SOCKET_COUNT = 600
+    ITERATIONS = 200
+    # fds to leave free for the rest of the test suite
+    RESERVED_FDS = 256
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.sockets = []
+        try:
+            for i in xrange(self.calc_socket_count()):
+                self.sockets.extend(util.make_dummy_socket_pair())
+        except:
+            # tearDown() won't get called, so don't leak the sockets
+            self.close_sockets()
+            MiroTestCase.tearDown(self)
+            raise
+        self.receivers = self.sockets[1::2]
+        self.sockets[0].send("a")
+
+    def tearDown(self):
+        self.close_sockets()
+        MiroTestCase.tearDown(self)
+
+    def close_sockets(self):
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+
+    def calc_socket_count(self):
+        """Get the number of socket pairs to open.
+
+        This is SOCKET_COUNT, unless the fd limit is too low for that.
+        """
+        if resource is None:
+            return self.SOCKET_COUNT
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if limit == resource.RLIM_INFINITY:
+            return self.SOCKET_COUNT
+        return max(1, min(self.SOCKET_COUNT,
+                          (limit - self.RESERVED_FDS) // 2))
+
+    def time_poller(self, poller, receivers):
+        for sock in receivers:
+            poller.register(sock.fileno(), eventloop.POLL_READ)
+        start = time.time()
+        for i in xrange(self.ITERATIONS):
+            readable, writable, exceptional = poller.poll(0)
+            self.assertEquals(readable, [self.receivers[0].fileno()])
+        elapsed = time.time() - start
+        poller.close()
+        return elapsed
+
+    def test_loop_overhead(self):
+        # select() can't handle fd numbers past FD_SETSIZE, so only give it
+        # the receivers that it can handle.
+        select_receivers = [s for s in self.receivers if s.fileno() < 1024]
+        elapsed = self.time_poller(eventloop.SelectPoller(), select_receivers)
+        logging.debug("select: %d sockets, %.1f usecs per loop",
+                      len(select_receivers),
+                      elapsed * 1000000 / self.ITERATIONS)
+        if hasattr(select, 'epoll'):
+            elapsed = self.time_poller(eventloop.EpollPoller(),
+                                       self.receivers)
+            logging.debug("epoll: %d sockets, %.1f usecs per loop",
+                          len(self.receivers),
+                          elapsed * 1000000 / self.ITERATIONS)
@@ -0,0 +1,116 @@
+"""Performance tests.
+
+These take a while to run, so they aren't part of the normal test suite.
+Run them by naming them on the command line, for example:
+"./run.sh --unittest performancetest".
+"""
+
+import logging
+import time
+
+from miro import workerprocess
+from miro.plat import resources
+from miro.test.framework import only_on_platforms
+from miro.test.subprocesstest import (WorkerProcessTest,
+                                      UnittestWorkerProcessHandler)
+
+class PerFileExtractorHandler(UnittestWorkerProcessHandler):
+    """Worker process handler that creates a new movie data pipeline for
+    each file, like we used to.
+    """
+    def handle_movie_data_program_task(self, msg):
+        from miro.frontends.widgets.gst import gst_extractor
+        gst_extractor.REUSE_PIPELINE = False
+        return UnittestWorkerProcessHandler.handle_movie_data_program_task(
+            self, msg)
+
+class MovieDataBenchmarkTest(WorkerProcessTest):
+    """Compare reusing the movie data pipeline with creating a new one for
+    each file.
+    """
+    FILE_COUNT = 50
+
+    def callback(self, msg, result):
+        self.results.append(result)
+        if len(self.results) == self.FILE_COUNT:
+            self.stopEventLoop(abnormal=False)
+
+    errback = callback
+
+    def time_tasks(self, handler_class, description):
+        self.results = []
+        workerprocess._subprocess_manager.handler_class = handler_class
+        workerprocess.startup(process_count=1)
+        source_path = resources.path(
+            "testdata/metadata/theora_with_ogg_extension.ogg")
+        start = time.time()
+        for i in xrange(self.FILE_COUNT):
+            msg = workerprocess.MovieDataProgramTask(source_path,
+                                                     self.tempdir)
+            workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(120)
+        elapsed = time.time() - start
+        workerprocess.shutdown()
+        self.assertEquals(len(self.results), self.FILE_COUNT)
+        for result in self.results:
+            if isinstance(result, Exception):
+                raise result
+            self.assertEquals(result['file_type'], 'video')
+        logging.debug("movie data (%s): %.1f files/sec", description,
+                      self.FILE_COUNT / elapsed)
+
+    @only_on_platforms('linux', 'win32')
+    def test_movie_data_throughput(self):
+        self.time_tasks(PerFileExtractorHandler, 'new pipeline per file')
+        self.time_tasks(UnittestWorkerProcessHandler, 'reused pipeline')
+
+class WorkerProcessBenchmarkTest(WorkerProcessTest):
+    """Measure how fast we can push MutagenTasks through the worker
+    processes.
+    """
+    TASK_COUNT = 2000
+
+    def callback(self, msg, result):
+        self.finished_count += 1
+        if self.finished_count == self.TASK_COUNT:
+            self.stopEventLoop(abnormal=False)
+
+    errback = callback
+
+    def time_tasks(self, process_count):
+        self.finished_count = 0
+        workerprocess.startup(process_count=process_count)
+        source_path = resources.path("testdata/metadata/mp3-0.mp3")
+        start = time.time()
+        for i in xrange(self.TASK_COUNT):
+            msg = workerprocess.MutagenTask(source_path, self.tempdir)
+            workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(120)
+        elapsed = time.time() - start
+        workerprocess.shutdown()
+        self.assertEquals(self.finished_count, self.TASK_COUNT)
+        logging.debug("%s processes: %.1f mutagen tasks/sec",
+                      process_count, self.TASK_COUNT / elapsed)
+
+    def test_mutagen_throughput(self):
+        self.time_tasks(1)
+        self.time_tasks(None)
+
+    def test_mutagen_batch_throughput(self):
+        batch_size = 20
+        self.finished_count = 0
+        workerprocess.startup(process_count=1)
+        source_path = resources.path("testdata/metadata/mp3-0.mp3")
+        def partial_callback(msg, path, result):
+            self.callback(msg, result)
+        start = time.time()
+        for i in xrange(self.TASK_COUNT / batch_size):
+            msg = workerprocess.MutagenBatchTask([source_path] * batch_size,
+                                                 self.tempdir)
+            workerprocess.send(msg, lambda msg, result: None, self.errback,
+                               partial_callback)
+        self.runEventLoop(120)
+        elapsed = time.time() - start
+        self.assertEquals(self.finished_count, self.TASK_COUNT)
+        logging.debug("1 process, batches of %d: %.1f mutagen tasks/sec",
+                      batch_size, self.TASK_COUNT / elapsed)
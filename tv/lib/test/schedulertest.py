@@ -1,8 +1,9 @@
 from time import time, sleep
+import logging
 import threading
 
 from miro import eventloop
-from miro.test.framework import EventLoopTest
+from miro.test.framework import EventLoopTest, MiroTestCase
 
 class SchedulerTest(EventLoopTest):
     def setUp(self):
@@ -57,3 +58,327 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+class CallQueueTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.queue = eventloop.CallQueue()
+        self.calls = []
+
+    def callback(self, value):
+        self.calls.append(value)
+
+    def add(self, value, priority=eventloop.PRIORITY_NORMAL,
+            coalesce_key=None):
+        return self.queue.add_idle(self.callback, "foo", args=(value,),
+                                   priority=priority,
+                                   coalesce_key=coalesce_key)
+
+    def test_priority_order(self):
+        self.add('background', eventloop.PRIORITY_BACKGROUND)
+        self.add('normal')
+        self.add('high', eventloop.PRIORITY_HIGH)
+        self.add('normal2')
+        self.queue.process_idles()
+        self.assertEquals(self.calls,
+                          ['high', 'normal', 'normal2', 'background'])
+
+    def test_coalesce(self):
+        dc = self.add(1, coalesce_key='key')
+        dc2 = self.add(2, coalesce_key='key')
+        self.add(3, coalesce_key='other-key')
+        self.assert_(dc is dc2)
+        self.queue.process_idles()
+        self.assertEquals(self.calls, [1, 3])
+        self.assertEquals(
+            self.queue.get_stats()[eventloop.PRIORITY_NORMAL]['coalesced'], 1)
+        # once the call runs, we should be able to schedule it again
+        self.add(4, coalesce_key='key')
+        self.queue.process_idles()
+        self.assertEquals(self.calls, [1, 3, 4])
+
+    def test_coalesce_canceled(self):
+        dc = self.add(1, coalesce_key='key')
+        dc.cancel()
+        self.add(2, coalesce_key='key')
+        self.queue.process_idles()
+        self.assertEquals(self.calls, [2])
+
+    def test_fairness(self):
+        limit = eventloop.CallQueue.STARVATION_LIMIT
+        self.add('background', eventloop.PRIORITY_BACKGROUND)
+        for i in xrange(limit * 2):
+            self.add(i)
+        self.queue.process_idles()
+        # the background call should run after being passed over limit
+        # times, not after all the normal calls.
+        self.assertEquals(self.calls.index('background'), limit)
+
+    def test_stats(self):
+        self.add(1)
+        self.add(2, eventloop.PRIORITY_BACKGROUND)
+        self.queue.process_idles()
+        stats = self.queue.get_stats()
+        self.assertEquals(stats[eventloop.PRIORITY_NORMAL]['count'], 1)
+        self.assertEquals(stats[eventloop.PRIORITY_BACKGROUND]['count'], 1)
+        self.assertEquals(stats[eventloop.PRIORITY_HIGH]['count'], 0)
+        self.assert_(stats[eventloop.PRIORITY_NORMAL]['max_latency'] >= 0)
+
+class SchedulerCancelTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.scheduler = eventloop.Scheduler()
+        self.calls = []
+
+    def callback(self, value):
+        self.calls.append(value)
+
+    def test_canceled_timeouts_skipped(self):
+        dc = self.scheduler.add_timeout(0, self.callback, "foo", args=(1,))
+        self.scheduler.add_timeout(100, self.callback, "foo", args=(2,))
+        dc.cancel()
+        # next_timeout() should skip over the canceled timeout
+        self.assert_(self.scheduler.next_timeout() > 50)
+        self.assert_(not self.scheduler.has_pending_timeout())
+        self.assertEquals(self.scheduler.pending_count(), 1)
+
+    def test_double_cancel(self):
+        dc = self.scheduler.add_timeout(10, self.callback, "foo", args=(1,))
+        dc.cancel()
+        dc.cancel()
+        self.assertEquals(self.scheduler.canceled_count, 1)
+        self.assertEquals(self.scheduler.pending_count(), 0)
+
+    def test_cancel_after_run(self):
+        dc = self.scheduler.add_timeout(0, self.callback, "foo", args=(1,))
+        sleep(0.01)
+        self.scheduler.process_next_timeout()
+        dc.cancel()
+        self.assertEquals(self.calls, [1])
+        self.assertEquals(self.scheduler.canceled_count, 0)
+
+    def test_compaction(self):
+        limit = eventloop.Scheduler.COMPACT_MIN_CANCELED
+        keep = self.scheduler.add_timeout(0, self.callback, "foo",
+                                          args=('keep',))
+        for i in xrange(limit * 10):
+            self.scheduler.add_timeout(100, self.callback, "foo",
+                                       args=(i,)).cancel()
+        self.assert_(self.scheduler.compact_count > 0)
+        self.assert_(len(self.scheduler.heap) <= limit * 2)
+        sleep(0.01)
+        while self.scheduler.has_pending_timeout():
+            self.scheduler.process_next_timeout()
+        self.assertEquals(self.calls, ['keep'])
+
+class SchedulerBenchmarkTest(MiroTestCase):
+    """Simulate the timer churn from lots of feeds rescheduling their
+    updates.
+    """
+    FEED_COUNT = 5000
+    RESCHEDULES = 10
+
+    def test_reschedule_churn(self):
+        scheduler = eventloop.Scheduler()
+        def callback():
+            pass
+        timeouts = [None] * self.FEED_COUNT
+        start = time()
+        for i in xrange(self.RESCHEDULES):
+            for feed_num in xrange(self.FEED_COUNT):
+                if timeouts[feed_num] is not None:
+                    timeouts[feed_num].cancel()
+                timeouts[feed_num] = scheduler.add_timeout(
+                    1000 + feed_num, callback, "feed update")
+            scheduler.next_timeout()
+        elapsed = time() - start
+        logging.debug("scheduler churn: %d add/cancel pairs in %.3f secs",
+                      self.FEED_COUNT * self.RESCHEDULES, elapsed)
+        # canceled timeouts shouldn't pile up in the heap
+        self.assertEquals(scheduler.pending_count(), self.FEED_COUNT)
+        self.assert_(len(scheduler.heap) <= self.FEED_COUNT * 2 +
+                     eventloop.Scheduler.COMPACT_MIN_CANCELED)
+
+class ThreadPoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.event_loop = eventloop.EventLoop()
+        self.pool = eventloop.ThreadPool(self.event_loop, 'test', 1, 3)
+        # grow as soon as a call is waiting, tests that check the wait time
+        # set this themselves
+        self.pool.GROW_WAIT = 0.0
+        self.results = []
+        self.block = threading.Event()
+
+    def tearDown(self):
+        self.block.set()
+        self.pool.close_threads()
+        MiroTestCase.tearDown(self)
+
+    def callback(self, result):
+        self.results.append(result)
+
+    def errback(self, error):
+        self.results.append(error)
+
+    def blocking_call(self, value):
+        self.block.wait(5)
+        return value
+
+    def wait_for_idle_count(self, count):
+        for i in xrange(100):
+            if self.pool.idle_count == count:
+                break
+            sleep(0.01)
+
+    def run_idles(self):
+        self.event_loop.idle_queue.process_idles()
+
+    def test_call(self):
+        self.pool.init_threads()
+        self.pool.queue_call(self.callback, self.errback, lambda: 'foo',
+                             'test call')
+        self.block.set()
+        for i in xrange(100):
+            if self.event_loop.idle_queue.has_pending_idle():
+                break
+            sleep(0.01)
+        self.run_idles()
+        self.assertEquals(self.results, ['foo'])
+        stats = self.pool.get_stats()
+        self.assertEquals(stats['calls'], 1)
+        self.assert_(stats['total_run'] >= 0)
+
+    def test_cancel_queued(self):
+        # don't start any threads, so calls stay queued
+        call = self.pool.queue_call(self.callback, self.errback,
+                                    lambda: 'foo', 'test call')
+        self.assertEquals(call.cancel(), True)
+        self.assertEquals(call.cancel(), False)
+        self.assert_(not self.pool.has_pending_calls())
+        self.assertEquals(self.pool.get_stats()['canceled'], 1)
+
+    def test_grow(self):
+        self.pool.init_threads()
+        self.assertEquals(len(self.pool.threads), 1)
+        for i in xrange(5):
+            self.pool.queue_call(self.callback, self.errback,
+                                 self.blocking_call, 'test call', i)
+            sleep(0.05)
+        # we should grow, but not past max_threads
+        self.assertEquals(len(self.pool.threads), 3)
+
+    def test_grow_while_blocked(self):
+        # calls queued behind a busy thread should get new threads once
+        # they've waited GROW_WAIT, without waiting for the busy one to
+        # finish
+        self.pool.GROW_WAIT = 0.1
+        self.pool.init_threads()
+        self.pool.queue_call(self.callback, self.errback, self.blocking_call,
+                             'test call', 0)
+        self.wait_for_idle_count(0)
+        for i in xrange(1, 5):
+            self.pool.queue_call(self.callback, self.errback,
+                                 self.blocking_call, 'test call', i)
+        # the calls haven't waited long enough yet
+        self.assertEquals(len(self.pool.threads), 1)
+        for i in xrange(100):
+            if len(self.pool.threads) == 3:
+                break
+            sleep(0.01)
+        self.assertEquals(len(self.pool.threads), 3)
+        self.assert_(not self.block.isSet())
+
+    def test_no_grow_for_short_waits(self):
+        # calls that an idle thread picks up quickly shouldn't start new
+        # threads
+        self.pool.GROW_WAIT = 10.0
+        self.pool.init_threads()
+        self.wait_for_idle_count(1)
+        for i in xrange(5):
+            self.pool.queue_call(self.callback, self.errback, lambda: 'foo',
+                                 'test call')
+            sleep(0.01)
+        self.assertEquals(len(self.pool.threads), 1)
+
+    def test_reinit(self):
+        # threads left waiting by close_threads() shouldn't count as idle
+        # after init_threads()
+        self.pool.init_threads()
+        self.wait_for_idle_count(1)
+        old_threads = self.pool.threads[:]
+        # hold the condition so the old thread can't wake up until after
+        # init_threads()
+        self.pool.condition.acquire()
+        try:
+            self.pool.close_threads()
+            self.pool.init_threads()
+        finally:
+            self.pool.condition.release()
+        for t in old_threads:
+            t.join(1.0)
+            self.assert_(not t.isAlive())
+        self.assertEquals(len(self.pool.threads), 1)
+        self.wait_for_idle_count(1)
+        self.assertEquals(self.pool.idle_count, 1)
+        self.pool.queue_call(self.callback, self.errback, lambda: 'foo',
+                             'test call')
+        for i in xrange(100):
+            if self.event_loop.idle_queue.has_pending_idle():
+                break
+            sleep(0.01)
+        self.run_idles()
+        self.assertEquals(self.results, ['foo'])
+
+    def test_shrink(self):
+        self.pool.SHRINK_TIMEOUT = 0.1
+        self.pool.init_threads()
+        for i in xrange(3):
+            self.pool.queue_call(self.callback, self.errback,
+                                 self.blocking_call, 'test call', i)
+            sleep(0.05)
+        self.assertEquals(len(self.pool.threads), 3)
+        self.block.set()
+        sleep(0.5)
+        self.assertEquals(len(self.pool.threads), 1)
+
+    def test_no_min_threads(self):
+        # pools without a minimum should start a thread for the first call
+        self.pool = eventloop.ThreadPool(self.event_loop, 'test', 0, 2)
+        self.pool.GROW_WAIT = 0.0
+        self.pool.queue_call(self.callback, self.errback, lambda: 'foo',
+                             'queued before start')
+        self.pool.init_threads()
+        self.assertEquals(len(self.pool.threads), 1)
+        self.pool.queue_call(self.callback, self.errback, lambda: 'bar',
+                             'test call')
+        for i in xrange(100):
+            if self.event_loop.idle_queue.has_pending_idle():
+                break
+            sleep(0.01)
+        self.pool.close_threads()
+        self.run_idles()
+        # the calls may run in separate threads, so don't count on the order
+        self.assertEquals(sorted(self.results), ['bar', 'foo'])
+
+    def test_separate_pools(self):
+        # A pool full of blocked calls shouldn't stop other pools
+        self.event_loop.init_threads()
+        try:
+            default = self.event_loop.threadpool
+            for i in xrange(default.max_threads + 1):
+                self.event_loop.call_in_thread(
+                    self.callback, self.errback, self.blocking_call,
+                    'test call', i)
+            self.event_loop.call_in_thread_pool(
+                'network', self.callback, self.errback, lambda: 'network',
+                'test call')
+            for i in xrange(100):
+                if self.event_loop.idle_queue.has_pending_idle():
+                    break
+                sleep(0.01)
+            self.run_idles()
+            self.assertEquals(self.results, ['network'])
+        finally:
+            self.block.set()
+            self.event_loop.close_threads()
@@ -1,5 +1,7 @@
 import itertools
+import logging
 import random
+import time
 
 from miro import signals
 
@@ -161,3 +163,57 @@ class SignalsTest(MiroTestCase):
         self.signaller.emit('signal1')
         self.assertEquals(self.callbacks, [])
 
+
+    def test_weak_callback_other_signal(self):
+        # dead weak callbacks get pruned when their signal is emitted
+        callback_obj = WeakCallbackTester(self)
+        self.signaller.connect_weak('signal1', callback_obj.callback, 0)
+        del callback_obj
+        self.signaller.emit('signal2')
+        self.assertEquals(len(self.signaller.get_callbacks('signal1')), 1)
+        self.signaller.emit('signal1')
+        self.assertEquals(len(self.signaller.get_callbacks('signal1')), 0)
+
+    def test_connect_during_emit(self):
+        # connecting while a signal is being emitted shouldn't affect the
+        # current emission
+        def callback(obj):
+            self.callbacks.append('callback')
+            self.signaller.connect('signal1', self.callback)
+            self.signaller.disconnect(first_handle)
+        first_handle = self.signaller.connect('signal1', callback)
+        self.signaller.emit('signal1')
+        self.assertEquals(self.callbacks, ['callback'])
+        self.signaller.emit('signal1')
+        self.assertEquals(self.callbacks, ['callback', (self.signaller,)])
+
+    def test_no_listeners(self):
+        self.assertEquals(self.signaller.emit('signal1', 'foo'), False)
+        self.assertRaises(KeyError, self.signaller.emit, 'signal5')
+
+class SignalsBenchmarkTest(MiroTestCase):
+    """Measure emit() throughput for the common cases."""
+    EMIT_COUNT = 20000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.signaller = TestSignaller()
+
+    def time_emits(self, name):
+        start = time.time()
+        for i in xrange(self.EMIT_COUNT):
+            self.signaller.emit(name, i)
+        elapsed = time.time() - start
+        logging.debug("%s: %d emits/sec", name,
+                      self.EMIT_COUNT / max(elapsed, 0.000001))
+
+    def test_emit_throughput(self):
+        self.time_emits('signal1')
+        callback_objs = [WeakCallbackTester(self) for i in xrange(5)]
+        for obj in callback_objs:
+            self.signaller.connect_weak('signal2', obj.callback)
+        for i in xrange(5):
+            self.signaller.connect('signal2', lambda obj, value: None)
+        self.callbacks = []
+        self.time_emits('signal2')
+        self.assertEquals(len(self.callbacks), self.EMIT_COUNT * 5)
@@ -508,6 +508,37 @@ class DiskTest(FakeSchemaTest):
         app.bulk_sql_manager.finish()
         self.assertEquals(Human.make_view().count(), 1)
 
+    def test_bulk_update(self):
+        new_humans = []
+        for x in range(10):
+            name = u"lee-clone-%s" % x
+            new_humans.append(Human(name, 25, 1.4, [], {}))
+        app.bulk_sql_manager.start()
+        for x, new_dude in enumerate(new_humans):
+            app.bulk_sql_manager.add_update(new_dude)
+            new_dude.age = 26
+            if x % 2:
+                new_dude.meters_tall = 1.5
+            new_dude.signal_change()
+        # nothing should be updated yet
+        self.assertEquals(Human.make_view('age=26').count(), 0)
+        app.bulk_sql_manager.finish()
+        self.db.extend(new_humans)
+        self.check_database()
+        self.assertEquals(Human.make_view('age=26').count(), 10)
+        self.assertEquals(Human.make_view('meters_tall=1.5').count(), 5)
+
+    def test_bulk_update_and_remove(self):
+        lee = Human(u'lee', 25, 1.4, [], {})
+        app.bulk_sql_manager.start()
+        app.bulk_sql_manager.add_update(lee)
+        lee.age = 26
+        lee.signal_change()
+        lee.remove()
+        app.bulk_sql_manager.finish()
+        self.assert_(not lee.id_exists())
+        self.assertEquals(Human.make_view("id=?", (lee.id,)).count(), 0)
+
     def test_insert_during_on_insert(self):
         # what happens if on_db_insert creates a new item (see #12680)
         def insert_callback(obj):
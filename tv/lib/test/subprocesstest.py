@@ -1,14 +1,19 @@
+import cPickle as pickle
+import logging
 import os
+import threading
 import time
 import Queue
 
 from miro import app
+from miro import eventloop
 from miro import moviedata
 from miro import subprocessmanager
 from miro import workerprocess
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, only_on_platforms
+from miro.test.framework import (EventLoopTest, MiroTestCase,
+                                 only_on_platforms)
 
 # setup some test messages/handlers
 class TestSubprocessHandler(subprocessmanager.SubprocessHandler):
@@ -226,6 +231,203 @@ class SubprocessManagerTest(EventLoopTest):
         self.runEventLoop(0.1, timeoutNormal=True)
         self.assertEquals(self.responder.pong_count, 1)
 
+    def test_message_batching(self):
+        # messages sent together from the event loop should get written in a
+        # single frame
+        self.subprocess.reset_stats()
+        def send_pings():
+            for i in xrange(10):
+                Ping().send_to_process()
+        eventloop.add_idle(send_pings, 'send pings')
+        self.runEventLoop(0.2, timeoutNormal=True)
+        self.assertEquals(self.responder.pong_count, 10)
+        stats = self.subprocess.get_stats()
+        self.assertEquals(stats['sent']['frames'], 1)
+        self.assertEquals(stats['sent']['messages']['Ping']['count'], 10)
+        self.assertEquals(stats['received']['messages']['Pong']['count'], 10)
+
+    def test_send_outside_event_loop(self):
+        # outside the event loop thread, messages should be written right
+        # away, since the event loop might not be running.
+        self.subprocess.reset_stats()
+        Ping().send_to_process()
+        self.assert_(not self.subprocess.writer.has_pending())
+        self.assertEquals(self.subprocess.get_stats()['sent']['frames'], 1)
+        self.runEventLoop(0.1, timeoutNormal=True)
+        self.assertEquals(self.responder.pong_count, 1)
+
+    def test_round_trip_benchmark(self):
+        message_count = 5000
+        self.subprocess.reset_stats()
+        start = time.time()
+        for i in xrange(message_count):
+            Ping().send_to_process()
+        while (self.responder.pong_count < message_count and
+               time.time() - start < 30):
+            self.runEventLoop(0.1, timeoutNormal=True)
+        elapsed = time.time() - start
+        self.assertEquals(self.responder.pong_count, message_count)
+        stats = self.subprocess.get_stats()
+        logging.debug("%d ping/pongs in %.3f secs (%d frames sent, "
+                      "%d received)", message_count, elapsed,
+                      stats['sent']['frames'], stats['received']['frames'])
+
+class MessageFramingTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'pipe-data')
+        self.out = open(self.path, 'wb')
+        self.stats = subprocessmanager.MessageStats()
+        self.writer = subprocessmanager.MessageWriter(self.out, self.stats)
+
+    def tearDown(self):
+        self.out.close()
+        MiroTestCase.tearDown(self)
+
+    def read_all(self, count):
+        self.out.flush()
+        reader = subprocessmanager.MessageReader(open(self.path, 'rb'))
+        return [reader.read() for i in xrange(count)]
+
+    def test_round_trip(self):
+        objs = [None, 1, u'\u1234', {'a': [1, 2, 3]}, ValueError("foo")]
+        for obj in objs:
+            self.writer.send(obj)
+        read_objs = self.read_all(len(objs))
+        self.assertEquals(read_objs[:4], objs[:4])
+        self.assert_(isinstance(read_objs[4], ValueError))
+        self.assertEquals(self.stats.get_stats()['frames'], len(objs))
+
+    def test_batch(self):
+        for i in xrange(10):
+            self.writer.queue(i)
+        self.assert_(self.writer.has_pending())
+        self.writer.flush()
+        self.assert_(not self.writer.has_pending())
+        self.assertEquals(self.read_all(10), range(10))
+        stats = self.stats.get_stats()
+        self.assertEquals(stats['frames'], 1)
+        self.assertEquals(stats['messages']['int']['count'], 10)
+
+    def test_max_frame_size(self):
+        # big messages should get split into separate frames
+        big_string = 'a' * (subprocessmanager.MAX_FRAME_SIZE / 2 + 1)
+        for i in xrange(3):
+            self.writer.queue(big_string)
+        self.writer.flush()
+        self.assertEquals(self.read_all(3), [big_string] * 3)
+        self.assertEquals(self.stats.get_stats()['frames'], 3)
+
+    def test_compression(self):
+        self.writer.compress_threshold = 1000
+        self.writer.send('small')
+        self.writer.send('b' * 10000)
+        self.assertEquals(self.read_all(2), ['small', 'b' * 10000])
+        stats = self.stats.get_stats()
+        self.assertEquals(stats['compressed_frames'], 1)
+        self.assert_(stats['frame_bytes'] < 1000)
+
+    def test_dump_obj(self):
+        # _dump_obj() and _load_obj() should be compatible with
+        # MessageWriter/MessageReader
+        subprocessmanager._dump_obj('foo', self.out)
+        self.writer.send('bar')
+        self.out.flush()
+        pipe = open(self.path, 'rb')
+        self.assertEquals(subprocessmanager._load_obj(pipe), 'foo')
+        self.assertEquals(subprocessmanager.MessageReader(pipe).read(), 'bar')
+
+    def test_write_error_keeps_queued_messages(self):
+        # If a write fails, messages that other threads left for the writing
+        # thread should stay queued.
+        def write(data):
+            self.writer.queue('from other thread')
+            self.writer.pipe = self.out
+            raise IOError("broken pipe")
+        self.writer.pipe = mock.Mock()
+        self.writer.pipe.write = write
+        self.writer.queue('lost')
+        self.assertRaises(IOError, self.writer.flush)
+        self.assert_(self.writer.has_pending())
+        self.writer.flush()
+        self.assertEquals(self.read_all(1), ['from other thread'])
+
+    def test_flush_wait(self):
+        # flush(wait=True) should wait for another thread's write to finish
+        can_write = threading.Event()
+        def write(data):
+            can_write.wait(5)
+            self.out.write(data)
+        self.writer.pipe = mock.Mock()
+        self.writer.pipe.write = write
+        thread = threading.Thread(target=self.writer.send, args=('a',))
+        thread.start()
+        while not self.writer.writing:
+            time.sleep(0.01)
+        waiter = threading.Thread(target=self.writer.send, args=('b', True))
+        waiter.start()
+        waiter.join(0.1)
+        self.assert_(waiter.isAlive())
+        can_write.set()
+        thread.join()
+        waiter.join()
+        self.assertEquals(self.read_all(2), ['a', 'b'])
+
+    def test_truncated(self):
+        self.writer.send('foo' * 100)
+        self.out.close()
+        data = open(self.path, 'rb').read()
+        open(self.path, 'wb').write(data[:-10])
+        reader = subprocessmanager.MessageReader(open(self.path, 'rb'))
+        self.assertRaises(subprocessmanager.LoadError, reader.read)
+
+class MessageFramingBenchmarkTest(MiroTestCase):
+    """Compare our framing with sending each message with a
+    default-protocol pickle.
+    """
+    MESSAGE_COUNT = 5000
+
+    def make_message(self, i):
+        return workerprocess.TaskResult(i, {
+            'title': u'Song %d' % i,
+            'artist': u'Some Artist',
+            'album': u'Some Album',
+            'duration': 123456,
+            'track': i,
+        })
+
+    def test_framing(self):
+        path = os.path.join(self.tempdir, 'pipe-data')
+        messages = [self.make_message(i) for i in xrange(self.MESSAGE_COUNT)]
+
+        out = open(path, 'wb', 0)
+        start = time.time()
+        for msg in messages:
+            data = pickle.dumps(msg)
+            out.write(subprocessmanager.struct.pack("Q", len(data)))
+            out.write(data)
+            out.flush()
+        out.close()
+        old_time = time.time() - start
+        old_size = os.path.getsize(path)
+
+        out = open(path, 'wb', 0)
+        writer = subprocessmanager.MessageWriter(out)
+        start = time.time()
+        for msg in messages:
+            writer.queue(msg)
+        writer.flush()
+        out.close()
+        reader = subprocessmanager.MessageReader(open(path, 'rb'))
+        for i in xrange(self.MESSAGE_COUNT):
+            self.assertEquals(reader.read().task_id, i)
+        new_time = time.time() - start
+        new_size = os.path.getsize(path)
+        logging.debug("old framing: %.3f secs (write only), %d bytes.  "
+                      "new framing: %.3f secs (write and read), %d bytes",
+                      old_time, old_size, new_time, new_size)
+        self.assert_(new_size < old_size)
+
 class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
     def handle_feedparser_task(self, msg):
         if msg.html == 'FORCE EXCEPTION':
@@ -297,17 +499,44 @@ class FeedParserTest(WorkerProcessTest):
         self.assertEquals(self.result, None)
         self.assert_(isinstance(self.error, ValueError))
 
+    def test_scrape_links(self):
+        workerprocess.startup()
+        html = ('<html><body><a href="/video.mpg">Video</a>'
+                '<a href="mailto:someone@example.com">mail</a></body></html>')
+        msg = workerprocess.ScrapeLinksTask(html, 'http://example.com/', None)
+        workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(4.0)
+        if self.error is not None:
+            raise self.error
+        title, urls, link_dict = self.result
+        self.assertEquals(urls, ['http://example.com/video.mpg'])
+        self.assertEquals(link_dict,
+                          {u'http://example.com/video.mpg': {'title': u'Video'}})
+
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
-        workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        workerprocess.startup(process_count=1)
+        manager = workerprocess._subprocess_manager.managers[0]
+        original_pid = manager.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        manager.process.terminate()
         with self.allow_warnings():
             self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, manager.process.pid)
+        self.check_successful_result()
+
+    def test_crash_one_of_many(self):
+        # crashing one process in the pool should restart only that one
+        workerprocess.startup(process_count=2)
+        managers = workerprocess._subprocess_manager.managers
+        original_pids = [m.process.pid for m in managers]
+        self.send_feedparser_task()
+        managers[0].process.terminate()
+        with self.allow_warnings():
+            self.runEventLoop(4.0)
+        self.assertNotEqual(original_pids[0], managers[0].process.pid)
+        self.assertEquals(original_pids[1], managers[1].process.pid)
         self.check_successful_result()
 
     def test_queue_before_start(self):
@@ -422,7 +651,174 @@ class MutagenTest(WorkerProcessTest):
         self.check_mutagen_call('drm.m4v', 'video', 2668832, 'Thinkers',
                                 True)
 
+    def test_mutagen_batch_task(self):
+        workerprocess.startup()
+        paths = [resources.path("testdata/metadata/" + filename)
+                 for filename in ('mp3-0.mp3', 'mp3-1.mp3', 'mp3-2.mp3')]
+        msg = workerprocess.MutagenBatchTask(paths, self.tempdir)
+        # paths in skip_paths shouldn't get processed
+        msg.skip_paths.add(paths[2])
+        partial_results = {}
+        def partial_callback(msg, path, result):
+            partial_results[path] = result
+        workerprocess.send(msg, self.callback, self.errback,
+                           partial_callback)
+        self.runEventLoop(4.0)
+        self.assertEquals(self.error, None)
+        self.assertEquals(self.result, None)
+        self.assertEquals(set(partial_results.keys()),
+                          set([paths[0], paths[1]]))
+        self.assertEquals(partial_results[paths[0]]['title'],
+                          'Invisible Walls')
+        self.assertEquals(partial_results[paths[1]]['title'], 'Race Lieu')
+        # results that we've already seen should get skipped if the task is
+        # resent
+        self.assertEquals(msg.skip_paths, set(partial_results.keys() +
+                                              [paths[2]]))
+
+
+class WorkerProcessHandlerTest(MiroTestCase):
+    def check_cancel_batch(self, supports_alarm):
+        handler = workerprocess.WorkerProcessHandler()
+        handler.supports_alarm = supports_alarm
+        batch_task = workerprocess.MutagenBatchTask(['/a', '/b', '/c'], '/')
+        task = workerprocess.MutagenTask('/b', '/')
+        handler.call_handler(handler.handle_mutagen_batch_task, batch_task)
+        handler.call_handler(handler.handle_mutagen_task, task)
+        handler.handle_cancel_file_operations(
+            workerprocess.CancelFileOperations(['/b', '/d']))
+        # the batch task should stay queued, but skip the canceled path
+        self.assertEquals(batch_task.skip_paths, set(['/b']))
+        self.assertEquals(self.queued_messages(handler), [batch_task])
+
+    def queued_messages(self, handler):
+        if handler.supports_alarm:
+            return [msg for (method, msg) in handler.main_thread_tasks]
+        messages = []
+        while True:
+            task_info = handler.task_queue._get_next_task()
+            if task_info is None:
+                return messages
+            messages.append(task_info[1])
+
+    def test_cancel_batch(self):
+        self.check_cancel_batch(True)
+        self.check_cancel_batch(False)
+
+    def test_cancel_running_batch(self):
+        # With the alarm, batches run in the main thread, which also reads
+        # messages.  Check that we dispatch messages in between files, so
+        # that cancels reach a batch that's running.
+        handler = workerprocess.WorkerProcessHandler()
+        handler.supports_alarm = True
+        queue = Queue.Queue()
+        processed = []
+        finished = []
+        def process_file(path, cover_art_directory):
+            processed.append(path)
+            # pretend that a message came in while we processed the file
+            queue.put(path)
+            return {}
+        def task_result(task_id, result):
+            finished.append(task_id)
+            queue.put('finished')
+            return mock.Mock()
+        self.patch_function('miro.filetags.process_file', process_file)
+        self.patch_function('miro.workerprocess.TaskPartialResult',
+                            lambda task_id, path, result: mock.Mock())
+        self.patch_function('miro.workerprocess.TaskResult', task_result)
+        batch_task = workerprocess.MutagenBatchTask(['/a', '/b', '/c'], '/')
+        handler.call_handler(handler.handle_mutagen_batch_task, batch_task)
+        self.assertEquals(handler.get_task_from_queue(queue), '/a')
+        handler.handle_cancel_file_operations(
+            workerprocess.CancelFileOperations(['/b']))
+        self.assertEquals(handler.get_task_from_queue(queue), '/c')
+        self.assertEquals(processed, ['/a', '/c'])
+        self.assertEquals(finished, [])
+        # once there are no paths left, we should send the batch result
+        self.assertEquals(handler.get_task_from_queue(queue), 'finished')
+        self.assertEquals(finished, [batch_task.task_id])
+        self.assertEquals(handler.batch_tasks, {})
+
+class WorkerProcessPoolTest(WorkerProcessTest):
+    def test_routing(self):
+        # tasks should be spread between the processes
+        workerprocess.startup(process_count=3)
+        managers = workerprocess._subprocess_manager.managers
+        for i in xrange(6):
+            workerprocess.send(workerprocess.FeedparserTask(''),
+                               self.callback, self.errback)
+        self.assertEquals([len(m.tasks_in_flight) for m in managers],
+                          [2, 2, 2])
+        # higher priority tasks only care about tasks they would have to
+        # wait behind
+        for i in xrange(3):
+            workerprocess.send(SlowRunningTask(), self.callback, self.errback)
+        workerprocess.send(workerprocess.FeedparserTask(''),
+                           self.callback, self.errback)
+        self.assertEquals([len(m.tasks_in_flight) for m in managers],
+                          [4, 3, 3])
+
+    def test_cancel_sent_to_all(self):
+        workerprocess.startup(process_count=2)
+        workerprocess.cancel_tasks_for_files(['/foo/bar.mp3'])
+        managers = workerprocess._subprocess_manager.managers
+        for manager in managers:
+            self.assertEquals(len(manager.tasks_in_flight), 1)
+        # wait for both processes to reply
+        start = time.time()
+        while (any(m.tasks_in_flight for m in managers) and
+               time.time() - start < 4.0):
+            self.runEventLoop(0.1, timeoutNormal=True)
+        for manager in workerprocess._subprocess_manager.managers:
+            self.assertEquals(len(manager.tasks_in_flight), 0)
+        self.assertEquals(workerprocess._miro_task_queue.tasks_in_progress,
+                          {})
+
+    def wait_for(self, condition, timeout=6.0):
+        start = time.time()
+        while not condition() and time.time() - start < timeout:
+            self.runEventLoop(0.1, timeoutNormal=True)
+        self.assert_(condition())
+
+    def test_dispatch(self):
+        # tasks should run in all the processes and come back to us
+        workerprocess.startup(process_count=2)
+        managers = workerprocess._subprocess_manager.managers
+        source_path = resources.path("testdata/metadata/mp3-0.mp3")
+        results = []
+        def callback(msg, result):
+            results.append(result)
+        for i in xrange(6):
+            msg = workerprocess.MutagenTask(source_path, self.tempdir)
+            workerprocess.send(msg, callback, callback)
+        self.assertEquals([len(m.tasks_in_flight) for m in managers], [3, 3])
+        self.wait_for(lambda: len(results) == 6)
+        for result in results:
+            self.assertEquals(result['title'], 'Invisible Walls')
+
+    def test_crashed_process_out_of_rotation(self):
+        pool = workerprocess._subprocess_manager
+        pool.restart_delay = 60
+        workerprocess.startup(process_count=2)
+        managers = pool.managers
+        self.wait_for(lambda: all(m.responder.worker_ready
+                                  for m in managers))
+        managers[0].process.terminate()
+        with self.allow_warnings():
+            self.wait_for(lambda: managers[0].crashed)
+        # While we wait to restart the crashed process, tasks should go to
+        # the other one, rather than the crashed process's pipe.
+        for i in xrange(4):
+            workerprocess.send(workerprocess.FeedparserTask(''),
+                               self.callback, self.errback)
+        self.assertEquals([len(m.tasks_in_flight) for m in managers], [0, 4])
+        # Once the process is restarted and ready, it should be back in
+        # rotation
+        managers[0].restart()
+        self.assert_(not managers[0].in_rotation)
+        self.wait_for(lambda: managers[0].in_rotation)
+        self.assert_(not managers[0].crashed)
 
 # TODO:
 #   Test task priority system in worker process
-#   Test that the CancelFileOperations message is handled properly
@@ -1,5 +1,8 @@
 import os
 
+from miro import feed
+from miro import feedupdate
+from miro import folder
 from miro import subscription
 from miro import autodiscover
 
@@ -319,3 +322,53 @@ class Testis_subscribe_links(MiroTestCase):
     def test_positive(self):
         is_s_l = subscription.is_subscribe_link
         self.assertEquals(is_s_l('http://subscribe.getdemocracy.com/'), True)
+
+class TestBulkAddSubscriptions(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.progress = []
+
+    def progress_callback(self, done, total):
+        self.progress.append((done, total))
+
+    def bulk_add(self, subscriptions):
+        return subscription.Subscriber().bulk_add_subscriptions(
+            subscriptions, self.progress_callback)
+
+    def test_add(self):
+        feed.Feed(u'http://example.com/existing')
+        added, ignored = self.bulk_add([
+            {'type': 'feed', 'url': u'http://example.com/1',
+             'title': u'Feed 1'},
+            {'type': 'feed', 'url': u'http://example.com/existing'},
+            {'type': 'folder', 'title': u'Folder', 'children': [
+                {'type': 'feed', 'url': u'http://example.com/2'},
+                {'type': 'feed', 'url': u'http://example.com/1'},
+            ]},
+        ])
+        self.assertEquals([s['url'] for s in added['feed']],
+                          [u'http://example.com/1', u'http://example.com/2'])
+        self.assertEquals([s['url'] for s in ignored['feed']],
+                          [u'http://example.com/existing',
+                           u'http://example.com/1'])
+        feed1 = feed.Feed.get_by_url(u'http://example.com/1')
+        self.assertEquals(feed1.get_title(), u'Feed 1')
+        self.assertEquals(feed1.get_folder(), None)
+        feed2 = feed.Feed.get_by_url(u'http://example.com/2')
+        self.assertEquals(feed2.get_folder(),
+                          folder.ChannelFolder.get_by_title(u'Folder'))
+        self.assertEquals(self.progress[-1], (5, 5))
+        self.assertEquals(len(self.progress), 5)
+
+    def test_first_update_is_queued(self):
+        urls = [u'http://example%d.com/feed' % i for i in range(5)]
+        self.bulk_add([{'type': 'feed', 'url': url} for url in urls])
+        queue = feedupdate.global_update_queue
+        # nothing downloads until the update queue runs, and then only a
+        # few feeds at a time in the order that they were listed
+        self.assertEquals([entry[0].orig_url for entry in queue.update_queue],
+                          urls)
+        for url in urls:
+            f = feed.Feed.get_by_url(url)
+            self.assert_(f.download is None)
+            self.assert_(f.loading)
@@ -33,6 +33,8 @@ class UnicodeFeedTestCase(framework.EventLoopTest):
         feedimpl = my_feed.actualFeed
         feedimpl.feedparser_callback(
             feedparserutil.parse(feedimpl.initialHTML))
+        # parsed feeds get merged into the database in an idle callback
+        self.process_idles()
 
     def is_proper_feed_parser_dict(self, parsed, name="top"):
         if isinstance(parsed, types.DictionaryType):
@@ -137,6 +139,7 @@ class UnicodeFeedTestCase(framework.EventLoopTest):
         my_feed = self.make_feed(u"file://" + self.filename)
 
         my_feed.update()
+        self.process_idles()
         self.assertEqual(my_feed.items.count(), 1)
         my_item = list(my_feed.items)[0]
         self.assertEqual(len(my_item.get_title()), 14)
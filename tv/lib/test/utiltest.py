@@ -9,10 +9,14 @@ import signal
 import shutil
 import unittest
 import sys
+import threading
 import zipfile
 
-from miro.test.framework import skip_for_platforms, MiroTestCase
+from miro.test.framework import (skip_for_platforms, MiroTestCase,
+                                 EventLoopTest)
 from miro import download_utils
+from miro import eventloop
+from miro import fileutil
 from miro import util
 from miro import buildutils
 from miro.fileobject import FilenameType
@@ -1121,3 +1125,44 @@ class NamedTupleTest(MiroTestCase):
         m = MyClass(1,2,3)
         self.assertEquals(m.__doc__, "My Docstring")
         self.assertEquals((m.a, m.b, m.c), (1,2,3))
+
+class DeleteInBackgroundTest(EventLoopTest):
+    def test_delete(self):
+        path = os.path.join(self.tempdir, 'file')
+        directory = os.path.join(self.tempdir, 'dir')
+        open(path, 'w').write('data')
+        os.mkdir(directory)
+        open(os.path.join(directory, 'file'), 'w').write('data')
+        deleted = []
+        fileutil.delete_in_background(path, lambda: deleted.append(path))
+        fileutil.delete_in_background(directory)
+        # directory scans should ignore the files until they're gone
+        self.assert_(path in fileutil.deletes_in_progress)
+        self.assert_(directory in fileutil.deletes_in_progress)
+        self.processThreads()
+        self.runPendingIdles()
+        self.assert_(not os.path.exists(path))
+        self.assert_(not os.path.exists(directory))
+        self.assertEquals(deleted, [path])
+        self.assert_(path not in fileutil.deletes_in_progress)
+        self.assert_(directory not in fileutil.deletes_in_progress)
+
+    def test_own_pool(self):
+        # deletes shouldn't wait behind file fingerprinting
+        block = threading.Event()
+        eventloop.call_in_thread_pool('files', lambda result: None,
+                                      lambda error: None, block.wait,
+                                      'block files pool', 5)
+        path = os.path.join(self.tempdir, 'file')
+        open(path, 'w').write('data')
+        fileutil.delete_in_background(path)
+        eventloop._eventloop.init_threads()
+        try:
+            for i in xrange(100):
+                if not os.path.exists(path):
+                    break
+                time.sleep(0.01)
+            self.assert_(not os.path.exists(path))
+        finally:
+            block.set()
+            eventloop._eventloop.close_threads()
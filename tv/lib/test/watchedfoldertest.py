@@ -1,7 +1,9 @@
 import os
 import shutil
+import time
 
 from miro import app
+from miro import dirscanner
 from miro import models
 from miro import signals
 from miro.test import mock
@@ -154,3 +156,134 @@ class WatchedFolderTest(EventLoopTest):
         self.feed.actualFeed._make_child(os.path.join(self.dir, 'a.mp3'))
         self.run_feed_update()
         self.check_failed_soft_count(1)
+
+    def set_mtime_in_past(self, *filenames):
+        # make directory mtimes old enough that the scanner trusts them
+        mtime = time.time() - 100
+        for filename in filenames:
+            os.utime(os.path.join(self.dir, filename), (mtime, mtime))
+
+    def test_incremental_scan(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        self.copy_new_file('a.mp3')
+        self.copy_new_file('sub/b.mp3')
+        self.set_mtime_in_past('', 'sub')
+        self.run_feed_update()
+        self.check_items('a.mp3', 'sub/b.mp3')
+        # nothing changed, so we shouldn't list any directories
+        self.run_feed_update()
+        self.check_items('a.mp3', 'sub/b.mp3')
+        scan_result = self.feed.actualFeed._directory_scanner.last_result
+        self.assertEquals(scan_result.dirs_listed, 0)
+        self.assertEquals(scan_result.dirs_skipped, 2)
+        self.assertEquals(scan_result.files_skipped, 2)
+        # add a file to the subdirectory, we should only list that one
+        self.copy_new_file('sub/c.mp3')
+        self.set_mtime_in_past('sub')
+        self.run_feed_update()
+        self.check_items('a.mp3', 'sub/b.mp3', 'sub/c.mp3')
+        scan_result = self.feed.actualFeed._directory_scanner.last_result
+        self.assertEquals(scan_result.dirs_listed, 1)
+        self.assertEquals(scan_result.dirs_skipped, 1)
+        self.assertEquals(scan_result.added,
+                          set([os.path.join(self.dir, 'sub/c.mp3')]))
+        # remove the subdirectory
+        shutil.rmtree(os.path.join(self.dir, 'sub'))
+        self.set_mtime_in_past('')
+        self.run_feed_update()
+        self.check_items('a.mp3')
+        scan_result = self.feed.actualFeed._directory_scanner.last_result
+        self.assertEquals(scan_result.removed,
+                          set([os.path.join(self.dir, 'sub/b.mp3'),
+                               os.path.join(self.dir, 'sub/c.mp3')]))
+
+    def test_index_saved(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        self.copy_new_file('a.mp3')
+        self.copy_new_file('sub/b.mp3')
+        self.set_mtime_in_past('', 'sub')
+        self.run_feed_update()
+        # a new scanner should load the index from the DB and not need to
+        # list anything
+        feed_impl_id = self.feed.actualFeed.id
+        scanner = dirscanner.DirectoryScanner(feed_impl_id, self.dir)
+        self.assert_(scanner.has_file(os.path.join(self.dir, 'sub/b.mp3')))
+        for dummy in scanner.scan():
+            pass
+        self.assertEquals(scanner.last_result.dirs_listed, 0)
+        self.assertEquals(scanner.last_result.files_skipped, 2)
+        # removing the feed should remove the index
+        self.feed.remove()
+        scanner = dirscanner.DirectoryScanner(feed_impl_id, self.dir)
+        self.assertEquals(scanner.all_files(), set())
+
+class DirectoryScannerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.dir = self.make_temp_dir_path()
+        self.scanner = dirscanner.DirectoryScanner(0, self.dir)
+
+    def make_file(self, filename):
+        open(os.path.join(self.dir, filename), 'wb').close()
+
+    def run_scan(self):
+        for dummy in self.scanner.scan():
+            pass
+        return self.scanner.last_result
+
+    def check_files(self, *filenames):
+        correct_files = set(os.path.join(self.dir, f) for f in filenames)
+        self.assertEquals(self.scanner.all_files(), correct_files)
+
+    def test_skip_files(self):
+        self.make_file('a.mp3')
+        self.make_file('.hidden.mp3')
+        self.make_file('Thumbs.db')
+        os.mkdir(os.path.join(self.dir, 'Incomplete Downloads'))
+        self.make_file('Incomplete Downloads/b.mp3')
+        self.run_scan()
+        self.check_files('a.mp3')
+
+    def test_symlink_loop(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        self.make_file('sub/a.mp3')
+        os.symlink(self.dir, os.path.join(self.dir, 'sub', 'loop'))
+        self.run_scan()
+        self.check_files('sub/a.mp3')
+
+    def test_recent_mtime(self):
+        # directories that changed very recently should be listed again on
+        # the next scan, since their mtime could stay the same if they change
+        # again.
+        self.make_file('a.mp3')
+        self.run_scan()
+        self.make_file('b.mp3')
+        scan_result = self.run_scan()
+        self.assertEquals(scan_result.dirs_listed, 1)
+        self.assertEquals(scan_result.added,
+                          set([os.path.join(self.dir, 'b.mp3')]))
+        self.check_files('a.mp3', 'b.mp3')
+
+    def test_full_scan(self):
+        self.make_file('a.mp3')
+        mtime = time.time() - 100
+        os.utime(self.dir, (mtime, mtime))
+        self.run_scan()
+        # change the directory without changing the mtime.  We won't notice
+        # until we do a full scan.
+        self.make_file('b.mp3')
+        os.utime(self.dir, (mtime, mtime))
+        self.assertEquals(self.run_scan().added, set())
+        self.scanner._last_full_scan -= self.scanner.FULL_SCAN_INTERVAL
+        scan_result = self.run_scan()
+        self.assert_(scan_result.full_scan)
+        self.assertEquals(scan_result.added,
+                          set([os.path.join(self.dir, 'b.mp3')]))
+
+    def test_root_changed(self):
+        self.make_file('a.mp3')
+        self.run_scan()
+        self.scanner.save()
+        other_dir = self.make_temp_dir_path()
+        scanner = dirscanner.DirectoryScanner(0, other_dir)
+        self.assertEquals(scanner.all_files(), set())
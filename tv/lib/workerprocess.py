@@ -32,8 +32,12 @@
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
 tasks to this process.  See #17328 for more details.  Right now this just
 includes feedparser, but we could pretty easily extend this to other tasks.
+
+We run a pool of worker processes, one per CPU by default, so that CPU-heavy
+tasks like mutagen parsing can use more than one core.
 """
 
+import collections
 from collections import deque, namedtuple
 import itertools
 import logging
@@ -43,6 +47,7 @@ from miro import clock
 from miro import eventloop
 from miro import feedparserutil
 from miro import filetags
+from miro import linkgrabber
 from miro import messagetools
 from miro import moviedata
 from miro import subprocessmanager
@@ -76,6 +81,14 @@ class FeedparserTask(TaskMessage):
         TaskMessage.__init__(self)
         self.html = html
 
+class ScrapeLinksTask(TaskMessage):
+    priority = FeedparserTask.priority
+    def __init__(self, html, baseurl, charset):
+        TaskMessage.__init__(self)
+        self.html = html
+        self.baseurl = baseurl
+        self.charset = charset
+
 class MovieDataProgramTask(TaskMessage):
     priority = 10
     def __init__(self, source_path, screenshot_directory):
@@ -96,6 +109,34 @@ class MutagenTask(TaskMessage):
     def __str__(self):
         return 'MutagenTask (path: %s)' % self.source_path
 
+class MutagenBatchTask(TaskMessage):
+    """Run mutagen on several files with one task.
+
+    We send back a TaskPartialResult for each file as we process it, then a
+    TaskResult with None as the result once the whole batch is done.
+
+    skip_paths holds paths that we shouldn't process, either because they
+    were canceled, or because we already sent back their result before the
+    worker process was restarted.
+
+    position is the index of the next path to process.  The worker process
+    uses it to process a batch one path at a time.
+    """
+    priority = MutagenTask.priority
+    def __init__(self, source_paths, cover_art_directory):
+        TaskMessage.__init__(self)
+        self.source_paths = source_paths
+        self.cover_art_directory = cover_art_directory
+        self.skip_paths = set()
+        self.position = 0
+
+    def cancel_paths(self, path_set):
+        """Skip any paths in path_set that are part of this batch."""
+        self.skip_paths.update(path_set.intersection(self.source_paths))
+
+    def __str__(self):
+        return 'MutagenBatchTask (%d paths)' % len(self.source_paths)
+
 class CancelFileOperations(TaskMessage):
     """Cancel mutagen/movie data tasks for a set of path."""
     priority = 0
@@ -111,6 +152,17 @@ class TaskResult(subprocessmanager.SubprocessResponse):
         self.task_id = task_id
         self.result = result
 
+class TaskPartialResult(subprocessmanager.SubprocessResponse):
+    """Result for one path in a MutagenBatchTask.
+
+    result is either the result for the path or the Exception that was raised
+    when processing it.
+    """
+    def __init__(self, task_id, source_path, result):
+        self.task_id = task_id
+        self.source_path = source_path
+        self.result = result
+
 class MovieDataTaskStatus(subprocessmanager.SubprocessResponse):
     """Report when we are handling movie data tasks.
 
@@ -129,6 +181,10 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         self.task_queue = WorkerTaskQueue()
         self.main_thread_tasks = deque()
         self.supports_alarm = util.supports_alarm()
+        # maps task ids to MutagenBatchTasks that we haven't finished.  We
+        # use this to cancel paths in batches that are queued or running.
+        self.batch_tasks = {}
+        self.batch_tasks_lock = threading.Lock()
 
     def call_handler(self, method, msg):
         try:
@@ -141,7 +197,10 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
                 # one.  Put it in main_thread_tasks and handle once
                 # there's no more tasks waiting in to be processed
                 self.main_thread_tasks.append((method, msg))
-            elif isinstance(msg, MutagenTask):
+            elif isinstance(msg, (MutagenTask, MutagenBatchTask)):
+                if isinstance(msg, MutagenBatchTask):
+                    with self.batch_tasks_lock:
+                        self.batch_tasks[msg.task_id] = msg
                 # If we're using the alarm, then MutagenTasks need to run in
                 # the main thread as well.  Signals aren't support outside of
                 # the main thread.
@@ -160,6 +219,14 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         # handle movie data tasks if no more tasks are coming in right now
         while queue.empty() and self.main_thread_tasks:
             method, msg = self.main_thread_tasks.popleft()
+            if (isinstance(msg, MutagenBatchTask) and
+                    self.process_next_batch_path(msg)):
+                # Handle batches one path at a time, so that we can dispatch
+                # messages that come in, especially CancelFileOperations, in
+                # between files.  Once there are no paths left,
+                # handle_task() sends the result for the batch.
+                self.main_thread_tasks.appendleft((method, msg))
+                continue
             if isinstance(msg, MutagenTask):
                 # if we're here, it means we want to use the signals
                 handle_task(self.handle_mutagen_task_with_alarm, msg)
@@ -192,9 +259,18 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         self.task_queue.cancel_file_operations(path_set)
         # we need to handle main_thread_tasks, since those skip the task
         # queue
-        filtered_tasks = deque(t for t in self.main_thread_tasks
-                               if t.source_path not in path_set)
+        filtered_tasks = deque((method, msg)
+                               for (method, msg) in self.main_thread_tasks
+                               if isinstance(msg, MutagenBatchTask) or
+                               msg.source_path not in path_set)
         self.main_thread_tasks = filtered_tasks
+        # batch tasks stay in the queues, but skip the canceled paths.  This
+        # also handles a batch that's currently running: in a worker thread
+        # it checks skip_paths before each file, and in the main thread
+        # get_task_from_queue() runs it one path at a time.
+        with self.batch_tasks_lock:
+            for batch_task in self.batch_tasks.values():
+                batch_task.cancel_paths(path_set)
         return None
 
     # handle_movie_data_program_task gets called in the main thread, unlike
@@ -209,12 +285,15 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
     # worker threads, so they should only call thread-safe functions
 
     def handle_feedparser_task(self, msg):
-        parsed_feed = feedparserutil.parse(msg.html)
+        parsed_feed = feedparserutil.parse_feed_body(msg.html)
         # bozo_exception is sometimes C object that is not picklable.  We
         # don't use it anyways, so just unset the value
         parsed_feed['bozo_exception'] = None
         return parsed_feed
 
+    def handle_scrape_links_task(self, msg):
+        return linkgrabber.scrape_links(msg.html, msg.baseurl, msg.charset)
+
     def handle_mutagen_task(self, msg):
         return filetags.process_file(msg.source_path, msg.cover_art_directory)
 
@@ -222,6 +301,40 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         with util.alarm(2):
             return self.handle_mutagen_task(msg)
 
+    def handle_mutagen_batch_task(self, msg):
+        # In the main thread, get_task_from_queue() has already processed
+        # all the paths, so this just finishes the batch.
+        try:
+            while self.process_next_batch_path(msg):
+                pass
+        finally:
+            with self.batch_tasks_lock:
+                self.batch_tasks.pop(msg.task_id, None)
+        return None
+
+    def process_next_batch_path(self, msg):
+        """Process the next path in a MutagenBatchTask.
+
+        :returns: False if there were no paths left to process
+        """
+        while msg.position < len(msg.source_paths):
+            path = msg.source_paths[msg.position]
+            msg.position += 1
+            if path not in msg.skip_paths:
+                break
+        else:
+            return False
+        # If we support the alarm, then we're running in the main thread (see
+        # call_handler()), so we can use it for each file.
+        try:
+            with util.alarm(2, set_signal=self.supports_alarm):
+                result = filetags.process_file(path, msg.cover_art_directory)
+        except StandardError, e:
+            logging.info("batch task error: %s (%s)", path, e)
+            result = e
+        TaskPartialResult(msg.task_id, path, result).send_to_main_process()
+        return True
+
 class _SinglePriorityQueue(object):
     """Manages tasks at a single priority for WorkerTaskQueue
 
@@ -385,15 +498,15 @@ MovieDataTaskStatusInfo = namedtuple('MovieDataTaskStatusInfo',
                                      'task_id start_time')
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
-    def __init__(self):
+    def __init__(self, manager):
         subprocessmanager.SubprocessResponder.__init__(self)
+        self.manager = manager
         self.worker_ready = False
-        self.startup_message = None
         self.movie_data_task_status = None
 
     def on_startup(self):
-        self.startup_message.send_to_process()
-        _miro_task_queue.run_pending_tasks()
+        self.manager.send_message(self.manager.pool.startup_message)
+        self.manager.resend_tasks()
 
     def on_shutdown(self):
         # do the tasks that we've already gotten
@@ -403,11 +516,23 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
     def on_restart(self):
         self.worker_ready = False
 
+    def on_crash(self):
+        self.worker_ready = False
+        self.manager.crashed = True
+        self.manager.in_rotation = False
+
     def handle_task_result(self, msg):
+        self.manager.task_finished(msg.task_id)
         _miro_task_queue.process_result(msg)
 
+    def handle_task_partial_result(self, msg):
+        # partial results count as activity for our hung check
+        self.manager.last_activity = clock.clock()
+        _miro_task_queue.process_partial_result(msg)
+
     def handle_worker_process_ready(self, msg):
         self.worker_ready = True
+        self.manager.in_rotation = True
 
     def handle_movie_data_task_status(self, msg):
         if msg.task_id is not None:
@@ -422,28 +547,53 @@ class MiroTaskQueue(object):
     Responsible for:
         - Storing callbacks/errbacks for each pending task
         - Calling the callback/errback for a finished task
+        - Calling the partial callback for each TaskPartialResult
     """
     def __init__(self):
         # maps task_ids to (msg, callback, errback) tuples
         self.tasks_in_progress = {}
+        # maps task_ids to partial callbacks
+        self.partial_callbacks = {}
 
     def reset(self):
         self.tasks_in_progress = {}
+        self.partial_callbacks = {}
 
-    def add_task(self, msg, callback, errback):
+    def add_task(self, msg, callback, errback, partial_callback=None):
         """Add a new task to the queue."""
         self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
+        if partial_callback is not None:
+            self.partial_callbacks[msg.task_id] = partial_callback
         if _subprocess_manager.is_running:
             msg.send_to_process()
 
     def process_result(self, reply):
         """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        try:
+            msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        except KeyError:
+            # CancelFileOperations gets sent to each worker process, so we
+            # get a result from each one.  Only the first counts.
+            return
+        self.partial_callbacks.pop(reply.task_id, None)
         if isinstance(reply.result, Exception):
             errback(msg, reply.result)
         else:
             callback(msg, reply.result)
 
+    def process_partial_result(self, reply):
+        """Process a TaskPartialResult from our subprocess."""
+        try:
+            msg = self.tasks_in_progress[reply.task_id][0]
+        except KeyError:
+            return
+        # If the task gets resent after a restart, don't process this path
+        # again.
+        msg.skip_paths.add(reply.source_path)
+        partial_callback = self.partial_callbacks.get(reply.task_id)
+        if partial_callback is not None:
+            partial_callback(msg, reply.source_path, reply.result)
+
     def run_pending_tasks(self):
         """Rerun all tasks in the queue."""
         for msg, callback, errback in self.tasks_in_progress.values():
@@ -453,10 +603,34 @@ _miro_task_queue = MiroTaskQueue()
 
 # Manage subprocess
 class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
-    def __init__(self):
-        subprocessmanager.SubprocessManager.__init__(self, WorkerMessage,
-                WorkerProcessResponder(), WorkerProcessHandler)
+    """Manages one worker process in a WorkerProcessPool."""
+    # If a process doesn't send back any results for this long while it has
+    # tasks, we consider it hung.
+    HUNG_TIMEOUT = 300
+    # Fail tasks that were in-progress during this many hangs.
+    MAX_TASK_HANGS = 2
+
+    def __init__(self, pool, index):
+        subprocessmanager.SubprocessManager.__init__(self, None,
+                WorkerProcessResponder(self), pool.handler_class,
+                restart_delay=pool.restart_delay)
+        self.pool = pool
+        self.index = index
         self.check_hung_timeout = None
+        # maps task ids to messages that we've sent to our process
+        self.tasks_in_flight = {}
+        # maps priorities to the number of tasks in tasks_in_flight
+        self.priority_counts = collections.defaultdict(int)
+        # maps task ids to how many times we've hung while running them
+        self.task_hang_counts = collections.defaultdict(int)
+        self.last_activity = clock.clock()
+        # Set when our process quits unexpectedly, until we restart it.  We
+        # hold on to tasks instead of writing them to the dead pipe.
+        self.crashed = False
+        # Should the pool send new tasks to us?  We're taken out of
+        # rotation when our process crashes or gets restarted, and put back
+        # once the new process sends WorkerProcessReady.
+        self.in_rotation = True
 
     def _start(self):
         subprocessmanager.SubprocessManager._start(self)
@@ -469,8 +643,51 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
     def restart(self, clean=False):
         self.cancel_check_subprocess_hung()
         self.responder.movie_data_task_status = None
+        self.crashed = False
+        self.in_rotation = False
         subprocessmanager.SubprocessManager.restart(self, clean)
 
+    def can_send(self):
+        """Can we write messages to our process right now?"""
+        return self.is_running and not self.crashed
+
+    def load_for_priority(self, priority):
+        """Get the number of our tasks that will run before a new task with
+        a given priority.
+        """
+        return sum(count for (task_priority, count)
+                   in self.priority_counts.iteritems()
+                   if task_priority >= priority)
+
+    def add_task(self, msg):
+        if not self.tasks_in_flight:
+            self.last_activity = clock.clock()
+        self.tasks_in_flight[msg.task_id] = msg
+        self.priority_counts[msg.priority] += 1
+        # If we can't send now, resend_tasks() will send it once our process
+        # starts up.
+        if self.can_send():
+            self.send_message(msg)
+
+    def task_finished(self, task_id):
+        self.last_activity = clock.clock()
+        self.task_hang_counts.pop(task_id, None)
+        try:
+            msg = self.tasks_in_flight.pop(task_id)
+        except KeyError:
+            return
+        self.priority_counts[msg.priority] -= 1
+
+    def resend_tasks(self):
+        """Send all our tasks to a newly started process."""
+        self.last_activity = clock.clock()
+        for msg in self.tasks_in_flight.values():
+            self.send_message(msg)
+
+    def fail_task(self, task_id):
+        error_result = TaskResult(task_id, SubprocessTimeoutError())
+        self.responder.handle_task_result(error_result)
+
     def schedule_check_subprocess_hung(self):
         self.check_hung_timeout = eventloop.add_timeout(90,
                 self.check_subprocess_hung, 'check workerprocess hung')
@@ -485,36 +702,116 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
 
         if (task_status is not None and
                 clock.clock() - task_status.start_time > 90):
-            logging.warn("Worker process is hanging on a movie data task.")
-            error_result = TaskResult(task_status.task_id,
-                    SubprocessTimeoutError())
-            self.responder.handle_task_result(error_result)
+            logging.warn("Worker process %s is hanging on a movie data task.",
+                         self.index)
+            self.fail_task(task_status.task_id)
+            self.restart()
+        elif (self.tasks_in_flight and
+                clock.clock() - self.last_activity > self.HUNG_TIMEOUT):
+            logging.warn("Worker process %s hasn't finished a task in %s "
+                         "seconds.  Restarting it.", self.index,
+                         self.HUNG_TIMEOUT)
+            # We don't know which task is the problem, so keep track of how
+            # many times each one hangs and give up on the repeat offenders.
+            for task_id in self.tasks_in_flight.keys():
+                self.task_hang_counts[task_id] += 1
+                if self.task_hang_counts[task_id] >= self.MAX_TASK_HANGS:
+                    self.fail_task(task_id)
             self.restart()
         else:
             self.schedule_check_subprocess_hung()
 
-_subprocess_manager = WorkerSubprocessManager()
+class WorkerProcessPool(object):
+    """Runs several worker processes and spreads tasks between them.
+
+    Each process is a WorkerSubprocessManager, which restarts its process
+    independently if it crashes or hangs.  Tasks are routed to the process
+    with the fewest queued tasks at the same or higher priority, since those
+    are the tasks it will run first.  Processes that crashed or are
+    restarting only get tasks if no other process is in rotation.  Tasks sent before we start are queued
+    in the MiroTaskQueue and sent when we start.
+    """
+    def __init__(self):
+        WorkerMessage.install_handler(self)
+        self.handler_class = WorkerProcessHandler
+        self.restart_delay = 60
+        self.managers = []
+        self.startup_message = None
+        self.is_running = False
+
+    def start(self, process_count, thread_count):
+        if self.is_running:
+            return
+        self.startup_message = WorkerStartupInfo(thread_count)
+        self.managers = [WorkerSubprocessManager(self, i)
+                         for i in xrange(process_count)]
+        self.is_running = True
+        for manager in self.managers:
+            manager.start()
+        _miro_task_queue.run_pending_tasks()
+
+    def shutdown(self):
+        self.is_running = False
+        for manager in self.managers:
+            manager.shutdown()
+
+    def _choose_manager(self, msg):
+        return min(self.managers,
+                   key=lambda m: (not m.can_send(),
+                                  not m.in_rotation,
+                                  m.load_for_priority(msg.priority),
+                                  m.index))
+
+    # implement the MessageHandler interface
+
+    def handle(self, msg):
+        if not self.is_running:
+            logging.warn("worker process pool not running (%s)", msg)
+            return
+        if isinstance(msg, TaskMessage):
+            for manager in self.managers:
+                if msg.task_id in manager.tasks_in_flight:
+                    # task is getting resent after a restart, nothing to do
+                    return
+        if isinstance(msg, CancelFileOperations):
+            for manager in self.managers:
+                manager.add_task(msg)
+        elif isinstance(msg, TaskMessage):
+            self._choose_manager(msg).add_task(msg)
+        else:
+            for manager in self.managers:
+                if manager.can_send():
+                    manager.send_message(msg)
+
+_subprocess_manager = WorkerProcessPool()
 
-def startup(thread_count=3):
-    """Startup the worker process."""
+def startup(thread_count=3, process_count=None):
+    """Startup the worker processes.
 
-    startup_msg = WorkerStartupInfo(thread_count)
-    _subprocess_manager.responder.startup_message = startup_msg
-    _subprocess_manager.start()
+    :param thread_count: number of worker threads in each process
+    :param process_count: number of processes to run.  Defaults to the
+                          number of CPUs.
+    """
+    if process_count is None:
+        process_count = utils.get_logical_cpu_count()
+    _subprocess_manager.start(max(process_count, 1), thread_count)
 
 def shutdown():
-    """Shutdown the worker process."""
+    """Shutdown the worker processes."""
     _subprocess_manager.shutdown()
 
 # API for sending tasks
-def send(msg, callback, errback):
+def send(msg, callback, errback, partial_callback=None):
     """Send a message to the worker process.
 
     :param msg: Message to send
     :param callback: function to call on success
     :param errback: function to call on error
+    :param partial_callback: function to call with (msg, source_path, result)
+                             for each path in a MutagenBatchTask.  result
+                             will be an Exception if that path failed.
     """
-    _miro_task_queue.add_task(msg, callback, errback)
+    _miro_task_queue.add_task(msg, callback, errback, partial_callback)
 
 def cancel_tasks_for_files(paths):
     """Cancel mutagen and movie data tasks for a list of paths."""